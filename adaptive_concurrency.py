@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""自适应并发控制 - 按 429 和延迟变化自动调整在途请求数（AIMD）
+
+固定的并发上限需要针对每个服务商手工调整：设小了吞吐上不去，设大了会触发 429 风暴。
+AIMDLimiter 按 TCP 拥塞控制的思路动态调整上限：
+1. 加性增：上限被占满的请求正常返回时，上限增加 increase / limit（约每轮增加 increase）
+2. 乘性减：收到 429，或延迟明显高于基线（短期 EWMA 超过长期 EWMA 的 latency_tolerance 倍）时，
+   上限乘以 decrease；同一轮请求内只减一次，避免一批 429 把上限压到底
+3. 延迟基线按阶段分别统计，分镜等长输出阶段不会被误判为延迟尖峰
+4. 同一 (base_url, api_key) 在进程内共享一个控制器：同步线程、asyncio 任务和 API 后台任务
+   共同占用名额，每次（重试）尝试各占一个名额
+当前上限通过遥测收集器报告（[CONCURRENCY] 行）。
+"""
+import asyncio
+import collections
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from llm_telemetry import current_stage, get_telemetry
+
+
+# 默认初始、最小和最大并发上限
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 64
+
+# 每轮（limit 个请求）增加的上限
+DEFAULT_INCREASE = 1.0
+
+# 过载时上限乘以的系数
+DEFAULT_DECREASE = 0.5
+
+# 短期延迟超过基线的倍数视为延迟尖峰
+DEFAULT_LATENCY_TOLERANCE = 2.0
+
+# 短期 / 长期延迟 EWMA 的平滑系数
+SHORT_ALPHA = 0.3
+LONG_ALPHA = 0.05
+
+# 每个阶段至少积累的延迟样本数，之后才检测延迟尖峰
+MIN_LATENCY_SAMPLES = 10
+
+# 两次乘性减之间的最短间隔（秒）：还没有延迟样本时，一批 429 也只下调一次
+MIN_DECREASE_WINDOW = 0.5
+
+
+def is_overload_error(error: Optional[BaseException]) -> bool:
+    """429 表示服务端容量不足"""
+    return getattr(error, "status_code", None) == 429
+
+
+class AIMDLimiter:
+    """加性增、乘性减的并发上限（线程安全，可同时用于同步和 asyncio 调用方）"""
+
+    def __init__(self, initial_limit: int = DEFAULT_INITIAL_LIMIT,
+                 min_limit: int = DEFAULT_MIN_LIMIT, max_limit: int = DEFAULT_MAX_LIMIT,
+                 increase: float = DEFAULT_INCREASE, decrease: float = DEFAULT_DECREASE,
+                 latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+                 name: str = "", clock: Callable[[], float] = time.monotonic):
+        """
+        初始化并发控制器
+
+        Args:
+            initial_limit: 初始并发上限
+            min_limit / max_limit: 上限的取值范围
+            increase: 每轮增加的上限
+            decrease: 过载时上限乘以的系数（0-1）
+            latency_tolerance: 短期延迟超过基线的倍数视为延迟尖峰
+            name: 名称（用于遥测，通常为 base_url）
+            clock: 单调时钟（测试时可替换）
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit)))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.name = name
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        # 等待名额的调用方：threading.Event（同步）或 (事件循环, Future)（异步），先到先得
+        self._waiters: "collections.deque[Any]" = collections.deque()
+        # {阶段: [短期 EWMA, 长期 EWMA, 样本数]}
+        self._latency: Dict[str, List[float]] = {}
+        self._last_decrease = float("-inf")
+
+        self.increases = 0
+        self.decreases = 0
+        self.min_seen = self.max_seen = int(self.limit)
+
+    @property
+    def capacity(self) -> int:
+        """当前允许的在途请求数"""
+        return max(self.min_limit, int(self.limit))
+
+    # ==================== 名额 ====================
+
+    def acquire(self) -> float:
+        """同步等待一个名额，返回开始时间（传给 release）"""
+        with self._lock:
+            if not self._waiters and self.in_flight < self.capacity:
+                self.in_flight += 1
+                return self._clock()
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+        return self._clock()
+
+    async def aacquire(self) -> float:
+        """异步等待一个名额（不占用线程），返回开始时间"""
+        with self._lock:
+            if not self._waiters and self.in_flight < self.capacity:
+                self.in_flight += 1
+                return self._clock()
+            loop = asyncio.get_running_loop()
+            waiter: Tuple[asyncio.AbstractEventLoop, asyncio.Future] = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    # 名额已经分配给了被取消的调用方，交给下一个等待者
+                    self.in_flight -= 1
+                    self._grant()
+            raise
+        return self._clock()
+
+    def _grant(self) -> None:
+        """把空出的名额按顺序分配给等待者（调用方持有锁）"""
+        while self._waiters and self.in_flight < self.capacity:
+            waiter = self._waiters.popleft()
+            if isinstance(waiter, threading.Event):
+                self.in_flight += 1
+                waiter.set()
+                continue
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # 事件循环已关闭，跳过该等待者
+                continue
+            self.in_flight += 1
+
+    def release(self, started: float, error: Optional[BaseException] = None,
+                latency: Optional[float] = None) -> None:
+        """
+        归还名额并根据结果调整上限
+
+        Args:
+            started: acquire 返回的开始时间
+            error: 调用失败时的异常（429 触发乘性减，其他错误不调整上限）
+            latency: 延迟样本（默认为从 acquire 到现在的时间；流式调用传入首字节时间）
+        """
+        now = self._clock()
+        latency = now - started if latency is None else latency
+        with self._lock:
+            saturated = self.in_flight >= self.capacity
+            self.in_flight -= 1
+            changed = self._adjust(now, saturated, error, latency)
+            self._grant()
+            limit = self.capacity
+        if changed:
+            get_telemetry().record_concurrency(self.name, limit, changed == "decrease")
+
+    # ==================== AIMD ====================
+
+    def _adjust(self, now: float, saturated: bool, error: Optional[BaseException],
+                latency: float) -> Optional[str]:
+        """根据一次调用的结果调整上限，返回 "increase" / "decrease" / None（调用方持有锁）"""
+        if is_overload_error(error):
+            return self._decrease(now)
+        if error is not None:
+            return None
+        if self._observe_latency(current_stage(), latency):
+            return self._decrease(now)
+        return self._increase() if saturated else None
+
+    def _increase(self) -> Optional[str]:
+        if self.limit >= self.max_limit:
+            return None
+        before = self.capacity
+        self.limit = min(float(self.max_limit), self.limit + self.increase / self.limit)
+        if self.capacity == before:
+            return None
+        self.increases += 1
+        self.max_seen = max(self.max_seen, self.capacity)
+        return "increase"
+
+    def _decrease(self, now: float) -> Optional[str]:
+        # 同一轮请求（约一个基线延迟）内只减一次
+        window = max([MIN_DECREASE_WINDOW] + [s[1] for s in self._latency.values()])
+        if now - self._last_decrease < window or self.limit <= self.min_limit:
+            return None
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.decrease)
+        self.decreases += 1
+        self.min_seen = min(self.min_seen, self.capacity)
+        for s in self._latency.values():
+            s[0] = s[1]
+        return "decrease"
+
+    def _observe_latency(self, stage: str, latency: float) -> bool:
+        """记录延迟样本，返回是否出现延迟尖峰"""
+        s = self._latency.get(stage)
+        if s is None:
+            self._latency[stage] = [latency, latency, 1]
+            return False
+        s[0] += SHORT_ALPHA * (latency - s[0])
+        s[1] += LONG_ALPHA * (latency - s[1])
+        s[2] += 1
+        return s[2] >= MIN_LATENCY_SAMPLES and s[0] > self.latency_tolerance * s[1]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回当前上限与调整次数"""
+        with self._lock:
+            return {
+                "limit": self.capacity,
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiters),
+                "min_seen": self.min_seen,
+                "max_seen": self.max_seen,
+                "increases": self.increases,
+                "decreases": self.decreases
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+# ==================== 进程级共享 ====================
+
+# 键包含进程号：fork 出的子进程创建自己的实例，不沿用父进程的 pid 和 SQLite 连接
+_shared_limiters: Dict[Tuple[str, str, int], AIMDLimiter] = {}
+_shared_limiters_lock = threading.Lock()
+
+
+def get_shared_concurrency_limiter(base_url: Optional[str] = None,
+                                   api_key: Optional[str] = None) -> Optional[AIMDLimiter]:
+    """
+    获取 (base_url, api_key) 对应的进程级共享并发控制器
+
+    LLM_ADAPTIVE_CONCURRENCY 未启用时返回 None（不限制）；上限范围读取
+    LLM_ADAPTIVE_MIN_CONCURRENCY / LLM_ADAPTIVE_MAX_CONCURRENCY，初始值读取 LLM_ADAPTIVE_INITIAL_CONCURRENCY。
+    设置了 LLM_SHARED_LIMITS_PATH 时名额和上限保存在该 SQLite 文件中，本机所有进程共同占用（见 shared_limits）。
+    """
+    if not adaptive_concurrency_enabled():
+        return None
+
+    key = (base_url or "", api_key or "", os.getpid())
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(key)
+        if limiter is None:
+            options = dict(
+                initial_limit=int(os.environ.get("LLM_ADAPTIVE_INITIAL_CONCURRENCY", DEFAULT_INITIAL_LIMIT)),
+                min_limit=int(os.environ.get("LLM_ADAPTIVE_MIN_CONCURRENCY", DEFAULT_MIN_LIMIT)),
+                max_limit=adaptive_max_concurrency(),
+                name=base_url or ""
+            )
+            path = os.environ.get("LLM_SHARED_LIMITS_PATH")
+            if path:
+                from shared_limits import SharedConcurrencyLimiter, get_limit_store, limit_key
+                limiter = SharedConcurrencyLimiter(get_limit_store(path), limit_key(base_url, api_key), **options)
+            else:
+                limiter = AIMDLimiter(**options)
+            _shared_limiters[key] = limiter
+        return limiter
+
+
+def adaptive_concurrency_enabled() -> bool:
+    """是否启用自适应并发（LLM_ADAPTIVE_CONCURRENCY）"""
+    return os.environ.get("LLM_ADAPTIVE_CONCURRENCY", "false").lower() in ("1", "true", "yes")
+
+
+def adaptive_max_concurrency() -> int:
+    """自适应并发的上限（LLM_ADAPTIVE_MAX_CONCURRENCY）"""
+    return int(os.environ.get("LLM_ADAPTIVE_MAX_CONCURRENCY", DEFAULT_MAX_LIMIT))
+
+
+def reset_shared_concurrency_limiters() -> None:
+    """清空共享并发控制器（测试或重新加载配置时使用）"""
+    with _shared_limiters_lock:
+        _shared_limiters.clear()
@@ -521,6 +521,7 @@ if __name__ == "__main__":
 
     # 开发模式启动
     # 生产环境建议使用：uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+    # 多个 worker 时设置 LLM_SHARED_LIMITS_PATH，让各 worker 共享限流预算和并发名额
     uvicorn.run(
         "api:app",
         host="0.0.0.0",
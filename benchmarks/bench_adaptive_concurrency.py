@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""基准测试：固定并发与自适应并发（AIMD）在容量受限的服务端上的吞吐
+
+替身服务器同时只处理 --capacity 个请求，超出的立即返回 429。分别用
+过小的固定并发、过大的固定并发和自适应并发发送 N 个请求，统计总耗时与 429 次数：
+    python benchmarks/bench_adaptive_concurrency.py --requests 300 --capacity 6
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from adaptive_concurrency import AIMDLimiter  # noqa: E402
+from circuit_breaker import reset_shared_circuit_breakers  # noqa: E402
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_client import AsyncLLMClient, OpenAICompatibleClient, aclose_shared_clients  # noqa: E402
+
+
+async def send_all(client: AsyncLLMClient, count: int) -> None:
+    messages = [{"role": "user", "content": "第1章 风起\n林舟推开客栈的门。"}]
+    await asyncio.gather(*(client.achat(messages) for _ in range(count)))
+    await aclose_shared_clients()
+
+
+def run(args, label: str, concurrency: int, adaptive: bool) -> None:
+    config = FaultConfig(latency=args.latency, max_concurrent=args.capacity, retry_after=args.retry_after,
+                         seed=args.seed)
+    limiter = AIMDLimiter(initial_limit=args.initial, max_limit=concurrency) if adaptive else None
+    with FakeLLMServer(config=config) as server:
+        base = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=20,
+                                      rate_limiter=None, circuit_breaker=None, concurrency_limiter=limiter)
+        start = time.perf_counter()
+        asyncio.run(send_all(AsyncLLMClient(base, max_concurrency=concurrency), args.requests))
+        elapsed = time.perf_counter() - start
+        total = server.stats()["total"]
+    reset_shared_circuit_breakers()
+
+    extra = ""
+    if limiter is not None:
+        stats = limiter.stats()
+        extra = f"，最终上限 {stats['limit']}（区间 {stats['min_seen']}-{stats['max_seen']}）"
+    print(f"{label}：耗时 {elapsed:.2f}s，吞吐 {args.requests / elapsed:.1f} 请求/秒，"
+          f"服务端请求 {total.get('requests', 0)}，429 {total.get('429', 0)} 次{extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="固定并发与自适应并发的吞吐基准（本地替身服务器）")
+    parser.add_argument("--requests", type=int, default=300, help="请求数")
+    parser.add_argument("--capacity", type=int, default=6, help="服务端同时处理的请求上限")
+    parser.add_argument("--latency", type=float, default=0.05, help="单次调用延迟（秒）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After（秒）")
+    parser.add_argument("--low", type=int, default=2, help="过小的固定并发")
+    parser.add_argument("--high", type=int, default=32, help="过大的固定并发（也是自适应上限的天花板）")
+    parser.add_argument("--initial", type=int, default=4, help="自适应并发的初始上限")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    run(args, f"固定并发 {args.low}", args.low, adaptive=False)
+    run(args, f"固定并发 {args.high}", args.high, adaptive=False)
+    run(args, "自适应并发", args.high, adaptive=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""基准测试：紧凑响应格式对每章输出 token 的影响
+
+在本地替身服务器上分别用标准格式和紧凑格式（短键、枚举代码、对白数组）处理 N 个章节，
+两种格式的响应内容相同，报告各阶段每章的输出 token、输入 token 与总耗时：
+    python benchmarks/bench_compact_output.py --chapters 20 --latency 0.2
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_client import OpenAICompatibleClient, close_shared_clients  # noqa: E402
+from llm_telemetry import get_telemetry, reset_telemetry  # noqa: E402
+from main import NovelProcessor  # noqa: E402
+
+
+def chapter_text(index: int) -> str:
+    return f"第{index}章 风起\n林舟推开客栈的门，沈念已在窗边等候多时。两人低声交谈，顾远的脚步声由远及近。" * 5
+
+
+def run(args, compact: bool) -> dict:
+    reset_telemetry()
+    with FakeLLMServer(config=FaultConfig(latency=args.latency, seed=args.seed)) as server:
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=0)
+        processor = NovelProcessor(client, compact_output=compact)
+
+        start = time.perf_counter()
+        for i in range(1, args.chapters + 1):
+            processor.process(chapter_text(i))
+        elapsed = time.perf_counter() - start
+        close_shared_clients()
+
+    summary = get_telemetry().summary()
+    label = "紧凑格式" if compact else "标准格式"
+    print(f"{label}：总计 {elapsed:.1f}s")
+    for stage, s in sorted(summary.items()):
+        print(f"    {stage}：每章输出 {s['completion_tokens'] / args.chapters:.0f} token，"
+              f"输入 {s['prompt_tokens'] / args.chapters:.0f} token")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="紧凑响应格式的输出 token 基准（本地替身服务器）")
+    parser.add_argument("--chapters", type=int, default=20, help="章节数")
+    parser.add_argument("--latency", type=float, default=0.0, help="单次调用延迟（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    standard = run(args, compact=False)
+    compact = run(args, compact=True)
+
+    total_standard = sum(s["completion_tokens"] for s in standard.values())
+    total_compact = sum(s["completion_tokens"] for s in compact.values())
+    print(f"每章输出 token：{total_standard / args.chapters:.0f} → {total_compact / args.chapters:.0f}"
+          f"（减少 {(1 - total_compact / max(total_standard, 1)) * 100:.1f}%）")
+
+
+if __name__ == "__main__":
+    main()
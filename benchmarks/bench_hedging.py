@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""基准测试：对冲请求对每章耗时长尾的影响
+
+在本地替身服务器（对数正态延迟，长尾明显）上顺序处理 N 个章节，
+分别在关闭 / 开启对冲时统计每章耗时的 p50 / p95 / p99 以及额外请求比例：
+    python benchmarks/bench_hedging.py --chapters 60 --latency 0.05 --latency-sigma 1.0
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_client import LLMClient, OpenAICompatibleClient, close_shared_clients  # noqa: E402
+from llm_hedging import HedgedLLMClient  # noqa: E402
+from main import NovelProcessor  # noqa: E402
+
+
+def chapter_text(index: int) -> str:
+    return f"第{index}章 风起\n林舟推开客栈的门，沈念已在窗边等候多时。两人低声交谈，顾远的脚步声由远及近。" * 5
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(args, hedge: bool) -> None:
+    config = FaultConfig(latency=args.latency, latency_sigma=args.latency_sigma, seed=args.seed)
+    with FakeLLMServer(config=config) as server:
+        client: LLMClient = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=0)
+        if hedge:
+            client = HedgedLLMClient(client, max_extra_ratio=args.max_extra_ratio,
+                                     min_samples=args.min_samples)
+        processor = NovelProcessor(client)
+
+        timings = []
+        for i in range(1, args.chapters + 1):
+            start = time.perf_counter()
+            processor.process(chapter_text(i))
+            timings.append(time.perf_counter() - start)
+        requests = server.stats()["total"]["requests"]
+        close_shared_clients()
+
+    label = "对冲" if hedge else "基线"
+    extra = ""
+    if hedge:
+        stats = client.stats()
+        extra = f"，额外请求 {stats['hedged']}（{stats['extra_ratio'] * 100:.1f}%），对冲先返回 {stats['hedge_wins']}"
+    print(f"{label}：每章 p50 {statistics.median(timings):.3f}s  p95 {percentile(timings, 0.95):.3f}s  "
+          f"p99 {percentile(timings, 0.99):.3f}s  总计 {sum(timings):.1f}s；服务端请求 {requests}{extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对冲请求的每章 p99 基准（本地替身服务器）")
+    parser.add_argument("--chapters", type=int, default=60, help="章节数")
+    parser.add_argument("--latency", type=float, default=0.05, help="单次调用延迟中位数（秒）")
+    parser.add_argument("--latency-sigma", type=float, default=1.0, help="延迟对数正态 sigma（越大长尾越重）")
+    parser.add_argument("--max-extra-ratio", type=float, default=0.1, help="对冲请求比例上限")
+    parser.add_argument("--min-samples", type=int, default=20, help="开始对冲前每阶段的最少样本数")
+    parser.add_argument("--seed", type=int, default=1, help="延迟随机种子")
+    args = parser.parse_args()
+
+    run(args, hedge=False)
+    run(args, hedge=True)
+
+
+if __name__ == "__main__":
+    main()
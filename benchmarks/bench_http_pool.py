@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""基准测试：共享连接池 vs 每次调用新建客户端
+
+在本地启动一个 OpenAI 兼容替身服务器，分别测量：
+1. 旧做法：每次调用都新建 OpenAI(...) 客户端（新连接 + 新连接池）
+2. 新做法：OpenAICompatibleClient 复用进程级共享客户端
+
+用法：
+    python benchmarks/bench_http_pool.py --calls 200
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_client import OpenAICompatibleClient, close_shared_clients  # noqa: E402
+
+
+RESPONSE_BODY = json.dumps({
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench-model",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": '{"characters": []}'},
+        "finish_reason": "stop"
+    }],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+}).encode("utf-8")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """立即返回固定响应的替身服务器，统计建立的连接数"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_fresh_client(base_url: str, calls: int) -> float:
+    """旧做法：每次调用新建 OpenAI 客户端"""
+    from openai import OpenAI
+
+    messages = [{"role": "user", "content": "hi"}]
+    start = time.perf_counter()
+    for _ in range(calls):
+        client = OpenAI(api_key="sk-bench", base_url=base_url)
+        client.chat.completions.create(model="bench-model", messages=messages)
+        client.close()
+    return time.perf_counter() - start
+
+
+def bench_shared_client(base_url: str, calls: int) -> float:
+    """新做法：复用共享连接池"""
+    client = OpenAICompatibleClient(api_key="sk-bench", base_url=base_url,
+                                    model="bench-model", max_retries=0)
+    messages = [{"role": "user", "content": "hi"}]
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.chat(messages)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共享连接池基准测试")
+    parser.add_argument("--calls", type=int, default=200, help="每种模式的调用次数")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    try:
+        # 预热（导入 openai、JIT 缓存等）
+        bench_fresh_client(base_url, 5)
+        bench_shared_client(base_url, 5)
+        close_shared_clients()
+
+        server.connections = 0
+        fresh = bench_fresh_client(base_url, args.calls)
+        fresh_conns = server.connections
+
+        server.connections = 0
+        shared = bench_shared_client(base_url, args.calls)
+        shared_conns = server.connections
+    finally:
+        close_shared_clients()
+        server.shutdown()
+        server.server_close()
+
+    fresh_ms = fresh / args.calls * 1000
+    shared_ms = shared / args.calls * 1000
+    print(f"调用次数：{args.calls}")
+    print(f"每次新建客户端：{fresh_ms:.2f} ms/次，建立连接 {fresh_conns} 个")
+    print(f"共享连接池：    {shared_ms:.2f} ms/次，建立连接 {shared_conns} 个")
+    print(f"每次调用节省：  {fresh_ms - shared_ms:.2f} ms ({(1 - shared_ms / fresh_ms) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""基准测试：模型级联对延迟与强模型调用量的影响
+
+用两个本地替身服务器分别模拟强模型（较慢）和廉价模型（较快，部分响应格式错误，无法通过校验），
+比较只用强模型与级联（人物提取和分镜先用廉价模型）处理 N 个章节的耗时和各模型的调用次数：
+    python benchmarks/bench_model_cascade.py --chapters 10 --strong-latency 0.4 --cheap-latency 0.1
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_cascade import CascadeLLMClient  # noqa: E402
+from llm_client import OpenAICompatibleClient, close_shared_clients  # noqa: E402
+from llm_telemetry import reset_telemetry  # noqa: E402
+from main import NovelProcessor  # noqa: E402
+
+
+def chapter_text(index: int) -> str:
+    return f"第{index}章 风起\n林舟推开客栈的门，沈念已在窗边等候多时。两人低声交谈，顾远的脚步声由远及近。" * 5
+
+
+def run(args, cascade: bool) -> None:
+    reset_telemetry()
+    strong_config = FaultConfig(latency=args.strong_latency, seed=args.seed)
+    cheap_config = FaultConfig(latency=args.cheap_latency, rate_malformed=args.cheap_failure_rate, seed=args.seed)
+    with FakeLLMServer(config=strong_config) as strong_server, FakeLLMServer(config=cheap_config) as cheap_server:
+        client = strong = OpenAICompatibleClient(api_key="sk-fake", base_url=strong_server.base_url,
+                                                 model="strong", max_retries=0)
+        if cascade:
+            cheap = OpenAICompatibleClient(api_key="sk-fake", base_url=cheap_server.base_url,
+                                           model="cheap", max_retries=0)
+            client = CascadeLLMClient(cheap, strong, stages=("character", "storyboard"))
+        processor = NovelProcessor(client)
+
+        start = time.perf_counter()
+        for i in range(1, args.chapters + 1):
+            processor.process(chapter_text(i))
+        elapsed = time.perf_counter() - start
+        strong_calls = strong_server.stats()["total"].get("requests", 0)
+        cheap_calls = cheap_server.stats()["total"].get("requests", 0)
+        close_shared_clients()
+
+    label = "级联" if cascade else "只用强模型"
+    print(f"{label}：总计 {elapsed:.1f}s，每章 {elapsed / args.chapters:.2f}s，"
+          f"强模型调用 {strong_calls} 次，廉价模型调用 {cheap_calls} 次")
+    if cascade:
+        for stage, s in sorted(client.stats().items()):
+            print(f"    {stage}：升级 {s['escalated']}/{s['calls']}（{s['escalation_rate'] * 100:.1f}%）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型级联的延迟与调用量基准（本地替身服务器）")
+    parser.add_argument("--chapters", type=int, default=10, help="章节数")
+    parser.add_argument("--strong-latency", type=float, default=0.4, help="强模型单次调用延迟（秒）")
+    parser.add_argument("--cheap-latency", type=float, default=0.1, help="廉价模型单次调用延迟（秒）")
+    parser.add_argument("--cheap-failure-rate", type=float, default=0.1, help="廉价模型结果无法通过校验的比例")
+    parser.add_argument("--seed", type=int, default=1, help="故障注入随机种子")
+    args = parser.parse_args()
+
+    run(args, cascade=False)
+    run(args, cascade=True)
+
+
+if __name__ == "__main__":
+    main()
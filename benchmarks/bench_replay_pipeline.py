@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""基准测试：用录制的真实流量离线回放 LongNovelProcessor
+
+先在有网络的机器上录制一次完整运行：
+    python main.py --file novel.txt --record cassettes/novel.jsonl
+
+之后在任何机器上离线回放（可按录制延迟等待，模拟真实 API 的耗时分布）：
+    python benchmarks/bench_replay_pipeline.py --file novel.txt \\
+        --cassette cassettes/novel.jsonl --latency-scale 1.0 --concurrency 8
+
+同一份 cassette 可以反复比较流水线改动前后的墙钟时间；
+改动了 prompt 的调用会计为"未录制"并在结果中报告。
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_replay import ReplayLLMClient  # noqa: E402
+from main import LongNovelProcessor  # noqa: E402
+from llm_client import LLMClient, MockLLMClient  # noqa: E402
+
+
+def make_client(args) -> ReplayLLMClient:
+    # 未录制的调用返回空结果而不是中断流水线，便于对比改动后的 prompt
+    fallback: LLMClient = MockLLMClient('{}')
+    return ReplayLLMClient(args.cassette, latency_scale=args.latency_scale, fallback=fallback)
+
+
+def make_processor(client: LLMClient, args) -> LongNovelProcessor:
+    return LongNovelProcessor(
+        llm_client=client,
+        max_chunk_size=args.chunk_size,
+        enable_checkpoint=False,
+        use_vector_memory=not args.classic_memory,
+        max_concurrency=args.concurrency
+    )
+
+
+def run_sync(args) -> float:
+    client = make_client(args)
+    processor = make_processor(client, args)
+    start = time.perf_counter()
+    processor.process_novel(args.file)
+    elapsed = time.perf_counter() - start
+    print(f"  同步：{elapsed:.2f}s  {client.stats()}")
+    return elapsed
+
+
+def run_async(args) -> float:
+    client = make_client(args)
+    processor = make_processor(client, args)
+    start = time.perf_counter()
+    asyncio.run(processor.aprocess_novel(args.file))
+    elapsed = time.perf_counter() - start
+    print(f"  异步：{elapsed:.2f}s  {client.stats()}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放录制流量，测量 LongNovelProcessor 耗时")
+    parser.add_argument("--file", required=True, help="录制时使用的小说文件")
+    parser.add_argument("--cassette", required=True, help="录制的 cassette 文件")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="按录制延迟 × 倍率等待（0 表示不等待，只测本地开销）")
+    parser.add_argument("--concurrency", type=int, default=8, help="异步模式的并发上限")
+    parser.add_argument("--chunk-size", type=int, default=8000, help="与录制时一致的分块大小")
+    parser.add_argument("--classic-memory", action="store_true", help="使用传统 MemoryBank")
+    parser.add_argument("--runs", type=int, default=1, help="重复次数")
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    results = {"sync": [], "async": []}
+    for i in range(args.runs):
+        print(f"第 {i + 1}/{args.runs} 轮")
+        if args.mode in ("sync", "both"):
+            results["sync"].append(run_sync(args))
+        if args.mode in ("async", "both"):
+            results["async"].append(run_async(args))
+
+    print()
+    for mode, times in results.items():
+        if times:
+            print(f"{mode}: 最好 {min(times):.2f}s，平均 {sum(times) / len(times):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
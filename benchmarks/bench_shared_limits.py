@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""基准测试：多进程各自限流与跨进程共享限流的 429 次数
+
+模拟 `uvicorn api:app --workers N`：N 个进程同时向本地替身服务器（同时只处理 --capacity 个请求，
+超出返回 429）发送请求，每个进程的并发上限都按账号容量配置为 --capacity。
+分别在进程内限流和设置 LLM_SHARED_LIMITS_PATH 共享名额时统计总耗时和 429 次数：
+    python benchmarks/bench_shared_limits.py --workers 4 --requests 40 --capacity 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_client import OpenAICompatibleClient, aclose_shared_clients  # noqa: E402
+
+
+def worker(base_url: str, count: int, env: dict) -> None:
+    """子进程：并发发送 count 个请求（并发由客户端的并发控制器限制）"""
+    os.environ.update(env)
+    client = OpenAICompatibleClient(api_key="sk-fake", base_url=base_url, max_retries=20)
+    messages = [{"role": "user", "content": "第1章 风起\n林舟推开客栈的门。"}]
+
+    async def run():
+        await asyncio.gather(*(client.achat(messages) for _ in range(count)))
+        await aclose_shared_clients()
+
+    asyncio.run(run())
+
+
+def run(args, shared: bool) -> None:
+    env = {
+        "LLM_ADAPTIVE_CONCURRENCY": "true",
+        # 上限固定为账号容量，只比较是否跨进程共享
+        "LLM_ADAPTIVE_MIN_CONCURRENCY": str(args.capacity),
+        "LLM_ADAPTIVE_MAX_CONCURRENCY": str(args.capacity),
+        "LLM_ADAPTIVE_INITIAL_CONCURRENCY": str(args.capacity),
+        "LLM_SHARED_LIMITS_PATH": ""
+    }
+    config = FaultConfig(latency=args.latency, max_concurrent=args.capacity, retry_after=args.retry_after,
+                         seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp, FakeLLMServer(config=config) as server:
+        if shared:
+            env["LLM_SHARED_LIMITS_PATH"] = os.path.join(tmp, "limits.sqlite3")
+        start = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+            pool.starmap(worker, [(server.base_url, args.requests, env)] * args.workers)
+        elapsed = time.perf_counter() - start
+        total = server.stats()["total"]
+
+    label = "跨进程共享" if shared else "进程内限流"
+    print(f"{label}：{args.workers} 个进程 × {args.requests} 个请求，耗时 {elapsed:.2f}s，"
+          f"服务端请求 {total.get('requests', 0)}，429 {total.get('429', 0)} 次，"
+          f"服务端峰值并发 {server.peak_concurrent}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="跨进程共享限流的 429 基准（本地替身服务器）")
+    parser.add_argument("--workers", type=int, default=4, help="进程数")
+    parser.add_argument("--requests", type=int, default=40, help="每个进程的请求数")
+    parser.add_argument("--capacity", type=int, default=4, help="服务端同时处理的请求上限（即账号容量）")
+    parser.add_argument("--latency", type=float, default=0.05, help="单次调用延迟（秒）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    run(args, shared=False)
+    run(args, shared=True)
+
+
+if __name__ == "__main__":
+    main()
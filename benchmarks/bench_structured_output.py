@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""基准测试：结构化输出对解析失败率、回退率和调用次数的影响
+
+在本地替身服务器上按一定比例注入格式错误的响应（说明文字包裹、单引号），
+分别在 JSON 模式（response_format=json_object）和严格 JSON Schema 下处理 N 个章节，
+报告各阶段的解析失败率、回退率以及服务端收到的请求数（回退场景会额外调用一次 LLM）：
+    python benchmarks/bench_structured_output.py --chapters 20 --rate-malformed 0.1
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, FaultConfig  # noqa: E402
+from llm_client import OpenAICompatibleClient, close_shared_clients  # noqa: E402
+from llm_telemetry import get_telemetry, reset_telemetry  # noqa: E402
+from main import NovelProcessor  # noqa: E402
+
+
+def chapter_text(index: int) -> str:
+    return f"第{index}章 风起\n林舟推开客栈的门，沈念已在窗边等候多时。两人低声交谈，顾远的脚步声由远及近。" * 5
+
+
+def run(args, structured_output: bool) -> None:
+    reset_telemetry()
+    config = FaultConfig(latency=args.latency, rate_malformed=args.rate_malformed, seed=args.seed)
+    with FakeLLMServer(config=config) as server:
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=0,
+                                        structured_output=structured_output)
+        processor = NovelProcessor(client)
+
+        start = time.perf_counter()
+        for i in range(1, args.chapters + 1):
+            processor.process(chapter_text(i))
+        elapsed = time.perf_counter() - start
+        requests = server.stats()["total"]["requests"]
+        close_shared_clients()
+
+    label = "JSON Schema" if structured_output else "JSON 模式"
+    print(f"{label}：服务端请求 {requests}，总计 {elapsed:.1f}s")
+    for stage, s in sorted(get_telemetry().parse_summary().items()):
+        print(f"    {stage}：解析失败 {s['failed']}/{s['parsed']}（{s['failure_rate'] * 100:.1f}%），"
+              f"回退 {s['fallback']}（{s['fallback_rate'] * 100:.1f}%）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="结构化输出的解析失败率与回退率基准（本地替身服务器）")
+    parser.add_argument("--chapters", type=int, default=20, help="章节数")
+    parser.add_argument("--rate-malformed", type=float, default=0.1, help="JSON 模式下格式错误响应的比例")
+    parser.add_argument("--latency", type=float, default=0.0, help="单次调用延迟（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="故障注入随机种子")
+    args = parser.parse_args()
+
+    run(args, structured_output=False)
+    run(args, structured_output=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,27 @@ from dataclasses import dataclass, field
 from models import Character
 
 
+def split_text(text: str) -> Tuple[str, str]:
+    """
+    在靠近中点的边界处把文本一分为二
+
+    依次尝试段落、换行和句末标点，取离中点最近的位置；中点附近没有边界时直接从中点切开。
+    """
+    middle = len(text) // 2
+    window = max(len(text) // 4, 1)
+    for separators in (("\n\n",), ("\n",), ("。", "！", "？", "；", "!", "?")):
+        best = -1
+        for sep in separators:
+            for pos in (text.rfind(sep, middle - window, middle), text.find(sep, middle, middle + window)):
+                if pos != -1 and (best == -1 or abs(pos + len(sep) - middle) < abs(best - middle)):
+                    best = pos + len(sep)
+        if 0 < best < len(text):
+            first, second = text[:best].strip(), text[best:].strip()
+            if first and second:
+                return first, second
+    return text[:middle], text[middle:]
+
+
 @dataclass
 class TextChunk:
     """文本块 - 代表小说的一个章节或场景"""
@@ -461,6 +482,18 @@ class ChunkingPipeline:
 
         return chunk, full_context
 
+    def get_chunk_context_parts(self, chunk_index: int) -> Tuple[TextChunk, str, str]:
+        """
+        获取指定块及其分开的上下文（供 token 预算按优先级裁剪）
+
+        Returns:
+            (块, 记忆上下文, 前一块原文)
+        """
+        chunk = self.reader.chunks[chunk_index]
+        previous = self.reader.get_context_window(chunk_index - 1, include_previous=0) \
+            if chunk_index > 0 else ""
+        return chunk, self.memory_bank.to_context_prompt(), previous
+
     def mark_processed(self, chunk_index: int) -> None:
         """标记块已处理"""
         self.processed_chunks.append(chunk_index)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""熔断器 - 服务端故障期间快速失败
+
+服务商宕机时，每次 chat 调用都会走完 max_retries 次指数退避，
+流水线的各个阶段、各个并发请求依次慢速失败。熔断器在同一
+(base_url, api_key) 的所有客户端之间共享：
+
+1. 关闭（closed）：正常放行；连续 N 次故障（连接错误、超时、5xx）后打开
+2. 打开（open）：所有调用立即抛出 CircuitOpenError，不再访问网络
+3. 半开（half-open）：冷却时间过后放行一个探测请求，成功则关闭，失败则重新打开
+
+429 表示服务端正常但在限流，交给限流器处理，不计入故障（半开状态下的 429 说明服务端可达，关闭熔断器）；
+4xx 说明服务端可达，视为成功；本地错误（参数错误、编程错误等非 API 异常）与服务端可用性无关，不计入。
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+# 默认参数
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器处于打开状态，调用被快速拒绝"""
+
+    def __init__(self, message: str, retry_in: float = 0.0):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+def is_outage_error(error: BaseException) -> Optional[bool]:
+    """
+    判断异常是否说明服务端不可用
+
+    Returns:
+        True 表示故障（连接错误、超时、5xx）；False 表示服务端可达（4xx）；
+        None 表示与可用性无关（429 限流、本地错误）
+    """
+    try:
+        from openai import APIConnectionError, APIStatusError
+    except ImportError:
+        return None
+
+    # APITimeoutError 是 APIConnectionError 的子类
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        if error.status_code == 429:
+            return None
+        return error.status_code >= 500
+    return None
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器，线程安全"""
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 recovery_timeout: float = DEFAULT_RECOVERY_TIMEOUT,
+                 name: str = "",
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        初始化熔断器
+
+        Args:
+            failure_threshold: 连续失败多少次后打开
+            recovery_timeout: 打开后多少秒进入半开状态发送探测请求
+            name: 用于日志的名称（通常是 base_url）
+            clock: 单调时钟（测试时可替换）
+        """
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.name = name
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self) -> None:
+        """
+        请求发送前调用：允许则直接返回，否则抛出 CircuitOpenError
+
+        半开状态下只放行一个探测请求；探测请求超过 recovery_timeout
+        仍未报告结果（例如被取消）时，允许下一个探测。
+        """
+        with self._lock:
+            now = self._clock()
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN:
+                remaining = self._opened_at + self.recovery_timeout - now
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(
+                        f"熔断器已打开（{self.name or '默认端点'}），{remaining:.1f} 秒后探测恢复",
+                        retry_in=remaining
+                    )
+                self._state = HALF_OPEN
+                self._probe_started = None
+            if self._probe_started is not None and now - self._probe_started < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"熔断器半开（{self.name or '默认端点'}），等待探测请求结果")
+            self._probe_started = now
+
+    def record_success(self) -> None:
+        """请求成功（或服务端可达）时调用"""
+        with self._lock:
+            if self._state != CLOSED:
+                print(f"[CIRCUIT] 探测成功，熔断器关闭（{self.name or '默认端点'}）")
+            self._state = CLOSED
+            self._consecutive_failures = 0
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        """请求因服务端故障失败时调用"""
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or (
+                    self._state == CLOSED and self._consecutive_failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = self._clock()
+                self._probe_started = None
+                self.times_opened += 1
+                print(f"[CIRCUIT] 连续 {self._consecutive_failures} 次故障，熔断器打开"
+                      f"（{self.name or '默认端点'}），{self.recovery_timeout:g} 秒内快速失败")
+
+    def record(self, error: BaseException) -> None:
+        """
+        按异常类型记录一次失败的请求
+
+        半开状态下探测请求收到 429 说明服务端可达，关闭熔断器；与可用性无关的错误
+        不改变状态，但会结束当前探测，允许下一个请求继续探测。
+        """
+        outage = is_outage_error(error)
+        if outage is True:
+            self.record_failure()
+        elif outage is False or (getattr(error, "status_code", None) == 429 and self.state == HALF_OPEN):
+            self.record_success()
+        else:
+            with self._lock:
+                self._probe_started = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN
+
+    def stats(self) -> Dict[str, Any]:
+        """返回熔断统计"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+
+# ==================== 进程级共享熔断器 ====================
+
+_shared_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+_shared_breakers_lock = threading.Lock()
+
+
+def get_shared_circuit_breaker(base_url: Optional[str] = None,
+                               api_key: Optional[str] = None) -> Optional[CircuitBreaker]:
+    """
+    获取 (base_url, api_key) 对应的进程级共享熔断器
+
+    参数从环境变量 LLM_CIRCUIT_THRESHOLD（连续失败次数，默认 5，0 表示禁用）
+    和 LLM_CIRCUIT_COOLDOWN（打开后的冷却秒数，默认 30）读取。
+    """
+    threshold = int(os.environ.get("LLM_CIRCUIT_THRESHOLD", DEFAULT_FAILURE_THRESHOLD) or 0)
+    if threshold <= 0:
+        return None
+
+    key = (base_url or "", api_key or "")
+    with _shared_breakers_lock:
+        breaker = _shared_breakers.get(key)
+        if breaker is None:
+            cooldown = float(os.environ.get("LLM_CIRCUIT_COOLDOWN", DEFAULT_RECOVERY_TIMEOUT) or 0)
+            breaker = CircuitBreaker(threshold, cooldown, name=base_url or "")
+            _shared_breakers[key] = breaker
+        return breaker
+
+
+def reset_shared_circuit_breakers() -> None:
+    """清空共享熔断器（测试或重新加载配置时使用）"""
+    with _shared_breakers_lock:
+        _shared_breakers.clear()
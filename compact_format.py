@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""紧凑响应格式 - 用短键和枚举代码减少输出 token
+
+输出 token 是每次调用中最慢、最贵的部分，而标准格式中的长字段名
+（camera_direction、characters_in_shot、audio_direction 等）在每个元素中都要重复一遍。
+启用紧凑格式后：
+1. prompt 末尾追加短键对照表（原有的字段说明保持不变，仍可命中前缀缓存）
+2. 字段名和顶层键改为一到两个字母的短键，对白写成 [人物 ID, 对白] 数组
+3. 镜头类型和运镜方向使用枚举代码；镜头的 id / scene_id / shot_number 和场景 id
+   可由上下文推导，不再输出
+4. expand_response 把紧凑响应还原为标准字段名，之后沿用各模块原有的解析逻辑
+
+请求是否使用紧凑格式由系统消息中的 COMPACT_MARKER 决定（is_compact_request），
+启用结构化输出时 OpenAICompatibleClient 据此发送紧凑版本的 JSON Schema（见 response_schemas），
+批处理和线程池中构建的请求同样适用。
+"""
+from typing import Any, Dict, Iterable, List, Optional
+
+from models import Character, Relationship, TimelineEvent, ScriptScene, StoryboardShot
+
+
+# 紧凑格式说明的标题（替身服务器据此识别紧凑请求）
+COMPACT_MARKER = "【紧凑输出格式】"
+
+# 顶层键：标准 → 紧凑
+COMPACT_KEYS = {"characters": "c", "relationships": "r", "events": "e", "scene": "sc", "shots": "s"}
+
+# 各顶层键的元素类型
+ITEM_MODELS = {
+    "characters": Character,
+    "relationships": Relationship,
+    "events": TimelineEvent,
+    "scene": ScriptScene,
+    "shots": StoryboardShot
+}
+
+# 字段名：标准 → 紧凑；不在表中的字段不输出，由解析逻辑按上下文推导
+COMPACT_FIELDS: Dict[type, Dict[str, str]] = {
+    Character: {"id": "i", "name": "n", "description": "d", "traits": "t", "goals": "g",
+                "background": "b", "appearance": "a"},
+    Relationship: {"id": "i", "character_id_1": "a", "character_id_2": "b", "type": "t",
+                   "description": "d", "conflict_level": "c", "strength": "s"},
+    TimelineEvent: {"id": "i", "chapter": "ch", "summary": "s", "description": "d",
+                    "character_ids": "c", "location": "l", "timestamp": "ts"},
+    ScriptScene: {"chapter": "ch", "location": "l", "time": "tm", "description": "d",
+                  "actions": "a", "dialogues": "dl", "character_ids": "c"},
+    StoryboardShot: {"shot_type": "k", "description": "d", "camera_direction": "m",
+                     "duration_seconds": "t", "audio_direction": "au", "characters_in_shot": "c"}
+}
+
+# 镜头类型代码
+SHOT_TYPE_CODES = {"W": "全景", "M": "中景", "C": "近景", "X": "特写", "XX": "大特写"}
+
+# 运镜方向代码
+CAMERA_CODES = {"F": "固定镜头", "I": "推镜头", "O": "拉镜头", "P": "摇镜头", "T": "移镜头", "G": "跟镜头"}
+
+# 使用枚举代码的字段
+FIELD_CODES = {
+    (StoryboardShot, "shot_type"): SHOT_TYPE_CODES,
+    (StoryboardShot, "camera_direction"): CAMERA_CODES
+}
+
+
+def is_compact_request(messages: List[Dict[str, str]]) -> bool:
+    """请求的系统消息是否要求紧凑格式"""
+    return bool(messages) and messages[0].get("role") == "system" \
+        and COMPACT_MARKER in messages[0].get("content", "")
+
+
+# ==================== Prompt ====================
+
+def compact_prompt(prompt: str, keys: Iterable[str]) -> str:
+    """
+    在系统消息末尾追加短键对照表
+
+    Args:
+        prompt: 标准格式的系统消息
+        keys: 响应中的顶层键（标准名），如 ("characters",)
+    """
+    keys = list(keys)
+    models = [ITEM_MODELS[key] for key in keys]
+    lines = [
+        "",
+        COMPACT_MARKER,
+        "为减少输出长度，请改用以下短键返回 JSON（含义与上面的同名字段相同），不要输出原字段名：",
+        "- 顶层：" + ", ".join(f"{key}→{COMPACT_KEYS[key]}" for key in keys)
+    ]
+    for key, model in zip(keys, models):
+        fields = ", ".join(f"{name}→{short}" for name, short in COMPACT_FIELDS[model].items())
+        lines.append(f"- {key} 的字段：{fields}")
+    if ScriptScene in models:
+        lines.append("- 场景不输出 id；dialogues 的每一项写成 [character_id, line] 数组")
+    if StoryboardShot in models:
+        lines.append("- 镜头不输出 id、scene_id、shot_number，按数组顺序编号")
+        lines.append("- shot_type 代码：" + ", ".join(f"{c}={n}" for c, n in SHOT_TYPE_CODES.items()))
+        lines.append("- camera_direction 代码：" + ", ".join(f"{c}={n}" for c, n in CAMERA_CODES.items()))
+    lines.append("- 可选字段无法确定时直接省略")
+    return prompt.rstrip("\n") + "\n" + "\n".join(lines) + "\n"
+
+
+# ==================== 编解码 ====================
+
+def expand_item(model: type, item: Dict[str, Any]) -> Dict[str, Any]:
+    """把紧凑元素还原为标准字段名（已是标准字段名的元素原样返回）"""
+    if not isinstance(item, dict):
+        return item
+    expanded = {}
+    shorts = {short: name for name, short in COMPACT_FIELDS[model].items()}
+    for key, value in item.items():
+        name = shorts.get(key, key)
+        codes = FIELD_CODES.get((model, name))
+        if codes is not None and isinstance(value, str):
+            value = codes.get(value, value)
+        elif model is ScriptScene and name == "dialogues" and isinstance(value, list):
+            value = [{"character_id": d[0], "line": d[1] if len(d) > 1 else ""}
+                     if isinstance(d, list) and d else d for d in value]
+        expanded[name] = value
+    return expanded
+
+
+def expand_response(data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    把紧凑响应还原为标准格式
+
+    只转换以短键出现的顶层键，模型仍按标准格式回答时原样返回。
+    """
+    if not data:
+        return data
+    expanded = dict(data)
+    for key, short in COMPACT_KEYS.items():
+        if short not in data or key in data:
+            continue
+        value = expanded.pop(short)
+        model = ITEM_MODELS[key]
+        if isinstance(value, list):
+            expanded[key] = [expand_item(model, item) for item in value]
+        else:
+            expanded[key] = expand_item(model, value)
+    return expanded
+
+
+def compact_item(model: type, item: Dict[str, Any]) -> Dict[str, Any]:
+    """把标准元素编码为紧凑格式（省略推导字段和空值）"""
+    compact = {}
+    for name, short in COMPACT_FIELDS[model].items():
+        value = item.get(name)
+        if value is None or value == "" or value == []:
+            continue
+        codes = FIELD_CODES.get((model, name))
+        if codes is not None:
+            value = next((code for code, text in codes.items() if text == value), value)
+        elif model is ScriptScene and name == "dialogues":
+            value = [[d.get("character_id", ""), d.get("line", "")] for d in value]
+        compact[short] = value
+    return compact
+
+
+def compact_response(data: Dict[str, Any]) -> Dict[str, Any]:
+    """把标准响应编码为紧凑格式（替身服务器与测试使用）"""
+    compact = {}
+    for key, value in data.items():
+        if key not in COMPACT_KEYS:
+            compact[key] = value
+            continue
+        model = ITEM_MODELS[key]
+        compact[COMPACT_KEYS[key]] = [compact_item(model, item) for item in value] \
+            if isinstance(value, list) else compact_item(model, value)
+    return compact
+
+
+def compact_keys(keys: Iterable[str]) -> List[str]:
+    """标准顶层键对应的紧凑键（流式解析时使用）"""
+    return [COMPACT_KEYS[key] for key in keys]
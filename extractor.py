@@ -3,185 +3,27 @@
 本模块使用大语言模型进行真正的人物、关系和时间线提取。
 支持自定义 LLM 客户端，默认提供 OpenAI 兼容接口调用逻辑。
 """
-import re
-import json
-import os
-from typing import List, Optional, Dict, Any
+import asyncio
+from typing import List, Optional, Dict, Any, Iterator, AsyncIterator
 from models import Character, Relationship, TimelineEvent
-
-
-# ==================== LLM 客户端接口 ====================
-
-class LLMClient:
-    """LLM 客户端基类 - 可继承实现不同平台的调用"""
-
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
-        self.api_key = api_key or os.environ.get("LLM_API_KEY", "")
-        self.base_url = base_url or os.environ.get("LLM_BASE_URL", "")
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        """发送对话请求并返回响应文本"""
-        raise NotImplementedError("子类必须实现 chat 方法")
-
-
-class MockLLMClient(LLMClient):
-    """Mock LLM 客户端 - 用于测试时无需真实 API 调用"""
-
-    def __init__(self, mock_response: str = ""):
-        super().__init__()
-        self.mock_response = mock_response
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        """返回预设的 mock 响应"""
-        return self.mock_response
-
-
-class OpenAICompatibleClient(LLMClient):
-    """OpenAI 兼容 API 客户端 - 支持原生 JSON Structured Output 和自动重试"""
-
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
-                 model: str = "gpt-4o-mini", use_json_mode: bool = True,
-                 max_retries: int = 3, retry_delay: float = 1.0):
-        """
-        初始化 OpenAI 兼容客户端
-
-        Args:
-            api_key: API 密钥
-            base_url: API 基础 URL
-            model: 模型名称
-            use_json_mode: 是否启用 JSON 结构化输出（response_format=json_object）
-            max_retries: 最大重试次数
-            retry_delay: 基础重试延迟（秒），实际延迟按指数退避计算
-        """
-        super().__init__(api_key, base_url)
-        self.model = model
-        self.use_json_mode = use_json_mode
-        self.max_retries = max_retries
-        self.retry_delay = retry_delay
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
-             json_mode: bool = False) -> str:
-        """
-        调用 OpenAI 兼容 API（带自动重试）
-
-        Args:
-            messages: 对话消息列表
-            temperature: 温度参数
-            json_mode: 是否强制使用 JSON 模式（覆盖实例变量）
-
-        Retries:
-            使用指数退避策略进行重试：
-            - HTTP 429 (Rate Limit): 重试
-            - HTTP 5xx (Server Error): 重试
-            - Connection Error: 重试
-            - HTTP 4xx (Client Error): 不重试
-        """
-        import time
-        import random
-
-        last_exception = None
-
-        for attempt in range(self.max_retries + 1):
-            try:
-                from openai import OpenAI, APIStatusError, APIConnectionError
-                client = OpenAI(
-                    api_key=self.api_key,
-                    base_url=self.base_url if self.base_url else None
-                )
-
-                # 构建请求参数
-                request_kwargs = {
-                    "model": self.model,
-                    "messages": messages,
-                    "temperature": temperature
-                }
-
-                # 启用 JSON 模式（原生结构化输出）
-                if self.use_json_mode or json_mode:
-                    # 方法 1: 使用 response_format（推荐，适用于支持 JSON Schema 的模型）
-                    request_kwargs["response_format"] = {"type": "json_object"}
-
-                    # 方法 2: 同时添加系统提示强化 JSON 要求
-                    if messages and messages[0].get("role") != "system":
-                        messages = [{
-                            "role": "system",
-                            "content": "You must respond with valid JSON only. No other text, no markdown code blocks."
-                        }] + messages
-
-                response = client.chat.completions.create(**request_kwargs)
-                return response.choices[0].message.content
-
-            except ImportError:
-                raise ImportError("请安装 openai 包：pip install openai")
-
-            except APIStatusError as e:
-                last_exception = e
-                status_code = e.status_code
-
-                # 429 Rate Limit - 需要重试
-                if status_code == 429:
-                    if attempt < self.max_retries:
-                        # 指数退避 + 抖动
-                        delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                        print(f"[RETRY] 遇到限流 (429)，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
-                        time.sleep(delay)
-                        continue
-                    else:
-                        print(f"[ERROR] 达到最大重试次数，限流错误仍未解决")
-                        raise
-
-                # 5xx Server Error - 需要重试
-                elif 500 <= status_code < 600:
-                    if attempt < self.max_retries:
-                        delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                        print(f"[RETRY] 服务器错误 ({status_code})，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
-                        time.sleep(delay)
-                        continue
-                    else:
-                        print(f"[ERROR] 达到最大重试次数，服务器错误仍未解决")
-                        raise
-
-                # 4xx Client Error - 不重试，直接抛出
-                elif 400 <= status_code < 500:
-                    print(f"[ERROR] 客户端错误 ({status_code}): {e}")
-                    raise
-
-            except APIConnectionError as e:
-                last_exception = e
-                if attempt < self.max_retries:
-                    delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                    print(f"[RETRY] 连接错误，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
-                    time.sleep(delay)
-                    continue
-                else:
-                    print(f"[ERROR] 达到最大重试次数，连接错误仍未解决")
-                    raise
-
-            except Exception as e:
-                last_exception = e
-                if attempt < self.max_retries:
-                    delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                    print(f"[RETRY] 未知错误 ({type(e).__name__})，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
-                    time.sleep(delay)
-                    continue
-                else:
-                    print(f"[ERROR] 达到最大重试次数，错误仍未解决")
-                    raise
-
-        # 理论上不会到达这里，但为了完整性
-        if last_exception:
-            raise last_exception
-        raise RuntimeError("重试循环异常退出")
+from llm_client import LLMClient, MockLLMClient, OpenAICompatibleClient, ResponseTruncatedError  # noqa: F401
+from chunking_engine import split_text
+from compact_format import compact_prompt, compact_keys, expand_item, expand_response
+from json_stream import parse_json_response, stream_items, astream_items
+from llm_telemetry import llm_stage
 
 
 # ==================== Prompt 模板 ====================
 
-CHARACTER_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专家。请阅读以下小说文本，提取其中出现的所有主要人物。
+# 系统消息只包含固定的指令和 Schema，可变的小说文本放在用户消息中，
+# 使所有请求共享逐字节相同的前缀，便于服务端复用前缀缓存
+
+CHARACTER_EXTRACTION_SYSTEM_PROMPT = """你是一个专业的文学小说分析专家。请阅读用户给出的小说文本，提取其中出现的所有主要人物。
 
 请严格按照以下 JSON Schema 格式返回结果：
-{{
+{
     "characters": [
-        {{
+        {
             "id": "char_人物姓名拼音或英文",
             "name": "人物姓名",
             "description": "人物简短描述（50 字以内）",
@@ -189,24 +31,21 @@ CHARACTER_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专家
             "goals": ["目标 1", "目标 2", ...],
             "background": "背景故事（可选）",
             "appearance": "外貌描写（可选）"
-        }}
+        }
     ]
-}}
+}
 
 如果某个字段无法确定，可以用空字符串或空数组填充。
 
-小说文本：
-{text}
-
-请只返回 JSON，不要包含任何额外说明：
+请只返回 JSON，不要包含任何额外说明。
 """
 
-RELATIONSHIP_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专家。请阅读以下小说文本，提取其中人物之间的关系。
+RELATIONSHIP_EXTRACTION_SYSTEM_PROMPT = """你是一个专业的文学小说分析专家。请阅读用户给出的小说文本，提取其中人物之间的关系。
 
 请严格按照以下 JSON Schema 格式返回结果：
-{{
+{
     "relationships": [
-        {{
+        {
             "id": "rel_人物 1_人物 2",
             "character_id_1": "char_人物 1 姓名",
             "character_id_2": "char_人物 2 姓名",
@@ -214,24 +53,21 @@ RELATIONSHIP_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专
             "description": "关系描述",
             "conflict_level": 0-5 的整数（0 无冲突，5 极度冲突）,
             "strength": 0-5 的整数（关系强度）
-        }}
+        }
     ]
-}}
+}
 
 如果没有检测到任何人物关系，返回空数组。
 
-小说文本：
-{text}
-
-请只返回 JSON，不要包含任何额外说明：
+请只返回 JSON，不要包含任何额外说明。
 """
 
-TIMELINE_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专家。请阅读以下小说文本，提取其中的时间线事件。
+TIMELINE_EXTRACTION_SYSTEM_PROMPT = """你是一个专业的文学小说分析专家。请阅读用户给出的小说文本，提取其中的时间线事件。
 
 请严格按照以下 JSON Schema 格式返回结果：
-{{
+{
     "events": [
-        {{
+        {
             "id": "event_ch 章节号",
             "chapter": 章节号（整数）,
             "summary": "事件摘要（20-50 字）",
@@ -239,195 +75,455 @@ TIMELINE_EXTRACTION_PROMPT = """你是一个专业的文学小说分析专家。
             "character_ids": ["char_人物 1", "char_人物 2", ...],
             "location": "事件发生地点（可选）",
             "timestamp": "时间戳或大致时间（可选）"
-        }}
+        }
     ]
-}}
+}
 
 请按章节顺序提取每个重要事件。
 
-小说文本：
-{text}
+请只返回 JSON，不要包含任何额外说明。
+"""
+
+
+# 融合提取：一次调用同时返回人物、关系和时间线，参考上下文只发送一次
+FUSED_EXTRACTION_SYSTEM_PROMPT = """你是一个专业的文学小说分析专家。请阅读用户给出的小说文本，一次性完成三项分析：
+1. 人物：文本中出现的所有主要人物
+2. 关系：人物之间的关系
+3. 时间线：本章发生的重要事件
+
+用户消息可能先给出参考上下文（人物记忆和上一章原文），参考上下文只用于识别人物和关系，
+时间线事件只从"小说文本"部分提取。
+
+请严格按照以下 JSON Schema 格式返回结果：
+{
+    "characters": [
+        {
+            "id": "char_人物姓名拼音或英文",
+            "name": "人物姓名",
+            "description": "人物简短描述（50 字以内）",
+            "traits": ["性格特点 1", "性格特点 2", ...],
+            "goals": ["目标 1", "目标 2", ...],
+            "background": "背景故事（可选）",
+            "appearance": "外貌描写（可选）"
+        }
+    ],
+    "relationships": [
+        {
+            "id": "rel_人物 1_人物 2",
+            "character_id_1": "char_人物 1 姓名",
+            "character_id_2": "char_人物 2 姓名",
+            "type": "关系类型（朋友/敌人/伙伴/亲人/师徒/恋人等）",
+            "description": "关系描述",
+            "conflict_level": 0-5 的整数（0 无冲突，5 极度冲突）,
+            "strength": 0-5 的整数（关系强度）
+        }
+    ],
+    "events": [
+        {
+            "id": "event_ch 章节号",
+            "chapter": 章节号（整数）,
+            "summary": "事件摘要（20-50 字）",
+            "description": "事件详细描述（100 字以内，可选）",
+            "character_ids": ["char_人物 1", "char_人物 2", ...],
+            "location": "事件发生地点（可选）",
+            "timestamp": "时间戳或大致时间（可选）"
+        }
+    ]
+}
+
+人物关系中的 character_id 应与 characters 中的 id 一致。如果某个字段无法确定，可以用空字符串或空数组填充；
+没有检测到的项目返回空数组。请按章节顺序提取每个重要事件。
 
-请只返回 JSON，不要包含任何额外说明：
+请只返回 JSON，不要包含任何额外说明。
 """
 
+# 融合提取的用户消息：参考上下文（可选）在前，本章正文在后
+FUSED_EXTRACTION_CONTEXT_PROMPT = """参考上下文：
+{context}
+
+"""
+
+# 用户消息：可变的小说文本（记忆上下文和上一章原文在前，本章正文在后）
+EXTRACTION_USER_PROMPT = """小说文本：
+{text}"""
+
+
+# ==================== 截断拆分 ====================
+
+# 正文短于此长度时不再拆分，改为修复解析截断前收到的部分
+MIN_SPLIT_CHARS = 200
+
+
+def _split_for_retry(text: str) -> Optional[List[str]]:
+    """响应被截断后把正文一分为二；已无法再拆分时返回 None"""
+    if len(text) < MIN_SPLIT_CHARS:
+        print(f"[SPLIT] 响应被截断且正文已无法再拆分（{len(text)} 字），保留已完成的部分")
+        return None
+    halves = list(split_text(text))
+    print(f"[SPLIT] 响应被截断，正文拆分为 {len(halves[0])} + {len(halves[1])} 字重新提取")
+    return halves
+
+
+def split_extract(extractor: Any, text: str, context: str = "") -> List[Any]:
+    """
+    调用提取器，响应被截断时拆分正文重新提取
+
+    响应在输出上限处被截断（ResponseTruncatedError）时，在中点附近的段落边界
+    把正文一分为二分别重新请求（参考上下文每一半都保留），必要时继续拆分；
+    正文已短于 MIN_SPLIT_CHARS 时解析截断前收到的部分（保留已完成的元素）。
+
+    Args:
+        extractor: 提供 llm_client、build_messages(text, context) 和 parse_response 的提取器
+
+    Returns:
+        各段的解析结果，按正文顺序排列
+    """
+    try:
+        response = extractor.llm_client.chat(extractor.build_messages(text, context))
+    except ResponseTruncatedError as e:
+        return split_after_truncation(extractor, e, text, context)
+    return [extractor.parse_response(response)]
+
+
+def split_after_truncation(extractor: Any, error: ResponseTruncatedError, text: str,
+                           context: str = "") -> List[Any]:
+    """
+    text 的响应已被截断（error）：拆分正文重新提取，已无法拆分时解析截断前收到的部分
+
+    供 split_extract 和批处理模式（实时回退仍被截断的请求）共用。
+    """
+    halves = _split_for_retry(text)
+    if halves is None:
+        return [extractor.parse_response(error.text)]
+    return [result for half in halves for result in split_extract(extractor, half, context)]
+
+
+async def asplit_extract(extractor: Any, text: str, context: str = "") -> List[Any]:
+    """split_extract 的异步版本（拆分后的两半并发请求）"""
+    try:
+        response = await extractor.llm_client.achat(extractor.build_messages(text, context))
+    except ResponseTruncatedError as e:
+        halves = _split_for_retry(text)
+        if halves is None:
+            return [extractor.parse_response(e.text)]
+        parts = await asyncio.gather(*[asplit_extract(extractor, half, context) for half in halves])
+        return [result for part in parts for result in part]
+    return [extractor.parse_response(response)]
+
+
+def _unique_by_id(items: List[Any]) -> List[Any]:
+    """按 id 去重，保留第一次出现的元素"""
+    seen = set()
+    unique = []
+    for item in items:
+        if item.id not in seen:
+            seen.add(item.id)
+            unique.append(item)
+    return unique
+
 
 # ==================== 提取器实现 ====================
 
 class CharacterExtractor:
     """人物提取器 - 使用 LLM 进行智能提取"""
 
-    def __init__(self, llm_client: Optional[LLMClient] = None):
+    def __init__(self, llm_client: Optional[LLMClient] = None, compact: bool = False):
         """
         初始化人物提取器
 
         Args:
             llm_client: LLM 客户端实例，如果为 None 则使用 MockLLMClient
+            compact: 是否要求紧凑响应格式（短键，见 compact_format）
         """
         self.llm_client = llm_client or MockLLMClient()
+        self.compact = compact
+        self.system_prompt = compact_prompt(CHARACTER_EXTRACTION_SYSTEM_PROMPT, ("characters",)) \
+            if compact else CHARACTER_EXTRACTION_SYSTEM_PROMPT
+
+    def extract(self, text: str, context: str = "") -> List[Character]:
+        """从文本中提取人物（context 为放在正文前的参考上下文，响应被截断时只拆分正文）"""
+        with llm_stage("character"):
+            return self.merge_results(split_extract(self, text, context))
+
+    async def aextract(self, text: str, context: str = "") -> List[Character]:
+        """从文本中提取人物（异步）"""
+        with llm_stage("character"):
+            return self.merge_results(await asplit_extract(self, text, context))
+
+    def extract_stream(self, text: str, context: str = "") -> Iterator[Character]:
+        """流式提取人物：每个对象的右花括号到达后立即产出，无需等待完整响应"""
+        return stream_items("character", lambda: self.llm_client.stream_chat(self.build_messages(text, context)),
+                            self._stream_keys(), self._convert_item, self.parse_response)
+
+    def aextract_stream(self, text: str, context: str = "") -> AsyncIterator[Character]:
+        """流式提取人物（异步）"""
+        return astream_items("character", lambda: self.llm_client.astream_chat(self.build_messages(text, context)),
+                             self._stream_keys(), self._convert_item, self.parse_response)
+
+    def _convert_item(self, item: Dict[str, Any], index: int) -> Character:
+        return self._to_character(expand_item(Character, item))
+
+    def _stream_keys(self) -> List[str]:
+        """增量解析的顶层键（紧凑格式使用短键）"""
+        return compact_keys(("characters",)) if self.compact else ["characters"]
+
+    def build_messages(self, text: str, context: str = "") -> List[Dict[str, str]]:
+        """构建人物提取请求"""
+        text = "\n\n".join(part for part in (context, text) if part)
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": EXTRACTION_USER_PROMPT.format(text=text)}
+        ]
 
-    def extract(self, text: str) -> List[Character]:
-        """从文本中提取人物"""
-        prompt = CHARACTER_EXTRACTION_PROMPT.format(text=text)
-        messages = [{"role": "user", "content": prompt}]
+    @staticmethod
+    def merge_results(parts: List[List[Character]]) -> List[Character]:
+        """合并拆分后各段的结果（按 id 去重）"""
+        return _unique_by_id([item for part in parts for item in part])
 
-        response = self.llm_client.chat(messages)
-        data = self._parse_json_response(response)
+    def parse_response(self, response: str) -> List[Character]:
+        """将 LLM 响应解析为人物列表"""
+        with llm_stage("character"):
+            return self.from_data(expand_response(parse_json_response(response)))
 
+    def from_data(self, data: Optional[Dict[str, Any]]) -> List[Character]:
+        """从解析后的响应对象中取出人物列表"""
         if not data or "characters" not in data:
             return []
 
-        characters = []
-        for char_data in data["characters"]:
-            character = Character(
-                id=char_data.get("id", f"char_{char_data.get('name', 'unknown')}"),
-                name=char_data.get("name", ""),
-                description=char_data.get("description", ""),
-                traits=char_data.get("traits", []),
-                goals=char_data.get("goals", []),
-                background=char_data.get("background"),
-                appearance=char_data.get("appearance")
-            )
-            characters.append(character)
-
-        return characters
-
-    def _parse_json_response(self, response: str) -> Optional[Dict[str, Any]]:
-        """解析 LLM 返回的 JSON 响应"""
-        # 尝试直接解析
-        try:
-            return json.loads(response.strip())
-        except json.JSONDecodeError:
-            pass
-
-        # 尝试提取代码块中的 JSON
-        match = re.search(r'```json\s*(.*?)\s*```', response, re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(1))
-            except json.JSONDecodeError:
-                pass
-
-        # 尝试查找第一个 { 和最后一个 } 之间的内容
-        start = response.find('{')
-        end = response.rfind('}') + 1
-        if start != -1 and end > start:
-            try:
-                return json.loads(response[start:end])
-            except json.JSONDecodeError:
-                pass
+        return [self._to_character(char_data) for char_data in data["characters"]]
 
-        return None
+    def _to_character(self, char_data: Dict[str, Any]) -> Character:
+        """将单个 JSON 对象转换为人物"""
+        return Character(
+            id=char_data.get("id", f"char_{char_data.get('name', 'unknown')}"),
+            name=char_data.get("name", ""),
+            description=char_data.get("description", ""),
+            traits=char_data.get("traits", []),
+            goals=char_data.get("goals", []),
+            background=char_data.get("background"),
+            appearance=char_data.get("appearance")
+        )
 
 
 class RelationshipExtractor:
     """关系提取器 - 使用 LLM 进行智能提取"""
 
-    def __init__(self, llm_client: Optional[LLMClient] = None):
+    def __init__(self, llm_client: Optional[LLMClient] = None, compact: bool = False):
         self.llm_client = llm_client or MockLLMClient()
+        self.compact = compact
+        self.system_prompt = compact_prompt(RELATIONSHIP_EXTRACTION_SYSTEM_PROMPT, ("relationships",)) \
+            if compact else RELATIONSHIP_EXTRACTION_SYSTEM_PROMPT
+
+    def extract(self, text: str, context: str = "") -> List[Relationship]:
+        """从文本中提取人物关系（context 为放在正文前的参考上下文，响应被截断时只拆分正文）"""
+        with llm_stage("relationship"):
+            return self.merge_results(split_extract(self, text, context))
+
+    async def aextract(self, text: str, context: str = "") -> List[Relationship]:
+        """从文本中提取人物关系（异步）"""
+        with llm_stage("relationship"):
+            return self.merge_results(await asplit_extract(self, text, context))
+
+    def extract_stream(self, text: str, context: str = "") -> Iterator[Relationship]:
+        """流式提取人物关系：每个对象的右花括号到达后立即产出，无需等待完整响应"""
+        return stream_items("relationship", lambda: self.llm_client.stream_chat(self.build_messages(text, context)),
+                            self._stream_keys(), self._convert_item, self.parse_response)
+
+    def aextract_stream(self, text: str, context: str = "") -> AsyncIterator[Relationship]:
+        """流式提取人物关系（异步）"""
+        return astream_items("relationship", lambda: self.llm_client.astream_chat(self.build_messages(text, context)),
+                             self._stream_keys(), self._convert_item, self.parse_response)
+
+    def _convert_item(self, item: Dict[str, Any], index: int) -> Relationship:
+        return self._to_relationship(expand_item(Relationship, item))
+
+    def _stream_keys(self) -> List[str]:
+        """增量解析的顶层键（紧凑格式使用短键）"""
+        return compact_keys(("relationships",)) if self.compact else ["relationships"]
+
+    def build_messages(self, text: str, context: str = "") -> List[Dict[str, str]]:
+        """构建关系提取请求"""
+        text = "\n\n".join(part for part in (context, text) if part)
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": EXTRACTION_USER_PROMPT.format(text=text)}
+        ]
 
-    def extract(self, text: str) -> List[Relationship]:
-        """从文本中提取人物关系"""
-        prompt = RELATIONSHIP_EXTRACTION_PROMPT.format(text=text)
-        messages = [{"role": "user", "content": prompt}]
+    @staticmethod
+    def merge_results(parts: List[List[Relationship]]) -> List[Relationship]:
+        """合并拆分后各段的结果（按 id 去重）"""
+        return _unique_by_id([item for part in parts for item in part])
 
-        response = self.llm_client.chat(messages)
-        data = self._parse_json_response(response)
+    def parse_response(self, response: str) -> List[Relationship]:
+        """将 LLM 响应解析为关系列表"""
+        with llm_stage("relationship"):
+            return self.from_data(expand_response(parse_json_response(response)))
 
+    def from_data(self, data: Optional[Dict[str, Any]]) -> List[Relationship]:
+        """从解析后的响应对象中取出关系列表"""
         if not data or "relationships" not in data:
             return []
 
-        relationships = []
-        for rel_data in data["relationships"]:
-            relationship = Relationship(
-                id=rel_data.get("id", f"rel_unknown"),
-                character_id_1=rel_data.get("character_id_1", ""),
-                character_id_2=rel_data.get("character_id_2", ""),
-                type=rel_data.get("type", "unknown"),
-                description=rel_data.get("description", ""),
-                conflict_level=rel_data.get("conflict_level", 0),
-                strength=rel_data.get("strength", 3)
-            )
-            relationships.append(relationship)
-
-        return relationships
-
-    def _parse_json_response(self, response: str) -> Optional[Dict[str, Any]]:
-        """解析 LLM 返回的 JSON 响应"""
-        try:
-            return json.loads(response.strip())
-        except json.JSONDecodeError:
-            match = re.search(r'```json\s*(.*?)\s*```', response, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except json.JSONDecodeError:
-                    pass
-
-        start = response.find('{')
-        end = response.rfind('}') + 1
-        if start != -1 and end > start:
-            try:
-                return json.loads(response[start:end])
-            except json.JSONDecodeError:
-                pass
+        return [self._to_relationship(rel_data) for rel_data in data["relationships"]]
 
-        return None
+    def _to_relationship(self, rel_data: Dict[str, Any]) -> Relationship:
+        """将单个 JSON 对象转换为人物关系"""
+        return Relationship(
+            id=rel_data.get("id", f"rel_unknown"),
+            character_id_1=rel_data.get("character_id_1", ""),
+            character_id_2=rel_data.get("character_id_2", ""),
+            type=rel_data.get("type", "unknown"),
+            description=rel_data.get("description", ""),
+            conflict_level=rel_data.get("conflict_level", 0),
+            strength=rel_data.get("strength", 3)
+        )
 
 
 class TimelineExtractor:
     """时间线提取器 - 使用 LLM 进行智能提取"""
 
-    def __init__(self, llm_client: Optional[LLMClient] = None):
+    def __init__(self, llm_client: Optional[LLMClient] = None, compact: bool = False):
         self.llm_client = llm_client or MockLLMClient()
+        self.compact = compact
+        self.system_prompt = compact_prompt(TIMELINE_EXTRACTION_SYSTEM_PROMPT, ("events",)) \
+            if compact else TIMELINE_EXTRACTION_SYSTEM_PROMPT
+
+    def extract(self, text: str, context: str = "") -> List[TimelineEvent]:
+        """从文本中提取时间线事件（context 为放在正文前的参考上下文，响应被截断时只拆分正文）"""
+        with llm_stage("timeline"):
+            return self.merge_results(split_extract(self, text, context))
+
+    async def aextract(self, text: str, context: str = "") -> List[TimelineEvent]:
+        """从文本中提取时间线事件（异步）"""
+        with llm_stage("timeline"):
+            return self.merge_results(await asplit_extract(self, text, context))
+
+    def extract_stream(self, text: str, context: str = "") -> Iterator[TimelineEvent]:
+        """流式提取时间线事件：每个对象的右花括号到达后立即产出，无需等待完整响应"""
+        return stream_items("timeline", lambda: self.llm_client.stream_chat(self.build_messages(text, context)),
+                            self._stream_keys(), self._convert_item, self.parse_response)
+
+    def aextract_stream(self, text: str, context: str = "") -> AsyncIterator[TimelineEvent]:
+        """流式提取时间线事件（异步）"""
+        return astream_items("timeline", lambda: self.llm_client.astream_chat(self.build_messages(text, context)),
+                             self._stream_keys(), self._convert_item, self.parse_response)
+
+    def _convert_item(self, item: Dict[str, Any], index: int) -> TimelineEvent:
+        return self._to_event(expand_item(TimelineEvent, item))
+
+    def _stream_keys(self) -> List[str]:
+        """增量解析的顶层键（紧凑格式使用短键）"""
+        return compact_keys(("events",)) if self.compact else ["events"]
+
+    def build_messages(self, text: str, context: str = "") -> List[Dict[str, str]]:
+        """构建时间线提取请求"""
+        text = "\n\n".join(part for part in (context, text) if part)
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": EXTRACTION_USER_PROMPT.format(text=text)}
+        ]
 
-    def extract(self, text: str) -> List[TimelineEvent]:
-        """从文本中提取时间线事件"""
-        prompt = TIMELINE_EXTRACTION_PROMPT.format(text=text)
-        messages = [{"role": "user", "content": prompt}]
+    @staticmethod
+    def merge_results(parts: List[List[TimelineEvent]]) -> List[TimelineEvent]:
+        """合并拆分后各段的结果（按正文顺序）"""
+        return [item for part in parts for item in part]
 
-        response = self.llm_client.chat(messages)
-        data = self._parse_json_response(response)
+    def parse_response(self, response: str) -> List[TimelineEvent]:
+        """将 LLM 响应解析为时间线事件列表"""
+        with llm_stage("timeline"):
+            return self.from_data(expand_response(parse_json_response(response)))
 
+    def from_data(self, data: Optional[Dict[str, Any]]) -> List[TimelineEvent]:
+        """从解析后的响应对象中取出时间线事件列表"""
         if not data or "events" not in data:
             return []
 
-        events = []
-        for event_data in data["events"]:
-            event = TimelineEvent(
-                id=event_data.get("id", f"event_ch{event_data.get('chapter', 'unknown')}"),
-                chapter=event_data.get("chapter", 0),
-                summary=event_data.get("summary", ""),
-                description=event_data.get("description"),
-                character_ids=event_data.get("character_ids", []),
-                location=event_data.get("location"),
-                timestamp=event_data.get("timestamp")
-            )
-            events.append(event)
-
-        return events
-
-    def _parse_json_response(self, response: str) -> Optional[Dict[str, Any]]:
-        """解析 LLM 返回的 JSON 响应"""
-        try:
-            return json.loads(response.strip())
-        except json.JSONDecodeError:
-            match = re.search(r'```json\s*(.*?)\s*```', response, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except json.JSONDecodeError:
-                    pass
-
-        start = response.find('{')
-        end = response.rfind('}') + 1
-        if start != -1 and end > start:
-            try:
-                return json.loads(response[start:end])
-            except json.JSONDecodeError:
-                pass
+        return [self._to_event(event_data) for event_data in data["events"]]
 
-        return None
+    def _to_event(self, event_data: Dict[str, Any]) -> TimelineEvent:
+        """将单个 JSON 对象转换为时间线事件"""
+        return TimelineEvent(
+            id=event_data.get("id", f"event_ch{event_data.get('chapter', 'unknown')}"),
+            chapter=event_data.get("chapter", 0),
+            summary=event_data.get("summary", ""),
+            description=event_data.get("description"),
+            character_ids=event_data.get("character_ids", []),
+            location=event_data.get("location"),
+            timestamp=event_data.get("timestamp")
+        )
+
+
+class FusedExtractor:
+    """融合提取器 - 一次 LLM 调用同时提取人物、关系和时间线
+
+    与分别调用三个提取器相比，每个章节只发送一次参考上下文，调用次数和输入
+    token 约为原来的三分之一；结果仍解析为 Character / Relationship / TimelineEvent。
+    """
+
+    def __init__(self, llm_client: Optional[LLMClient] = None, compact: bool = False):
+        """
+        初始化融合提取器
+
+        Args:
+            llm_client: LLM 客户端实例，如果为 None 则使用 MockLLMClient
+            compact: 是否要求紧凑响应格式（短键，见 compact_format）
+        """
+        self.llm_client = llm_client or MockLLMClient()
+        self.compact = compact
+        self.system_prompt = compact_prompt(FUSED_EXTRACTION_SYSTEM_PROMPT,
+                                            ("characters", "relationships", "events")) \
+            if compact else FUSED_EXTRACTION_SYSTEM_PROMPT
+        # 复用各提取器的解析逻辑（融合响应同时包含三个集合）
+        self.character_extractor = CharacterExtractor(self.llm_client)
+        self.relationship_extractor = RelationshipExtractor(self.llm_client)
+        self.timeline_extractor = TimelineExtractor(self.llm_client)
+
+    def extract(self, text: str, context: str = "") -> Dict[str, Any]:
+        """
+        从文本中提取人物、关系和时间线
+
+        Args:
+            text: 本章正文
+            context: 参考上下文（记忆上下文、上一章原文），只用于识别人物和关系
+
+        Returns:
+            {"characters": [...], "relationships": [...], "timeline_events": [...]}
+        """
+        with llm_stage("extraction"):
+            return self.merge_results(split_extract(self, text, context))
+
+    async def aextract(self, text: str, context: str = "") -> Dict[str, Any]:
+        """从文本中提取人物、关系和时间线（异步）"""
+        with llm_stage("extraction"):
+            return self.merge_results(await asplit_extract(self, text, context))
+
+    def build_messages(self, text: str, context: str = "") -> List[Dict[str, str]]:
+        """构建融合提取请求"""
+        content = EXTRACTION_USER_PROMPT.format(text=text)
+        if context:
+            content = FUSED_EXTRACTION_CONTEXT_PROMPT.format(context=context) + content
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": content}
+        ]
+
+    def parse_response(self, response: str) -> Dict[str, Any]:
+        """将 LLM 响应解析为三个集合（响应只解析一次）"""
+        with llm_stage("extraction"):
+            data = expand_response(parse_json_response(response))
+        return {
+            "characters": self.character_extractor.from_data(data),
+            "relationships": self.relationship_extractor.from_data(data),
+            "timeline_events": self.timeline_extractor.from_data(data)
+        }
+
+    def merge_results(self, parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """合并拆分后各段的结果"""
+        return {
+            "characters": self.character_extractor.merge_results([p["characters"] for p in parts]),
+            "relationships": self.relationship_extractor.merge_results([p["relationships"] for p in parts]),
+            "timeline_events": self.timeline_extractor.merge_results([p["timeline_events"] for p in parts])
+        }
 
 
 if __name__ == "__main__":
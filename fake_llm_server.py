@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+"""本地 OpenAI 兼容替身服务器 - 支持延迟与故障注入
+
+实现足以让 OpenAICompatibleClient 通过 LLM_BASE_URL 直接调用的
+/v1/chat/completions（含 stream=True 的 SSE 流式响应）。
+根据 prompt 判断请求类型（人物 / 关系 / 时间线 / 场景 / 分镜 / 时间判断），
+返回符合各模块 JSON Schema 的固定内容，因此整条流水线可以在本地跑通。
+系统消息要求紧凑格式（compact_format）时按短键编码返回。
+
+可配置的故障：
+- 延迟：对数正态分布（中位数 + sigma）
+- 429 比例（带 Retry-After 响应头）
+- 5xx 比例
+- 截断比例（返回一半内容，finish_reason=length）
+- 格式错误比例（JSON 被说明文字包裹且改用单引号，无法解析）；请求携带
+  response_format={"type": "json_schema"} 时模拟服务端约束解码，不注入格式错误
+
+模拟服务端前缀缓存：请求的前若干条消息与之前的请求逐字节相同时，
+usage.prompt_tokens_details.cached_tokens 报告这部分的 token 数。
+
+用法：
+    python fake_llm_server.py --port 8001 --latency 0.5 --latency-sigma 0.4 --rate-429 0.05 --rate-5xx 0.02
+    LLM_API_KEY=fake LLM_BASE_URL=http://127.0.0.1:8001/v1 python main.py --file novel.txt
+
+GET /stats 返回按请求类型和故障类型统计的计数。
+
+另外实现了 Batch API 所需的 /v1/files 与 /v1/batches：批处理任务创建后
+保持 in_progress（时长由 batch_latency 配置），之后在首次查询时按同样的
+固定响应与故障注入逐条处理，注入的 429/5xx 写入错误文件。
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from compact_format import COMPACT_MARKER, compact_response
+from llm_client import estimate_messages_tokens, estimate_tokens
+
+
+@dataclass
+class FaultConfig:
+    """延迟与故障注入配置"""
+    latency: float = 0.0  # 延迟中位数（秒）
+    latency_sigma: float = 0.0  # 对数正态分布的 sigma，0 表示固定延迟
+    rate_429: float = 0.0  # 返回 429 的比例
+    rate_5xx: float = 0.0  # 返回 500/502/503 的比例
+    rate_truncate: float = 0.0  # 返回截断内容（finish_reason=length）的比例
+    rate_malformed: float = 0.0  # 返回无法解析的内容的比例（结构化输出请求不受影响）
+    retry_after: float = 1.0  # 429 响应的 Retry-After（秒）
+    max_concurrent: int = 0  # 同时处理的对话请求上限，超出的请求直接返回 429（0 表示不限制）
+    stream_chunk_size: int = 16  # 流式响应每个分片的字符数
+    stream_chunk_delay: float = 0.0  # 流式分片之间的间隔（秒）
+    batch_latency: float = 0.0  # 批处理任务从创建到完成的时间（秒）
+    seed: Optional[int] = None
+
+
+# ==================== 固定响应 ====================
+
+_NAMES = ["林舟", "沈念", "顾远", "苏晚", "陆川", "叶知秋"]
+_LOCATIONS = ["客栈", "山门", "书房", "渡口", "长街"]
+_TIMES = ["日", "夜", "黄昏", "清晨"]
+_SHOT_TYPES = ["全景", "中景", "近景", "特写"]
+
+
+def detect_prompt_type(prompt: str) -> str:
+    """根据 prompt 中的固定措辞判断请求类型"""
+    if "一次性完成三项分析" in prompt:
+        return "extraction"
+    if "提取其中出现的所有主要人物" in prompt:
+        return "character"
+    if "提取其中人物之间的关系" in prompt:
+        return "relationship"
+    if "提取其中的时间线事件" in prompt:
+        return "timeline"
+    if "转化为规范的剧本场景" in prompt:
+        return "scene"
+    if "拆解为" in prompt and "分镜镜头" in prompt:
+        return "storyboard"
+    if "判断时间" in prompt:
+        return "time"
+    return "other"
+
+
+def malformed_response(content: str) -> str:
+    """模拟不遵守格式要求的响应：说明文字包裹、单引号代替双引号"""
+    return "好的，以下是分析结果：\n" + content.replace('"', "'")
+
+
+def is_structured_request(request: Dict[str, Any]) -> bool:
+    """请求是否要求严格 JSON Schema 输出"""
+    return (request.get("response_format") or {}).get("type") == "json_schema"
+
+
+def _seed_of(text: str) -> int:
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _pick_names(prompt: str, count: int) -> List[str]:
+    """按 prompt 内容稳定地选取人物名，同一文本的各类请求得到一致的人物"""
+    text = prompt.split("小说文本：", 1)[-1]
+    start = _seed_of(text[:200]) % len(_NAMES)
+    return [_NAMES[(start + i) % len(_NAMES)] for i in range(count)]
+
+
+def _chapter_of(prompt: str) -> int:
+    match = re.search(r"第(\d+)章", prompt)
+    return int(match.group(1)) if match else 1
+
+
+def _field(prompt: str, label: str, default: str = "") -> str:
+    match = re.search(label + r"[:：]\s*(.+)", prompt)
+    return match.group(1).strip() if match else default
+
+
+def canned_response(prompt: str) -> Tuple[str, str]:
+    """
+    为 prompt 生成符合 Schema 的固定响应
+
+    Returns:
+        (请求类型, 响应文本)
+    """
+    kind = detect_prompt_type(prompt)
+    # 紧凑格式的对照表不参与随机种子，同一请求两种格式得到相同的内容
+    rng = random.Random(_seed_of(re.sub(re.escape(COMPACT_MARKER) + r".*?\n\n", "", prompt, flags=re.S)))
+
+    if kind == "time":
+        return kind, rng.choice(_TIMES)
+    if kind == "extraction":
+        # 融合提取：一个响应同时包含人物、关系和时间线
+        data = {}
+        for part in ("character", "relationship", "timeline"):
+            data.update(_canned_data(part, prompt, rng))
+    else:
+        data = _canned_data(kind, prompt, rng)
+    if COMPACT_MARKER in prompt:
+        data = compact_response(data)
+    return kind, json.dumps(data, ensure_ascii=False)
+
+
+def _canned_data(kind: str, prompt: str, rng: random.Random) -> Dict[str, Any]:
+    """按请求类型生成响应数据"""
+    if kind == "character":
+        names = _pick_names(prompt, 3)
+        data: Any = {"characters": [
+            {"id": f"char_{name}", "name": name, "description": f"{name}是故事中的重要人物",
+             "traits": ["坚韧", "机敏"][: 1 + i % 2], "goals": ["查明真相"],
+             "background": "", "appearance": ""}
+            for i, name in enumerate(names)
+        ]}
+    elif kind == "relationship":
+        a, b, c = _pick_names(prompt, 3)
+        data = {"relationships": [
+            {"id": f"rel_{a}_{b}", "character_id_1": f"char_{a}", "character_id_2": f"char_{b}",
+             "type": "伙伴", "description": f"{a}与{b}结伴同行", "conflict_level": 1, "strength": 4},
+            {"id": f"rel_{a}_{c}", "character_id_1": f"char_{a}", "character_id_2": f"char_{c}",
+             "type": "敌人", "description": f"{c}暗中阻挠{a}", "conflict_level": 4, "strength": 3}
+        ]}
+    elif kind == "timeline":
+        names = _pick_names(prompt, 3)
+        chapter = _chapter_of(prompt.split("小说文本：", 1)[-1])
+        data = {"events": [
+            {"id": f"event_ch{chapter}_{i + 1}", "chapter": chapter,
+             "summary": f"{names[i]}在{_LOCATIONS[(chapter + i) % len(_LOCATIONS)]}遭遇变故",
+             "description": f"{names[i]}与{names[(i + 1) % 3]}发生争执，局势骤然紧张。",
+             "character_ids": [f"char_{names[i]}", f"char_{names[(i + 1) % 3]}"],
+             "location": _LOCATIONS[(chapter + i) % len(_LOCATIONS)], "timestamp": ""}
+            for i in range(2)
+        ]}
+    elif kind == "scene":
+        scene_id = _field(prompt, "场景 ID", "scene_unknown")
+        characters = [c.strip() for c in _field(prompt, "涉及人物").split(",") if c.strip() and c.strip() != "未明确"]
+        summary = _field(prompt, "摘要", "事件")
+        data = {"scene": {
+            "id": scene_id,
+            "chapter": _chapter_of(prompt),
+            "location": _field(prompt, "地点", "未知地点"),
+            "time": rng.choice(_TIMES),
+            "description": summary,
+            "actions": [f"{summary}（动作一）", f"{summary}（动作二）"],
+            "dialogues": [{"character_id": c, "line": "事情没有那么简单。"} for c in characters[:2]],
+            "character_ids": characters
+        }}
+    elif kind == "storyboard":
+        scene_id = _field(prompt, "场景 ID", "scene_unknown")
+        characters = [c.strip() for c in _field(prompt, "涉及人物").split(",") if c.strip() and c.strip() != "未明确"]
+        count = rng.randint(3, 6)
+        data = {"shots": [
+            {"id": f"{scene_id}_shot_{n}", "scene_id": scene_id, "shot_number": n,
+             "shot_type": "全景" if n == 1 else rng.choice(_SHOT_TYPES),
+             "description": f"镜头{n}：{_field(prompt, '场景描述', '场景')}",
+             "camera_direction": "固定镜头" if n == 1 else rng.choice(["推镜头", "摇镜头", "跟镜头"]),
+             "duration_seconds": round(rng.uniform(2.0, 5.0), 1),
+             "audio_direction": "环境音", "characters_in_shot": characters[:2]}
+            for n in range(1, count + 1)
+        ]}
+    else:
+        data = {}
+    return data
+
+
+# ==================== HTTP 服务 ====================
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容接口的请求处理"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeLLMServer"
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        batch = re.search(r"/batches/([\w-]+)$", path)
+        content = re.search(r"/files/([\w-]+)/content$", path)
+        if path.endswith("/stats"):
+            self._send_json(200, self.server.stats())
+        elif path.endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+        elif batch:
+            payload = self.server.get_batch(batch.group(1))
+            self._send_json(200 if payload else 404, payload or {"error": {"message": "batch not found"}})
+        elif content and content.group(1) in self.server.files:
+            data = self.server.files[content.group(1)]["data"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/files"):
+            self._upload_file(raw)
+            return
+        try:
+            request = json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid JSON body", "type": "invalid_request_error"}})
+            return
+
+        if path.endswith("/batches"):
+            payload = self.server.create_batch(request)
+            self._send_json(200 if "id" in payload else 400, payload)
+            return
+        if not path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        messages = request.get("messages") or []
+        prompt = "\n".join(m.get("content") or "" for m in messages)
+        kind, content = canned_response(prompt)
+
+        overloaded = not self.server.admit()
+        try:
+            fault, delay = self.server.draw(kind, structured=is_structured_request(request), overloaded=overloaded)
+            # 超出容量的请求立即拒绝，不占用处理时间
+            time.sleep(0.0 if overloaded else delay)
+        finally:
+            self.server.leave()
+
+        if fault == "429":
+            self._send_json(429, {"error": {"message": "Rate limit exceeded (injected)", "type": "rate_limit"}},
+                            headers={"Retry-After": f"{self.server.config.retry_after:g}"})
+            return
+        if fault == "5xx":
+            status = random.choice([500, 502, 503])
+            self._send_json(status, {"error": {"message": f"Server error {status} (injected)", "type": "server_error"}})
+            return
+
+        finish_reason = "stop"
+        if fault == "truncate":
+            content = content[: len(content) // 2]
+            finish_reason = "length"
+        elif fault == "malformed":
+            content = malformed_response(content)
+
+        model = request.get("model", "fake-model")
+        if request.get("stream"):
+            self.server.cached_prefix_tokens(messages)
+            self._send_stream(model, content, finish_reason)
+        else:
+            self._send_json(200, self.server.completion(model, messages, content, finish_reason))
+
+    def _upload_file(self, raw: bytes) -> None:
+        """解析 multipart/form-data 上传的文件"""
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("utf-8")
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + raw)
+        fields: Dict[str, Any] = {}
+        filename = "upload.jsonl"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = part.get_payload(decode=True)
+            if name == "file":
+                filename = part.get_filename() or filename
+        if "file" not in fields:
+            self._send_json(400, {"error": {"message": "missing file", "type": "invalid_request_error"}})
+            return
+        purpose = (fields.get("purpose") or b"batch").decode("utf-8")
+        self._send_json(200, self.server.add_file(filename, purpose, fields["file"]))
+
+    def _send_json(self, status: int, payload: Dict[str, Any],
+                   headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, model: str, content: str, finish_reason: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        call_id = f"chatcmpl-fake-{self.server.next_id()}"
+        size = max(1, self.server.config.stream_chunk_size)
+        pieces = [content[i:i + size] for i in range(0, len(content), size)]
+        for i, piece in enumerate(pieces):
+            if i and self.server.config.stream_chunk_delay:
+                time.sleep(self.server.config.stream_chunk_delay)
+            self._write_event(call_id, model, {"content": piece}, None)
+        self._write_event(call_id, model, {}, finish_reason)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_event(self, call_id: str, model: str, delta: Dict[str, Any],
+                     finish_reason: Optional[str]) -> None:
+        event = {
+            "id": call_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """可在测试或基准中嵌入的替身服务器"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 config: Optional[FaultConfig] = None):
+        """
+        初始化服务器（port=0 时自动分配端口）
+
+        Args:
+            host: 监听地址
+            port: 监听端口
+            config: 延迟与故障注入配置
+        """
+        super().__init__((host, port), _FakeHandler)
+        self.config = config or FaultConfig()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._counter = 0
+        self._active = 0
+        self.peak_concurrent = 0
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._prefixes: set = set()
+        self._prompt_tokens = 0
+        self._cached_tokens = 0
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self._batch_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        """供 LLM_BASE_URL 使用的地址"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def next_id(self) -> int:
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def completion(self, model: str, messages: List[Dict[str, Any]], content: str,
+                   finish_reason: str = "stop") -> Dict[str, Any]:
+        """构建 chat.completion 响应体"""
+        usage = {
+            "prompt_tokens": estimate_messages_tokens(messages),
+            "completion_tokens": estimate_tokens(content),
+            "prompt_tokens_details": {"cached_tokens": self.cached_prefix_tokens(messages)}
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return {
+            "id": f"chatcmpl-fake-{self.next_id()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": usage
+        }
+
+    # ==================== Batch API ====================
+
+    def add_file(self, filename: str, purpose: str, data: bytes) -> Dict[str, Any]:
+        """保存上传的文件，返回文件对象"""
+        file = {"id": f"file-fake-{self.next_id()}", "object": "file", "bytes": len(data),
+                "created_at": int(time.time()), "filename": filename, "purpose": purpose,
+                "status": "processed"}
+        with self._lock:
+            self.files[file["id"]] = dict(file, data=data)
+        return file
+
+    def create_batch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """创建批处理任务"""
+        input_file = self.files.get(request.get("input_file_id", ""))
+        if input_file is None:
+            return {"error": {"message": "input file not found", "type": "invalid_request_error"}}
+        total = sum(1 for line in input_file["data"].splitlines() if line.strip())
+        batch = {
+            "id": f"batch_fake_{self.next_id()}", "object": "batch",
+            "endpoint": request.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": input_file["id"], "completion_window": request.get("completion_window", "24h"),
+            "status": "in_progress", "created_at": int(time.time()), "metadata": request.get("metadata"),
+            "output_file_id": None, "error_file_id": None, "errors": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "_ready_at": time.monotonic() + self.config.batch_latency
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        return self._public_batch(batch)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """查询批处理任务（到期后首次查询时完成处理）"""
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        with self._batch_lock:
+            if batch["status"] == "in_progress" and time.monotonic() >= batch["_ready_at"]:
+                self._run_batch(batch)
+            return self._public_batch(batch)
+
+    def _run_batch(self, batch: Dict[str, Any]) -> None:
+        """逐条处理批处理请求，成功结果写入输出文件，注入的故障写入错误文件"""
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            body = entry.get("body") or {}
+            messages = body.get("messages") or []
+            kind, content = canned_response("\n".join(m.get("content") or "" for m in messages))
+            fault, _ = self.draw(kind, structured=is_structured_request(body))
+            if fault in ("429", "5xx"):
+                status = 429 if fault == "429" else 500
+                errors.append({"id": f"batch_req_{self.next_id()}", "custom_id": entry["custom_id"],
+                               "response": {"status_code": status,
+                                            "body": {"error": {"message": f"injected {fault}"}}},
+                               "error": None})
+                continue
+            finish_reason = "stop"
+            if fault == "truncate":
+                content, finish_reason = content[: len(content) // 2], "length"
+            elif fault == "malformed":
+                content = malformed_response(content)
+            outputs.append({"id": f"batch_req_{self.next_id()}", "custom_id": entry["custom_id"],
+                            "response": {"status_code": 200,
+                                         "body": self.completion(body.get("model", "fake-model"), messages,
+                                                                 content, finish_reason)},
+                            "error": None})
+
+        def write(entries: List[Dict[str, Any]], suffix: str) -> Optional[str]:
+            if not entries:
+                return None
+            data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries).encode("utf-8")
+            return self.add_file(f"{batch['id']}_{suffix}.jsonl", "batch_output", data)["id"]
+
+        batch.update(status="completed", completed_at=int(time.time()),
+                     output_file_id=write(outputs, "output"), error_file_id=write(errors, "error"),
+                     request_counts={"total": len(outputs) + len(errors), "completed": len(outputs),
+                                     "failed": len(errors)})
+
+    @staticmethod
+    def _public_batch(batch: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def cached_prefix_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        模拟前缀缓存：返回与之前请求相同的最长消息前缀的 token 数
+
+        以整条消息为粒度（最后一条消息不参与），本次请求的各前缀随后被缓存
+        """
+        keys = []
+        digest = hashlib.sha256()
+        for message in messages[:-1]:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            keys.append(digest.hexdigest())
+
+        with self._lock:
+            hits = 0
+            for k, key in enumerate(keys, 1):
+                if key in self._prefixes:
+                    hits = k
+            self._prefixes.update(keys)
+            cached = estimate_messages_tokens(messages[:hits]) if hits else 0
+            self._prompt_tokens += estimate_messages_tokens(messages)
+            self._cached_tokens += cached
+        return cached
+
+    def admit(self) -> bool:
+        """请求开始处理，返回是否在容量（max_concurrent）以内；无论结果如何都要调用 leave"""
+        with self._lock:
+            self._active += 1
+            self.peak_concurrent = max(self.peak_concurrent, self._active)
+            return not self.config.max_concurrent or self._active <= self.config.max_concurrent
+
+    def leave(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    def draw(self, kind: str, structured: bool = False, overloaded: bool = False) -> Tuple[str, float]:
+        """
+        抽取本次请求的故障类型和延迟，并计入统计
+
+        structured 为结构化输出请求（不会格式错误），overloaded 为超出容量的请求（固定返回 429）。
+        """
+        config = self.config
+        with self._lock:
+            roll = self._rng.random()
+            if overloaded:
+                fault = "429"
+            elif roll < config.rate_429:
+                fault = "429"
+            elif roll < config.rate_429 + config.rate_5xx:
+                fault = "5xx"
+            elif roll < config.rate_429 + config.rate_5xx + config.rate_truncate:
+                fault = "truncate"
+            elif roll < config.rate_429 + config.rate_5xx + config.rate_truncate + config.rate_malformed \
+                    and not structured:
+                fault = "malformed"
+            else:
+                fault = "ok"
+
+            delay = config.latency
+            if config.latency > 0 and config.latency_sigma > 0:
+                delay = config.latency * math.exp(self._rng.gauss(0.0, config.latency_sigma))
+
+            stats = self._stats.setdefault(kind, {"requests": 0, "ok": 0, "429": 0, "5xx": 0, "truncate": 0,
+                                                   "malformed": 0})
+            stats["requests"] += 1
+            stats[fault] += 1
+        return fault, delay
+
+    def stats(self) -> Dict[str, Any]:
+        """按请求类型统计的请求数与注入的故障数，以及前缀缓存命中的 token 数"""
+        with self._lock:
+            by_kind = {k: dict(v) for k, v in self._stats.items()}
+            prompt_cache = {"prompt_tokens": self._prompt_tokens, "cached_tokens": self._cached_tokens}
+        totals: Dict[str, int] = {}
+        for counts in by_kind.values():
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+        return {"config": asdict(self.config), "by_type": by_kind, "total": totals, "prompt_cache": prompt_cache}
+
+    def start(self) -> "FakeLLMServer":
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """停止服务并释放端口"""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "FakeLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务器（延迟与故障注入）")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认 127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8001, help="监听端口（默认 8001）")
+    parser.add_argument("--latency", type=float, default=0.0, help="延迟中位数（秒）")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="延迟对数正态分布的 sigma")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的比例（0-1）")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="返回 5xx 的比例（0-1）")
+    parser.add_argument("--rate-truncate", type=float, default=0.0, help="返回截断响应的比例（0-1）")
+    parser.add_argument("--rate-malformed", type=float, default=0.0,
+                        help="返回无法解析的内容的比例（0-1，结构化输出请求不受影响）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After（秒）")
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.0, help="流式分片间隔（秒）")
+    parser.add_argument("--batch-latency", type=float, default=0.0, help="批处理任务完成所需时间（秒）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子（便于复现）")
+    args = parser.parse_args()
+
+    config = FaultConfig(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        rate_truncate=args.rate_truncate,
+        rate_malformed=args.rate_malformed,
+        retry_after=args.retry_after,
+        stream_chunk_delay=args.stream_chunk_delay,
+        batch_latency=args.batch_latency,
+        seed=args.seed
+    )
+    server = FakeLLMServer(args.host, args.port, config)
+    print(f"[INFO] 替身服务器已启动：{server.base_url}")
+    print(f"[INFO] 设置 LLM_BASE_URL={server.base_url} 并使用任意 LLM_API_KEY 即可调用")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[INFO] 已停止")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
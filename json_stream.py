@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""JSON 响应解析 - 完整响应的容错解析与流式响应的增量解析
+
+LLM 的结构化响应形如 {"characters": [{...}, {...}]}。
+
+完整响应由 parse_json_response 解析（各提取器和生成器共用）：
+1. 从第一个左花括号到最后一个右花括号一次解析，兼容 ```json 代码块和前后说明文字；
+   安装了 orjson 时使用 orjson 解码
+2. 右花括号之后还有其他内容时，只解码第一个完整对象
+3. 响应在 max_tokens 处被截断时，截到最后一个完整的值并补齐括号，
+   数组中已完成的元素全部保留，不必重新调用或走回退逻辑
+4. 每次解析的结果（ok / repaired / failed）计入当前阶段的遥测
+
+流式接收时，不必等整个响应结束：每当目标数组中的某个对象的右花括号到达，
+IncrementalJSONParser 就立即解析并交给下一阶段。解析器只跟踪括号深度和
+字符串状态，每个字符只扫描一次；顶层对象之前的内容（如 ```json 代码块标记）会被忽略。
+"""
+import json
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from llm_telemetry import llm_stage, record_parse_outcome
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时使用标准库
+    orjson = None
+
+
+_decoder = json.JSONDecoder()
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _loads(text: str) -> Any:
+    """解码 JSON 文本（失败时抛出 ValueError）"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+@dataclass
+class ParsedJSON:
+    """完整响应的解析结果"""
+    data: Optional[Dict[str, Any]]
+    truncated: bool = False  # 响应不完整，data 由截断修复得到
+    recovered: int = 0  # 截断修复时保留下来的完整对象数（不含顶层对象）
+
+
+def parse_json(response: str) -> ParsedJSON:
+    """
+    解析 LLM 响应中的 JSON 对象
+
+    Returns:
+        解析结果；找不到可用的 JSON 对象时 data 为 None
+    """
+    start = response.find("{")
+    if start == -1:
+        return ParsedJSON(None)
+
+    end = response.rfind("}") + 1
+    if end > start:
+        try:
+            data = _loads(response[start:end])
+            return ParsedJSON(data if isinstance(data, dict) else None)
+        except ValueError:
+            pass
+        try:
+            # 对象之后还有包含花括号的说明文字
+            data, _ = _decoder.raw_decode(response, start)
+            return ParsedJSON(data if isinstance(data, dict) else None)
+        except ValueError:
+            pass
+
+    return _repair_truncated(response, start)
+
+
+def _repair_truncated(text: str, start: int) -> ParsedJSON:
+    """
+    截到最后一个完整的值，补齐未闭合的括号
+
+    数组中未完成的对象元素整体丢弃（不产出缺字段的半个对象）；
+    其他位置的未完成内容丢弃到上一个完整的值为止。
+    """
+    stack: List[str] = []
+    elements: List[bool] = []  # 各层容器是否为数组中的对象元素
+    open_elements = 0
+    in_string = False
+    escape = False
+    is_value = False  # 当前字符串是否为值（而非字段名）
+    after_colon: List[bool] = []  # 各层对象中是否已读到冒号
+    closed = 0
+    cut = -1
+    cut_stack: List[str] = []
+    cut_closed = 0
+
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                if is_value and not open_elements:
+                    cut, cut_stack, cut_closed = pos + 1, stack[:], closed
+            continue
+
+        if ch == '"':
+            in_string = True
+            is_value = bool(stack) and (stack[-1] == "[" or after_colon[-1])
+        elif ch in "{[":
+            element = ch == "{" and bool(stack) and stack[-1] == "["
+            stack.append(ch)
+            elements.append(element)
+            after_colon.append(False)
+            open_elements += element
+            if not open_elements:
+                cut, cut_stack, cut_closed = pos + 1, stack[:], closed
+        elif ch in "}]":
+            if not stack:
+                break
+            if stack.pop() == "{" and stack:
+                closed += 1
+            open_elements -= elements.pop()
+            after_colon.pop()
+            if not stack:
+                break
+            if not open_elements:
+                cut, cut_stack, cut_closed = pos + 1, stack[:], closed
+        elif ch == ":" and stack:
+            after_colon[-1] = True
+        elif ch == "," and stack:
+            # 逗号之前一定是完整的值（含数字、布尔值等）
+            after_colon[-1] = False
+            if not open_elements:
+                cut, cut_stack, cut_closed = pos, stack[:], closed
+
+    if cut == -1:
+        return ParsedJSON(None)
+    repaired = text[start:cut] + "".join(_CLOSERS[c] for c in reversed(cut_stack))
+    try:
+        data = _loads(repaired)
+    except ValueError:
+        return ParsedJSON(None)
+    if not isinstance(data, dict):
+        return ParsedJSON(None)
+    return ParsedJSON(data, truncated=True, recovered=cut_closed)
+
+
+def parse_json_response(response: str) -> Optional[Dict[str, Any]]:
+    """
+    解析 LLM 响应中的 JSON 对象（截断的响应尽量修复）
+
+    Returns:
+        解析得到的对象，无法解析时返回 None
+    """
+    result = parse_json(response)
+    if result.truncated:
+        print(f"[REPAIR] 响应不完整，已修复并保留 {result.recovered} 个完整对象")
+    record_parse_outcome("failed" if result.data is None else "repaired" if result.truncated else "ok")
+    return result.data
+
+
+class IncrementalJSONParser:
+    """从顶层对象的指定数组字段中增量提取对象元素"""
+
+    def __init__(self, keys: Iterable[str]):
+        """
+        初始化解析器
+
+        Args:
+            keys: 需要产出元素的顶层数组字段名，如 ("characters",)
+        """
+        self.keys = set(keys)
+        # 收到的增量只追加到列表，读取 text 时才拼接，避免每段增量都复制整个缓冲区
+        self._chunks: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # 正在解析的字段名 / 数组元素：此前各段增量中的部分，以及在当前增量中的起点（-1 表示不在其中）
+        self._key_parts: List[str] = []
+        self._key_start = -1
+        self._element_parts: List[str] = []
+        self._element_start = -1
+        self._last_key: Optional[str] = None
+        self._array_key: Optional[str] = None
+        self._done = False
+
+    @property
+    def text(self) -> str:
+        """目前为止收到的完整文本"""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def feed(self, chunk: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        输入一段增量文本（只扫描本段，每个字符只扫描一次）
+
+        Returns:
+            本次新完成的 (字段名, 元素) 列表，按出现顺序排列
+        """
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        if self._done:
+            return []
+
+        completed = []
+        for pos, ch in enumerate(chunk):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_start >= 0:
+                        # 顶层对象中的字符串：可能是字段名
+                        fragment = "".join(self._key_parts) + chunk[self._key_start:pos + 1]
+                        self._key_parts = []
+                        self._key_start = -1
+                        try:
+                            self._last_key = json.loads(fragment)
+                        except json.JSONDecodeError:
+                            self._last_key = None
+                continue
+
+            if ch == '"':
+                if self._depth > 0:
+                    self._in_string = True
+                    if self._depth == 1:
+                        self._key_start = pos
+            elif ch in "{[":
+                if self._depth == 0 and ch == "[":
+                    # 顶层对象开始之前的方括号（如说明文字）不计入
+                    continue
+                self._depth += 1
+                if self._depth == 2:
+                    self._array_key = self._last_key if ch == "[" else None
+                elif self._depth == 3 and ch == "{" and self._array_key in self.keys:
+                    self._element_start = pos
+            elif ch in "}]":
+                if self._depth == 0:
+                    continue
+                if self._depth == 3 and ch == "}" and self._element_start >= 0:
+                    element = self._decode("".join(self._element_parts) + chunk[self._element_start:pos + 1])
+                    if element is not None:
+                        completed.append((self._array_key, element))
+                    self._element_parts = []
+                    self._element_start = -1
+                self._depth -= 1
+                if self._depth == 1:
+                    self._array_key = None
+                elif self._depth == 0:
+                    self._done = True
+                    return completed
+
+        # 跨越增量边界的字段名 / 元素：保存本段中的部分，下一段从开头继续
+        if self._key_start >= 0:
+            self._key_parts.append(chunk[self._key_start:])
+            self._key_start = 0
+        if self._element_start >= 0:
+            self._element_parts.append(chunk[self._element_start:])
+            self._element_start = 0
+        return completed
+
+    @staticmethod
+    def _decode(fragment: str) -> Optional[Dict[str, Any]]:
+        try:
+            value = _loads(fragment)
+        except ValueError:
+            return None
+        return value if isinstance(value, dict) else None
+
+
+def iter_json_items(chunks: Iterable[str], keys: Iterable[str],
+                    parser: Optional[IncrementalJSONParser] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    从文本增量流中逐个产出已完成的数组元素
+
+    Args:
+        chunks: 文本增量（如 stream_chat 的输出）
+        keys: 目标数组字段名
+        parser: 可选的解析器实例（调用方可在结束后读取 parser.text）
+    """
+    parser = parser or IncrementalJSONParser(keys)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+
+async def aiter_json_items(chunks: AsyncIterator[str], keys: Iterable[str],
+                           parser: Optional[IncrementalJSONParser] = None
+                           ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """iter_json_items 的异步版本"""
+    parser = parser or IncrementalJSONParser(keys)
+    async for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+
+
+_END = object()
+
+
+def stream_items(stage: str, open_chunks: Callable[[], Iterable[str]], keys: Iterable[str],
+                 convert: Callable[[Dict[str, Any], int], Any],
+                 fallback: Callable[[str], Iterable[Any]]) -> Iterator[Any]:
+    """
+    流式调用并逐个产出转换后的数组元素（各提取器和生成器的 *_stream 共用）
+
+    阶段只在发起调用、读取每段增量和回退解析时生效，不包住 yield：
+    调用方在两次取值之间发出的调用（如把镜头交给下一阶段）仍归入调用方自己的阶段。
+
+    Args:
+        stage: 遥测阶段名
+        open_chunks: 发起流式调用、返回文本增量的函数
+        keys: 目标数组字段名
+        convert: (元素, 从 1 开始的序号) -> 结果对象
+        fallback: 增量解析未找到任何元素时（如 JSON 被说明文字包裹），对完整文本做完整解析
+    """
+    with llm_stage(stage):
+        chunks = iter(open_chunks())
+    parser = IncrementalJSONParser(keys)
+    count = 0
+    try:
+        while True:
+            with llm_stage(stage):
+                chunk = next(chunks, _END)
+                if chunk is _END:
+                    break
+                results = [convert(item, count + i) for i, (_, item) in enumerate(parser.feed(chunk), start=1)]
+            for result in results:
+                count += 1
+                yield result
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            with llm_stage(stage):
+                close()
+    if not count:
+        with llm_stage(stage):
+            results = list(fallback(parser.text))
+        yield from results
+
+
+async def astream_items(stage: str, open_chunks: Callable[[], AsyncIterator[str]], keys: Iterable[str],
+                        convert: Callable[[Dict[str, Any], int], Any],
+                        fallback: Callable[[str], Iterable[Any]]) -> AsyncIterator[Any]:
+    """stream_items 的异步版本"""
+    with llm_stage(stage):
+        chunks = open_chunks().__aiter__()
+    parser = IncrementalJSONParser(keys)
+    count = 0
+    try:
+        while True:
+            with llm_stage(stage):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                results = [convert(item, count + i) for i, (_, item) in enumerate(parser.feed(chunk), start=1)]
+            for result in results:
+                count += 1
+                yield result
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            with llm_stage(stage):
+                await aclose()
+    if not count:
+        with llm_stage(stage):
+            results = list(fallback(parser.text))
+        for result in results:
+            yield result
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""Batch API 离线提交 - 一轮请求整体提交，完成后统一取回结果
+
+夜间任务不在乎延迟，只在乎成本和限流：OpenAI 风格的 Batch API 价格约为
+实时接口的一半，并且使用独立的限流额度。BatchRunner 把一轮请求写成
+Batch JSONL 文件，上传（/v1/files）并创建批处理任务（/v1/batches），
+轮询直到任务结束，再下载结果文件按 custom_id 取回响应文本。
+
+- 一个批处理任务只能使用一个模型，请求按（端点, 模型）分组提交
+- 任务 ID 与下载的结果保存在工作目录中：进程中断后用相同的请求重新运行，
+  会继续等待原任务或直接读取已下载的结果，不会重复提交
+- 包装链中有 CachedLLMClient 时，命中缓存的请求不再提交，取回的结果写入缓存
+- 无法批量提交的阶段（Mock、回放、多端点路由）以及在批处理中失败或
+  在输出上限处被截断（finish_reason 为 length）的请求，回退为通过原客户端实时调用
+"""
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from llm_cache import CachedLLMClient
+from llm_client import LLMClient, LLMClientWrapper, OpenAICompatibleClient, client_fingerprint, \
+    get_shared_openai_client
+from llm_stages import StageLLMClient
+from llm_telemetry import begin_call, end_call, llm_stage
+
+
+# 批处理请求的目标接口
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# 默认工作目录（保存提交的 JSONL、任务状态和下载的结果）
+DEFAULT_BATCH_DIR = "batches"
+
+# 默认轮询间隔（秒）
+DEFAULT_POLL_INTERVAL = 60.0
+
+# 默认完成时限（OpenAI 目前只支持 24h）
+DEFAULT_COMPLETION_WINDOW = "24h"
+
+# 单个批处理任务的请求数上限
+MAX_REQUESTS_PER_BATCH = 50000
+
+# 批处理任务的终止状态
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchError(RuntimeError):
+    """批处理任务未通过校验或无法取回结果"""
+
+
+@dataclass
+class BatchRequest:
+    """一轮批处理中的一个 chat 请求"""
+    custom_id: str
+    stage: str
+    messages: List[Dict[str, str]]
+    temperature: float = 0.7
+
+
+def batch_endpoint(client: Optional[LLMClient], stage: str) -> Optional[OpenAICompatibleClient]:
+    """沿包装链找到阶段实际使用的 OpenAICompatibleClient（不支持批量提交时返回 None）"""
+    while client is not None:
+        if isinstance(client, OpenAICompatibleClient):
+            return client
+        if isinstance(client, StageLLMClient):
+            client = client.client_for(stage)
+        elif isinstance(client, LLMClientWrapper):
+            client = client.client
+        else:
+            return None
+    return None
+
+
+def _find_cache(client: LLMClient) -> Optional[CachedLLMClient]:
+    while isinstance(client, LLMClientWrapper):
+        if isinstance(client, CachedLLMClient):
+            return client
+        client = client.client
+    return None
+
+
+class BatchRunner:
+    """按轮提交批处理任务并取回结果"""
+
+    def __init__(self, llm_client: LLMClient, work_dir: str = DEFAULT_BATCH_DIR,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 completion_window: str = DEFAULT_COMPLETION_WINDOW,
+                 max_requests: int = MAX_REQUESTS_PER_BATCH,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        初始化批处理提交器
+
+        Args:
+            llm_client: 实时调用使用的客户端（沿包装链找到实际端点，回退时直接调用）
+            work_dir: 工作目录
+            poll_interval: 轮询间隔（秒）
+            completion_window: 批处理完成时限
+            max_requests: 单个批处理任务的请求数上限，超出时拆分为多个任务
+            sleep: 轮询等待函数（测试时可替换）
+        """
+        self.llm_client = llm_client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_requests = max_requests
+        self.sleep = sleep
+
+        self.batches = 0  # 提交的批处理任务数
+        self.submitted = 0  # 通过批处理完成的请求数
+        self.cache_hits = 0
+        self.live_calls = 0  # 回退为实时调用的请求数
+
+    def run(self, requests: List[BatchRequest], name: str) -> Dict[str, Any]:
+        """
+        提交一轮请求并等待全部完成
+
+        Args:
+            requests: 本轮请求（custom_id 不可重复）
+            name: 本轮名称（用于工作目录中的文件名）
+
+        Returns:
+            {custom_id: 响应文本}；实时回退仍失败的请求对应其异常（不抛出，单个请求失败不中断整轮，
+            由调用方决定拆分重试或跳过，如 ResponseTruncatedError）
+        """
+        results: Dict[str, Any] = {}
+        live: List[BatchRequest] = []
+        groups: Dict[Tuple[str, str, str], Tuple[OpenAICompatibleClient, List]] = {}
+        cache = _find_cache(self.llm_client)
+
+        for request in requests:
+            with llm_stage(request.stage):
+                if cache is not None:
+                    cached = cache.cache.get(client_fingerprint(cache.client, request.messages, request.temperature))
+                    if cached is not None:
+                        results[request.custom_id] = cached
+                        self.cache_hits += 1
+                        continue
+                endpoint = batch_endpoint(self.llm_client, request.stage)
+                if endpoint is None:
+                    live.append(request)
+                    continue
+                # 请求体按阶段构建（启用结构化输出时带上该阶段的 JSON Schema）
+                body = endpoint.build_request(request.messages, request.temperature, json_mode=False)
+            key = (endpoint.base_url or "", endpoint.api_key or "", body["model"])
+            groups.setdefault(key, (endpoint, []))[1].append((request, body))
+
+        # 先提交全部任务再统一等待，各任务在服务端并行执行
+        jobs = []
+        for endpoint, items in groups.values():
+            for start in range(0, len(items), self.max_requests):
+                jobs.append(self._submit(endpoint, items[start:start + self.max_requests], name))
+        for job in jobs:
+            failed = self._collect(job, results, cache)
+            live.extend(failed)
+
+        if live:
+            print(f"[BATCH] {name}：{len(live)} 个请求改为实时调用")
+        for request in live:
+            with llm_stage(request.stage):
+                try:
+                    results[request.custom_id] = self.llm_client.chat(request.messages, request.temperature)
+                except Exception as e:
+                    print(f"[BATCH] {request.custom_id} 实时调用失败：{type(e).__name__}: {e}")
+                    results[request.custom_id] = e
+            self.live_calls += 1
+        return results
+
+    def _submit(self, endpoint: OpenAICompatibleClient, items: List[Tuple[BatchRequest, Dict[str, Any]]],
+                name: str) -> Dict[str, Any]:
+        """写出 JSONL 并提交（已有相同内容的任务时继续使用原任务）"""
+        lines = [
+            json.dumps({"custom_id": request.custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                       ensure_ascii=False)
+            for request, body in items
+        ]
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        prefix = os.path.join(self.work_dir, f"{name}-{hashlib.sha256(data).hexdigest()[:16]}")
+        job = {"endpoint": endpoint, "items": items, "prefix": prefix, "batch_id": None}
+        if os.path.exists(prefix + ".output.jsonl"):
+            return job
+
+        client = get_shared_openai_client(endpoint.api_key, endpoint.base_url, endpoint.pool_size)
+        state_path = prefix + ".state.json"
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                job["batch_id"] = json.load(f)["batch_id"]
+            if client.batches.retrieve(job["batch_id"]).status not in ("failed", "expired", "cancelled"):
+                print(f"[BATCH] 继续等待已提交的批处理 {job['batch_id']}（{name}，{len(items)} 个请求）")
+                return job
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        with open(prefix + ".jsonl", "wb") as f:
+            f.write(data)
+        with open(prefix + ".jsonl", "rb") as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+            metadata={"name": name}
+        )
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch.id, "input_file_id": uploaded.id}, f)
+        job["batch_id"] = batch.id
+        self.batches += 1
+        print(f"[BATCH] 已提交 {name}：{len(items)} 个请求（{items[0][1]['model']}，批处理 {batch.id}）")
+        return job
+
+    def _wait(self, job: Dict[str, Any]) -> str:
+        """轮询直到任务结束，下载结果并返回结果文件的文本"""
+        endpoint = job["endpoint"]
+        client = get_shared_openai_client(endpoint.api_key, endpoint.base_url, endpoint.pool_size)
+        while True:
+            batch = client.batches.retrieve(job["batch_id"])
+            if batch.status in FINAL_STATUSES:
+                break
+            counts = batch.request_counts
+            progress = f"，已完成 {counts.completed}/{counts.total}" if counts else ""
+            print(f"[BATCH] {batch.id}：{batch.status}{progress}")
+            self.sleep(self.poll_interval)
+
+        if batch.status == "failed":
+            errors = "; ".join(e.message or "" for e in (batch.errors.data or [])) if batch.errors else ""
+            raise BatchError(f"批处理 {batch.id} 未通过校验：{errors or '未知错误'}")
+
+        # 过期或取消的任务只包含已完成的部分结果，其余请求回退为实时调用
+        text = ""
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text += client.files.content(file_id).text.rstrip("\n") + "\n"
+        with open(job["prefix"] + ".output.jsonl", "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[BATCH] {batch.id}：{batch.status}")
+        return text
+
+    def _collect(self, job: Dict[str, Any], results: Dict[str, str],
+                 cache: Optional[CachedLLMClient]) -> List[BatchRequest]:
+        """取回任务结果写入 results，返回需要实时重试的请求"""
+        from openai.types.chat import ChatCompletion
+
+        output_path = job["prefix"] + ".output.jsonl"
+        if os.path.exists(output_path):
+            with open(output_path, "r", encoding="utf-8") as f:
+                text = f.read()
+        else:
+            text = self._wait(job)
+
+        responses = {}
+        for line in text.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200:
+                    responses[entry["custom_id"]] = response["body"]
+
+        endpoint = job["endpoint"]
+        failed = []
+        for request, body in job["items"]:
+            if request.custom_id not in responses:
+                failed.append(request)
+                continue
+            completion = ChatCompletion.model_validate(responses[request.custom_id])
+            content = completion.choices[0].message.content
+            truncated = completion.choices[0].finish_reason == "length"
+            with llm_stage(request.stage):
+                end_call(begin_call(body["model"], endpoint.base_url), completion,
+                         messages=body["messages"], text=content)
+                if truncated:
+                    # 与实时调用一致：在输出上限处截断的结果不缓存、不解析，改为实时调用
+                    failed.append(request)
+                    continue
+                if cache is not None and content is not None:
+                    cache.cache.put(client_fingerprint(cache.client, request.messages, request.temperature),
+                                    content)
+            results[request.custom_id] = content
+            self.submitted += 1
+        return failed
+
+    def stats(self) -> Dict[str, int]:
+        """返回提交统计"""
+        return {
+            "batches": self.batches,
+            "submitted": self.submitted,
+            "cache_hits": self.cache_hits,
+            "live_calls": self.live_calls
+        }
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""LLM 响应缓存 - 内容寻址的磁盘缓存
+
+以请求指纹（模型 + 消息 + 温度 + JSON 模式的哈希）为键，把 LLM 响应保存到
+SQLite 文件中。崩溃后重跑或修改了与 prompt 无关的代码时，已完成的提取、
+场景和分镜调用直接命中缓存，不再重复计费和等待。
+
+- 按总字节数做 LRU 淘汰（最近最少访问的条目优先删除）
+- 可选 TTL，过期条目视为未命中
+- 统计命中/未命中次数，便于观察每次运行节省的调用
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Dict, Any, Iterator, AsyncIterator
+
+from llm_client import LLMClient, LLMClientWrapper, client_fingerprint
+
+
+# 默认缓存文件路径
+DEFAULT_CACHE_PATH = ".llm_cache.sqlite3"
+
+# 默认缓存容量上限（字节）
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class LLMResponseCache:
+    """基于 SQLite 的响应存储，线程安全"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl_seconds: Optional[float] = None):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite 文件路径
+            max_bytes: 缓存内容总字节数上限，超出后按 LRU 淘汰
+            ttl_seconds: 条目有效期（秒），None 表示永不过期
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)"
+        )
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        self._total_bytes = row[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """查找缓存，命中时刷新访问时间"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, size, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            response, size, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                # 已过期：删除并视为未命中
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return response
+
+    async def aget(self, key: str) -> Optional[str]:
+        """在线程池中查找缓存，SQLite 读写不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    def put(self, key: str, response: str) -> None:
+        """写入缓存，必要时淘汰最久未访问的条目"""
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self.stores += 1
+
+            if self._total_bytes > self.max_bytes:
+                self._evict(exclude_key=key)
+
+    async def aput(self, key: str, response: str) -> None:
+        """在线程池中写入缓存"""
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, response)
+
+    def _evict(self, exclude_key: str) -> None:
+        """按访问时间从旧到新删除条目，直到总大小回到上限以内（调用方持有锁）"""
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses WHERE key != ? ORDER BY accessed_at ASC",
+            (exclude_key,)
+        )
+        to_delete = []
+        for key, size in rows:
+            if self._total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+
+        if to_delete:
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+            self.evictions += len(to_delete)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._total_bytes = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def total_bytes(self) -> int:
+        """当前缓存内容总字节数"""
+        return self._total_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_bytes": self._total_bytes
+        }
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+
+class CachedLLMClient(LLMClientWrapper):
+    """带响应缓存的 LLM 客户端，可包装任意 LLMClient"""
+
+    def __init__(self, client: LLMClient, cache: Optional[LLMResponseCache] = None,
+                 cache_path: str = DEFAULT_CACHE_PATH,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl_seconds: Optional[float] = None):
+        """
+        初始化缓存客户端
+
+        Args:
+            client: 被包装的 LLM 客户端
+            cache: 已有的缓存实例（提供时忽略其余缓存参数）
+            cache_path: SQLite 文件路径
+            max_bytes: 缓存容量上限（字节）
+            ttl_seconds: 条目有效期（秒），None 表示永不过期
+        """
+        super().__init__(client)
+        self.cache = cache if cache is not None else LLMResponseCache(cache_path, max_bytes, ttl_seconds)
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        response = self.client.chat(messages, temperature, **kwargs)
+        if response is not None:
+            self.cache.put(key, response)
+        return response
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            return cached
+
+        response = await self.client.achat(messages, temperature, **kwargs)
+        if response is not None:
+            await self.cache.aput(key, response)
+        return response
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        received = []
+        for chunk in self.client.stream_chat(messages, temperature, **kwargs):
+            received.append(chunk)
+            yield chunk
+        # 只缓存完整接收的响应：内层流抛出异常（包括截断时的 ResponseTruncatedError）
+        # 或调用方提前停止读取时不会执行到这里，chat 之后仍会请求并走拆分重试
+        self.cache.put(key, "".join(received))
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            yield cached
+            return
+
+        received = []
+        async for chunk in self.client.astream_chat(messages, temperature, **kwargs):
+            received.append(chunk)
+            yield chunk
+        await self.cache.aput(key, "".join(received))
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        return self.cache.stats()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""模型级联 - 先用廉价模型，结果未通过校验时再升级到强模型
+
+长篇网文的大部分章节并不难：人物明确、场景简单，快速廉价的模型足以给出合格结果。
+CascadeLLMClient 对配置了校验器的阶段（默认人物提取、融合提取和分镜）先调用廉价模型，
+解析响应并做结构校验（人物非空、镜头编号连续、镜头中的人物 ID 出现在请求中等），
+只有校验失败或廉价模型调用出错（熔断除外）时才用同样的消息请求强模型。其余阶段直接使用强模型。
+
+级联位于客户端层，各提取器和生成器无需感知；两个模型的调用都会进入遥测，
+按阶段的成本统计中可以看到各自的调用量。
+
+通过环境变量 LLM_CASCADE_MODEL（廉价模型）和 LLM_CASCADE_STAGES 启用，见 cascade_from_env。
+"""
+import os
+import re
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional
+
+from circuit_breaker import CircuitOpenError
+from compact_format import expand_response
+from json_stream import parse_json
+from llm_client import LLMClient, OpenAICompatibleClient
+from llm_telemetry import current_stage
+
+
+# 校验器：(请求消息, 响应文本) -> 失败原因，通过时返回 None
+Validator = Callable[[List[Dict[str, str]], str], Optional[str]]
+
+# 默认启用级联的阶段
+DEFAULT_CASCADE_STAGES = ("character", "extraction", "storyboard")
+
+# 请求文本中的标识符（人物 ID 等），按完整标识符比较，避免 char_1 误匹配 char_10
+_IDENTIFIER = re.compile(r"[\w\-]+")
+
+
+# ==================== 校验器 ====================
+
+def _parse(response: str) -> Optional[Dict[str, Any]]:
+    """解析响应（紧凑格式还原为标准字段名），不计入解析遥测"""
+    data = parse_json(response).data
+    return expand_response(data) if isinstance(data, dict) else None
+
+
+def _request_text(messages: List[Dict[str, str]]) -> str:
+    return "\n".join(m.get("content") or "" for m in messages if m.get("role") != "system")
+
+
+def _check_characters(data: Dict[str, Any]) -> Optional[str]:
+    characters = data.get("characters")
+    if not isinstance(characters, list) or not characters:
+        return "没有提取到人物"
+    ids = []
+    for item in characters:
+        if not isinstance(item, dict) or not item.get("id") or not item.get("name"):
+            return "人物缺少 id 或 name"
+        ids.append(item["id"])
+    if len(set(ids)) != len(ids):
+        return "人物 id 重复"
+    return None
+
+
+def validate_characters(messages: List[Dict[str, str]], response: str) -> Optional[str]:
+    """人物提取：至少一个人物，每个人物都有 id 和 name，id 不重复"""
+    data = _parse(response)
+    if data is None:
+        return "响应不是合法的 JSON"
+    return _check_characters(data)
+
+
+def validate_extraction(messages: List[Dict[str, str]], response: str) -> Optional[str]:
+    """融合提取：人物校验同上，关系两端都是返回的人物，至少一个时间线事件"""
+    data = _parse(response)
+    if data is None:
+        return "响应不是合法的 JSON"
+    reason = _check_characters(data)
+    if reason:
+        return reason
+    ids = {item["id"] for item in data["characters"]}
+    for rel in data.get("relationships") or []:
+        if not isinstance(rel, dict) or rel.get("character_id_1") not in ids or rel.get("character_id_2") not in ids:
+            return "关系引用了未提取的人物"
+    if not data.get("events"):
+        return "没有提取到时间线事件"
+    return None
+
+
+def validate_shots(messages: List[Dict[str, str]], response: str) -> Optional[str]:
+    """分镜：至少一个镜头，shot_number（如有）从 1 连续编号，镜头中的人物 ID 都出现在请求中"""
+    data = _parse(response)
+    if data is None:
+        return "响应不是合法的 JSON"
+    shots = data.get("shots")
+    if not isinstance(shots, list) or not shots:
+        return "没有生成镜头"
+    known_ids = set(_IDENTIFIER.findall(_request_text(messages)))
+    for number, shot in enumerate(shots, start=1):
+        if not isinstance(shot, dict) or not shot.get("shot_type") or not shot.get("description"):
+            return "镜头缺少 shot_type 或 description"
+        if shot.get("shot_number", number) != number:
+            return "shot_number 不连续"
+        unknown = [c for c in shot.get("characters_in_shot") or [] if str(c) not in known_ids]
+        if unknown:
+            return f"镜头包含未知人物 {', '.join(map(str, unknown))}"
+    return None
+
+
+DEFAULT_VALIDATORS: Dict[str, Validator] = {
+    "character": validate_characters,
+    "extraction": validate_extraction,
+    "storyboard": validate_shots
+}
+
+
+# ==================== 级联客户端 ====================
+
+class CascadeLLMClient(LLMClient):
+    """先调用廉价模型，结果未通过所在阶段的校验时升级到强模型"""
+
+    def __init__(self, cheap: LLMClient, strong: LLMClient,
+                 stages: Iterable[str] = DEFAULT_CASCADE_STAGES,
+                 validators: Optional[Dict[str, Validator]] = None):
+        """
+        初始化级联客户端
+
+        Args:
+            cheap: 廉价、快速的模型客户端
+            strong: 强模型客户端（未启用级联的阶段直接使用）
+            stages: 启用级联的阶段
+            validators: {阶段: 校验器}，默认使用 DEFAULT_VALIDATORS
+        """
+        super().__init__(getattr(strong, "api_key", None), getattr(strong, "base_url", None))
+        self.cheap = cheap
+        self.strong = strong
+        validators = validators if validators is not None else DEFAULT_VALIDATORS
+        unknown = [stage for stage in stages if stage not in validators]
+        if unknown:
+            raise ValueError(f"以下阶段没有校验器，无法级联：{', '.join(unknown)}")
+        self.validators = {stage: validators[stage] for stage in stages}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _validator(self) -> Optional[Validator]:
+        return self.validators.get(current_stage())
+
+    @property
+    def model(self) -> Optional[str]:
+        # 缓存指纹：级联阶段的结果可能来自任一模型
+        if self._validator() is None:
+            return getattr(self.strong, "model", None)
+        return f"{getattr(self.cheap, 'model', None)}>{getattr(self.strong, 'model', None)}"
+
+    @property
+    def use_json_mode(self) -> bool:
+        return getattr(self.strong, "use_json_mode", False)
+
+    @property
+    def structured_output(self) -> bool:
+        return getattr(self.strong, "structured_output", False)
+
+    def _accept(self, validator: Validator, messages: List[Dict[str, str]], response: str) -> bool:
+        """校验廉价模型的响应并记录统计"""
+        return self._record(validator(messages, response))
+
+    def _reject_error(self, error: Exception) -> None:
+        """廉价模型调用失败（熔断除外）：记为一次升级，由强模型重试"""
+        self._record(f"调用失败：{type(error).__name__}: {error}")
+
+    def _record(self, reason: Optional[str]) -> bool:
+        """记录一次廉价模型调用，reason 非空表示升级到强模型"""
+        stage = current_stage()
+        with self._lock:
+            s = self._stats.setdefault(stage, {"calls": 0, "escalated": 0})
+            s["calls"] += 1
+            if reason:
+                s["escalated"] += 1
+        if reason:
+            print(f"[CASCADE] {stage} 阶段廉价模型的结果未通过（{reason}），"
+                  f"升级到 {getattr(self.strong, 'model', None)}")
+        return reason is None
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        validator = self._validator()
+        if validator is not None:
+            try:
+                response = self.cheap.chat(messages, temperature, **kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                self._reject_error(e)
+            else:
+                if self._accept(validator, messages, response):
+                    return response
+        return self.strong.chat(messages, temperature, **kwargs)
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        validator = self._validator()
+        if validator is not None:
+            try:
+                response = await self.cheap.achat(messages, temperature, **kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                self._reject_error(e)
+            else:
+                if self._accept(validator, messages, response):
+                    return response
+        return await self.strong.achat(messages, temperature, **kwargs)
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        """流式调用：级联阶段需要完整响应才能校验，廉价模型的结果通过后一次性产出"""
+        validator = self._validator()
+        if validator is not None:
+            try:
+                response = "".join(self.cheap.stream_chat(messages, temperature, **kwargs))
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                self._reject_error(e)
+            else:
+                if self._accept(validator, messages, response):
+                    yield response
+                    return
+        yield from self.strong.stream_chat(messages, temperature, **kwargs)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        validator = self._validator()
+        if validator is not None:
+            try:
+                response = "".join([chunk async for chunk in self.cheap.astream_chat(messages, temperature, **kwargs)])
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                self._reject_error(e)
+            else:
+                if self._accept(validator, messages, response):
+                    yield response
+                    return
+        async for chunk in self.strong.astream_chat(messages, temperature, **kwargs):
+            yield chunk
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """{阶段: {calls, escalated, escalation_rate}}"""
+        with self._lock:
+            return {
+                stage: dict(s, escalation_rate=s["escalated"] / s["calls"] if s["calls"] else 0.0)
+                for stage, s in self._stats.items()
+            }
+
+
+def cascade_from_env(strong: LLMClient) -> LLMClient:
+    """
+    根据环境变量为客户端加上模型级联
+
+    LLM_CASCADE_MODEL 为廉价模型（与 LLM_API_KEY / LLM_BASE_URL 同一服务商），
+    LLM_CASCADE_STAGES 为逗号分隔的阶段列表（默认 character,extraction,storyboard）。
+
+    Returns:
+        级联客户端；未配置 LLM_CASCADE_MODEL 时原样返回 strong
+    """
+    model = os.environ.get("LLM_CASCADE_MODEL")
+    if not model:
+        return strong
+    raw = os.environ.get("LLM_CASCADE_STAGES")
+    stages = [s.strip() for s in raw.split(",") if s.strip()] if raw else DEFAULT_CASCADE_STAGES
+    cheap = OpenAICompatibleClient(
+        api_key=os.environ.get("LLM_API_KEY"),
+        base_url=os.environ.get("LLM_BASE_URL"),
+        model=model,
+        use_json_mode=True
+    )
+    return CascadeLLMClient(cheap, strong, stages)
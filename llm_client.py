@@ -0,0 +1,847 @@
+# -*- coding: utf-8 -*-
+"""LLM 客户端层 - 所有阶段共享的调用基础设施
+
+本模块集中定义 LLM 客户端接口及其 OpenAI 兼容实现：
+1. LLMClient / MockLLMClient / OpenAICompatibleClient（extractor、script_generator、
+   storyboard_generator 均从此处导入，不再各自复制一份）
+2. 进程级共享的 HTTP 连接池：同一 (base_url, api_key) 只创建一个底层客户端，
+   复用 keep-alive 连接，在安装了 h2 时启用 HTTP/2
+3. 异步调用：每个客户端都提供 achat 协程，AsyncLLMClient 负责限制并发请求数
+4. 主动限流：发送前向共享的 RPM/TPM 令牌桶预约预算（见 rate_limiter）
+5. 流式调用：stream_chat / astream_chat 逐段产出响应文本，配合 json_stream
+   可以在响应结束前拿到已完成的 JSON 元素
+6. 遥测：每次上游调用记录耗时、首字节时间、token 用量、重试次数和
+   finish_reason（见 llm_telemetry）
+7. 熔断：同一端点连续故障后快速失败，不再逐个走完重试退避（见 circuit_breaker）
+8. 截断检测：响应因输出上限被截断（finish_reason=length）时抛出 ResponseTruncatedError，
+   由调用阶段把工作拆小后重新请求，而不是解析半截内容
+9. 结构化输出：LLM_STRUCTURED_OUTPUT=true 时按当前阶段发送严格 JSON Schema
+   （见 response_schemas），服务端约束解码，不再出现解析失败和回退调用
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import weakref
+from typing import List, Optional, Dict, Any, Tuple, Iterator, AsyncIterator
+
+from rate_limiter import RateLimiter, get_shared_rate_limiter, parse_retry_after
+from adaptive_concurrency import AIMDLimiter, get_shared_concurrency_limiter
+from circuit_breaker import CircuitBreaker, CircuitOpenError, get_shared_circuit_breaker
+from llm_telemetry import (
+    begin_call, begin_attempt, current_stage, end_call, mark_first_byte, sending, response_hook, aresponse_hook
+)
+from compact_format import is_compact_request
+from response_schemas import response_schema
+
+
+# ==================== 共享连接池 ====================
+
+# 默认连接池大小，可通过环境变量 LLM_POOL_SIZE 覆盖
+DEFAULT_POOL_SIZE = 20
+
+# 空闲 keep-alive 连接的保留时间（秒）
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+# 单次请求超时（秒）
+DEFAULT_TIMEOUT = 600.0
+
+# 异步调用的默认最大并发数
+DEFAULT_MAX_CONCURRENCY = 8
+
+# 限流预约时对输出 token 数的预估（实际值在收到 response.usage 后校正）
+DEFAULT_COMPLETION_TOKEN_ESTIMATE = 512
+
+_shared_clients: Dict[Tuple[str, str], Any] = {}
+_shared_clients_lock = threading.Lock()
+
+# 异步客户端绑定在事件循环上，按循环分别缓存；循环被回收后条目自动消失
+_shared_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], Any]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _http2_available() -> bool:
+    """检测是否可以启用 HTTP/2（httpx 需要额外安装 h2 包）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _resolve_pool_size(pool_size: Optional[int]) -> int:
+    """解析连接池大小：显式参数 > 环境变量 LLM_POOL_SIZE > 默认值"""
+    if pool_size:
+        return pool_size
+    try:
+        return int(os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+    except ValueError:
+        return DEFAULT_POOL_SIZE
+
+
+def _http_limits(pool_size: Optional[int]) -> Any:
+    """构建 httpx 连接池限制"""
+    import httpx
+
+    size = _resolve_pool_size(pool_size)
+    return httpx.Limits(
+        max_connections=size,
+        max_keepalive_connections=size,
+        keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY
+    )
+
+
+def get_shared_openai_client(api_key: Optional[str] = None, base_url: Optional[str] = None,
+                             pool_size: Optional[int] = None,
+                             timeout: float = DEFAULT_TIMEOUT) -> Any:
+    """
+    获取进程级共享的 OpenAI 客户端
+
+    同一 (base_url, api_key) 在整个进程内只创建一次，所有提取器和生成器
+    复用同一个连接池，避免每次调用都重新建立 TCP/TLS 连接。
+
+    Args:
+        api_key: API 密钥
+        base_url: API 基础 URL
+        pool_size: 连接池大小（仅在首次创建时生效）
+        timeout: 请求超时（秒，仅在首次创建时生效）
+
+    Returns:
+        openai.OpenAI 实例
+    """
+    key = (base_url or "", api_key or "")
+
+    with _shared_clients_lock:
+        client = _shared_clients.get(key)
+        if client is None:
+            import httpx
+            from openai import OpenAI
+
+            http_client = httpx.Client(
+                http2=_http2_available(),
+                limits=_http_limits(pool_size),
+                timeout=timeout,
+                event_hooks={"response": [response_hook]}
+            )
+            # 重试由 OpenAICompatibleClient 统一负责，关闭 SDK 自带的重试以免叠加
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url if base_url else None,
+                http_client=http_client,
+                max_retries=0
+            )
+            _shared_clients[key] = client
+        return client
+
+
+def get_shared_async_openai_client(api_key: Optional[str] = None, base_url: Optional[str] = None,
+                                   pool_size: Optional[int] = None,
+                                   timeout: float = DEFAULT_TIMEOUT) -> Any:
+    """
+    获取当前事件循环内共享的 AsyncOpenAI 客户端
+
+    与 get_shared_openai_client 相同，但连接池绑定在当前运行的事件循环上，
+    必须在协程中调用。
+
+    Returns:
+        openai.AsyncOpenAI 实例
+    """
+    loop = asyncio.get_running_loop()
+    key = (base_url or "", api_key or "")
+
+    with _shared_clients_lock:
+        clients = _shared_async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            http_client = httpx.AsyncClient(
+                http2=_http2_available(),
+                limits=_http_limits(pool_size),
+                timeout=timeout,
+                event_hooks={"response": [aresponse_hook]}
+            )
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url if base_url else None,
+                http_client=http_client,
+                max_retries=0
+            )
+            clients[key] = client
+        return client
+
+
+def close_shared_clients() -> None:
+    """关闭并清空所有共享的同步客户端（进程退出或测试清理时调用）"""
+    with _shared_clients_lock:
+        clients = list(_shared_clients.values())
+        _shared_clients.clear()
+
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+async def aclose_shared_clients() -> None:
+    """关闭当前事件循环内的共享异步客户端（在 asyncio.run 结束前调用）"""
+    loop = asyncio.get_running_loop()
+    with _shared_clients_lock:
+        clients = list(_shared_async_clients.pop(loop, {}).values())
+
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+# ==================== 请求指纹 ====================
+
+def request_fingerprint(model: Optional[str], messages: List[Dict[str, str]],
+                        temperature: float, json_mode: bool = False,
+                        schema: Optional[str] = None) -> str:
+    """
+    计算请求指纹（内容寻址键）
+
+    相同的模型、消息、温度、JSON 模式和结构化输出 Schema 得到相同的指纹，用于响应缓存等场景。
+
+    Returns:
+        十六进制 SHA-256 摘要
+    """
+    request = {
+        "model": model or "",
+        "messages": messages,
+        "temperature": temperature,
+        "json_mode": bool(json_mode)
+    }
+    if schema:
+        # 未启用结构化输出时不加入该字段，已有的缓存键保持不变
+        request["schema"] = schema
+    payload = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def client_fingerprint(client: "LLMClient", messages: List[Dict[str, str]],
+                       temperature: float, **kwargs) -> str:
+    """按客户端当前配置（model、use_json_mode、structured_output）计算一次 chat 调用的请求指纹"""
+    json_mode = kwargs.get("json_mode", False) or getattr(client, "use_json_mode", False)
+    stage = current_stage()
+    schema = stage if getattr(client, "structured_output", False) and response_schema(stage) else None
+    return request_fingerprint(getattr(client, "model", None), messages, temperature, json_mode, schema)
+
+
+# ==================== Token 估算 ====================
+
+# CJK 统一表意文字、假名、韩文及全角标点
+_CJK_PATTERN = re.compile(
+    "[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    快速估算文本的 token 数（无需分词器）
+
+    中日韩字符按约 1 token/字计算，其余字符按约 4 字符/token 计算，
+    对中文小说文本略微偏高估计，适合用于限流和预算判断。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def estimate_messages_tokens(messages: List[Dict[str, str]]) -> int:
+    """估算一组对话消息的 prompt token 数"""
+    return sum(estimate_tokens(m.get("content") or "") + MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+
+# ==================== LLM 客户端接口 ====================
+
+class ResponseTruncatedError(RuntimeError):
+    """响应在输出上限处被截断（finish_reason=length）
+
+    原样重试只会再次被截断；调用方应把工作拆小后重新请求，无法再拆分时
+    可以修复解析 text 中截断前收到的部分。
+    """
+
+    def __init__(self, text: str, model: Optional[str] = None):
+        super().__init__(f"{model or 'LLM'} 的响应在输出上限处被截断（finish_reason=length，已收到 {len(text)} 字）")
+        self.text = text
+        self.model = model
+
+
+class LLMClient:
+    """LLM 客户端基类 - 可继承实现不同平台的调用"""
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key or os.environ.get("LLM_API_KEY", "")
+        self.base_url = base_url or os.environ.get("LLM_BASE_URL", "")
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+        """发送对话请求并返回响应文本"""
+        raise NotImplementedError("子类必须实现 chat 方法")
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        """
+        异步发送对话请求
+
+        默认实现把同步 chat 放到线程池中执行，因此任何只实现了 chat 的子类
+        都可以直接用于异步流水线；支持原生异步的子类应覆盖此方法。
+        """
+        call = functools.partial(self.chat, messages, temperature, **kwargs)
+        return await asyncio.to_thread(call)
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        """
+        流式发送对话请求，逐段产出响应文本
+
+        默认实现一次性产出 chat 的完整结果；支持流式的子类应覆盖此方法。
+        """
+        yield self.chat(messages, temperature, **kwargs)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        """stream_chat 的异步版本，默认一次性产出 achat 的完整结果"""
+        yield await self.achat(messages, temperature, **kwargs)
+
+
+class MockLLMClient(LLMClient):
+    """Mock LLM 客户端 - 用于测试时无需真实 API 调用"""
+
+    def __init__(self, mock_response: str = ""):
+        super().__init__()
+        self.mock_response = mock_response
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+        """返回预设的 mock 响应"""
+        return self.mock_response
+
+
+class LLMClientWrapper(LLMClient):
+    """包装另一个 LLMClient 的基类
+
+    默认把 chat / achat 原样转发给内部客户端，未定义的属性（如 model、
+    use_json_mode）也从内部客户端读取，子类只需覆盖需要增强的部分。
+    """
+
+    def __init__(self, client: LLMClient):
+        self.client = client
+
+    def __getattr__(self, name: str) -> Any:
+        # 仅在常规属性查找失败时调用；client 尚未设置时避免无限递归
+        if name == "client":
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        return self.client.chat(messages, temperature, **kwargs)
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        return await self.client.achat(messages, temperature, **kwargs)
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        yield from self.client.stream_chat(messages, temperature, **kwargs)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        async for chunk in self.client.astream_chat(messages, temperature, **kwargs):
+            yield chunk
+
+
+class AsyncLLMClient(LLMClientWrapper):
+    """异步并发受限的 LLM 客户端
+
+    achat 在进入内部客户端前先获取信号量，保证同时在途的请求数不超过
+    max_concurrency；同步 chat 不受影响，原样转发。
+    """
+
+    def __init__(self, client: LLMClient, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        """
+        初始化异步客户端
+
+        Args:
+            client: 被包装的 LLM 客户端
+            max_concurrency: 最大在途请求数
+        """
+        super().__init__(client)
+        self.max_concurrency = max(1, max_concurrency)
+        # asyncio.Semaphore 绑定事件循环，按循环分别创建
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        async with self._get_semaphore():
+            return await self.client.achat(messages, temperature, **kwargs)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        # 整个流读取期间都占用一个并发名额
+        async with self._get_semaphore():
+            async for chunk in self.client.astream_chat(messages, temperature, **kwargs):
+                yield chunk
+
+
+class OpenAICompatibleClient(LLMClient):
+    """OpenAI 兼容 API 客户端 - 支持原生 JSON Structured Output、连接池复用和自动重试"""
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                 model: str = "gpt-4o-mini", use_json_mode: bool = True,
+                 max_retries: int = 3, retry_delay: float = 1.0,
+                 pool_size: Optional[int] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 structured_output: Optional[bool] = None,
+                 concurrency_limiter: Optional[AIMDLimiter] = None):
+        """
+        初始化 OpenAI 兼容客户端
+
+        Args:
+            api_key: API 密钥
+            base_url: API 基础 URL
+            model: 模型名称
+            use_json_mode: 是否启用 JSON 结构化输出（response_format=json_object）
+            max_retries: 最大重试次数
+            retry_delay: 基础重试延迟（秒），实际延迟按指数退避计算
+            pool_size: 共享连接池大小（默认读取 LLM_POOL_SIZE）
+            rate_limiter: 限流器（默认使用按 LLM_RPM / LLM_TPM 配置的进程级共享限流器）
+            circuit_breaker: 熔断器（默认使用同一 base_url + api_key 共享的熔断器）
+            structured_output: 是否按当前阶段发送严格 JSON Schema（response_format=json_schema，
+                默认读取 LLM_STRUCTURED_OUTPUT）；没有固定响应结构的调用仍使用 JSON 模式
+            concurrency_limiter: 自适应并发控制器（默认在 LLM_ADAPTIVE_CONCURRENCY 启用时
+                使用同一 base_url + api_key 共享的控制器），每次尝试占用一个名额
+        """
+        super().__init__(api_key, base_url)
+        self.model = model
+        self.use_json_mode = use_json_mode
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter if rate_limiter is not None else \
+            get_shared_rate_limiter(self.base_url, self.api_key)
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else \
+            get_shared_circuit_breaker(self.base_url, self.api_key)
+        self.concurrency_limiter = concurrency_limiter if concurrency_limiter is not None else \
+            get_shared_concurrency_limiter(self.base_url, self.api_key)
+        if structured_output is None:
+            structured_output = os.environ.get("LLM_STRUCTURED_OUTPUT", "false").lower() in ("1", "true", "yes")
+        self.structured_output = structured_output
+
+    def _get_client(self) -> Any:
+        """获取共享的底层 OpenAI 客户端"""
+        return get_shared_openai_client(self.api_key, self.base_url, self.pool_size)
+
+    def _get_async_client(self) -> Any:
+        """获取当前事件循环内共享的底层 AsyncOpenAI 客户端"""
+        return get_shared_async_openai_client(self.api_key, self.base_url, self.pool_size)
+
+    def build_request(self, messages: List[Dict[str, str]], temperature: float,
+                       json_mode: bool) -> Dict[str, Any]:
+        """构建 chat.completions.create 的请求参数"""
+        schema = response_schema(current_stage(), is_compact_request(messages)) if self.structured_output else None
+        json_mode = json_mode or schema is not None
+
+        # 启用 JSON 模式（原生结构化输出）
+        if self.use_json_mode or json_mode:
+            # 同时添加系统提示强化 JSON 要求
+            if messages and messages[0].get("role") != "system":
+                messages = [{
+                    "role": "system",
+                    "content": "You must respond with valid JSON only. No other text, no markdown code blocks."
+                }] + messages
+
+        request_kwargs = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature
+        }
+
+        if schema is not None:
+            # 严格 JSON Schema：服务端约束解码，响应一定符合该阶段的结构
+            request_kwargs["response_format"] = schema
+        elif self.use_json_mode or json_mode:
+            request_kwargs["response_format"] = {"type": "json_object"}
+
+        return request_kwargs
+
+    def _estimate_request_tokens(self, request_kwargs: Dict[str, Any]) -> int:
+        """预估一次请求的 token 消耗（prompt + 预期输出），用于限流预约"""
+        return estimate_messages_tokens(request_kwargs["messages"]) + DEFAULT_COMPLETION_TOKEN_ESTIMATE
+
+    def _release_tokens(self, estimated_tokens: int) -> None:
+        """请求未成功时退还预约的 token 预算（失败的请求不计入服务端 TPM）"""
+        if self.rate_limiter:
+            self.rate_limiter.reconcile(estimated_tokens, 0)
+
+    def _release_slot(self, slot: Optional[float], error: Optional[BaseException] = None,
+                      latency: Optional[float] = None) -> None:
+        """归还自适应并发名额（429 和延迟尖峰会降低上限）"""
+        if slot is not None:
+            self.concurrency_limiter.release(slot, error, latency)
+
+    def _reconcile_usage(self, estimated_tokens: int, response: Any) -> None:
+        """用 response.usage 中的实际 token 数校正限流器"""
+        usage = getattr(response, "usage", None)
+        total_tokens = getattr(usage, "total_tokens", None)
+        if self.rate_limiter and total_tokens is not None:
+            self.rate_limiter.reconcile(estimated_tokens, total_tokens)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        根据异常类型决定是否重试
+
+        Returns:
+            重试前应等待的秒数；不应重试时返回 None（调用方应重新抛出异常）
+
+        Retries:
+            使用指数退避策略进行重试：
+            - HTTP 429 (Rate Limit): 重试
+            - HTTP 5xx (Server Error): 重试
+            - Connection Error: 重试
+            - HTTP 4xx (Client Error): 不重试
+        """
+        from openai import APIStatusError, APIConnectionError
+
+        can_retry = attempt < self.max_retries
+        # 指数退避 + 抖动
+        delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
+
+        if isinstance(error, APIStatusError):
+            status_code = error.status_code
+
+            # 服务端给出 Retry-After 时按其等待，并暂停共享限流器，让其他线程一起让出
+            retry_after = parse_retry_after(error) if status_code == 429 or status_code >= 500 else None
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, 0.1)
+                if self.rate_limiter:
+                    self.rate_limiter.penalize(retry_after)
+
+            # 429 Rate Limit - 需要重试
+            if status_code == 429:
+                if can_retry:
+                    print(f"[RETRY] 遇到限流 (429)，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
+                    return delay
+                print(f"[ERROR] 达到最大重试次数，限流错误仍未解决")
+                return None
+
+            # 5xx Server Error - 需要重试
+            if 500 <= status_code < 600:
+                if can_retry:
+                    print(f"[RETRY] 服务器错误 ({status_code})，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
+                    return delay
+                print(f"[ERROR] 达到最大重试次数，服务器错误仍未解决")
+                return None
+
+            # 4xx Client Error - 不重试，直接抛出
+            print(f"[ERROR] 客户端错误 ({status_code}): {error}")
+            return None
+
+        if isinstance(error, APIConnectionError):
+            if can_retry:
+                print(f"[RETRY] 连接错误，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
+                return delay
+            print(f"[ERROR] 达到最大重试次数，连接错误仍未解决")
+            return None
+
+        if can_retry:
+            print(f"[RETRY] 未知错误 ({type(error).__name__})，{delay:.1f}秒后重试... (尝试 {attempt + 1}/{self.max_retries})")
+            return delay
+        print(f"[ERROR] 达到最大重试次数，错误仍未解决")
+        return None
+
+    def _check_circuit(self, record: Any, request_kwargs: Dict[str, Any]) -> None:
+        """熔断器打开时快速失败，不访问网络也不再重试"""
+        if self.circuit_breaker is None:
+            return
+        try:
+            self.circuit_breaker.allow()
+        except CircuitOpenError as e:
+            end_call(record, error=e, messages=request_kwargs["messages"])
+            raise
+
+    def _failure_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """把失败计入熔断器，再决定是否重试；熔断器因此打开时不再重试"""
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(error)
+            if self.circuit_breaker.is_open:
+                return None
+        return self._retry_delay(error, attempt)
+
+    def _record_success(self) -> None:
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+
+    def _record_failure(self, error: Exception) -> None:
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(error)
+
+    def _check_truncated(self, response: Any, content: Optional[str]) -> None:
+        """响应因输出上限被截断时抛出 ResponseTruncatedError（不重试，也不计入熔断器）"""
+        if response.choices[0].finish_reason == "length":
+            raise ResponseTruncatedError(content or "", self.model)
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+             json_mode: bool = False) -> str:
+        """
+        调用 OpenAI 兼容 API（带自动重试）
+
+        Args:
+            messages: 对话消息列表
+            temperature: 温度参数
+            json_mode: 是否强制使用 JSON 模式（覆盖实例变量）
+        """
+        try:
+            import openai  # noqa: F401
+        except ImportError:
+            raise ImportError("请安装 openai 包：pip install openai")
+
+        request_kwargs = self.build_request(messages, temperature, json_mode)
+        estimated_tokens = self._estimate_request_tokens(request_kwargs)
+        record = begin_call(self.model, self.base_url)
+
+        for attempt in range(self.max_retries + 1):
+            begin_attempt(record, attempt)
+            self._check_circuit(record, request_kwargs)
+            if self.rate_limiter:
+                self.rate_limiter.acquire(estimated_tokens)
+            slot = self.concurrency_limiter.acquire() if self.concurrency_limiter else None
+            try:
+                with sending(record):
+                    response = self._get_client().chat.completions.create(**request_kwargs)
+            except BaseException as e:
+                self._release_slot(slot, e)
+                if not isinstance(e, Exception):
+                    raise
+                self._release_tokens(estimated_tokens)
+                delay = self._failure_delay(e, attempt)
+                if delay is None:
+                    end_call(record, error=e, messages=request_kwargs["messages"])
+                    raise
+                time.sleep(delay)
+                continue
+
+            self._release_slot(slot)
+            self._record_success()
+            self._reconcile_usage(estimated_tokens, response)
+            content = response.choices[0].message.content
+            end_call(record, response, messages=request_kwargs["messages"], text=content)
+            self._check_truncated(response, content)
+            return content
+
+        # 理论上不会到达这里，但为了完整性
+        raise RuntimeError("重试循环异常退出")
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    json_mode: bool = False) -> str:
+        """
+        异步调用 OpenAI 兼容 API（带自动重试）
+
+        与 chat 行为一致，但使用共享的 AsyncOpenAI 连接池，等待期间不占用线程。
+        """
+        try:
+            import openai  # noqa: F401
+        except ImportError:
+            raise ImportError("请安装 openai 包：pip install openai")
+
+        request_kwargs = self.build_request(messages, temperature, json_mode)
+        estimated_tokens = self._estimate_request_tokens(request_kwargs)
+        record = begin_call(self.model, self.base_url)
+
+        for attempt in range(self.max_retries + 1):
+            begin_attempt(record, attempt)
+            self._check_circuit(record, request_kwargs)
+            if self.rate_limiter:
+                await self.rate_limiter.aacquire(estimated_tokens)
+            slot = await self.concurrency_limiter.aacquire() if self.concurrency_limiter else None
+            try:
+                with sending(record):
+                    response = await self._get_async_client().chat.completions.create(**request_kwargs)
+            except BaseException as e:
+                self._release_slot(slot, e)
+                if not isinstance(e, Exception):
+                    raise
+                self._release_tokens(estimated_tokens)
+                delay = self._failure_delay(e, attempt)
+                if delay is None:
+                    end_call(record, error=e, messages=request_kwargs["messages"])
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            self._release_slot(slot)
+            self._record_success()
+            self._reconcile_usage(estimated_tokens, response)
+            content = response.choices[0].message.content
+            end_call(record, response, messages=request_kwargs["messages"], text=content)
+            self._check_truncated(response, content)
+            return content
+
+        raise RuntimeError("重试循环异常退出")
+
+    def _reconcile_streamed(self, estimated_tokens: int, request_kwargs: Dict[str, Any],
+                            received: List[str]) -> None:
+        """流式响应没有 usage 字段，按已收到的文本估算实际消耗并校正限流器"""
+        if self.rate_limiter:
+            actual = estimate_messages_tokens(request_kwargs["messages"]) + estimate_tokens("".join(received))
+            self.rate_limiter.reconcile(estimated_tokens, actual)
+
+    def _check_stream_truncated(self, record: Any, received: List[str]) -> None:
+        """流式响应的最后一个 finish_reason 为 length 时抛出 ResponseTruncatedError"""
+        if record.finish_reason == "length":
+            raise ResponseTruncatedError("".join(received), self.model)
+
+    @staticmethod
+    def _track_chunk(record: Any, chunk: Any) -> None:
+        """流式分片到达时更新遥测：首个分片即首字节时间，记录 finish_reason"""
+        mark_first_byte(record)
+        if chunk.choices and chunk.choices[0].finish_reason:
+            record.finish_reason = chunk.choices[0].finish_reason
+
+    @staticmethod
+    def _delta_text(chunk: Any) -> Optional[str]:
+        """取出流式分片中的增量文本"""
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.content
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    json_mode: bool = False) -> Iterator[str]:
+        """
+        流式调用 OpenAI 兼容 API，逐段产出服务端推送的增量文本
+
+        只在建立流之前的错误上重试；开始产出文本后出错会直接抛出，
+        因为调用方可能已经消费了部分内容。
+        """
+        request_kwargs = self.build_request(messages, temperature, json_mode)
+        request_kwargs["stream"] = True
+        estimated_tokens = self._estimate_request_tokens(request_kwargs)
+        record = begin_call(self.model, self.base_url, streamed=True)
+
+        for attempt in range(self.max_retries + 1):
+            begin_attempt(record, attempt)
+            self._check_circuit(record, request_kwargs)
+            if self.rate_limiter:
+                self.rate_limiter.acquire(estimated_tokens)
+            slot = self.concurrency_limiter.acquire() if self.concurrency_limiter else None
+            try:
+                stream = self._get_client().chat.completions.create(**request_kwargs)
+            except BaseException as e:
+                self._release_slot(slot, e)
+                if not isinstance(e, Exception):
+                    raise
+                self._release_tokens(estimated_tokens)
+                delay = self._failure_delay(e, attempt)
+                if delay is None:
+                    end_call(record, error=e, messages=request_kwargs["messages"])
+                    raise
+                time.sleep(delay)
+                continue
+
+            received: List[str] = []
+            error: Optional[BaseException] = None
+            try:
+                for chunk in stream:
+                    self._track_chunk(record, chunk)
+                    text = self._delta_text(chunk)
+                    if text:
+                        received.append(text)
+                        yield text
+            except Exception as e:
+                error = e
+                # 读取响应体时的失败（读超时、连接断开）同样计入熔断器
+                self._record_failure(e)
+                raise
+            else:
+                # 响应体完整读完才算成功
+                self._record_success()
+            finally:
+                stream.close()
+                # 整个流读取期间都占用名额，延迟样本取首字节时间
+                self._release_slot(slot, error, record.ttfb_seconds)
+                self._reconcile_streamed(estimated_tokens, request_kwargs, received)
+                end_call(record, error=error, messages=request_kwargs["messages"], text="".join(received))
+            # 与 chat 一致：流在输出上限处结束时抛出 ResponseTruncatedError，携带已收到的文本
+            self._check_stream_truncated(record, received)
+            return
+
+        raise RuntimeError("重试循环异常退出")
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           json_mode: bool = False) -> AsyncIterator[str]:
+        """stream_chat 的异步版本，使用共享的 AsyncOpenAI 连接池"""
+        request_kwargs = self.build_request(messages, temperature, json_mode)
+        request_kwargs["stream"] = True
+        estimated_tokens = self._estimate_request_tokens(request_kwargs)
+        record = begin_call(self.model, self.base_url, streamed=True)
+
+        for attempt in range(self.max_retries + 1):
+            begin_attempt(record, attempt)
+            self._check_circuit(record, request_kwargs)
+            if self.rate_limiter:
+                await self.rate_limiter.aacquire(estimated_tokens)
+            slot = await self.concurrency_limiter.aacquire() if self.concurrency_limiter else None
+            try:
+                stream = await self._get_async_client().chat.completions.create(**request_kwargs)
+            except BaseException as e:
+                self._release_slot(slot, e)
+                if not isinstance(e, Exception):
+                    raise
+                self._release_tokens(estimated_tokens)
+                delay = self._failure_delay(e, attempt)
+                if delay is None:
+                    end_call(record, error=e, messages=request_kwargs["messages"])
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            received: List[str] = []
+            error: Optional[BaseException] = None
+            try:
+                async for chunk in stream:
+                    self._track_chunk(record, chunk)
+                    text = self._delta_text(chunk)
+                    if text:
+                        received.append(text)
+                        yield text
+            except Exception as e:
+                error = e
+                # 读取响应体时的失败（读超时、连接断开）同样计入熔断器
+                self._record_failure(e)
+                raise
+            else:
+                # 响应体完整读完才算成功
+                self._record_success()
+            finally:
+                await stream.close()
+                self._release_slot(slot, error, record.ttfb_seconds)
+                self._reconcile_streamed(estimated_tokens, request_kwargs, received)
+                end_call(record, error=error, messages=request_kwargs["messages"], text="".join(received))
+            self._check_stream_truncated(record, received)
+            return
+
+        raise RuntimeError("重试循环异常退出")
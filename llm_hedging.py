@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""对冲请求（hedged requests）- 削减 LLM 调用的长尾延迟
+
+顺序处理章节时，一次落在 p99 长尾里的慢调用会拖住整部小说。
+HedgedLLMClient 按阶段（llm_stage 标签）记录最近的调用延迟：
+一次调用超过所在阶段的 p95 仍未返回时，再发出一个相同的请求，
+取先返回的结果，另一个请求被取消（异步）或结果被丢弃（同步线程无法中断）。
+
+额外成本有上限：对冲请求数不超过总调用数 × max_extra_ratio；
+样本不足 min_samples 的阶段不做对冲。流式调用原样转发。
+
+对冲层应直接包在真实客户端外面（缓存、录制、请求合并之内），
+这样重复请求确实会发往服务端，而不会被单飞层合并掉。
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from llm_client import LLMClient, LLMClientWrapper
+from llm_telemetry import current_stage
+
+
+# 默认参数
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_MAX_EXTRA_RATIO = 0.1
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_WINDOW = 200
+
+
+class StageLatencyTracker:
+    """按阶段记录最近 N 次调用延迟，线程安全"""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def count(self, stage: str) -> int:
+        with self._lock:
+            return len(self._samples.get(stage, ()))
+
+    def percentile(self, stage: str, q: float) -> Optional[float]:
+        """阶段延迟的分位数；没有样本时返回 None"""
+        with self._lock:
+            values = sorted(self._samples.get(stage, ()))
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class HedgedLLMClient(LLMClientWrapper):
+    """超过阶段 p95 仍未返回时发出对冲请求，取先返回的结果"""
+
+    def __init__(self, client: LLMClient,
+                 percentile: float = DEFAULT_HEDGE_PERCENTILE,
+                 max_extra_ratio: float = DEFAULT_MAX_EXTRA_RATIO,
+                 min_samples: int = DEFAULT_MIN_SAMPLES,
+                 min_delay: float = 0.0,
+                 tracker: Optional[StageLatencyTracker] = None,
+                 max_workers: int = 32):
+        """
+        初始化对冲客户端
+
+        Args:
+            client: 被包装的（真实）LLM 客户端
+            percentile: 触发对冲的延迟分位数
+            max_extra_ratio: 对冲请求数占总调用数的上限（额外成本上限）
+            min_samples: 阶段累计样本数达到该值后才开始对冲
+            min_delay: 对冲等待时间的下限（秒），避免对很快的调用也发重复请求
+            tracker: 延迟记录器（默认新建）
+            max_workers: 同步调用使用的线程池大小
+        """
+        super().__init__(client)
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.tracker = tracker or StageLatencyTracker()
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    # ---------- 对冲策略 ----------
+
+    def hedge_delay(self, stage: str) -> Optional[float]:
+        """阶段的对冲等待时间；样本不足时返回 None（不对冲）"""
+        if self.tracker.count(stage) < self.min_samples:
+            return None
+        threshold = self.tracker.percentile(stage, self.percentile)
+        return max(self.min_delay, threshold or 0.0)
+
+    def _begin(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def _reserve_hedge(self) -> bool:
+        """在额外成本预算内预约一次对冲请求"""
+        with self._lock:
+            if self.hedged + 1 > self.calls * self.max_extra_ratio:
+                return False
+            self.hedged += 1
+            return True
+
+    def _won(self, is_hedge: bool) -> None:
+        if is_hedge:
+            with self._lock:
+                self.hedge_wins += 1
+
+    # ---------- 同步调用 ----------
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="llm-hedge")
+            return self._executor
+
+    def _submit(self, stage: str, messages: List[Dict[str, str]], temperature: float,
+                kwargs: Dict[str, Any]) -> Future:
+        def timed() -> Tuple[str, float]:
+            start = time.perf_counter()
+            result = self.client.chat(messages, temperature, **kwargs)
+            elapsed = time.perf_counter() - start
+            self.tracker.observe(stage, elapsed)
+            return result, elapsed
+
+        # 线程池中保留调用方的上下文（阶段标签等）
+        context = contextvars.copy_context()
+        return self._get_executor().submit(context.run, timed)
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        stage = current_stage()
+        delay = self.hedge_delay(stage)
+        self._begin()
+        if delay is None:
+            start = time.perf_counter()
+            result = self.client.chat(messages, temperature, **kwargs)
+            self.tracker.observe(stage, time.perf_counter() - start)
+            return result
+
+        primary = self._submit(stage, messages, temperature, kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._reserve_hedge():
+            return primary.result()[0]
+
+        hedge = self._submit(stage, messages, temperature, kwargs)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # 落选的请求无法中断，只丢弃其结果
+                    for other in pending:
+                        other.cancel()
+                    self._won(future is hedge)
+                    return future.result()[0]
+                error = error or future.exception()
+        raise error
+
+    # ---------- 异步调用 ----------
+
+    async def _atimed(self, stage: str, messages: List[Dict[str, str]], temperature: float,
+                      kwargs: Dict[str, Any]) -> str:
+        start = time.perf_counter()
+        result = await self.client.achat(messages, temperature, **kwargs)
+        self.tracker.observe(stage, time.perf_counter() - start)
+        return result
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        stage = current_stage()
+        delay = self.hedge_delay(stage)
+        self._begin()
+        if delay is None:
+            return await self._atimed(stage, messages, temperature, kwargs)
+
+        primary = asyncio.ensure_future(self._atimed(stage, messages, temperature, kwargs))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done or not self._reserve_hedge():
+                return await primary
+
+            hedge = asyncio.ensure_future(self._atimed(stage, messages, temperature, kwargs))
+            pending.add(hedge)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._won(task is hedge)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # 取消落选（或调用方被取消时仍在途）的请求
+            for task in pending:
+                task.cancel()
+
+    # ---------- 统计 ----------
+
+    def stats(self) -> Dict[str, Any]:
+        """返回对冲统计"""
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "extra_ratio": self.hedged / self.calls if self.calls else 0.0
+        }
+
+    def close(self) -> None:
+        """关闭同步调用使用的线程池（不等待落选的请求）"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
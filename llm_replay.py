@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""LLM 调用录制与回放
+
+RecordingLLMClient 把每次真实的请求/响应写入 cassette 文件（JSON Lines）；
+ReplayLLMClient 按请求内容指纹把录制的响应原样返回，可选按录制时的延迟等待。
+这样可以在没有网络的机器上，用一部真实小说的完整流量对
+LongNovelProcessor 的改动做可重复的基准测试。
+
+cassette 每行一条记录：
+    {"key": 内容指纹, "model": 模型, "temperature": 温度, "stage": 阶段,
+     "messages": [...], "response": 响应文本, "latency": 秒}
+
+内容指纹只包含消息与温度（不含模型），因此同一份 cassette 可以在
+路由、分阶段模型等配置变化后继续回放；同一 prompt 录制了多个模型时，
+优先返回与回放客户端 model 相同的记录。
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from llm_client import LLMClient, LLMClientWrapper, request_fingerprint
+from llm_telemetry import current_stage
+
+
+def replay_key(messages: List[Dict[str, str]], temperature: float) -> str:
+    """cassette 中使用的内容指纹（与模型无关）"""
+    return request_fingerprint(None, messages, temperature)
+
+
+class CassetteMissError(KeyError):
+    """回放时 cassette 中没有对应请求的录制"""
+
+
+class RecordingLLMClient(LLMClientWrapper):
+    """把经过的每次调用追加写入 cassette 文件"""
+
+    def __init__(self, client: LLMClient, path: str):
+        """
+        初始化录制客户端
+
+        Args:
+            client: 被包装的（真实）LLM 客户端
+            path: cassette 文件路径，已存在时追加写入
+        """
+        super().__init__(client)
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, messages: List[Dict[str, str]], temperature: float,
+               response: str, latency: float) -> None:
+        entry = {
+            "key": replay_key(messages, temperature),
+            "model": getattr(self.client, "model", None),
+            "temperature": temperature,
+            "stage": current_stage(),
+            "messages": messages,
+            "response": response,
+            "latency": round(latency, 4)
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.recorded += 1
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        start = time.perf_counter()
+        response = self.client.chat(messages, temperature, **kwargs)
+        self._write(messages, temperature, response, time.perf_counter() - start)
+        return response
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        start = time.perf_counter()
+        response = await self.client.achat(messages, temperature, **kwargs)
+        self._write(messages, temperature, response, time.perf_counter() - start)
+        return response
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        start = time.perf_counter()
+        received = []
+        for chunk in self.client.stream_chat(messages, temperature, **kwargs):
+            received.append(chunk)
+            yield chunk
+        self._write(messages, temperature, "".join(received), time.perf_counter() - start)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        received = []
+        async for chunk in self.client.astream_chat(messages, temperature, **kwargs):
+            received.append(chunk)
+            yield chunk
+        self._write(messages, temperature, "".join(received), time.perf_counter() - start)
+
+
+def load_cassette(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """读取 cassette 文件，按内容指纹分组（保持录制顺序），跳过损坏的行"""
+    entries: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries.setdefault(entry["key"], []).append(entry)
+    return entries
+
+
+class ReplayLLMClient(LLMClient):
+    """从 cassette 文件回放录制的响应，无需网络"""
+
+    def __init__(self, path: str, latency_scale: float = 0.0,
+                 fallback: Optional[LLMClient] = None,
+                 model: Optional[str] = None, use_json_mode: bool = True):
+        """
+        初始化回放客户端
+
+        Args:
+            path: cassette 文件路径
+            latency_scale: 按录制延迟 × 该系数等待后再返回（0 表示立即返回）
+            fallback: 未录制的请求交给该客户端处理；为 None 时抛出 CassetteMissError
+            model: 优先回放该模型的录制（默认不区分模型）
+            use_json_mode: 暴露给缓存等包装层的 JSON 模式标记
+        """
+        super().__init__()
+        self.path = path
+        self.latency_scale = latency_scale
+        self.fallback = fallback
+        self.model = model
+        self.use_json_mode = use_json_mode
+        self._entries = load_cassette(path)
+        # 同一 prompt 录制了多次时按顺序轮流返回
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._entries.values())
+
+    def _lookup(self, messages: List[Dict[str, str]], temperature: float) -> Optional[Dict[str, Any]]:
+        key = replay_key(messages, temperature)
+        with self._lock:
+            candidates = self._entries.get(key)
+            if not candidates:
+                self.misses += 1
+                return None
+            if self.model:
+                candidates = [e for e in candidates if e.get("model") == self.model] or candidates
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            self.hits += 1
+            return candidates[cursor % len(candidates)]
+
+    def _miss(self, messages: List[Dict[str, str]]) -> CassetteMissError:
+        preview = (messages[-1].get("content") or "")[:60] if messages else ""
+        return CassetteMissError(f"cassette {self.path} 中没有该请求的录制：{preview!r}")
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        entry = self._lookup(messages, temperature)
+        if entry is None:
+            if self.fallback is None:
+                raise self._miss(messages)
+            return self.fallback.chat(messages, temperature, **kwargs)
+        if self.latency_scale > 0:
+            time.sleep(entry.get("latency", 0.0) * self.latency_scale)
+        return entry["response"]
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        entry = self._lookup(messages, temperature)
+        if entry is None:
+            if self.fallback is None:
+                raise self._miss(messages)
+            return await self.fallback.achat(messages, temperature, **kwargs)
+        if self.latency_scale > 0:
+            await asyncio.sleep(entry.get("latency", 0.0) * self.latency_scale)
+        return entry["response"]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回回放命中统计"""
+        return {"recorded": len(self), "hits": self.hits, "misses": self.misses}
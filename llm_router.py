@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""多端点路由 - 按延迟与错误率选择后端并自动故障转移
+
+同时接入多个 OpenAI 兼容后端（如 DashScope 与自建服务）时，
+RouterLLMClient 为每个端点维护延迟和错误率的指数加权移动平均（EWMA），
+每次调用优先发往得分最好的健康端点；遇到 5xx、429 或连接错误时
+立即转到下一个端点，并让出错端点冷却一段时间。
+这样单个变慢或故障的服务商不会拖慢整条流水线。
+
+端点列表可通过环境变量 LLM_ENDPOINTS 配置（JSON 数组），见 endpoints_from_env。
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from circuit_breaker import CircuitOpenError
+from llm_client import LLMClient, OpenAICompatibleClient, ResponseTruncatedError
+
+
+# EWMA 平滑系数：越大越偏重最近的调用
+DEFAULT_EWMA_ALPHA = 0.3
+
+# 端点连续失败后的基础冷却时间（秒），按连续失败次数指数增长
+DEFAULT_COOLDOWN = 5.0
+
+# 冷却时间上限（秒）
+MAX_COOLDOWN = 120.0
+
+
+def is_failover_error(error: Exception) -> bool:
+    """
+    判断异常是否应转到其他端点
+
+    5xx、429、连接/超时错误（APIConnectionError）和该端点熔断器已打开说明问题出在该端点；
+    其余 4xx、响应截断和本地代码抛出的异常换端点也无济于事，原样抛出。
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    if isinstance(error, ResponseTruncatedError):
+        return False
+    try:
+        from openai import APIConnectionError, APIStatusError
+    except ImportError:
+        return False
+
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+class EndpointState:
+    """单个端点的健康状态与延迟统计（由 RouterLLMClient 加锁访问）"""
+
+    def __init__(self, client: LLMClient, name: str):
+        self.client = client
+        self.name = name
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def score(self) -> float:
+        """期望延迟得分，越小越好；尚无样本的端点得分为 0，会被优先试探"""
+        if self.latency_ewma is None:
+            return 0.0
+        return self.latency_ewma / max(0.05, 1.0 - self.error_ewma)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "failures": self.failures,
+            "latency_ewma": self.latency_ewma,
+            "error_rate": self.error_ewma,
+            "cooldown_until": self.cooldown_until
+        }
+
+
+class RouterLLMClient(LLMClient):
+    """在多个 LLM 客户端之间按延迟路由并故障转移"""
+
+    def __init__(self, clients: List[LLMClient], names: Optional[List[str]] = None,
+                 alpha: float = DEFAULT_EWMA_ALPHA, cooldown: float = DEFAULT_COOLDOWN,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        初始化路由客户端
+
+        Args:
+            clients: 各端点的 LLM 客户端（通常是不同 base_url/model 的 OpenAICompatibleClient）
+            names: 端点名称（用于统计输出，默认取 base_url 或序号）
+            alpha: EWMA 平滑系数
+            cooldown: 端点失败后的基础冷却时间（秒）
+            clock: 单调时钟（测试时可替换）
+        """
+        if not clients:
+            raise ValueError("RouterLLMClient 至少需要一个端点")
+        super().__init__()
+        names = names or [getattr(c, "base_url", "") or f"endpoint_{i}" for i, c in enumerate(clients)]
+        self.endpoints = [EndpointState(c, n) for c, n in zip(clients, names)]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        # 供缓存等包装层计算请求指纹：路由结果可能来自任一模型
+        models = sorted({str(getattr(c, "model", "")) for c in clients})
+        self.model = "|".join(models)
+        self.use_json_mode = any(getattr(c, "use_json_mode", False) for c in clients)
+        self.structured_output = any(getattr(c, "structured_output", False) for c in clients)
+
+    def _ranked(self) -> List[EndpointState]:
+        """按健康状态和得分排序：健康端点在前，冷却中的端点作为最后手段"""
+        now = self._clock()
+        with self._lock:
+            return sorted(self.endpoints, key=lambda e: (not e.is_healthy(now), e.score()))
+
+    def _record_success(self, endpoint: EndpointState, latency: float) -> None:
+        with self._lock:
+            endpoint.calls += 1
+            if endpoint.latency_ewma is None:
+                endpoint.latency_ewma = latency
+            else:
+                endpoint.latency_ewma += self.alpha * (latency - endpoint.latency_ewma)
+            endpoint.error_ewma *= 1.0 - self.alpha
+            endpoint.consecutive_failures = 0
+            endpoint.cooldown_until = 0.0
+
+    def _record_failure(self, endpoint: EndpointState, error: Exception) -> None:
+        with self._lock:
+            endpoint.calls += 1
+            endpoint.failures += 1
+            endpoint.error_ewma += self.alpha * (1.0 - endpoint.error_ewma)
+            endpoint.consecutive_failures += 1
+            cooldown = min(MAX_COOLDOWN, self.cooldown * (2 ** (endpoint.consecutive_failures - 1)))
+            endpoint.cooldown_until = self._clock() + cooldown
+        print(f"[ROUTER] 端点 {endpoint.name} 调用失败（{type(error).__name__}），"
+              f"冷却 {cooldown:.0f} 秒并切换到下一个端点")
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        last_error: Optional[Exception] = None
+        for endpoint in self._ranked():
+            start = self._clock()
+            try:
+                response = endpoint.client.chat(messages, temperature, **kwargs)
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                self._record_failure(endpoint, e)
+                last_error = e
+                continue
+            self._record_success(endpoint, self._clock() - start)
+            return response
+        raise last_error
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        last_error: Optional[Exception] = None
+        for endpoint in self._ranked():
+            start = self._clock()
+            try:
+                response = await endpoint.client.achat(messages, temperature, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                self._record_failure(endpoint, e)
+                last_error = e
+                continue
+            self._record_success(endpoint, self._clock() - start)
+            return response
+        raise last_error
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        """流式调用：只在收到第一段文本之前故障转移"""
+        last_error: Optional[Exception] = None
+        for endpoint in self._ranked():
+            start = self._clock()
+            stream = endpoint.client.stream_chat(messages, temperature, **kwargs)
+            try:
+                first = next(stream, None)
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                self._record_failure(endpoint, e)
+                last_error = e
+                continue
+            # 以首字节时间作为流式调用的延迟样本
+            self._record_success(endpoint, self._clock() - start)
+            if first is not None:
+                yield first
+            yield from stream
+            return
+        raise last_error
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        last_error: Optional[Exception] = None
+        for endpoint in self._ranked():
+            start = self._clock()
+            stream = endpoint.client.astream_chat(messages, temperature, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                self._record_failure(endpoint, e)
+                last_error = e
+                continue
+            self._record_success(endpoint, self._clock() - start)
+            if first is not None:
+                yield first
+                async for chunk in stream:
+                    yield chunk
+            return
+        raise last_error
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """返回各端点的调用统计"""
+        with self._lock:
+            return [e.stats() for e in self.endpoints]
+
+
+def endpoints_from_env() -> Optional[RouterLLMClient]:
+    """
+    根据环境变量 LLM_ENDPOINTS 创建路由客户端
+
+    LLM_ENDPOINTS 为 JSON 数组，每项可包含 base_url、model、api_key、name；
+    省略的 api_key / model 使用 LLM_API_KEY / LLM_MODEL。例如：
+        [{"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "qwen-plus"},
+         {"base_url": "http://10.0.0.5:8000/v1", "model": "qwen2.5-72b", "api_key": "none"}]
+
+    Returns:
+        路由客户端；未配置 LLM_ENDPOINTS 时返回 None
+    """
+    raw = os.environ.get("LLM_ENDPOINTS")
+    if not raw:
+        return None
+    try:
+        specs = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"LLM_ENDPOINTS 不是合法的 JSON：{e}")
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("LLM_ENDPOINTS 必须是非空的 JSON 数组")
+
+    default_key = os.environ.get("LLM_API_KEY")
+    default_model = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+    clients, names = [], []
+    for i, spec in enumerate(specs):
+        client = OpenAICompatibleClient(
+            api_key=spec.get("api_key") or default_key,
+            base_url=spec.get("base_url"),
+            model=spec.get("model") or default_model,
+            use_json_mode=True,
+            # 端点内只做一次快速重试，其余交给路由层换端点
+            max_retries=int(spec.get("max_retries", 1))
+        )
+        clients.append(client)
+        names.append(spec.get("name") or f"{client.base_url or 'default'}#{client.model}")
+    return RouterLLMClient(clients, names)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""分阶段模型路由 - 按流水线阶段选择模型、并发与限流预算
+
+流水线的各个阶段（与 llm_telemetry 的阶段标签一致）调用量和难度差别很大：
+人物提取每章一次、需要较强的理解能力；时间线和分镜调用量大、格式固定，
+适合用更便宜、更快的模型。StageLLMClient 按当前阶段（llm_stage 上下文）
+把请求分发给对应的客户端，因此各提取器和生成器无需感知模型配置，
+缓存、录制、请求合并等包装层也只需构建一次。
+
+配置来源（后者覆盖前者）：
+1. EXTRACTOR_MODEL（人物 / 关系 / 时间线 / 融合提取）、SCRIPT_GENERATOR_MODEL（场景）、
+   STORYBOARD_GENERATOR_MODEL（分镜）
+2. LLM_STAGES：JSON 对象，按阶段指定 model、concurrency、rpm、tpm、max_tokens（prompt 预算），例如
+   {"storyboard": {"model": "qwen-turbo", "concurrency": 16, "rpm": 600}}
+
+LLM_PRICES 按模型配置每百万 token 的价格 [输入, 输出] 或 [输入, 输出, 缓存命中的输入]，
+用于按阶段报告成本和每美元吞吐量。
+"""
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from llm_client import LLMClient
+from llm_telemetry import LLMCallRecord, current_stage
+
+
+# 流水线阶段（与 llm_stage 标签一致；extraction 为融合提取，一次调用代替前三个阶段）
+STAGES = ("character", "relationship", "timeline", "extraction", "scene", "storyboard")
+
+# .env.example 中文档化的按任务模型变量
+STAGE_MODEL_ENV = {
+    "character": "EXTRACTOR_MODEL",
+    "relationship": "EXTRACTOR_MODEL",
+    "timeline": "EXTRACTOR_MODEL",
+    "extraction": "EXTRACTOR_MODEL",
+    "scene": "SCRIPT_GENERATOR_MODEL",
+    "storyboard": "STORYBOARD_GENERATOR_MODEL"
+}
+
+
+@dataclass
+class StageConfig:
+    """单个阶段的模型与预算配置（None 表示沿用全局配置）"""
+    model: Optional[str] = None
+    max_concurrency: Optional[int] = None
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    max_prompt_tokens: Optional[int] = None
+
+    @property
+    def has_rate_budget(self) -> bool:
+        return bool(self.requests_per_minute or self.tokens_per_minute)
+
+
+def stage_configs_from_env() -> Dict[str, StageConfig]:
+    """
+    根据环境变量读取各阶段配置
+
+    Returns:
+        {阶段: StageConfig}，只包含有配置的阶段
+    """
+    configs: Dict[str, StageConfig] = {}
+    for stage, env_name in STAGE_MODEL_ENV.items():
+        model = os.environ.get(env_name)
+        if model:
+            configs[stage] = StageConfig(model=model)
+
+    raw = os.environ.get("LLM_STAGES")
+    if raw:
+        try:
+            specs = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"LLM_STAGES 不是合法的 JSON：{e}")
+        if not isinstance(specs, dict):
+            raise ValueError("LLM_STAGES 必须是以阶段名为键的 JSON 对象")
+        for stage, spec in specs.items():
+            if stage not in STAGES:
+                raise ValueError(f"LLM_STAGES 中的未知阶段：{stage}（可选：{', '.join(STAGES)}）")
+            config = configs.setdefault(stage, StageConfig())
+            if spec.get("model"):
+                config.model = spec["model"]
+            if spec.get("concurrency"):
+                config.max_concurrency = int(spec["concurrency"])
+            if spec.get("rpm"):
+                config.requests_per_minute = float(spec["rpm"])
+            if spec.get("tpm"):
+                config.tokens_per_minute = float(spec["tpm"])
+            if spec.get("max_tokens"):
+                config.max_prompt_tokens = int(spec["max_tokens"])
+    return configs
+
+
+def model_prices_from_env() -> Dict[str, Tuple[float, ...]]:
+    """
+    读取 LLM_PRICES：{"模型": [输入价格, 输出价格, 缓存命中的输入价格（可选）]}，单位为每百万 token
+
+    未配置时返回空字典（不报告成本）
+    """
+    raw = os.environ.get("LLM_PRICES")
+    if not raw:
+        return {}
+    try:
+        specs = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"LLM_PRICES 不是合法的 JSON：{e}")
+    return {model: tuple(float(p) for p in price[:3]) for model, price in specs.items()}
+
+
+class StageLLMClient(LLMClient):
+    """按当前流水线阶段分发请求的客户端注册表"""
+
+    def __init__(self, default: LLMClient, clients: Optional[Dict[str, LLMClient]] = None):
+        """
+        初始化分阶段客户端
+
+        Args:
+            default: 未单独配置的阶段使用的客户端
+            clients: {阶段: 客户端}
+        """
+        super().__init__(getattr(default, "api_key", None), getattr(default, "base_url", None))
+        self.default = default
+        self.clients = dict(clients or {})
+
+    def client_for(self, stage: Optional[str] = None) -> LLMClient:
+        """返回阶段对应的客户端（默认取当前上下文的阶段）"""
+        return self.clients.get(stage or current_stage(), self.default)
+
+    @property
+    def model(self) -> Optional[str]:
+        # 缓存指纹、录制和遥测看到的是当前阶段实际使用的模型
+        return getattr(self.client_for(), "model", None)
+
+    @property
+    def use_json_mode(self) -> bool:
+        return getattr(self.client_for(), "use_json_mode", False)
+
+    @property
+    def structured_output(self) -> bool:
+        return getattr(self.client_for(), "structured_output", False)
+
+    def distinct_clients(self) -> List[LLMClient]:
+        """去重后的全部客户端（默认客户端在前）"""
+        seen: List[LLMClient] = []
+        for client in [self.default, *self.clients.values()]:
+            if not any(client is s for s in seen):
+                seen.append(client)
+        return seen
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        return self.client_for().chat(messages, temperature, **kwargs)
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        return await self.client_for().achat(messages, temperature, **kwargs)
+
+    def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> Iterator[str]:
+        yield from self.client_for().stream_chat(messages, temperature, **kwargs)
+
+    async def astream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                           **kwargs) -> AsyncIterator[str]:
+        async for chunk in self.client_for().astream_chat(messages, temperature, **kwargs):
+            yield chunk
+
+    def describe(self) -> Dict[str, Optional[str]]:
+        """{阶段: 模型}"""
+        return {stage: getattr(self.client_for(stage), "model", None) for stage in STAGES}
+
+
+# ==================== 成本统计 ====================
+
+def summarize_stage_costs(records: Iterable[LLMCallRecord],
+                          prices: Dict[str, Tuple[float, ...]]) -> Dict[str, Dict[str, Any]]:
+    """
+    按阶段汇总成本与每美元吞吐量
+
+    Args:
+        records: 遥测记录
+        prices: {模型: (输入价格, 输出价格[, 缓存命中的输入价格])}，单位为每百万 token，
+            未配置缓存价格时缓存命中的 token 按输入价格计
+
+    Returns:
+        {阶段: {models, calls, prompt_tokens, completion_tokens, cached_tokens, cost,
+                calls_per_dollar, tokens_per_dollar, unpriced_calls}}
+    """
+    summary: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        s = summary.setdefault(record.stage, {
+            "models": [], "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "cached_tokens": 0, "cost": 0.0, "unpriced_calls": 0
+        })
+        if record.model not in s["models"]:
+            s["models"].append(record.model)
+        prompt = record.prompt_tokens or 0
+        completion = record.completion_tokens or 0
+        cached = min(record.cached_tokens or 0, prompt)
+        s["calls"] += 1
+        s["prompt_tokens"] += prompt
+        s["completion_tokens"] += completion
+        s["cached_tokens"] += cached
+        price = prices.get(record.model)
+        if price is None:
+            s["unpriced_calls"] += 1
+        else:
+            cached_price = price[2] if len(price) > 2 else price[0]
+            s["cost"] += ((prompt - cached) * price[0] + cached * cached_price
+                          + completion * price[1]) / 1_000_000
+
+    for s in summary.values():
+        cost = s["cost"]
+        tokens = s["prompt_tokens"] + s["completion_tokens"]
+        s["calls_per_dollar"] = s["calls"] / cost if cost > 0 else None
+        s["tokens_per_dollar"] = tokens / cost if cost > 0 else None
+    return summary
+
+
+def format_stage_costs(records: Iterable[LLMCallRecord],
+                       prices: Dict[str, Tuple[float, ...]]) -> List[str]:
+    """生成按阶段的成本文本行（按成本从高到低排序）"""
+    summary = summarize_stage_costs(records, prices)
+    lines = []
+    for stage, s in sorted(summary.items(), key=lambda kv: -kv[1]["cost"]):
+        models = ", ".join(str(m) for m in s["models"])
+        if s["calls_per_dollar"] is None:
+            lines.append(f"[COST] {stage}（{models}）：{s['calls']} 次调用，未配置价格")
+            continue
+        line = (f"[COST] {stage}（{models}）：${s['cost']:.4f}，"
+                f"每美元 {s['calls_per_dollar']:.1f} 次调用 / {s['tokens_per_dollar']:,.0f} token")
+        if s["cached_tokens"]:
+            line += f"，前缀缓存命中 {s['cached_tokens'] / max(s['prompt_tokens'], 1) * 100:.1f}%"
+        if s["unpriced_calls"]:
+            line += f"（{s['unpriced_calls']} 次调用未配置价格）"
+        lines.append(line)
+    return lines
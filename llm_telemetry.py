@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""LLM 调用遥测 - 每次调用的结构化记录与按阶段聚合
+
+每次发往上游的 LLM 调用生成一条 LLMCallRecord：所属阶段（character /
+relationship / timeline / scene / storyboard）、总耗时、首字节时间、
+prompt/completion token 数、服务端前缀缓存命中的 token 数、重试次数和 finish_reason。
+记录按阶段聚合成直方图，运行结束时打印，用于判断哪个阶段占用了
+主要的成本和延迟。
+
+- 阶段通过 llm_stage 上下文管理器设置（基于 contextvars，异步任务和
+  asyncio.to_thread 会自动继承）
+- 设置 LOG_LLM_REQUESTS=true 时，每条记录连同请求/响应以 JSON Lines
+  追加到 LOG_FILE（默认 logs/llm_requests.log）
+- 各阶段解析响应的结果（ok / repaired / failed）和回退到基础结果的次数（fallback）
+  由 record_parse_outcome 按阶段计数，用于对比启用结构化输出前后的解析失败率
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, Iterator, List, Optional
+
+
+# 未设置阶段时使用的名称
+UNKNOWN_STAGE = "other"
+
+# 延迟直方图的桶上界（秒），最后一个桶收纳更长的调用
+LATENCY_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+
+# 默认请求日志路径
+DEFAULT_LOG_FILE = "logs/llm_requests.log"
+
+# 内存中保留的最大记录数（长期运行的 API 服务只聚合最近的调用）
+MAX_RECORDS = 100000
+
+# 响应解析结果：ok 一次解析成功，repaired 截断修复后可用，failed 无法解析，
+# fallback 解析结果不可用、改为生成基础结果（如 _create_fallback_scene）
+PARSE_OUTCOMES = ("ok", "repaired", "failed", "fallback")
+
+_current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("llm_stage", default=UNKNOWN_STAGE)
+
+# 当前正在发送的调用（供 HTTP 响应钩子记录首字节时间）
+_active_call: contextvars.ContextVar[Optional["LLMCallRecord"]] = \
+    contextvars.ContextVar("llm_active_call", default=None)
+
+
+@contextlib.contextmanager
+def llm_stage(name: str) -> Iterator[None]:
+    """在该上下文内发出的 LLM 调用都归入阶段 name"""
+    token = _current_stage.set(name)
+    try:
+        yield
+    finally:
+        try:
+            _current_stage.reset(token)
+        except ValueError:
+            # 生成器在另一个上下文中被关闭（如被垃圾回收），该上下文无需恢复
+            pass
+
+
+def current_stage() -> str:
+    """返回当前上下文的阶段名"""
+    return _current_stage.get()
+
+
+@dataclass
+class LLMCallRecord:
+    """一次上游 LLM 调用的遥测记录"""
+    stage: str
+    model: str
+    endpoint: str = ""
+    streamed: bool = False
+    started_at: float = 0.0  # Unix 时间戳
+    wall_seconds: float = 0.0
+    ttfb_seconds: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    total_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None  # prompt 中命中服务端前缀缓存的 token 数
+    retries: int = 0
+    finish_reason: Optional[str] = None
+    error: Optional[str] = None
+    _start: float = field(default=0.0, repr=False)
+    _attempt_start: float = field(default=0.0, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: v for k, v in asdict(self).items() if not k.startswith("_")}
+
+
+def begin_call(model: str, endpoint: str = "", streamed: bool = False) -> LLMCallRecord:
+    """开始记录一次调用（阶段取自当前上下文）"""
+    now = time.perf_counter()
+    return LLMCallRecord(
+        stage=current_stage(),
+        model=model or "",
+        endpoint=endpoint or "",
+        streamed=streamed,
+        started_at=time.time(),
+        _start=now,
+        _attempt_start=now
+    )
+
+
+def begin_attempt(record: LLMCallRecord, attempt: int) -> None:
+    """开始一次（重试）尝试：首字节时间从最后一次尝试开始计算"""
+    record.retries = attempt
+    record._attempt_start = time.perf_counter()
+    record.ttfb_seconds = None
+
+
+def mark_first_byte(record: LLMCallRecord) -> None:
+    """记录首字节时间（同一次尝试只记录第一次）"""
+    if record.ttfb_seconds is None:
+        record.ttfb_seconds = time.perf_counter() - record._attempt_start
+
+
+@contextlib.contextmanager
+def sending(record: LLMCallRecord) -> Iterator[None]:
+    """标记 record 为当前正在发送的调用，HTTP 响应头到达时由钩子记录首字节时间"""
+    token = _active_call.set(record)
+    try:
+        yield
+    finally:
+        _active_call.reset(token)
+
+
+def response_hook(response: Any) -> None:
+    """httpx 同步客户端的 response 事件钩子（响应头到达、正文读取之前触发）"""
+    record = _active_call.get()
+    if record is not None:
+        mark_first_byte(record)
+
+
+async def aresponse_hook(response: Any) -> None:
+    """httpx 异步客户端的 response 事件钩子"""
+    response_hook(response)
+
+
+def _cached_tokens(usage: Any) -> Optional[int]:
+    """读取服务端报告的缓存命中 token 数（OpenAI 与 DeepSeek 两种字段）"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached = details.get("cached_tokens")
+    else:
+        cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached
+
+
+def end_call(record: LLMCallRecord, response: Any = None, error: Optional[BaseException] = None,
+             messages: Optional[List[Dict[str, str]]] = None, text: Optional[str] = None) -> LLMCallRecord:
+    """
+    结束记录并提交给全局收集器
+
+    Args:
+        record: begin_call 返回的记录
+        response: ChatCompletion 响应（读取 usage 与 finish_reason）
+        error: 调用失败时的异常
+        messages / text: 请求消息与响应文本，仅写入请求日志
+    """
+    record.wall_seconds = time.perf_counter() - record._start
+    if record.ttfb_seconds is None and error is None:
+        record.ttfb_seconds = time.perf_counter() - record._attempt_start
+
+    if response is not None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            record.prompt_tokens = getattr(usage, "prompt_tokens", None)
+            record.completion_tokens = getattr(usage, "completion_tokens", None)
+            record.total_tokens = getattr(usage, "total_tokens", None)
+            record.cached_tokens = _cached_tokens(usage)
+        choices = getattr(response, "choices", None)
+        if choices:
+            record.finish_reason = getattr(choices[0], "finish_reason", None)
+    if error is not None:
+        record.error = f"{type(error).__name__}: {error}"
+
+    get_telemetry().record(record, messages=messages, text=text)
+    return record
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class TelemetryCollector:
+    """收集调用记录并按阶段聚合，线程安全"""
+
+    def __init__(self, log_file: Optional[str] = None):
+        """
+        初始化收集器
+
+        Args:
+            log_file: 请求日志路径（None 表示不写日志）
+        """
+        self.log_file = log_file
+        self.records: "collections.deque[LLMCallRecord]" = collections.deque(maxlen=MAX_RECORDS)
+        self.parse_outcomes: Dict[str, Dict[str, int]] = {}
+        self.concurrency: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, record: LLMCallRecord, messages: Optional[List[Dict[str, str]]] = None,
+               text: Optional[str] = None) -> None:
+        with self._lock:
+            self.records.append(record)
+            if self.log_file:
+                entry = record.to_dict()
+                entry["request"] = messages
+                entry["response"] = text
+                directory = os.path.dirname(self.log_file)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.log_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def record_parse(self, stage: str, outcome: str) -> None:
+        """计入一次响应解析结果（outcome 取自 PARSE_OUTCOMES）"""
+        with self._lock:
+            counts = self.parse_outcomes.setdefault(stage, dict.fromkeys(PARSE_OUTCOMES, 0))
+            counts[outcome] += 1
+
+    def parse_summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        按阶段汇总解析结果
+
+        Returns:
+            {阶段: {ok, repaired, failed, fallback, parsed, failure_rate, fallback_rate}}，
+            两个比例都以解析次数为分母
+        """
+        with self._lock:
+            outcomes = {stage: dict(counts) for stage, counts in self.parse_outcomes.items()}
+        for counts in outcomes.values():
+            parsed = counts["ok"] + counts["repaired"] + counts["failed"]
+            counts["parsed"] = parsed
+            counts["failure_rate"] = counts["failed"] / parsed if parsed else 0.0
+            counts["fallback_rate"] = counts["fallback"] / parsed if parsed else 0.0
+        return outcomes
+
+    def record_concurrency(self, name: str, limit: int, decreased: bool) -> None:
+        """记录自适应并发控制器（见 adaptive_concurrency）调整后的上限"""
+        with self._lock:
+            s = self.concurrency.setdefault(name, {"limit": limit, "min": limit, "max": limit,
+                                                   "increases": 0, "decreases": 0})
+            s["limit"] = limit
+            s["min"] = min(s["min"], limit)
+            s["max"] = max(s["max"], limit)
+            s["decreases" if decreased else "increases"] += 1
+
+    def concurrency_summary(self) -> Dict[str, Dict[str, int]]:
+        """
+        各端点的自适应并发上限
+
+        Returns:
+            {端点: {limit（当前上限）, min, max, increases, decreases}}
+        """
+        with self._lock:
+            return {name: dict(s) for name, s in self.concurrency.items()}
+
+    def reset(self) -> None:
+        """清空已收集的记录（开始新一轮运行时调用）"""
+        with self._lock:
+            self.records.clear()
+            self.parse_outcomes.clear()
+            self.concurrency.clear()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        按阶段聚合
+
+        Returns:
+            {阶段: {calls, errors, retries, prompt_tokens, completion_tokens,
+                    cached_tokens, wall_seconds, latency_p50, latency_p95, latency_max, ttfb_p50,
+                    latency_histogram, finish_reasons}}
+        """
+        with self._lock:
+            records = list(self.records)
+
+        by_stage: Dict[str, List[LLMCallRecord]] = {}
+        for record in records:
+            by_stage.setdefault(record.stage, []).append(record)
+
+        summary = {}
+        for stage, items in by_stage.items():
+            latencies = sorted(r.wall_seconds for r in items)
+            ttfbs = sorted(r.ttfb_seconds for r in items if r.ttfb_seconds is not None)
+            histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+            for latency in latencies:
+                bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound),
+                              len(LATENCY_BUCKETS))
+                histogram[bucket] += 1
+            finish_reasons: Dict[str, int] = {}
+            for r in items:
+                if r.finish_reason:
+                    finish_reasons[r.finish_reason] = finish_reasons.get(r.finish_reason, 0) + 1
+
+            summary[stage] = {
+                "calls": len(items),
+                "errors": sum(1 for r in items if r.error),
+                "retries": sum(r.retries for r in items),
+                "prompt_tokens": sum(r.prompt_tokens or 0 for r in items),
+                "completion_tokens": sum(r.completion_tokens or 0 for r in items),
+                "cached_tokens": sum(r.cached_tokens or 0 for r in items),
+                "wall_seconds": sum(latencies),
+                "latency_p50": _percentile(latencies, 0.5),
+                "latency_p95": _percentile(latencies, 0.95),
+                "latency_max": latencies[-1] if latencies else 0.0,
+                "ttfb_p50": _percentile(ttfbs, 0.5),
+                "latency_histogram": histogram,
+                "finish_reasons": finish_reasons
+            }
+        return summary
+
+    def format_summary(self) -> List[str]:
+        """生成按阶段汇总的文本行（按总耗时从高到低排序），最后是各阶段的解析结果和并发上限"""
+        summary = self.summary()
+        if not summary:
+            return self.format_parse_summary() + self.format_concurrency_summary()
+
+        total_wall = sum(s["wall_seconds"] for s in summary.values()) or 1.0
+        total_tokens = sum(s["prompt_tokens"] + s["completion_tokens"] for s in summary.values()) or 1
+        labels = [f"≤{b:g}s" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]:g}s"]
+
+        lines = []
+        for stage, s in sorted(summary.items(), key=lambda kv: -kv[1]["wall_seconds"]):
+            tokens = s["prompt_tokens"] + s["completion_tokens"]
+            lines.append(
+                f"[STATS] {stage}: {s['calls']} 次调用，错误 {s['errors']}，重试 {s['retries']}；"
+                f"耗时占比 {s['wall_seconds'] / total_wall * 100:.1f}%，"
+                f"p50 {s['latency_p50']:.2f}s / p95 {s['latency_p95']:.2f}s，首字节 p50 {s['ttfb_p50']:.2f}s；"
+                f"token {s['prompt_tokens']}+{s['completion_tokens']}（占比 {tokens / total_tokens * 100:.1f}%）"
+            )
+            if s["cached_tokens"]:
+                lines.append(f"        前缀缓存命中 {s['cached_tokens']} token"
+                             f"（prompt 的 {s['cached_tokens'] / max(s['prompt_tokens'], 1) * 100:.1f}%）")
+            buckets = "  ".join(f"{label}:{count}" for label, count in zip(labels, s["latency_histogram"]) if count)
+            lines.append(f"        延迟分布 {buckets}")
+            if s["finish_reasons"]:
+                reasons = ", ".join(f"{k}={v}" for k, v in sorted(s["finish_reasons"].items()))
+                lines.append(f"        finish_reason {reasons}")
+        return lines + self.format_parse_summary() + self.format_concurrency_summary()
+
+    def format_parse_summary(self) -> List[str]:
+        """生成各阶段解析结果的文本行"""
+        lines = []
+        for stage, s in sorted(self.parse_summary().items()):
+            lines.append(
+                f"[PARSE] {stage}：解析 {s['parsed']} 次，修复 {s['repaired']}，失败 {s['failed']}"
+                f"（{s['failure_rate'] * 100:.1f}%），回退 {s['fallback']}（{s['fallback_rate'] * 100:.1f}%）"
+            )
+        return lines
+
+    def format_concurrency_summary(self) -> List[str]:
+        """生成自适应并发上限的文本行"""
+        return [
+            f"[CONCURRENCY] {name or 'default'}：当前上限 {s['limit']}（区间 {s['min']}-{s['max']}），"
+            f"上调 {s['increases']} 次，下调 {s['decreases']} 次"
+            for name, s in sorted(self.concurrency_summary().items())
+        ]
+
+
+# ==================== 进程级收集器 ====================
+
+_telemetry: Optional[TelemetryCollector] = None
+_telemetry_lock = threading.Lock()
+
+
+def _log_file_from_env() -> Optional[str]:
+    if os.environ.get("LOG_LLM_REQUESTS", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return os.environ.get("LOG_FILE") or DEFAULT_LOG_FILE
+
+
+def get_telemetry() -> TelemetryCollector:
+    """获取进程级遥测收集器（首次调用时读取 LOG_LLM_REQUESTS / LOG_FILE）"""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = TelemetryCollector(log_file=_log_file_from_env())
+        return _telemetry
+
+
+def record_parse_outcome(outcome: str) -> None:
+    """把一次响应解析结果计入当前阶段"""
+    get_telemetry().record_parse(current_stage(), outcome)
+
+
+def reset_telemetry() -> None:
+    """丢弃进程级收集器，下次获取时重新读取环境变量"""
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry = None
@@ -9,11 +9,15 @@
 5. 真实 LLM API 调用
 """
 import argparse
+import asyncio
+import contextvars
 import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -21,24 +25,60 @@ load_dotenv()
 
 from models import Character, Relationship, TimelineEvent, ScriptScene, StoryboardShot
 from extractor import (
-    CharacterExtractor, RelationshipExtractor, TimelineExtractor,
-    LLMClient, OpenAICompatibleClient, MockLLMClient
+    CharacterExtractor, RelationshipExtractor, TimelineExtractor, FusedExtractor,
+    LLMClient, OpenAICompatibleClient, MockLLMClient,
+    EXTRACTION_USER_PROMPT, FUSED_EXTRACTION_CONTEXT_PROMPT, split_after_truncation
 )
+from llm_client import (
+    AsyncLLMClient, LLMClientWrapper, DEFAULT_MAX_CONCURRENCY, ResponseTruncatedError, aclose_shared_clients
+)
+from llm_batch import BatchRequest, BatchRunner, DEFAULT_BATCH_DIR, DEFAULT_POLL_INTERVAL
+from llm_cache import CachedLLMClient, DEFAULT_MAX_BYTES
+from single_flight import SingleFlightLLMClient
+from llm_router import RouterLLMClient, endpoints_from_env
+from llm_telemetry import get_telemetry, llm_stage
+from llm_replay import RecordingLLMClient, ReplayLLMClient
+from llm_hedging import HedgedLLMClient, DEFAULT_MAX_EXTRA_RATIO
+from llm_cascade import CascadeLLMClient, cascade_from_env
+from llm_stages import (
+    STAGES, StageConfig, StageLLMClient, stage_configs_from_env, model_prices_from_env, format_stage_costs
+)
+from rate_limiter import get_stage_rate_limiter
+from adaptive_concurrency import adaptive_concurrency_enabled, adaptive_max_concurrency
+from token_budget import ContextPart, TokenBudgetPlanner
 from script_generator import ScriptGenerator
 from storyboard_generator import StoryboardGenerator
 from chunking_engine import NovelReader, MemoryBank, ChunkingPipeline, TextChunk
 from vector_store import VectorMemoryBank
 
 
+def max_concurrency_from_env() -> int:
+    """
+    异步模式的静态并发上限
+
+    优先读取 LLM_MAX_CONCURRENCY；启用自适应并发时默认取 LLM_ADAPTIVE_MAX_CONCURRENCY，
+    静态信号量只作为天花板，实际在途请求数由客户端的 AIMD 控制器调整。
+    """
+    if os.environ.get("LLM_MAX_CONCURRENCY"):
+        return int(os.environ["LLM_MAX_CONCURRENCY"])
+    return adaptive_max_concurrency() if adaptive_concurrency_enabled() else DEFAULT_MAX_CONCURRENCY
+
+
+def compact_output_from_env() -> bool:
+    """是否启用紧凑响应格式（LLM_COMPACT_OUTPUT）"""
+    return os.environ.get("LLM_COMPACT_OUTPUT", "false").lower() in ("1", "true", "yes")
+
+
 class NovelProcessor:
     """小说处理器 - 完整的自动化处理流水线"""
 
-    def __init__(self, llm_client: Optional[LLMClient] = None):
+    def __init__(self, llm_client: Optional[LLMClient] = None, compact_output: Optional[bool] = None):
         """
         初始化小说处理器
 
         Args:
             llm_client: LLM 客户端实例，如果为 None 则使用 OpenAICompatibleClient
+            compact_output: 是否要求紧凑响应格式（短键，见 compact_format），默认读取 LLM_COMPACT_OUTPUT
         """
         # 使用传入的客户端或创建默认的 OpenAI 客户端
         self.llm_client = llm_client or OpenAICompatibleClient(
@@ -48,11 +88,12 @@ class NovelProcessor:
         )
 
         # 初始化各个提取器和生成器
-        self.character_extractor = CharacterExtractor(self.llm_client)
-        self.relationship_extractor = RelationshipExtractor(self.llm_client)
-        self.timeline_extractor = TimelineExtractor(self.llm_client)
-        self.script_generator = ScriptGenerator(self.llm_client)
-        self.storyboard_generator = StoryboardGenerator(self.llm_client)
+        compact = compact_output_from_env() if compact_output is None else compact_output
+        self.character_extractor = CharacterExtractor(self.llm_client, compact)
+        self.relationship_extractor = RelationshipExtractor(self.llm_client, compact)
+        self.timeline_extractor = TimelineExtractor(self.llm_client, compact)
+        self.script_generator = ScriptGenerator(self.llm_client, compact=compact)
+        self.storyboard_generator = StoryboardGenerator(self.llm_client, compact=compact)
 
     def process(self, novel_text: str) -> Dict[str, Any]:
         """
@@ -90,6 +131,10 @@ class NovelProcessor:
         }
 
 
+# 同步模式下每章三个提取器的并发线程数
+DEFAULT_EXTRACTION_WORKERS = 3
+
+
 class LongNovelProcessor:
     """长篇小说处理器 - 支持分块处理和记忆合并"""
 
@@ -98,7 +143,14 @@ class LongNovelProcessor:
                  enable_memory_merge: bool = True,
                  enable_checkpoint: bool = True,
                  checkpoint_interval: int = 5,
-                 use_vector_memory: bool = True):
+                 use_vector_memory: bool = True,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 stage_concurrency: Optional[Dict[str, int]] = None,
+                 max_prompt_tokens: Optional[int] = None,
+                 stage_prompt_tokens: Optional[Dict[str, int]] = None,
+                 fused_extraction: bool = False,
+                 extraction_workers: int = DEFAULT_EXTRACTION_WORKERS,
+                 compact_output: Optional[bool] = None):
         """
         初始化长篇小说处理器
 
@@ -109,18 +161,41 @@ class LongNovelProcessor:
             enable_checkpoint: 是否启用检查点保存
             checkpoint_interval: 检查点保存间隔（每 N 个章节保存一次）
             use_vector_memory: 是否使用向量化记忆银行（解决记忆膨胀问题）
+            max_concurrency: 异步模式（aprocess_novel）下同时在途的 LLM 请求上限
+            stage_concurrency: 按阶段单独设置的并发上限（{阶段: 上限}），
+                这些阶段使用独立的并发名额，其余阶段共享 max_concurrency
+            max_prompt_tokens: 单次请求的 prompt token 预算（None 表示不检查），
+                超出时按优先级裁剪上一章原文和记忆上下文
+            stage_prompt_tokens: 按阶段单独设置的 prompt token 预算（{阶段: 上限}）
+            fused_extraction: 是否使用融合提取（每章一次调用同时提取人物、关系和时间线），
+                关闭时人物、关系、时间线分别调用
+            extraction_workers: 同步模式下并发执行人物、关系、时间线提取的线程数（1 表示依次执行），
+                线程池由所有章节共享
+            compact_output: 是否要求紧凑响应格式（短键和枚举代码，减少输出 token），
+                默认读取 LLM_COMPACT_OUTPUT
         """
-        self.llm_client = llm_client or OpenAICompatibleClient(
+        llm_client = llm_client or OpenAICompatibleClient(
             api_key=os.environ.get("LLM_API_KEY"),
             base_url=os.environ.get("LLM_BASE_URL"),
             model=os.environ.get("LLM_MODEL", "gpt-4o-mini")
         )
+        # 同步调用原样转发；异步调用受 max_concurrency 限制
+        self.llm_client = AsyncLLMClient(llm_client, max_concurrency=max_concurrency)
+        self.stage_clients = {
+            stage: AsyncLLMClient(llm_client, max_concurrency=limit)
+            for stage, limit in (stage_concurrency or {}).items()
+        }
 
         self.enable_memory_merge = enable_memory_merge
         self.enable_checkpoint = enable_checkpoint
         self.checkpoint_interval = checkpoint_interval
         self.use_vector_memory = use_vector_memory
 
+        # 各阶段的 token 预算规划器（未配置预算的阶段不检查）
+        budgets = {stage: max_prompt_tokens for stage in STAGES if max_prompt_tokens}
+        budgets.update(stage_prompt_tokens or {})
+        self.token_budgets = {stage: TokenBudgetPlanner(limit) for stage, limit in budgets.items()}
+
         # 初始化分块流水线
         self.chunking_pipeline = ChunkingPipeline(max_chunk_size=max_chunk_size)
 
@@ -128,11 +203,18 @@ class LongNovelProcessor:
         self.memory_bank = VectorMemoryBank() if use_vector_memory else MemoryBank()
 
         # 初始化提取器和生成器（传入记忆银行）
-        self.character_extractor = CharacterExtractor(self.llm_client)
-        self.relationship_extractor = RelationshipExtractor(self.llm_client)
-        self.timeline_extractor = TimelineExtractor(self.llm_client)
-        self.script_generator = ScriptGenerator(self.llm_client, self.memory_bank)
-        self.storyboard_generator = StoryboardGenerator(self.llm_client, self.memory_bank)
+        compact = compact_output_from_env() if compact_output is None else compact_output
+        self.character_extractor = CharacterExtractor(self._stage_client("character"), compact)
+        self.relationship_extractor = RelationshipExtractor(self._stage_client("relationship"), compact)
+        self.timeline_extractor = TimelineExtractor(self._stage_client("timeline"), compact)
+        self.fused_extractor = FusedExtractor(self._stage_client("extraction"), compact) if fused_extraction else None
+        self.extraction_workers = max(1, extraction_workers)
+        self._extraction_executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self.script_generator = ScriptGenerator(self._stage_client("scene"), self.memory_bank,
+                                                self.token_budgets.get("scene"), compact)
+        self.storyboard_generator = StoryboardGenerator(self._stage_client("storyboard"), self.memory_bank,
+                                                        self.token_budgets.get("storyboard"), compact)
 
         # 结果存储
         self.all_characters: List[Character] = []
@@ -141,6 +223,10 @@ class LongNovelProcessor:
         self.all_script_scenes: List[ScriptScene] = []
         self.all_storyboard_shots: List[StoryboardShot] = []
 
+    def _stage_client(self, stage: str) -> AsyncLLMClient:
+        """阶段使用的并发受限客户端（未单独设置并发上限的阶段共享 self.llm_client）"""
+        return self.stage_clients.get(stage, self.llm_client)
+
     def load_novel(self, file_path: str) -> List[TextChunk]:
         """加载小说文件并切分"""
         print(f"[INFO] 正在读取小说文件：{file_path}")
@@ -151,25 +237,144 @@ class LongNovelProcessor:
             print(f"  - 第{chunk.chapter_number}章：{title} ({chunk.word_count} 字)")
         return chunks
 
-    def _extract_with_memory(self, chunk: TextChunk, context: str) -> Dict[str, Any]:
-        """使用上下文记忆进行提取"""
-        # 将记忆上下文添加到文本前面
-        full_text = context + "\n\n" + chunk.content
+    def _extraction_texts(self, chunk: TextChunk, memory_context: str,
+                          previous_context: str) -> Dict[str, Tuple[str, str]]:
+        """
+        按各提取阶段的 token 预算组装输入文本
+
+        人物和关系提取使用"记忆上下文 + 上一章原文 + 本章正文"，超出预算时
+        先裁剪上一章原文、再裁剪记忆上下文；时间线提取只使用本章正文。
+        本章正文本身超出预算时抛出 PromptBudgetError，不发送请求。
+
+        Returns:
+            {阶段: (本章正文, 参考上下文)}，响应被截断时提取器只拆分正文
+        """
+        texts = {}
+        for stage, extractor in (("character", self.character_extractor),
+                                 ("relationship", self.relationship_extractor)):
+            memory, previous = memory_context, previous_context
+            planner = self.token_budgets.get(stage)
+            if planner is not None:
+                plan = planner.plan(extractor.system_prompt + EXTRACTION_USER_PROMPT, [
+                    ContextPart("previous", previous, keep="tail"),
+                    ContextPart("memory", memory),
+                    ContextPart("chunk", chunk.content, required=True)
+                ], stage)
+                memory, previous = plan.texts["memory"], plan.texts["previous"]
+            texts[stage] = (chunk.content, "\n\n".join(part for part in (memory, previous) if part))
+
+        planner = self.token_budgets.get("timeline")
+        if planner is not None:
+            planner.plan(self.timeline_extractor.system_prompt + EXTRACTION_USER_PROMPT,
+                         [ContextPart("chunk", chunk.content, required=True)], "timeline")
+        texts["timeline"] = (chunk.content, "")
+        return texts
+
+    def _fused_extraction_parts(self, chunk: TextChunk, memory_context: str,
+                                previous_context: str) -> Tuple[str, str]:
+        """
+        按融合提取的 token 预算组装（参考上下文, 本章正文）
 
-        # 提取人物、关系、时间线
-        characters = self.character_extractor.extract(full_text)
-        relationships = self.relationship_extractor.extract(full_text)
-        timeline_events = self.timeline_extractor.extract(chunk.content)
+        裁剪顺序与分阶段提取相同：先裁剪上一章原文、再裁剪记忆上下文。
+        """
+        memory, previous = memory_context, previous_context
+        planner = self.token_budgets.get("extraction")
+        if planner is not None:
+            plan = planner.plan(
+                self.fused_extractor.system_prompt + FUSED_EXTRACTION_CONTEXT_PROMPT + EXTRACTION_USER_PROMPT, [
+                    ContextPart("previous", previous, keep="tail"),
+                    ContextPart("memory", memory),
+                    ContextPart("chunk", chunk.content, required=True)
+                ], "extraction")
+            memory, previous = plan.texts["memory"], plan.texts["previous"]
+        return "\n\n".join(part for part in (memory, previous) if part), chunk.content
+
+    def _extract_with_memory(self, chunk: TextChunk, memory_context: str,
+                             previous_context: str) -> Dict[str, Any]:
+        """使用上下文记忆进行提取"""
+        if self.fused_extractor is not None:
+            # 融合提取：一次调用同时提取人物、关系和时间线
+            context, text = self._fused_extraction_parts(chunk, memory_context, previous_context)
+            extracted = self.fused_extractor.extract(text, context)
+        else:
+            # 将记忆上下文和上一章原文添加到文本前面
+            texts = self._extraction_texts(chunk, memory_context, previous_context)
+
+            # 三个提取器互不依赖，在共享线程池中并发请求
+            jobs = [(self.character_extractor, texts["character"]),
+                    (self.relationship_extractor, texts["relationship"]),
+                    (self.timeline_extractor, texts["timeline"])]
+            if self.extraction_workers > 1:
+                executor = self._get_extraction_executor()
+                futures = [executor.submit(contextvars.copy_context().run, self._run_extractor, extractor, *args)
+                           for extractor, args in jobs]
+                outcomes = [future.result() for future in futures]
+            else:
+                outcomes = [self._run_extractor(extractor, *args) for extractor, args in jobs]
+            extracted = self._collect_extractions(chunk, outcomes)
 
         # 修正事件的章节号
-        for event in timeline_events:
+        for event in extracted["timeline_events"]:
             event.chapter = chunk.chapter_number
+        return extracted
+
+    def _get_extraction_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._extraction_executor is None:
+                self._extraction_executor = ThreadPoolExecutor(max_workers=self.extraction_workers,
+                                                               thread_name_prefix="extract")
+            return self._extraction_executor
+
+    def close(self) -> None:
+        """关闭提取线程池（之后再处理章节时会重新创建）"""
+        with self._executor_lock:
+            executor, self._extraction_executor = self._extraction_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    @staticmethod
+    def _run_extractor(extractor, text: str, context: str) -> Any:
+        """执行一个提取器，失败时返回异常而不抛出"""
+        try:
+            return extractor.extract(text, context)
+        except Exception as e:
+            return e
+
+    def _collect_extractions(self, chunk: TextChunk, outcomes: List[Any]) -> Dict[str, Any]:
+        """
+        汇总三个提取器的结果
 
-        return {
-            "characters": characters,
-            "relationships": relationships,
-            "timeline_events": timeline_events
-        }
+        单个提取器失败时只丢弃它自己的结果（记为空列表并打印警告），
+        其余提取器的结果照常使用；全部失败时抛出第一个异常。
+        """
+        keys = ("characters", "relationships", "timeline_events")
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if len(errors) == len(outcomes):
+            raise errors[0]
+        for key, outcome in zip(keys, outcomes):
+            if isinstance(outcome, BaseException):
+                print(f"  [WARN] 第{chunk.chapter_number}章 {key} 提取失败，已跳过：{outcome}")
+        return {key: [] if isinstance(outcome, BaseException) else outcome for key, outcome in zip(keys, outcomes)}
+
+    async def _aextract_with_memory(self, chunk: TextChunk, memory_context: str,
+                                    previous_context: str) -> Dict[str, Any]:
+        """使用上下文记忆进行提取（异步，三个提取器并发请求）"""
+        if self.fused_extractor is not None:
+            context, text = self._fused_extraction_parts(chunk, memory_context, previous_context)
+            extracted = await self.fused_extractor.aextract(text, context)
+        else:
+            texts = self._extraction_texts(chunk, memory_context, previous_context)
+            outcomes = await asyncio.gather(
+                self.character_extractor.aextract(*texts["character"]),
+                self.relationship_extractor.aextract(*texts["relationship"]),
+                self.timeline_extractor.aextract(*texts["timeline"]),
+                return_exceptions=True
+            )
+            extracted = self._collect_extractions(chunk, list(outcomes))
+
+        for event in extracted["timeline_events"]:
+            event.chapter = chunk.chapter_number
+        return extracted
 
     def _merge_characters(self, new_characters: List[Character], chapter_num: int) -> None:
         """将新提取的人物合并到记忆银行"""
@@ -213,31 +418,53 @@ class LongNovelProcessor:
                 if rel_desc not in self.chunking_pipeline.memory_bank.global_context["relationships"]:
                     self.chunking_pipeline.memory_bank.global_context["relationships"].append(rel_desc)
 
+    def _merge_extracted(self, extracted: Dict[str, Any], chunk: TextChunk) -> str:
+        """将提取结果合并到记忆银行，并返回用于生成剧本和分镜的记忆上下文"""
+        # 合并到记忆银行
+        if self.enable_memory_merge:
+            self._merge_characters(extracted["characters"], chunk.chapter_number)
+            self._merge_relationships(extracted["relationships"])
+
+        # 构建记忆上下文（用于生成剧本和分镜）
+        if self.use_vector_memory:
+            return self.memory_bank.to_context_prompt(chunk.content)
+        return self.chunking_pipeline.memory_bank.to_context_prompt()
+
+    def _accumulate_chunk_result(self, chunk: TextChunk, extracted: Dict[str, Any],
+                                 script_scenes: List[ScriptScene],
+                                 storyboard_shots: List[StoryboardShot]) -> Dict[str, Any]:
+        """累积单个章节的结果并返回章节统计"""
+        self.all_characters.extend(extracted["characters"])
+        self.all_relationships.extend(extracted["relationships"])
+        self.all_timeline_events.extend(extracted["timeline_events"])
+        self.all_script_scenes.extend(script_scenes)
+        self.all_storyboard_shots.extend(storyboard_shots)
+
+        return {
+            "chapter": chunk.chapter_number,
+            "characters_count": len(extracted["characters"]),
+            "relationships_count": len(extracted["relationships"]),
+            "events_count": len(extracted["timeline_events"]),
+            "scenes_count": len(script_scenes),
+            "shots_count": len(storyboard_shots)
+        }
+
     def process_chunk(self, chunk: TextChunk) -> Dict[str, Any]:
         """处理单个章节"""
         title = chunk.chapter_title or f"第{chunk.chapter_number}章"
         print(f"\n[PROCESS] 处理第{chunk.chapter_number}章：{title}")
 
-        # 获取带上下文的文本
-        chunk_data, context = self.chunking_pipeline.get_chunk_with_context(
+        # 获取记忆上下文和上一章原文
+        _, memory_context, previous_context = self.chunking_pipeline.get_chunk_context_parts(
             self.chunking_pipeline.reader.chunks.index(chunk)
         )
 
         # 提取信息
         print("  → 提取人物、关系、时间线...")
-        extracted = self._extract_with_memory(chunk, context)
-
-        # 合并到记忆银行
-        if self.enable_memory_merge:
-            self._merge_characters(extracted["characters"], chunk.chapter_number)
-            self._merge_relationships(extracted["relationships"])
+        extracted = self._extract_with_memory(chunk, memory_context, previous_context)
 
-        # 构建记忆上下文（用于生成剧本和分镜）
-        memory_context = ""
-        if self.use_vector_memory:
-            memory_context = self.memory_bank.to_context_prompt(chunk.content)
-        else:
-            memory_context = self.chunking_pipeline.memory_bank.to_context_prompt()
+        # 合并到记忆银行并构建记忆上下文
+        memory_context = self._merge_extracted(extracted, chunk)
 
         # 生成剧本场景（注入记忆上下文）
         print("  → 生成剧本场景...")
@@ -257,23 +484,36 @@ class LongNovelProcessor:
             storyboard_shots.extend(shots)
 
         # 累积结果
-        self.all_characters.extend(extracted["characters"])
-        self.all_relationships.extend(extracted["relationships"])
-        self.all_timeline_events.extend(extracted["timeline_events"])
-        self.all_script_scenes.extend(script_scenes)
-        self.all_storyboard_shots.extend(storyboard_shots)
+        result = self._accumulate_chunk_result(chunk, extracted, script_scenes, storyboard_shots)
 
         # 标记已处理
         self.chunking_pipeline.mark_processed(self.chunking_pipeline.reader.chunks.index(chunk))
 
-        return {
-            "chapter": chunk.chapter_number,
-            "characters_count": len(extracted["characters"]),
-            "relationships_count": len(extracted["relationships"]),
-            "events_count": len(extracted["timeline_events"]),
-            "scenes_count": len(script_scenes),
-            "shots_count": len(storyboard_shots)
-        }
+        return result
+
+    async def _agenerate_for_chunk(self, events: List[TimelineEvent],
+                                   memory_context: str) -> Tuple[List[ScriptScene], List[StoryboardShot]]:
+        """为一个章节的事件生成剧本和分镜（异步）
+
+        每个事件的场景生成完成后立即开始生成其分镜，不等待同章其他事件；
+        返回结果按事件顺序排列。
+        """
+        async def generate_for_event(event: TimelineEvent):
+            scenes = await self.script_generator.agenerate([event], memory_context=memory_context)
+            shot_lists = await asyncio.gather(*[
+                self.storyboard_generator.agenerate(scene, memory_context=memory_context)
+                for scene in scenes
+            ])
+            return scenes, [shot for shots in shot_lists for shot in shots]
+
+        results = await asyncio.gather(*[generate_for_event(event) for event in events])
+
+        script_scenes: List[ScriptScene] = []
+        storyboard_shots: List[StoryboardShot] = []
+        for scenes, shots in results:
+            script_scenes.extend(scenes)
+            storyboard_shots.extend(shots)
+        return script_scenes, storyboard_shots
 
     def process_novel(self, file_path: str, output_path: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -294,16 +534,258 @@ class LongNovelProcessor:
         print(f"   启用检查点：{self.enable_checkpoint}")
 
         chapter_results = []
+        try:
+            for i, chunk in enumerate(chunks):
+                result = self.process_chunk(chunk)
+                chapter_results.append(result)
+
+                # 定期保存检查点
+                self._maybe_save_checkpoint(i, chunk)
+        finally:
+            # 提取线程池只在同步处理期间使用，处理结束（或出错）后释放线程
+            self.close()
+
+        return self._finish_novel(file_path, chunks, chapter_results, start_time, output_path)
+
+    async def aprocess_novel(self, file_path: str, output_path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        处理整部小说（异步版本）
+
+        章节提取、场景生成和分镜生成可同时有多个请求在途，总并发数由
+        max_concurrency 限制。为保证结果确定性：
+        - 记忆合并严格按章节顺序进行，每章的记忆上下文与同步版本一致
+        - 使用传统 MemoryBank 时，提取上下文依赖之前章节的合并结果，
+          因此章节提取按顺序进行（场景和分镜仍然并发）
+        - 返回结果按章节顺序排列
+
+        Args:
+            file_path: 小说文件路径
+            output_path: 输出文件路径（可选）
+
+        Returns:
+            处理结果字典（与 process_novel 相同）
+        """
+        start_time = datetime.now()
+        chunks = self.load_novel(file_path)
+
+        print(f"\n[START] 开始异步处理长篇小说...")
+        print(f"   启用记忆合并：{self.enable_memory_merge}")
+        print(f"   启用检查点：{self.enable_checkpoint}")
+        print(f"   最大并发请求：{self.llm_client.max_concurrency}")
+        for stage, client in self.stage_clients.items():
+            print(f"   {stage} 阶段并发上限：{client.max_concurrency}")
+
+        # 向量记忆模式下，提取上下文只包含原文，所有章节可以立即并发提取
+        sequential_extraction = self.enable_memory_merge and not self.use_vector_memory
+
+        def start_extraction(index: int) -> "asyncio.Task":
+            _, memory_context, previous_context = self.chunking_pipeline.get_chunk_context_parts(index)
+            return asyncio.ensure_future(
+                self._aextract_with_memory(chunks[index], memory_context, previous_context)
+            )
+
+        extraction_tasks: List[Optional[asyncio.Task]] = [None] * len(chunks)
+        generation_tasks: List[asyncio.Task] = []
+
+        try:
+            if not sequential_extraction:
+                extraction_tasks = [start_extraction(i) for i in range(len(chunks))]
+
+            # 按章节顺序合并记忆，合并完成后立即启动该章的场景与分镜生成
+            extracted_results = []
+            for i, chunk in enumerate(chunks):
+                if extraction_tasks[i] is None:
+                    extraction_tasks[i] = start_extraction(i)
+                extracted = await extraction_tasks[i]
+                extracted_results.append(extracted)
+
+                memory_context = self._merge_extracted(extracted, chunk)
+                generation_tasks.append(asyncio.ensure_future(
+                    self._agenerate_for_chunk(extracted["timeline_events"], memory_context)
+                ))
+                self._maybe_save_checkpoint(i, chunk)
+
+            chapter_results = []
+            for i, chunk in enumerate(chunks):
+                script_scenes, storyboard_shots = await generation_tasks[i]
+                result = self._accumulate_chunk_result(
+                    chunk, extracted_results[i], script_scenes, storyboard_shots
+                )
+                self.chunking_pipeline.mark_processed(i)
+                chapter_results.append(result)
+
+                title = chunk.chapter_title or f"第{chunk.chapter_number}章"
+                print(f"[OK] 第{chunk.chapter_number}章：{title} "
+                      f"（{result['scenes_count']} 场景，{result['shots_count']} 镜头）")
+        finally:
+            # 出错时取消所有仍在进行的请求
+            for task in extraction_tasks + generation_tasks:
+                if task is not None and not task.done():
+                    task.cancel()
+
+        return self._finish_novel(file_path, chunks, chapter_results, start_time, output_path)
+
+    def process_novel_batch(self, file_path: str, output_path: Optional[str] = None,
+                            batch_runner: Optional[BatchRunner] = None) -> Dict[str, Any]:
+        """
+        处理整部小说（离线批处理版本）
+
+        适合只在乎成本和限流、不在乎延迟的夜间任务。全部请求分三轮通过
+        Batch API 提交，每轮全部完成后再构建下一轮：
+        1. 所有章节的人物、关系、时间线提取（或融合提取）
+        2. 按章节顺序合并记忆后，所有事件的场景生成
+        3. 所有场景的分镜生成
+
+        提交提取请求时之前章节的结果尚未返回，因此提取上下文只包含上一章原文
+        （与向量记忆模式下的同步版本一致，使用传统 MemoryBank 时不含之前章节
+        合并的记忆）；场景与分镜使用的记忆上下文与同步版本一致。
+
+        Args:
+            file_path: 小说文件路径
+            output_path: 输出文件路径（可选）
+            batch_runner: 批处理提交器（默认使用 self.llm_client 的端点）
+
+        Returns:
+            处理结果字典（与 process_novel 相同）
+        """
+        runner = batch_runner or BatchRunner(self.llm_client)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        start_time = datetime.now()
+        chunks = self.load_novel(file_path)
+
+        print(f"\n[START] 开始批处理长篇小说...")
+        print(f"   启用记忆合并：{self.enable_memory_merge}")
+        print(f"   工作目录：{runner.work_dir}")
+
+        # 第一轮：提取
+        extractors = {
+            "character": self.character_extractor,
+            "relationship": self.relationship_extractor,
+            "timeline": self.timeline_extractor
+        }
+        requests = []
+        chapter_texts = []
+        for i, chunk in enumerate(chunks):
+            _, memory_context, previous_context = self.chunking_pipeline.get_chunk_context_parts(i)
+            if self.fused_extractor is not None:
+                context, text = self._fused_extraction_parts(chunk, memory_context, previous_context)
+                chapter_texts.append({"extraction": (text, context)})
+                requests.append(BatchRequest(f"ch{i}-extraction", "extraction",
+                                             self.fused_extractor.build_messages(text, context)))
+                continue
+            texts = self._extraction_texts(chunk, memory_context, previous_context)
+            chapter_texts.append(texts)
+            for stage, extractor in extractors.items():
+                requests.append(BatchRequest(f"ch{i}-{stage}", stage, extractor.build_messages(*texts[stage])))
+        responses = runner.run(requests, f"{name}-extraction")
+
+        # 按章节顺序合并记忆
+        extracted_results = []
+        memory_contexts = []
         for i, chunk in enumerate(chunks):
-            result = self.process_chunk(chunk)
+            if self.fused_extractor is not None:
+                extracted = self._batch_extraction("extraction", self.fused_extractor,
+                                                   responses[f"ch{i}-extraction"], *chapter_texts[i]["extraction"])
+                if isinstance(extracted, BaseException):
+                    raise extracted
+            else:
+                extracted = self._collect_extractions(chunk, [
+                    self._batch_extraction(stage, extractor, responses[f"ch{i}-{stage}"], *chapter_texts[i][stage])
+                    for stage, extractor in extractors.items()
+                ])
+            for event in extracted["timeline_events"]:
+                event.chapter = chunk.chapter_number
+            extracted_results.append(extracted)
+            memory_contexts.append(self._merge_extracted(extracted, chunk))
+            self._maybe_save_checkpoint(i, chunk)
+
+        # 第二轮：场景
+        requests = [
+            BatchRequest(f"ch{i}-event{j}", "scene",
+                         self.script_generator.build_messages(event, memory_contexts[i]), 0.8)
+            for i, extracted in enumerate(extracted_results)
+            for j, event in enumerate(extracted["timeline_events"])
+        ]
+        responses = runner.run(requests, f"{name}-scene")
+        chapter_scenes = [
+            [self._batch_scene(responses[f"ch{i}-event{j}"], event)
+             for j, event in enumerate(extracted["timeline_events"])]
+            for i, extracted in enumerate(extracted_results)
+        ]
+
+        # 第三轮：分镜
+        requests = [
+            BatchRequest(f"ch{i}-scene{j}", "storyboard",
+                         self.storyboard_generator.build_messages(scene, memory_contexts[i]), 0.8)
+            for i, scenes in enumerate(chapter_scenes)
+            for j, scene in enumerate(scenes)
+        ]
+        responses = runner.run(requests, f"{name}-storyboard")
+
+        chapter_results = []
+        for i, chunk in enumerate(chunks):
+            storyboard_shots = []
+            for j, scene in enumerate(chapter_scenes[i]):
+                storyboard_shots.extend(self._batch_shots(responses[f"ch{i}-scene{j}"], scene, memory_contexts[i]))
+            result = self._accumulate_chunk_result(chunk, extracted_results[i], chapter_scenes[i], storyboard_shots)
+            self.chunking_pipeline.mark_processed(i)
             chapter_results.append(result)
 
-            # 定期保存检查点
-            if self.enable_checkpoint and (i + 1) % self.checkpoint_interval == 0:
-                checkpoint_path = f".checkpoint_ch{chunk.chapter_number}.json"
-                self.chunking_pipeline.save_checkpoint(checkpoint_path)
-                print(f"  [OK] 已保存检查点：{checkpoint_path}")
+        stats = runner.stats()
+        print(f"[BATCH] 共提交 {stats['batches']} 个批处理任务，{stats['submitted']} 个请求通过批处理完成，"
+              f"{stats['cache_hits']} 个命中缓存，{stats['live_calls']} 个实时调用")
+        return self._finish_novel(file_path, chunks, chapter_results, start_time, output_path)
+
+    @staticmethod
+    def _batch_extraction(stage: str, extractor: Any, outcome: Any, text: str, context: str) -> Any:
+        """
+        批处理取回的提取响应 -> 提取结果
 
+        实时回退仍被截断时与同步流水线一样拆分正文重新提取；其余失败返回异常而不抛出，
+        与 _run_extractor 一样交给 _collect_extractions 按提取器隔离
+        """
+        try:
+            with llm_stage(stage):
+                if isinstance(outcome, ResponseTruncatedError):
+                    return extractor.merge_results(split_after_truncation(extractor, outcome, text, context))
+                if isinstance(outcome, BaseException):
+                    return outcome
+                return extractor.parse_response(outcome)
+        except Exception as e:
+            return e
+
+    def _batch_scene(self, outcome: Any, event: TimelineEvent) -> ScriptScene:
+        """批处理取回的场景响应 -> 场景（被截断时保留已完成的部分，其余失败使用基础场景）"""
+        if isinstance(outcome, ResponseTruncatedError):
+            outcome = self.script_generator.truncated_response(event, outcome)
+        elif isinstance(outcome, BaseException):
+            print(f"  [WARN] 事件 {event.id} 的场景生成失败，使用基础场景：{outcome}")
+            outcome = ""
+        return self.script_generator.parse_response(outcome, event)
+
+    def _batch_shots(self, outcome: Any, scene: ScriptScene, memory_context: str) -> List[StoryboardShot]:
+        """批处理取回的分镜响应 -> 镜头（被截断时拆分场景重新生成，其余失败使用基础分镜）"""
+        try:
+            if isinstance(outcome, ResponseTruncatedError):
+                return self.storyboard_generator.retry_truncated(scene, outcome, memory_context)
+            if isinstance(outcome, BaseException):
+                raise outcome
+        except Exception as e:
+            print(f"  [WARN] 场景 {scene.id} 的分镜生成失败，使用基础分镜：{e}")
+            outcome = ""
+        return self.storyboard_generator.parse_response(outcome, scene)
+
+    def _maybe_save_checkpoint(self, index: int, chunk: TextChunk) -> None:
+        """每处理 checkpoint_interval 个章节保存一次检查点"""
+        if self.enable_checkpoint and (index + 1) % self.checkpoint_interval == 0:
+            checkpoint_path = f".checkpoint_ch{chunk.chapter_number}.json"
+            self.chunking_pipeline.save_checkpoint(checkpoint_path)
+            print(f"  [OK] 已保存检查点：{checkpoint_path}")
+
+    def _finish_novel(self, file_path: str, chunks: List[TextChunk],
+                      chapter_results: List[Dict[str, Any]], start_time: datetime,
+                      output_path: Optional[str]) -> Dict[str, Any]:
+        """保存最终记忆、汇总结果、写出文件并打印摘要"""
         # 保存最终记忆状态
         if self.enable_checkpoint:
             self.chunking_pipeline.save_checkpoint("memory_bank_final.json")
@@ -407,23 +889,193 @@ class LongNovelProcessor:
         print(f"   分镜镜头：{result['statistics']['total_shots']}")
 
 
-def create_llm_client() -> LLMClient:
-    """根据环境变量创建 LLM 客户端"""
+def create_stage_client(default: LLMClient, stage_configs: Dict[str, StageConfig]) -> LLMClient:
+    """为配置了独立模型或限流预算的阶段创建客户端，组合成 StageLLMClient
+
+    模型与限流预算相同的阶段共用一个客户端；没有阶段需要独立客户端时原样返回 default。
+    """
+    if isinstance(default, RouterLLMClient):
+        print("[INFO] 多端点路由下由各端点决定模型，忽略分阶段模型配置")
+        return default
+
+    shared: Dict[Tuple[Any, ...], LLMClient] = {}
+    clients: Dict[str, LLMClient] = {}
+    for stage, config in stage_configs.items():
+        model = config.model or getattr(default, "model", None)
+        if model == getattr(default, "model", None) and not config.has_rate_budget:
+            continue
+        # 有独立限流预算的阶段各用一个客户端，预算按阶段共享
+        key = (model, stage if config.has_rate_budget else None)
+        if key not in shared:
+            if isinstance(default, ReplayLLMClient):
+                # 回放时优先返回该阶段模型的录制
+                shared[key] = ReplayLLMClient(default.path, latency_scale=default.latency_scale,
+                                              fallback=default.fallback, model=model)
+            else:
+                # 阶段预算与账号总预算（LLM_RPM / LLM_TPM）同时生效，其余设置沿用默认客户端
+                limiter = get_stage_rate_limiter(default.base_url, default.api_key, stage,
+                                                 config.requests_per_minute, config.tokens_per_minute) \
+                    if config.has_rate_budget else getattr(default, "rate_limiter", None)
+                shared[key] = OpenAICompatibleClient(
+                    api_key=default.api_key,
+                    base_url=default.base_url,
+                    model=model,
+                    use_json_mode=getattr(default, "use_json_mode", True),
+                    max_retries=getattr(default, "max_retries", 3),
+                    retry_delay=getattr(default, "retry_delay", 1.0),
+                    pool_size=getattr(default, "pool_size", None),
+                    rate_limiter=limiter,
+                    circuit_breaker=getattr(default, "circuit_breaker", None),
+                    structured_output=getattr(default, "structured_output", None),
+                    concurrency_limiter=getattr(default, "concurrency_limiter", None)
+                )
+        clients[stage] = shared[key]
+
+    if not clients:
+        return default
+    client = StageLLMClient(default, clients)
+    models = ", ".join(f"{stage}={model}" for stage, model in client.describe().items())
+    print(f"[INFO] 分阶段模型：{models}")
+    return client
+
+
+def create_llm_client(cache_path: Optional[str] = None,
+                      record_path: Optional[str] = None,
+                      replay_path: Optional[str] = None,
+                      replay_latency: Optional[float] = None,
+                      stage_configs: Optional[Dict[str, StageConfig]] = None,
+                      hedge: Optional[bool] = None) -> LLMClient:
+    """根据环境变量创建 LLM 客户端
+
+    Args:
+        cache_path: 响应缓存文件路径（默认读取 LLM_CACHE_PATH，未设置则不缓存）
+        record_path: 录制 cassette 路径（默认读取 LLM_RECORD_PATH），真实调用会被追加写入
+        replay_path: 回放 cassette 路径（默认读取 LLM_REPLAY_PATH），设置后不访问网络
+        replay_latency: 回放时按录制延迟 × 该系数等待（默认读取 LLM_REPLAY_LATENCY，0 为不等待）
+        stage_configs: 分阶段模型与限流配置（见 llm_stages.stage_configs_from_env）
+        hedge: 是否启用对冲请求（默认读取 LLM_HEDGE），额外请求比例上限读取 LLM_HEDGE_RATIO
+    """
     api_key = os.environ.get("LLM_API_KEY")
     base_url = os.environ.get("LLM_BASE_URL")
     model = os.environ.get("LLM_MODEL", "gpt-4o-mini")
 
-    if not api_key:
-        print("⚠️  未检测到 LLM_API_KEY，将使用 Mock 客户端进行测试")
-        return MockLLMClient('{"characters": [], "relationships": [], "events": []}')
+    replay_path = replay_path or os.environ.get("LLM_REPLAY_PATH")
+    record_path = record_path or os.environ.get("LLM_RECORD_PATH")
+
+    if replay_path:
+        # 离线回放录制的真实流量
+        if replay_latency is None:
+            replay_latency = float(os.environ.get("LLM_REPLAY_LATENCY", 0) or 0)
+        client: LLMClient = ReplayLLMClient(replay_path, latency_scale=replay_latency)
+        print(f"[INFO] 回放 LLM 录制：{replay_path}（{len(client)} 条，延迟系数 {replay_latency:g}）")
+        record_path = None
+    else:
+        # 配置了多个端点时使用按延迟路由、自动故障转移的客户端
+        client = endpoints_from_env()
+        if client is not None:
+            print(f"[INFO] 已启用多端点路由：{', '.join(e.name for e in client.endpoints)}")
+        elif not api_key:
+            print("⚠️  未检测到 LLM_API_KEY，将使用 Mock 客户端进行测试")
+            return MockLLMClient('{"characters": [], "relationships": [], "events": []}')
+        else:
+            # 启用 JSON 结构化输出模式
+            client = OpenAICompatibleClient(
+                api_key=api_key,
+                base_url=base_url,
+                model=model,
+                use_json_mode=True
+            )
 
-    # 启用 JSON 结构化输出模式
-    return OpenAICompatibleClient(
-        api_key=api_key,
-        base_url=base_url,
-        model=model,
-        use_json_mode=True
-    )
+    # 可选：按阶段使用不同模型 / 限流预算
+    if stage_configs:
+        client = create_stage_client(client, stage_configs)
+
+    # 可选：模型级联（先用 LLM_CASCADE_MODEL，结果未通过校验时再用上面的模型）
+    if not isinstance(client, ReplayLLMClient):
+        client = cascade_from_env(client)
+        if isinstance(client, CascadeLLMClient):
+            print(f"[INFO] 已启用模型级联：{', '.join(client.validators)} 阶段先调用 {client.cheap.model}")
+
+    # 可选：对冲请求（超过阶段 p95 未返回时发出重复请求，取先返回的结果）
+    if hedge is None:
+        hedge = os.environ.get("LLM_HEDGE", "false").lower() == "true"
+    if hedge and not isinstance(client, ReplayLLMClient):
+        ratio = float(os.environ.get("LLM_HEDGE_RATIO", DEFAULT_MAX_EXTRA_RATIO))
+        client = HedgedLLMClient(client, max_extra_ratio=ratio)
+        print(f"[INFO] 已启用对冲请求（额外请求上限 {ratio * 100:.0f}%）")
+
+    # 可选：录制真实请求/响应（录制时建议不启用缓存，以便完整记录每次调用及其延迟）
+    if record_path:
+        client = RecordingLLMClient(client, record_path)
+        print(f"[INFO] 录制 LLM 调用到：{record_path}")
+
+    # 可选：磁盘响应缓存
+    cache_path = cache_path or os.environ.get("LLM_CACHE_PATH")
+    if cache_path:
+        ttl = os.environ.get("LLM_CACHE_TTL")
+        client = CachedLLMClient(
+            client,
+            cache_path=cache_path,
+            max_bytes=int(float(os.environ.get("LLM_CACHE_MAX_MB", DEFAULT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024),
+            ttl_seconds=float(ttl) if ttl else None
+        )
+        print(f"[INFO] 已启用 LLM 响应缓存：{cache_path}")
+
+    # 合并进程内同时在途的相同请求（不同 API 任务共享同一合并组）
+    client = SingleFlightLLMClient(client)
+
+    return client
+
+
+def print_llm_client_stats(client: LLMClient) -> None:
+    """打印客户端包装链上各层的运行统计"""
+    while client is not None:
+        if isinstance(client, CachedLLMClient):
+            stats = client.stats()
+            print(f"[CACHE] 命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+                  f"命中率 {stats['hit_rate'] * 100:.1f}%，淘汰 {stats['evictions']} 条")
+        if isinstance(client, SingleFlightLLMClient):
+            stats = client.stats()
+            print(f"[SINGLE-FLIGHT] 上游调用 {stats['calls']} 次，合并重复请求 {stats['coalesced']} 次")
+        if isinstance(client, HedgedLLMClient):
+            stats = client.stats()
+            print(f"[HEDGE] 对冲 {stats['hedged']} 次（占调用 {stats['extra_ratio'] * 100:.1f}%），"
+                  f"其中对冲请求先返回 {stats['hedge_wins']} 次")
+        if isinstance(client, ReplayLLMClient):
+            stats = client.stats()
+            print(f"[REPLAY] 命中 {stats['hits']} 次，未录制 {stats['misses']} 次")
+        if isinstance(client, RecordingLLMClient):
+            print(f"[RECORD] 已录制 {client.recorded} 次调用到 {client.path}")
+        if isinstance(client, StageLLMClient):
+            for stage_client in client.distinct_clients():
+                print_llm_client_stats(stage_client)
+        if isinstance(client, CascadeLLMClient):
+            for stage, stats in sorted(client.stats().items()):
+                print(f"[CASCADE] {stage}：廉价模型 {stats['calls']} 次，升级到强模型 {stats['escalated']} 次"
+                      f"（{stats['escalation_rate'] * 100:.1f}%）")
+            print_llm_client_stats(client.cheap)
+            print_llm_client_stats(client.strong)
+        if isinstance(client, RouterLLMClient):
+            for endpoint in client.stats():
+                latency = endpoint["latency_ewma"]
+                print(f"[ROUTER] {endpoint['name']}：调用 {endpoint['calls']} 次，失败 {endpoint['failures']} 次，"
+                      f"平均延迟 {latency if latency is not None else 0:.2f} 秒")
+        limiter = getattr(client, "rate_limiter", None) if not isinstance(client, LLMClientWrapper) else None
+        if limiter is not None:
+            stats = limiter.stats()
+            print(f"[RATE] 限流等待 {stats['throttled_requests']} 次，"
+                  f"累计 {stats['total_wait_seconds']:.1f} 秒")
+        breaker = getattr(client, "circuit_breaker", None) if not isinstance(client, LLMClientWrapper) else None
+        if breaker is not None and breaker.times_opened:
+            stats = breaker.stats()
+            print(f"[CIRCUIT] 熔断 {stats['times_opened']} 次，快速失败 {stats['rejected']} 次调用，"
+                  f"当前状态 {stats['state']}")
+        concurrency = getattr(client, "concurrency_limiter", None) if not isinstance(client, LLMClientWrapper) else None
+        if concurrency is not None:
+            stats = concurrency.stats()
+            print(f"[CONCURRENCY] 自适应并发上限 {stats['limit']}（区间 {stats['min_seen']}-{stats['max_seen']}），"
+                  f"上调 {stats['increases']} 次，下调 {stats['decreases']} 次")
+        client = client.client if isinstance(client, LLMClientWrapper) else None
 
 
 def main():
@@ -441,6 +1093,15 @@ def main():
 
   # 仅处理单个章节（测试用）
   python main.py --file novel.txt --chapter 1
+
+  # 崩溃后重跑时复用已完成的 LLM 调用
+  python main.py --file novel.txt --output result.json --cache .llm_cache.sqlite3
+
+  # 异步并发处理（最多 16 个请求同时在途）
+  python main.py --file novel.txt --output result.json --async --concurrency 16
+
+  # 夜间任务：通过 Batch API 离线提交（成本更低，完成时间最长 24 小时）
+  python main.py --file novel.txt --output result.json --batch
         """
     )
 
@@ -491,6 +1152,88 @@ def main():
         help="仅处理指定章节（用于测试）"
     )
 
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="使用 asyncio 并发处理章节、场景和分镜请求"
+    )
+
+    parser.add_argument(
+        "--fused-extraction",
+        action="store_true",
+        help="融合提取：每章一次调用同时提取人物、关系和时间线（调用次数和输入 token 约为三分之一）"
+    )
+
+    parser.add_argument(
+        "--compact-output",
+        action="store_true",
+        default=None,
+        help="紧凑响应格式：要求模型使用短键和枚举代码返回 JSON，减少输出 token（默认读取 LLM_COMPACT_OUTPUT）"
+    )
+
+    parser.add_argument(
+        "--extraction-workers",
+        type=int,
+        default=DEFAULT_EXTRACTION_WORKERS,
+        help=f"同步模式下每章人物、关系、时间线提取的并发线程数（默认 {DEFAULT_EXTRACTION_WORKERS}，1 表示依次执行）"
+    )
+
+    parser.add_argument(
+        "--batch",
+        type=str,
+        nargs="?",
+        const=DEFAULT_BATCH_DIR,
+        default=None,
+        metavar="DIR",
+        help=f"通过 Batch API 离线提交全部请求，可指定工作目录（默认 {DEFAULT_BATCH_DIR}）"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=max_concurrency_from_env(),
+        help=f"异步模式下同时在途的 LLM 请求上限（默认 {DEFAULT_MAX_CONCURRENCY}；"
+             f"启用 LLM_ADAPTIVE_CONCURRENCY 时为自适应上限的天花板）"
+    )
+
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="LLM 响应缓存文件路径（SQLite），重跑时复用已完成的调用"
+    )
+
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="把真实 LLM 请求/响应录制到 cassette 文件（JSON Lines）"
+    )
+
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="从 cassette 文件回放 LLM 响应（离线运行，不访问网络）"
+    )
+
+    parser.add_argument(
+        "--replay-latency",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=None,
+        help="回放时按录制延迟等待，可指定倍率（默认不等待；仅写该参数时为 1.0）"
+    )
+
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        default=None,
+        help="启用对冲请求：调用超过所在阶段 p95 延迟时发出重复请求，取先返回的结果"
+    )
+
     args = parser.parse_args()
 
     # 检查文件是否存在
@@ -498,8 +1241,16 @@ def main():
         print(f"[ERROR] 错误：文件不存在 - {args.file}")
         sys.exit(1)
 
-    # 创建 LLM 客户端
-    llm_client = create_llm_client()
+    # 创建 LLM 客户端（可按阶段使用不同模型、并发与限流预算）
+    stage_configs = stage_configs_from_env()
+    llm_client = create_llm_client(
+        cache_path=args.cache,
+        record_path=args.record,
+        replay_path=args.replay,
+        replay_latency=args.replay_latency,
+        stage_configs=stage_configs,
+        hedge=args.hedge
+    )
 
     # 创建处理器
     processor = LongNovelProcessor(
@@ -507,15 +1258,63 @@ def main():
         max_chunk_size=args.chunk_size,
         enable_memory_merge=not args.no_memory_merge,
         enable_checkpoint=not args.no_checkpoint,
-        checkpoint_interval=args.checkpoint_interval
+        checkpoint_interval=args.checkpoint_interval,
+        max_concurrency=args.concurrency,
+        stage_concurrency={
+            stage: config.max_concurrency
+            for stage, config in stage_configs.items() if config.max_concurrency
+        },
+        max_prompt_tokens=int(os.environ["MAX_TOKENS_PER_CHUNK"]) if os.environ.get("MAX_TOKENS_PER_CHUNK") else None,
+        stage_prompt_tokens={
+            stage: config.max_prompt_tokens
+            for stage, config in stage_configs.items() if config.max_prompt_tokens
+        },
+        fused_extraction=args.fused_extraction,
+        extraction_workers=args.extraction_workers,
+        compact_output=args.compact_output
     )
 
     # 处理小说
     try:
-        result = processor.process_novel(
-            file_path=args.file,
-            output_path=args.output
-        )
+        if args.batch:
+            runner = BatchRunner(
+                processor.llm_client,
+                work_dir=args.batch,
+                poll_interval=float(os.environ.get("LLM_BATCH_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+            )
+            result = processor.process_novel_batch(
+                file_path=args.file,
+                output_path=args.output,
+                batch_runner=runner
+            )
+        elif args.use_async:
+            async def run_async():
+                try:
+                    return await processor.aprocess_novel(
+                        file_path=args.file,
+                        output_path=args.output
+                    )
+                finally:
+                    await aclose_shared_clients()
+
+            result = asyncio.run(run_async())
+        else:
+            result = processor.process_novel(
+                file_path=args.file,
+                output_path=args.output
+            )
+        print_llm_client_stats(llm_client)
+        for line in get_telemetry().format_summary():
+            print(line)
+        for stage, planner in processor.token_budgets.items():
+            stats = planner.stats()
+            if stats["trimmed_calls"]:
+                print(f"[BUDGET] {stage}：{stats['trimmed_calls']} 次请求裁剪了上下文，"
+                      f"共约 {stats['trimmed_tokens']} token")
+        prices = model_prices_from_env()
+        if prices:
+            for line in format_stage_costs(get_telemetry().records, prices):
+                print(line)
         print("\n[OK] 处理完成！")
     except Exception as e:
         print(f"\n[ERROR] 处理失败：{e}")
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""客户端限流器 - 基于 RPM/TPM 预算的令牌桶
+
+在请求发出之前主动限流，而不是等到服务端返回 429 后再指数退避：
+1. 请求数桶（RPM）和 token 数桶（TPM）分别计数
+2. 发送前按 prompt 大小预估 token 消耗，收到响应后用 response.usage 校正
+3. 服务端返回 Retry-After 时暂停整个限流器，所有线程一起等待，而不是各自重试
+4. 同一 (base_url, api_key) 在进程内共享一个限流器，所有提取器和生成器共同消耗预算；
+   设置 LLM_SHARED_LIMITS_PATH 后本机所有进程共享同一份预算（见 shared_limits）
+5. 阶段独立预算（见 get_stage_rate_limiter）同样按进程级 / 跨进程共享，并且仍计入账号总预算
+"""
+import asyncio
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Tuple, Any
+
+
+# 令牌桶允许的突发时长（秒）：桶容量 = 每秒速率 × 突发时长
+DEFAULT_BURST_SECONDS = 10.0
+
+
+class TokenBucket:
+    """令牌桶（允许透支）
+
+    reserve 立即扣除令牌并返回需要等待的秒数；余额为负表示透支，
+    后续预约按顺序排队，因此并发调用方会被均匀地错开，而不是同时醒来。
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = DEFAULT_BURST_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        初始化令牌桶
+
+        Args:
+            rate_per_minute: 每分钟补充的令牌数
+            burst_seconds: 桶容量对应的秒数
+            clock: 单调时钟（测试时可替换）
+        """
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate_per_second * burst_seconds)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_second)
+            self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """预约 amount 个令牌，返回需要等待的秒数（调用方负责加锁）"""
+        now = self._clock()
+        self._refill(now)
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate_per_second
+
+    def adjust(self, delta: float) -> None:
+        """校正余额：delta > 0 退还令牌，delta < 0 追加扣除（调用方负责加锁）"""
+        self._refill(self._clock())
+        self._tokens = min(self.capacity, self._tokens + delta)
+
+    def snapshot(self) -> Tuple[float, float]:
+        """当前状态 (余额, 更新时间)，用于跨进程共享（见 shared_limits）"""
+        return self._tokens, self._updated_at
+
+    def restore(self, tokens: float, updated_at: float) -> None:
+        """恢复 snapshot 保存的状态"""
+        self._tokens = min(self.capacity, tokens)
+        self._updated_at = updated_at
+
+    @property
+    def available(self) -> float:
+        """当前可用令牌数（可能为负）"""
+        self._refill(self._clock())
+        return self._tokens
+
+
+class RateLimiter:
+    """RPM/TPM 双桶限流器，线程安全，同时支持同步和异步等待"""
+
+    def __init__(self, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 burst_seconds: float = DEFAULT_BURST_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        初始化限流器
+
+        Args:
+            requests_per_minute: 每分钟请求数上限（None 表示不限制）
+            tokens_per_minute: 每分钟 token 数上限（None 表示不限制）
+            burst_seconds: 允许的突发时长（秒）
+            clock: 单调时钟（测试时可替换）
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._request_bucket = TokenBucket(requests_per_minute, burst_seconds, clock) \
+            if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute, burst_seconds, clock) \
+            if tokens_per_minute else None
+        self._blocked_until = 0.0
+
+        self.throttled_requests = 0
+        self.total_wait_seconds = 0.0
+
+    def reserve(self, estimated_tokens: int) -> float:
+        """
+        为一次请求预约预算
+
+        Args:
+            estimated_tokens: 预估的 token 消耗（prompt + 预期输出）
+
+        Returns:
+            发送请求前需要等待的秒数
+        """
+        with self._lock:
+            wait = max(0.0, self._blocked_until - self._clock())
+            if self._request_bucket:
+                wait = max(wait, self._request_bucket.reserve(1))
+            if self._token_bucket:
+                wait = max(wait, self._token_bucket.reserve(estimated_tokens))
+
+            if wait > 0:
+                self.throttled_requests += 1
+                self.total_wait_seconds += wait
+            return wait
+
+    def acquire(self, estimated_tokens: int) -> float:
+        """同步等待直到预算允许发送请求，返回实际等待的秒数"""
+        wait = self.reserve(estimated_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def areserve(self, estimated_tokens: int) -> float:
+        """reserve 的异步版本（进程内限流器直接预约）"""
+        return self.reserve(estimated_tokens)
+
+    async def aacquire(self, estimated_tokens: int) -> float:
+        """异步等待直到预算允许发送请求，返回实际等待的秒数"""
+        wait = await self.areserve(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """用服务端返回的实际 token 数校正预估值"""
+        if not self._token_bucket:
+            return
+        with self._lock:
+            self._token_bucket.adjust(estimated_tokens - actual_tokens)
+
+    def penalize(self, retry_after: float) -> None:
+        """服务端要求暂停时（Retry-After），在此期间阻塞所有预约"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self._clock() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回限流统计"""
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "throttled_requests": self.throttled_requests,
+            "total_wait_seconds": self.total_wait_seconds
+        }
+
+
+class CompositeRateLimiter(RateLimiter):
+    """同时从多个限流器预约预算（如阶段预算 + 账号总预算），等待时间取最长者"""
+
+    def __init__(self, *limiters: RateLimiter):
+        super().__init__()
+        self.limiters = limiters
+        self.requests_per_minute = min((l.requests_per_minute for l in limiters if l.requests_per_minute),
+                                       default=None)
+        self.tokens_per_minute = min((l.tokens_per_minute for l in limiters if l.tokens_per_minute),
+                                     default=None)
+
+    def _record_wait(self, wait: float) -> float:
+        if wait > 0:
+            with self._lock:
+                self.throttled_requests += 1
+                self.total_wait_seconds += wait
+        return wait
+
+    def reserve(self, estimated_tokens: int) -> float:
+        return self._record_wait(max(l.reserve(estimated_tokens) for l in self.limiters))
+
+    async def areserve(self, estimated_tokens: int) -> float:
+        waits = [await l.areserve(estimated_tokens) for l in self.limiters]
+        return self._record_wait(max(waits))
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        for limiter in self.limiters:
+            limiter.reconcile(estimated_tokens, actual_tokens)
+
+    def penalize(self, retry_after: float) -> None:
+        for limiter in self.limiters:
+            limiter.penalize(retry_after)
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """
+    从 API 异常的响应头中解析 Retry-After
+
+    支持 retry-after-ms（毫秒）、retry-after（秒数或 HTTP 日期）。
+
+    Returns:
+        需要等待的秒数；没有该响应头时返回 None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ==================== 进程级共享限流器 ====================
+
+# 按进程区分：fork 出的子进程不共用父进程的 SQLite 连接（见 shared_limits）
+_shared_limiters: Dict[Tuple[str, str, str, int], RateLimiter] = {}
+_shared_limiters_lock = threading.Lock()
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _get_limiter(base_url: Optional[str], api_key: Optional[str], scope: str,
+                 rpm: Optional[float], tpm: Optional[float]) -> RateLimiter:
+    """按 (base_url, api_key, 范围) 取进程级共享限流器；设置了 LLM_SHARED_LIMITS_PATH 时预算跨进程共享"""
+    key = (base_url or "", api_key or "", scope, os.getpid())
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(key)
+        if limiter is None:
+            path = os.environ.get("LLM_SHARED_LIMITS_PATH")
+            if path:
+                from shared_limits import SharedRateLimiter, get_limit_store, limit_key
+                shared_key = limit_key(base_url, api_key) + (f"/{scope}" if scope else "")
+                limiter = SharedRateLimiter(get_limit_store(path), shared_key,
+                                            requests_per_minute=rpm, tokens_per_minute=tpm)
+            else:
+                limiter = RateLimiter(requests_per_minute=rpm, tokens_per_minute=tpm)
+            _shared_limiters[key] = limiter
+        return limiter
+
+
+def get_shared_rate_limiter(base_url: Optional[str] = None,
+                            api_key: Optional[str] = None) -> Optional[RateLimiter]:
+    """
+    获取 (base_url, api_key) 对应的进程级共享限流器
+
+    预算从环境变量 LLM_RPM / LLM_TPM 读取；两者都未配置时返回 None（不限流）。
+    设置了 LLM_SHARED_LIMITS_PATH 时预算保存在该 SQLite 文件中，本机所有进程共同消耗（见 shared_limits）。
+    """
+    rpm = _env_float("LLM_RPM")
+    tpm = _env_float("LLM_TPM")
+    if not rpm and not tpm:
+        return None
+    return _get_limiter(base_url, api_key, "", rpm, tpm)
+
+
+def get_stage_rate_limiter(base_url: Optional[str], api_key: Optional[str], stage: str,
+                           requests_per_minute: Optional[float] = None,
+                           tokens_per_minute: Optional[float] = None) -> Optional[RateLimiter]:
+    """
+    获取带阶段预算的限流器
+
+    阶段预算按 (base_url, api_key, 阶段) 共享（设置 LLM_SHARED_LIMITS_PATH 时跨进程共享），
+    同时仍从账号总预算（get_shared_rate_limiter）中扣除，各阶段合计不会超出账号上限。
+
+    Returns:
+        阶段没有预算时返回账号限流器（可能为 None）；没有账号预算时只返回阶段限流器
+    """
+    account = get_shared_rate_limiter(base_url, api_key)
+    if not requests_per_minute and not tokens_per_minute:
+        return account
+    limiter = _get_limiter(base_url, api_key, stage, requests_per_minute, tokens_per_minute)
+    return limiter if account is None else CompositeRateLimiter(limiter, account)
+
+
+def reset_shared_rate_limiters() -> None:
+    """清空共享限流器（测试或重新加载配置时使用）"""
+    with _shared_limiters_lock:
+        _shared_limiters.clear()
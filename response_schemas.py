@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""结构化输出 Schema - 由 models.py 的数据类生成各阶段的严格 JSON Schema
+
+response_format={"type": "json_object"} 只保证返回合法 JSON，字段缺失、类型不符
+（如 chapter 写成 "第1章"）或顶层键拼错时，解析阶段仍会失败并走回退逻辑
+（ScriptGenerator 的回退还要额外调用一次 LLM）。启用结构化输出后，
+OpenAICompatibleClient 按当前阶段（llm_stage 上下文）发送
+response_format={"type": "json_schema", "strict": true, ...}，由服务端约束解码，
+响应一定符合 Schema。
+
+Schema 直接由数据类生成，模型字段变化时无需同步修改：
+- 严格模式要求所有字段都列入 required，Optional 字段以 null 表示缺省
+- 所有对象都设置 additionalProperties: false
+
+请求使用紧凑格式（见 compact_format）时发送同结构的紧凑版本：字段名换成短键，
+推导字段不出现，镜头类型和运镜方向限定为枚举代码，对白为 [人物 ID, 对白] 数组。
+"""
+import typing
+from dataclasses import fields
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from compact_format import COMPACT_FIELDS, COMPACT_KEYS, FIELD_CODES
+from models import Character, Relationship, TimelineEvent, ScriptScene, StoryboardShot
+
+
+# 无法从类型注解推断结构的字段
+FIELD_OVERRIDES: Dict[Tuple[type, str], Dict[str, Any]] = {
+    (ScriptScene, "dialogues"): {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"character_id": {"type": "string"}, "line": {"type": "string"}},
+            "required": ["character_id", "line"],
+            "additionalProperties": False
+        }
+    }
+}
+
+_SCALAR_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+
+def _type_schema(annotation: Any) -> Dict[str, Any]:
+    """把字段的类型注解转换为 JSON Schema"""
+    origin = typing.get_origin(annotation)
+    if origin is Union:
+        args = [a for a in typing.get_args(annotation) if a is not type(None)]
+        if len(args) != 1:
+            raise TypeError(f"不支持的联合类型：{annotation}")
+        schema = _type_schema(args[0])
+        return {**schema, "type": [schema["type"], "null"]}
+    if origin in (list, List):
+        return {"type": "array", "items": _type_schema(typing.get_args(annotation)[0])}
+    if annotation in _SCALAR_TYPES:
+        return {"type": _SCALAR_TYPES[annotation]}
+    raise TypeError(f"无法为类型 {annotation} 生成 JSON Schema")
+
+
+def dataclass_schema(cls: type) -> Dict[str, Any]:
+    """
+    由数据类生成严格模式的对象 Schema
+
+    所有字段都是必填的；带 Optional 注解的字段允许为 null。
+    """
+    hints = typing.get_type_hints(cls)
+    properties = {}
+    for f in fields(cls):
+        properties[f.name] = FIELD_OVERRIDES.get((cls, f.name)) or _type_schema(hints[f.name])
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+def compact_dataclass_schema(cls: type) -> Dict[str, Any]:
+    """数据类 Schema 的紧凑版本（字段名换成短键，省略推导字段）"""
+    full = dataclass_schema(cls)["properties"]
+    properties = {}
+    for name, short in COMPACT_FIELDS[cls].items():
+        schema = full[name]
+        codes = FIELD_CODES.get((cls, name))
+        if codes is not None:
+            nullable = isinstance(schema["type"], list)
+            schema = {"type": schema["type"], "enum": list(codes) + ([None] if nullable else [])}
+        elif cls is ScriptScene and name == "dialogues":
+            schema = {"type": "array", "items": {"type": "array", "items": {"type": "string"}}}
+        properties[short] = schema
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+def _envelope(members: Dict[str, Any], compact: bool = False) -> Dict[str, Any]:
+    """顶层对象：{键: 数据类} 表示单个对象，{键: [数据类]} 表示对象数组"""
+    item_schema = compact_dataclass_schema if compact else dataclass_schema
+    properties = {}
+    for key, model in members.items():
+        name = COMPACT_KEYS[key] if compact else key
+        if isinstance(model, list):
+            properties[name] = {"type": "array", "items": item_schema(model[0])}
+        else:
+            properties[name] = item_schema(model)
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+# 各阶段（与 llm_stage 标签一致）的响应结构，与对应 prompt 模板中的 JSON 格式一致
+STAGE_RESPONSES: Dict[str, Dict[str, Any]] = {
+    "character": {"characters": [Character]},
+    "relationship": {"relationships": [Relationship]},
+    "timeline": {"events": [TimelineEvent]},
+    "extraction": {"characters": [Character], "relationships": [Relationship], "events": [TimelineEvent]},
+    "scene": {"scene": ScriptScene},
+    "storyboard": {"shots": [StoryboardShot]}
+}
+
+_response_formats: Dict[Tuple[str, bool], Dict[str, Any]] = {}
+
+
+def response_schema(stage: str, compact: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    返回阶段对应的 response_format 参数
+
+    Args:
+        stage: 阶段名称
+        compact: 是否返回紧凑格式的 Schema
+
+    Returns:
+        {"type": "json_schema", "json_schema": {...}}；阶段没有固定的响应结构时返回 None
+    """
+    if stage not in STAGE_RESPONSES:
+        return None
+    key = (stage, compact)
+    if key not in _response_formats:
+        _response_formats[key] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": f"{stage}_compact_response" if compact else f"{stage}_response",
+                "strict": True,
+                "schema": _envelope(STAGE_RESPONSES[stage], compact)
+            }
+        }
+    return _response_formats[key]
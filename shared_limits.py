@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""跨进程共享的限流预算与并发名额
+
+RateLimiter 和 AIMDLimiter 只在进程内共享：`uvicorn api:app --workers 4` 的每个 worker
+和同时运行的命令行任务各自按完整预算发送请求，合起来会超出账号配额并引发 429 风暴。
+设置 LLM_SHARED_LIMITS_PATH 后，同一 (base_url, api_key) 的限流器和并发控制器把状态
+保存在该 SQLite 文件中，本机所有使用 OpenAICompatibleClient 的进程共同消耗：
+1. 令牌桶余额与 Retry-After 暂停时间：每次预约在 BEGIN IMMEDIATE 事务中读取、扣除、写回
+2. 并发名额：按进程记录在途请求数，总数达到上限时轮询等待；进程退出后遗留的名额自动回收
+3. AIMD 并发上限与上次下调时间：任一进程收到 429 都会降低所有进程的上限
+延迟基线仍按进程统计。时间使用墙上时钟（time.time），以便在进程间比较。
+SQLite 操作可能等待其他进程的写锁，异步调用方的预约、归还和校正都交给线程池执行，不阻塞事件循环。
+"""
+import asyncio
+import contextvars
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from adaptive_concurrency import (
+    AIMDLimiter, DEFAULT_INITIAL_LIMIT, DEFAULT_MIN_LIMIT, DEFAULT_MAX_LIMIT,
+    DEFAULT_INCREASE, DEFAULT_DECREASE, DEFAULT_LATENCY_TOLERANCE
+)
+from llm_telemetry import get_telemetry
+from rate_limiter import RateLimiter, TokenBucket, DEFAULT_BURST_SECONDS
+
+
+# 默认共享状态文件路径
+DEFAULT_LIMITS_PATH = ".llm_limits.sqlite3"
+
+# 并发名额已满时的轮询间隔（秒）
+DEFAULT_POLL_INTERVAL = 0.05
+
+# 等待 SQLite 写锁的超时（秒）
+LOCK_TIMEOUT = 30.0
+
+# 名额已满时检查已退出进程遗留名额的最短间隔（秒）
+RECLAIM_INTERVAL = 1.0
+
+
+def limit_key(base_url: Optional[str], api_key: Optional[str]) -> str:
+    """共享状态的键：base_url + api_key 的摘要（文件中不保存明文密钥）"""
+    digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    return f"{base_url or ''}#{digest}"
+
+
+def _run_off_loop(func: Callable[..., Any], *args: Any) -> None:
+    """
+    在事件循环线程中调用时交给默认线程池执行（不等待结果，保留当前上下文中的阶段），否则直接执行
+
+    asyncio.run 退出前会等待默认线程池中的任务完成，因此归还和校正不会丢失。
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        func(*args)
+        return
+    try:
+        loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, func, *args))
+    except RuntimeError:
+        # 事件循环正在关闭，线程池不再接受任务
+        func(*args)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedLimitStore:
+    """保存限流与并发状态的 SQLite 文件，线程安全，可被多个进程同时打开"""
+
+    def __init__(self, path: str = DEFAULT_LIMITS_PATH):
+        """
+        打开（必要时创建）共享状态文件
+
+        Args:
+            path: SQLite 文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (key, name)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS penalties (
+                    key TEXT PRIMARY KEY,
+                    blocked_until REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS concurrency (
+                    key TEXT PRIMARY KEY,
+                    limit_value REAL NOT NULL,
+                    last_decrease REAL NOT NULL,
+                    increases INTEGER NOT NULL,
+                    decreases INTEGER NOT NULL,
+                    min_seen INTEGER NOT NULL,
+                    max_seen INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS holders (
+                    key TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    in_flight INTEGER NOT NULL,
+                    PRIMARY KEY (key, pid)
+                )
+            """)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：持有进程内的锁和 SQLite 的写锁，退出时提交（异常时回滚）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """只读访问（WAL 模式下不阻塞其他进程的写入）"""
+        with self._lock:
+            yield self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SharedRateLimiter(RateLimiter):
+    """令牌桶余额保存在 SharedLimitStore 中的 RPM/TPM 限流器"""
+
+    def __init__(self, store: SharedLimitStore, key: str,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 burst_seconds: float = DEFAULT_BURST_SECONDS):
+        """
+        初始化限流器
+
+        Args:
+            store: 共享状态文件
+            key: 共享状态的键（见 limit_key）
+            requests_per_minute / tokens_per_minute / burst_seconds: 同 RateLimiter
+        """
+        super().__init__(requests_per_minute, tokens_per_minute, burst_seconds, clock=time.time)
+        self.store = store
+        self.key = key
+
+    def _buckets(self) -> List[Tuple[str, TokenBucket]]:
+        return [(name, bucket) for name, bucket in (("requests", self._request_bucket),
+                                                    ("tokens", self._token_bucket)) if bucket]
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        for name, bucket in self._buckets():
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ? AND name = ?",
+                               (self.key, name)).fetchone()
+            if row:
+                bucket.restore(*row)
+        row = conn.execute("SELECT blocked_until FROM penalties WHERE key = ?", (self.key,)).fetchone()
+        self._blocked_until = row[0] if row else 0.0
+
+    def _save(self, conn: sqlite3.Connection) -> None:
+        for name, bucket in self._buckets():
+            conn.execute("INSERT OR REPLACE INTO buckets (key, name, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                         (self.key, name, *bucket.snapshot()))
+        conn.execute("INSERT OR REPLACE INTO penalties (key, blocked_until) VALUES (?, ?)",
+                     (self.key, self._blocked_until))
+
+    def reserve(self, estimated_tokens: int) -> float:
+        with self.store.transaction() as conn:
+            self._load(conn)
+            wait = super().reserve(estimated_tokens)
+            self._save(conn)
+        return wait
+
+    async def areserve(self, estimated_tokens: int) -> float:
+        """预约在线程池中执行，等待 SQLite 写锁时不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.reserve, estimated_tokens)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        if self._token_bucket:
+            _run_off_loop(self._reconcile, estimated_tokens, actual_tokens)
+
+    def _reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        with self.store.transaction() as conn:
+            self._load(conn)
+            super().reconcile(estimated_tokens, actual_tokens)
+            self._save(conn)
+
+    def penalize(self, retry_after: float) -> None:
+        _run_off_loop(self._penalize, retry_after)
+
+    def _penalize(self, retry_after: float) -> None:
+        with self.store.transaction() as conn:
+            self._load(conn)
+            super().penalize(retry_after)
+            self._save(conn)
+
+
+class SharedConcurrencyLimiter(AIMDLimiter):
+    """在途请求数与 AIMD 上限保存在 SharedLimitStore 中的并发控制器"""
+
+    def __init__(self, store: SharedLimitStore, key: str,
+                 initial_limit: int = DEFAULT_INITIAL_LIMIT,
+                 min_limit: int = DEFAULT_MIN_LIMIT, max_limit: int = DEFAULT_MAX_LIMIT,
+                 increase: float = DEFAULT_INCREASE, decrease: float = DEFAULT_DECREASE,
+                 latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+                 name: str = "", poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """
+        初始化并发控制器
+
+        Args:
+            store: 共享状态文件
+            key: 共享状态的键（见 limit_key）
+            poll_interval: 名额已满时的轮询间隔（秒）
+            其余参数同 AIMDLimiter；initial_limit 只在共享状态中还没有上限时使用
+        """
+        super().__init__(initial_limit, min_limit, max_limit, increase, decrease, latency_tolerance,
+                         name=name, clock=time.time)
+        self.store = store
+        self.key = key
+        self.poll_interval = poll_interval
+        self._pid = os.getpid()
+        self._waiting = 0
+        self._last_reclaim = float("-inf")
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        row = conn.execute(
+            "SELECT limit_value, last_decrease, increases, decreases, min_seen, max_seen "
+            "FROM concurrency WHERE key = ?", (self.key,)
+        ).fetchone()
+        if row:
+            limit, self._last_decrease, self.increases, self.decreases, self.min_seen, self.max_seen = row
+            self.limit = min(float(self.max_limit), max(float(self.min_limit), limit))
+
+    def _save(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO concurrency "
+            "(key, limit_value, last_decrease, increases, decreases, min_seen, max_seen) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.key, self.limit, max(0.0, self._last_decrease), self.increases, self.decreases,
+             self.min_seen, self.max_seen)
+        )
+
+    def _total_in_flight(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT COALESCE(SUM(in_flight), 0) FROM holders WHERE key = ?",
+                           (self.key,)).fetchone()
+        return row[0]
+
+    def _reclaim(self, conn: sqlite3.Connection) -> None:
+        """回收已退出进程遗留的名额"""
+        self._last_reclaim = time.monotonic()
+        rows = conn.execute("SELECT pid FROM holders WHERE key = ? AND pid != ?", (self.key, self._pid))
+        for pid in [row[0] for row in rows.fetchall() if not _pid_alive(row[0])]:
+            conn.execute("DELETE FROM holders WHERE key = ? AND pid = ?", (self.key, pid))
+
+    def try_acquire(self) -> bool:
+        """
+        不等待地尝试占用一个名额
+
+        实例状态（上限、计数、延迟基线）只在 SharedLimitStore 的锁内读写，不另外持有实例锁。
+        """
+        # 轮询时先只读检查，名额已满时不争抢写锁
+        with self.store.read() as conn:
+            self._load(conn)
+            full = self._total_in_flight(conn) >= self.capacity
+            if full and time.monotonic() - self._last_reclaim < RECLAIM_INTERVAL:
+                return False
+        return self._acquire_slot()
+
+    def _acquire_slot(self) -> bool:
+        with self.store.transaction() as conn:
+            self._load(conn)
+            total = self._total_in_flight(conn)
+            if total >= self.capacity:
+                self._reclaim(conn)
+                total = self._total_in_flight(conn)
+                if total >= self.capacity:
+                    return False
+            conn.execute(
+                "INSERT INTO holders (key, pid, in_flight) VALUES (?, ?, 1) "
+                "ON CONFLICT(key, pid) DO UPDATE SET in_flight = in_flight + 1",
+                (self.key, self._pid)
+            )
+            self.in_flight += 1
+            self._save(conn)
+            return True
+
+    def _return_slot(self) -> None:
+        """归还名额，不调整上限"""
+        with self.store.transaction() as conn:
+            conn.execute("UPDATE holders SET in_flight = MAX(in_flight - 1, 0) WHERE key = ? AND pid = ?",
+                         (self.key, self._pid))
+            self.in_flight -= 1
+
+    def acquire(self) -> float:
+        """同步等待一个名额（名额已满时轮询），返回开始时间"""
+        with self._lock:
+            self._waiting += 1
+        try:
+            while not self.try_acquire():
+                time.sleep(self.poll_interval)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        return self._clock()
+
+    async def aacquire(self) -> float:
+        """异步等待一个名额（每次尝试在线程池中执行，不阻塞事件循环），返回开始时间"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while not await self._atry_acquire(loop):
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        return self._clock()
+
+    async def _atry_acquire(self, loop: asyncio.AbstractEventLoop) -> bool:
+        future = loop.run_in_executor(None, self.try_acquire)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 线程池中的尝试可能已经占用了名额，完成后归还
+            future.add_done_callback(self._return_if_acquired)
+            raise
+
+    def _return_if_acquired(self, future: "asyncio.Future[bool]") -> None:
+        if not future.cancelled() and future.exception() is None and future.result():
+            _run_off_loop(self._return_slot)
+
+    def release(self, started: float, error: Optional[BaseException] = None,
+                latency: Optional[float] = None) -> None:
+        now = self._clock()
+        _run_off_loop(self._release, now, error, now - started if latency is None else latency)
+
+    def _release(self, now: float, error: Optional[BaseException], latency: float) -> None:
+        with self.store.transaction() as conn:
+            self._load(conn)
+            saturated = self._total_in_flight(conn) >= self.capacity
+            conn.execute("UPDATE holders SET in_flight = MAX(in_flight - 1, 0) WHERE key = ? AND pid = ?",
+                         (self.key, self._pid))
+            self.in_flight -= 1
+            changed = self._adjust(now, saturated, error, latency)
+            self._save(conn)
+            limit = self.capacity
+        if changed:
+            get_telemetry().record_concurrency(self.name, limit, changed == "decrease")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回共享的上限与调整次数；in_flight 为所有进程的在途请求数，waiting 为本进程的等待数"""
+        with self.store.read() as conn:
+            self._load(conn)
+            in_flight = self._total_in_flight(conn)
+            return {
+                "limit": self.capacity,
+                "in_flight": in_flight,
+                "waiting": self._waiting,
+                "min_seen": self.min_seen,
+                "max_seen": self.max_seen,
+                "increases": self.increases,
+                "decreases": self.decreases
+            }
+
+
+# ==================== 进程级共享 ====================
+
+_stores: Dict[Tuple[str, int], SharedLimitStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_limit_store(path: str = DEFAULT_LIMITS_PATH) -> SharedLimitStore:
+    """获取本进程打开的共享状态文件（按进程区分，fork 出的子进程会重新打开）"""
+    key = (os.path.abspath(path), os.getpid())
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = SharedLimitStore(path)
+            _stores[key] = store
+        return store
+
+
+def close_limit_stores() -> None:
+    """关闭本进程打开的共享状态文件（测试时使用）"""
+    with _stores_lock:
+        for (_, pid), store in _stores.items():
+            if pid == os.getpid():
+                store.close()
+        _stores.clear()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""单飞（single-flight）请求合并
+
+多个 API 任务处理相同或重叠的上传、或者重试风暴重复发出同一个 prompt 时，
+完全相同的请求会同时打到 LLM。单飞层按请求指纹合并在途请求：
+第一个调用方（leader）真正发出请求，其余并发调用方等待并共享同一结果
+（包括异常），不再重复计费。
+
+只合并"同时在途"的请求；请求完成后不保留结果（持久复用交给 llm_cache）。
+流式调用（stream_chat）原样转发，不参与合并。
+"""
+import asyncio
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from llm_client import LLMClient, LLMClientWrapper, client_fingerprint
+
+
+class _Call:
+    """一次同步在途调用"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlightGroup:
+    """按键合并并发调用，线程安全；同步与异步调用分别合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        # asyncio.Future 绑定事件循环，按循环分别记录
+        self._async_calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]" = \
+            weakref.WeakKeyDictionary()
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        执行 fn，若相同 key 的调用正在进行则等待其结果
+
+        Args:
+            key: 合并键（通常是请求指纹）
+            fn: 无参调用，仅由 leader 执行
+
+        Returns:
+            fn 的返回值；leader 抛出的异常会同样抛给所有等待者
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        do 的异步版本
+
+        上游调用作为独立任务运行，某个调用方被取消不会影响其他等待者。
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            calls = self._async_calls.setdefault(loop, {})
+            future = calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                future = asyncio.ensure_future(fn())
+                calls[key] = future
+                self.calls += 1
+                future.add_done_callback(lambda _f: self._forget_async(loop, key, _f))
+
+        return await asyncio.shield(future)
+
+    def _forget_async(self, loop: asyncio.AbstractEventLoop, key: str, future: asyncio.Future) -> None:
+        with self._lock:
+            calls = self._async_calls.get(loop)
+            if calls is not None and calls.get(key) is future:
+                del calls[key]
+        # 所有等待者都已取消时避免 "exception was never retrieved" 警告
+        if not future.cancelled():
+            future.exception()
+
+    def in_flight(self) -> int:
+        """当前在途（未完成）的合并键数量"""
+        with self._lock:
+            return len(self._calls) + sum(len(c) for c in self._async_calls.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """返回合并统计"""
+        total = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesce_rate": self.coalesced / total if total else 0.0
+        }
+
+
+class SingleFlightLLMClient(LLMClientWrapper):
+    """按请求指纹合并并发相同请求的 LLM 客户端，可包装任意 LLMClient"""
+
+    def __init__(self, client: LLMClient, group: Optional[SingleFlightGroup] = None):
+        """
+        初始化单飞客户端
+
+        Args:
+            client: 被包装的 LLM 客户端
+            group: 合并组（默认使用进程级共享组，使不同 API 任务之间也能合并）
+        """
+        super().__init__(client)
+        self.group = group if group is not None else get_shared_single_flight_group()
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, **kwargs) -> str:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        return self.group.do(key, lambda: self.client.chat(messages, temperature, **kwargs))
+
+    async def achat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    **kwargs) -> str:
+        key = client_fingerprint(self.client, messages, temperature, **kwargs)
+        return await self.group.ado(key, lambda: self.client.achat(messages, temperature, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        """返回合并统计"""
+        return self.group.stats()
+
+
+# ==================== 进程级共享合并组 ====================
+
+_shared_group: Optional[SingleFlightGroup] = None
+_shared_group_lock = threading.Lock()
+
+
+def get_shared_single_flight_group() -> SingleFlightGroup:
+    """获取进程级共享的合并组"""
+    global _shared_group
+    with _shared_group_lock:
+        if _shared_group is None:
+            _shared_group = SingleFlightGroup()
+        return _shared_group
+
+
+def reset_shared_single_flight_group() -> None:
+    """丢弃共享合并组（测试时使用）"""
+    global _shared_group
+    with _shared_group_lock:
+        _shared_group = None
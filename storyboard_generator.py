@@ -4,120 +4,24 @@
 本模块使用大语言模型将剧本场景拆解为专业的分镜镜头。
 LLM 负责根据画面张力和戏剧节奏自动分配镜头类型和运镜方向。
 """
-import re
-import json
-import os
-from typing import List, Optional, Dict, Any
+import asyncio
+from dataclasses import replace
+from typing import List, Optional, Dict, Any, Callable, Iterator, AsyncIterator, Tuple
 from models import ScriptScene, StoryboardShot
-
-
-# ==================== LLM 客户端接口 ====================
-
-class LLMClient:
-    """LLM 客户端基类"""
-
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
-        self.api_key = api_key or os.environ.get("LLM_API_KEY", "")
-        self.base_url = base_url or os.environ.get("LLM_BASE_URL", "")
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        raise NotImplementedError("子类必须实现 chat 方法")
-
-
-class MockLLMClient(LLMClient):
-    """Mock LLM 客户端 - 用于测试"""
-
-    def __init__(self, mock_response: str = ""):
-        super().__init__()
-        self.mock_response = mock_response
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        return self.mock_response
-
-
-class OpenAICompatibleClient(LLMClient):
-    """OpenAI 兼容 API 客户端（带重试机制）"""
-
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
-                 model: str = "gpt-4o-mini", max_retries: int = 3, retry_delay: float = 1.0):
-        super().__init__(api_key, base_url)
-        self.model = model
-        self.max_retries = max_retries
-        self.retry_delay = retry_delay
-
-    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        """调用 OpenAI 兼容 API（带自动重试）"""
-        import time
-        import random
-
-        last_exception = None
-
-        for attempt in range(self.max_retries + 1):
-            try:
-                from openai import OpenAI, APIStatusError, APIConnectionError
-                client = OpenAI(
-                    api_key=self.api_key,
-                    base_url=self.base_url if self.base_url else None
-                )
-                response = client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=temperature
-                )
-                return response.choices[0].message.content
-
-            except ImportError:
-                raise ImportError("请安装 openai 包：pip install openai")
-
-            except APIStatusError as e:
-                last_exception = e
-                status_code = e.status_code
-                if status_code in (429, 500, 502, 503, 504):
-                    if attempt < self.max_retries:
-                        delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                        print(f"[RETRY] API 错误 ({status_code})，{delay:.1f}秒后重试...")
-                        time.sleep(delay)
-                        continue
-                raise
-
-            except APIConnectionError as e:
-                last_exception = e
-                if attempt < self.max_retries:
-                    delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                    print(f"[RETRY] 连接错误，{delay:.1f}秒后重试...")
-                    time.sleep(delay)
-                    continue
-                raise
-
-            except Exception as e:
-                last_exception = e
-                if attempt < self.max_retries:
-                    delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 1)
-                    print(f"[RETRY] 未知错误，{delay:.1f}秒后重试...")
-                    time.sleep(delay)
-                    continue
-                raise
-
-        if last_exception:
-            raise last_exception
-        raise RuntimeError("重试循环异常退出")
+from llm_client import LLMClient, MockLLMClient, OpenAICompatibleClient, ResponseTruncatedError  # noqa: F401
+from compact_format import compact_prompt, compact_keys, expand_item, expand_response
+from json_stream import parse_json_response, stream_items, astream_items
+from llm_telemetry import llm_stage, record_parse_outcome
+from token_budget import ContextPart, TokenBudgetPlanner
 
 
 # ==================== Prompt 模板 ====================
 
-STORYBOARD_GENERATION_PROMPT = """你是一个经验丰富的电影分镜师，擅长将剧本场景拆解为具有视觉冲击力的分镜镜头。
+# 系统消息只包含固定的指令和 Schema，场景信息和记忆上下文放在用户消息中，
+# 使所有请求共享逐字节相同的前缀，便于服务端复用前缀缓存
+STORYBOARD_GENERATION_SYSTEM_PROMPT = """你是一个经验丰富的电影分镜师，擅长将剧本场景拆解为具有视觉冲击力的分镜镜头。
 
-请分析以下剧本场景，并将其拆解为 3-6 个专业的分镜镜头：
-
-场景信息：
-- 场景 ID: {scene_id}
-- 章节：第{chapter}章
-- 地点：{location}
-- 时间：{time}
-- 场景描述：{description}
-- 动作列表：{actions}
-- 对白列表：{dialogues}
-- 涉及人物：{characters}
+请分析用户给出的剧本场景，并将其拆解为 3-6 个专业的分镜镜头。
 
 作为分镜师，你需要考虑：
 1. 第一个镜头应该是建立镜头（Establishing Shot），用于展示场景环境
@@ -126,12 +30,12 @@ STORYBOARD_GENERATION_PROMPT = """你是一个经验丰富的电影分镜师，
 4. 为每个镜头预估合理的时长
 5. 考虑音频方向（背景音乐/音效/对白等）
 
-请严格按照以下 JSON Schema 格式返回结果：
-{{
+请严格按照以下 JSON Schema 格式返回结果（其中的场景 ID 取自场景信息）：
+{
     "shots": [
-        {{
-            "id": "{scene_id}_shot_1",
-            "scene_id": "{scene_id}",
+        {
+            "id": "场景 ID_shot_1",
+            "scene_id": "场景 ID",
             "shot_number": 1,
             "shot_type": "全景/中景/近景/特写/大特写",
             "description": "镜头内容描述（50-100 字）",
@@ -139,10 +43,10 @@ STORYBOARD_GENERATION_PROMPT = """你是一个经验丰富的电影分镜师，
             "duration_seconds": 3.0,
             "audio_direction": "音频说明",
             "characters_in_shot": ["char_人物 1", ...]
-        }},
+        },
         ...
     ]
-}}
+}
 
 注意：
 - shot_number 从 1 开始连续编号
@@ -150,9 +54,24 @@ STORYBOARD_GENERATION_PROMPT = """你是一个经验丰富的电影分镜师，
 - 根据对白数量安排适当的反应镜头
 - 动作场面应该使用更有动感的运镜方式
 
-请只返回 JSON，不要包含任何额外说明：
+请只返回 JSON，不要包含任何额外说明。
 """
 
+# 用户消息：可变的场景信息
+STORYBOARD_GENERATION_USER_PROMPT = """场景信息：
+- 场景 ID: {scene_id}
+- 章节：第{chapter}章
+- 地点：{location}
+- 时间：{time}
+- 场景描述：{description}
+- 动作列表：{actions}
+- 对白列表：{dialogues}
+- 涉及人物：{characters}"""
+
+
+# 记忆上下文的引导语
+STORYBOARD_MEMORY_HEADER = "以下是相关人物的记忆信息，请在生成分镜时参考这些信息来保持人物的一致性："
+
 
 # ==================== 分镜生成器实现 ====================
 
@@ -160,16 +79,24 @@ class StoryboardGenerator:
     """分镜生成器 - 使用 LLM 进行智能拆解"""
 
     def __init__(self, llm_client: Optional[LLMClient] = None,
-                 memory_bank: Optional[Any] = None):
+                 memory_bank: Optional[Any] = None,
+                 token_budget: Optional[TokenBudgetPlanner] = None,
+                 compact: bool = False):
         """
         初始化分镜生成器
 
         Args:
             llm_client: LLM 客户端实例，如果为 None 则使用 MockLLMClient
             memory_bank: 可选的记忆银行，用于注入人物上下文
+            token_budget: 可选的 token 预算规划器，超出预算时裁剪记忆上下文
+            compact: 是否要求紧凑响应格式（短键和枚举代码，见 compact_format）
         """
         self.llm_client = llm_client or MockLLMClient()
         self.memory_bank = memory_bank  # 支持向量化记忆银行或传统 MemoryBank
+        self.token_budget = token_budget
+        self.compact = compact
+        self.system_prompt = compact_prompt(STORYBOARD_GENERATION_SYSTEM_PROMPT, ("shots",)) \
+            if compact else STORYBOARD_GENERATION_SYSTEM_PROMPT
 
     def generate(self, scene: ScriptScene,
                  memory_context: Optional[str] = None) -> List[StoryboardShot]:
@@ -179,13 +106,95 @@ class StoryboardGenerator:
             scene: 剧本场景
             memory_context: 可选的记忆上下文，用于保持人物连贯性
         """
-        prompt_parts = []
-
-        # 如果有记忆上下文，添加到 prompt 前面
-        if memory_context:
-            prompt_parts.append(f"以下是相关人物的记忆信息，请在生成分镜时参考这些信息来保持人物的一致性：\n{memory_context}\n\n")
+        with llm_stage("storyboard"):
+            messages = self.build_messages(scene, memory_context)
+            try:
+                response = self.llm_client.chat(messages, temperature=0.8)
+            except ResponseTruncatedError as e:
+                return self.retry_truncated(scene, e, memory_context)
+            return self.parse_response(response, scene)
+
+    def retry_truncated(self, scene: ScriptScene, error: ResponseTruncatedError,
+                        memory_context: Optional[str] = None) -> List[StoryboardShot]:
+        """场景的分镜响应已被截断（error）：拆分场景重新生成，无法拆分时保留已完成的镜头"""
+        with llm_stage("storyboard"):
+            halves = self._split_for_retry(scene)
+            if halves is None:
+                return self.parse_response(error.text, scene)
+            return self._renumber(scene, [shot for half in halves
+                                          for shot in self.generate(half, memory_context)])
+
+    async def agenerate(self, scene: ScriptScene,
+                        memory_context: Optional[str] = None) -> List[StoryboardShot]:
+        """从剧本场景生成分镜镜头（异步）"""
+        with llm_stage("storyboard"):
+            messages = self.build_messages(scene, memory_context)
+            try:
+                response = await self.llm_client.achat(messages, temperature=0.8)
+            except ResponseTruncatedError as e:
+                halves = self._split_for_retry(scene)
+                if halves is None:
+                    return self.parse_response(e.text, scene)
+                parts = await asyncio.gather(*[self.agenerate(half, memory_context) for half in halves])
+                return self._renumber(scene, [shot for part in parts for shot in part])
+            return self.parse_response(response, scene)
+
+    @staticmethod
+    def _split_for_retry(scene: ScriptScene) -> Optional[Tuple[ScriptScene, ScriptScene]]:
+        """
+        分镜响应被截断后，把场景的动作和对白一分为二，分别生成分镜
 
-        prompt_parts.append(STORYBOARD_GENERATION_PROMPT.format(
+        动作和对白合计不足两项时无法再拆分，返回 None（改为修复解析截断前收到的部分）。
+        """
+        if len(scene.actions) + len(scene.dialogues) < 2:
+            print(f"[SPLIT] 场景 {scene.id} 的分镜响应被截断且无法再拆分，保留已完成的镜头")
+            return None
+        actions = (len(scene.actions) + 1) // 2
+        dialogues = len(scene.dialogues) // 2
+        print(f"[SPLIT] 场景 {scene.id} 的分镜响应被截断，按动作和对白拆分为两半重新生成")
+        return (replace(scene, actions=scene.actions[:actions], dialogues=scene.dialogues[:dialogues]),
+                replace(scene, actions=scene.actions[actions:], dialogues=scene.dialogues[dialogues:]))
+
+    @staticmethod
+    def _renumber(scene: ScriptScene, shots: List[StoryboardShot]) -> List[StoryboardShot]:
+        """拆分生成的镜头按顺序重新编号"""
+        return [replace(shot, id=f"{scene.id}_shot_{number}", scene_id=scene.id, shot_number=number)
+                for number, shot in enumerate(shots, start=1)]
+
+    def generate_stream(self, scene: ScriptScene,
+                        memory_context: Optional[str] = None) -> Iterator[StoryboardShot]:
+        """流式生成分镜：每个镜头的 JSON 对象完整到达后立即产出
+
+        响应中没有可用镜头时，与 generate 一样回退到基础分镜。
+        """
+        return stream_items("storyboard",
+                            lambda: self.llm_client.stream_chat(self.build_messages(scene, memory_context),
+                                                                temperature=0.8),
+                            self._stream_keys(), self._shot_converter(scene),
+                            lambda text: self.parse_response(text, scene))
+
+    def agenerate_stream(self, scene: ScriptScene,
+                         memory_context: Optional[str] = None) -> AsyncIterator[StoryboardShot]:
+        """流式生成分镜（异步）"""
+        return astream_items("storyboard",
+                             lambda: self.llm_client.astream_chat(self.build_messages(scene, memory_context),
+                                                                  temperature=0.8),
+                             self._stream_keys(), self._shot_converter(scene),
+                             lambda text: self.parse_response(text, scene))
+
+    def _stream_keys(self) -> List[str]:
+        """增量解析的顶层键（紧凑格式使用短键）"""
+        return compact_keys(("shots",)) if self.compact else ["shots"]
+
+    def _shot_converter(self, scene: ScriptScene) -> Callable[[Dict[str, Any], int], StoryboardShot]:
+        """流式解析出的第 n 个镜头对象 -> StoryboardShot"""
+        return lambda item, number: self._to_shot(expand_item(StoryboardShot, item), scene, number)
+
+    def build_messages(self, scene: ScriptScene,
+                       memory_context: Optional[str] = None) -> List[Dict[str, str]]:
+        """构建分镜生成请求"""
+        prompt_parts = []
+        prompt = STORYBOARD_GENERATION_USER_PROMPT.format(
             scene_id=scene.id,
             chapter=scene.chapter,
             location=scene.location,
@@ -194,34 +203,39 @@ class StoryboardGenerator:
             actions=", ".join(scene.actions) if scene.actions else "无明显动作",
             dialogues=str(scene.dialogues) if scene.dialogues else "无对白",
             characters=", ".join(scene.character_ids) if scene.character_ids else "未明确"
-        ))
+        )
+
+        # 记忆上下文超出 token 预算时按预算裁剪（场景信息本身超出预算时抛出 PromptBudgetError）
+        if self.token_budget is not None:
+            plan = self.token_budget.plan(
+                self.system_prompt + STORYBOARD_MEMORY_HEADER + prompt,
+                [ContextPart("memory", memory_context or "")], "storyboard"
+            )
+            memory_context = plan.texts["memory"]
+
+        # 如果有记忆上下文，添加到场景信息前面（同一章节的请求共享更长的前缀）
+        if memory_context:
+            prompt_parts.append(f"{STORYBOARD_MEMORY_HEADER}\n{memory_context}\n\n")
 
-        prompt = "".join(prompt_parts)
-        messages = [{"role": "user", "content": prompt}]
+        prompt_parts.append(prompt)
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": "".join(prompt_parts)}
+        ]
 
-        response = self.llm_client.chat(messages, temperature=0.8)
-        data = self._parse_json_response(response)
+    def parse_response(self, response: str, scene: ScriptScene) -> List[StoryboardShot]:
+        """将 LLM 响应解析为分镜列表，解析失败时返回基础分镜"""
+        with llm_stage("storyboard"):
+            data = expand_response(parse_json_response(response))
 
         if not data or "shots" not in data:
             # 如果 LLM 解析失败，返回一个基础版本
             return self._create_fallback_shots(scene)
 
-        shots_data = data["shots"]
-        shots = []
-
-        for shot_data in shots_data:
-            shot = StoryboardShot(
-                id=shot_data.get("id", f"{scene.id}_shot_{shot_data.get('shot_number', len(shots)+1)}"),
-                scene_id=shot_data.get("scene_id", scene.id),
-                shot_number=shot_data.get("shot_number", len(shots) + 1),
-                shot_type=shot_data.get("shot_type", "中景"),
-                description=shot_data.get("description", scene.description),
-                camera_direction=shot_data.get("camera_direction"),
-                duration_seconds=shot_data.get("duration_seconds", 3.0),
-                audio_direction=shot_data.get("audio_direction"),
-                characters_in_shot=shot_data.get("characters_in_shot", [])
-            )
-            shots.append(shot)
+        shots = [
+            self._to_shot(shot_data, scene, number)
+            for number, shot_data in enumerate(data["shots"], start=1)
+        ]
 
         # 确保至少有一个镜头
         if not shots:
@@ -229,8 +243,23 @@ class StoryboardGenerator:
 
         return shots
 
+    def _to_shot(self, shot_data: Dict[str, Any], scene: ScriptScene, number: int) -> StoryboardShot:
+        """将单个 JSON 对象转换为分镜镜头，number 为缺省时使用的镜头序号"""
+        return StoryboardShot(
+            id=shot_data.get("id", f"{scene.id}_shot_{shot_data.get('shot_number', number)}"),
+            scene_id=shot_data.get("scene_id", scene.id),
+            shot_number=shot_data.get("shot_number", number),
+            shot_type=shot_data.get("shot_type", "中景"),
+            description=shot_data.get("description", scene.description),
+            camera_direction=shot_data.get("camera_direction"),
+            duration_seconds=shot_data.get("duration_seconds", 3.0),
+            audio_direction=shot_data.get("audio_direction"),
+            characters_in_shot=shot_data.get("characters_in_shot", [])
+        )
+
     def _create_fallback_shots(self, scene: ScriptScene) -> List[StoryboardShot]:
         """当 LLM 解析失败时，创建基础分镜"""
+        record_parse_outcome("fallback")
         shots = []
 
         # 第一个镜头：建立场景的全景
@@ -280,28 +309,6 @@ class StoryboardGenerator:
 
         return shots
 
-    def _parse_json_response(self, response: str) -> Optional[Dict[str, Any]]:
-        """解析 LLM 返回的 JSON 响应"""
-        try:
-            return json.loads(response.strip())
-        except json.JSONDecodeError:
-            match = re.search(r'```json\s*(.*?)\s*```', response, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except json.JSONDecodeError:
-                    pass
-
-        start = response.find('{')
-        end = response.rfind('}') + 1
-        if start != -1 and end > start:
-            try:
-                return json.loads(response[start:end])
-            except json.JSONDecodeError:
-                pass
-
-        return None
-
 
 if __name__ == "__main__":
     # 演示用法
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""自适应并发控制器测试"""
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+import llm_client
+from adaptive_concurrency import (
+    AIMDLimiter, get_shared_concurrency_limiter, reset_shared_concurrency_limiters
+)
+from circuit_breaker import reset_shared_circuit_breakers
+from fake_llm_server import FakeLLMServer, FaultConfig
+from llm_client import OpenAICompatibleClient, close_shared_clients
+from llm_telemetry import get_telemetry, llm_stage, reset_telemetry
+
+
+class FakeClock:
+    """可手动推进的时钟"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_rate_limit_error():
+    request = httpx.Request("POST", "http://test/v1/chat/completions")
+    return RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+
+
+def warm_up(limiter, latency=1.0, samples=10):
+    """积累延迟基线（不占满名额，不会上调）"""
+    for _ in range(samples):
+        limiter.release(limiter.acquire(), latency=latency)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    reset_telemetry()
+    reset_shared_concurrency_limiters()
+    yield
+    reset_telemetry()
+    reset_shared_concurrency_limiters()
+
+
+class TestAIMD:
+    """测试加性增、乘性减"""
+
+    def test_increase_only_when_saturated(self):
+        limiter = AIMDLimiter(initial_limit=2, clock=FakeClock())
+        warm_up(limiter)
+        assert limiter.capacity == 2 and limiter.increases == 0
+
+        for _ in range(3):
+            slots = [limiter.acquire() for _ in range(limiter.capacity)]
+            for slot in slots:
+                limiter.release(slot, latency=1.0)
+        assert limiter.capacity == 3
+        assert limiter.increases == 1
+
+    def test_429_halves_once_per_window(self):
+        clock = FakeClock()
+        limiter = AIMDLimiter(initial_limit=8, clock=clock)
+        warm_up(limiter, latency=1.0)
+
+        for _ in range(3):
+            limiter.release(limiter.acquire(), error=make_rate_limit_error())
+        assert limiter.capacity == 4 and limiter.decreases == 1
+
+        clock.advance(1.5)
+        limiter.release(limiter.acquire(), error=make_rate_limit_error())
+        assert limiter.capacity == 2
+        assert limiter.stats()["min_seen"] == 2
+
+    def test_other_errors_keep_limit(self):
+        limiter = AIMDLimiter(initial_limit=4, clock=FakeClock())
+        limiter.release(limiter.acquire(), error=ConnectionError("reset"))
+        assert limiter.capacity == 4 and limiter.decreases == 0
+
+    def test_latency_spike_per_stage(self):
+        limiter = AIMDLimiter(initial_limit=8, clock=FakeClock())
+        with llm_stage("character"):
+            warm_up(limiter, latency=1.0)
+        # 分镜阶段的长延迟有自己的基线，不算尖峰
+        with llm_stage("storyboard"):
+            warm_up(limiter, latency=10.0)
+        assert limiter.decreases == 0
+
+        with llm_stage("character"):
+            for _ in range(5):
+                limiter.release(limiter.acquire(), latency=5.0)
+        assert limiter.decreases == 1
+        assert limiter.capacity == 4
+
+    def test_min_limit(self):
+        clock = FakeClock()
+        limiter = AIMDLimiter(initial_limit=2, min_limit=2, clock=clock)
+        limiter.release(limiter.acquire(), error=make_rate_limit_error())
+        assert limiter.capacity == 2 and limiter.decreases == 0
+
+    def test_telemetry_reports_limit(self):
+        limiter = AIMDLimiter(initial_limit=8, name="http://fake/v1", clock=FakeClock())
+        limiter.release(limiter.acquire(), error=make_rate_limit_error())
+        assert get_telemetry().concurrency_summary()["http://fake/v1"] == \
+            {"limit": 4, "min": 4, "max": 4, "increases": 0, "decreases": 1}
+        assert any(line.startswith("[CONCURRENCY] http://fake/v1：当前上限 4")
+                   for line in get_telemetry().format_summary())
+
+
+class TestWaiters:
+    """测试名额排队"""
+
+    def test_blocked_thread_gets_released_slot(self):
+        limiter = AIMDLimiter(initial_limit=1, max_limit=1)
+        slot = limiter.acquire()
+        acquired = threading.Event()
+
+        def worker():
+            limiter.release(limiter.acquire())
+            acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not acquired.wait(0.1)
+        assert limiter.stats()["waiting"] == 1
+        limiter.release(slot)
+        assert acquired.wait(2)
+        thread.join()
+        assert limiter.stats()["in_flight"] == 0
+
+    def test_async_waiter_cancelled(self):
+        limiter = AIMDLimiter(initial_limit=1, max_limit=1)
+
+        async def scenario():
+            slot = await limiter.aacquire()
+            waiter = asyncio.ensure_future(limiter.aacquire())
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            limiter.release(slot)
+            limiter.release(await asyncio.wait_for(limiter.aacquire(), 1))
+
+        asyncio.run(scenario())
+        assert limiter.stats()["in_flight"] == 0
+        assert limiter.stats()["waiting"] == 0
+
+
+class TestClientIntegration:
+    """测试 OpenAICompatibleClient 使用共享控制器"""
+
+    def test_disabled_by_default(self, monkeypatch):
+        monkeypatch.delenv("LLM_ADAPTIVE_CONCURRENCY", raising=False)
+        assert get_shared_concurrency_limiter("http://a/v1", "k") is None
+        client = OpenAICompatibleClient(api_key="k", base_url="http://a/v1")
+        assert client.concurrency_limiter is None
+
+    def test_shared_per_endpoint(self, monkeypatch):
+        monkeypatch.setenv("LLM_ADAPTIVE_CONCURRENCY", "true")
+        monkeypatch.setenv("LLM_ADAPTIVE_INITIAL_CONCURRENCY", "6")
+        a = OpenAICompatibleClient(api_key="k", base_url="http://a/v1", model="m1")
+        b = OpenAICompatibleClient(api_key="k", base_url="http://a/v1", model="m2")
+        c = OpenAICompatibleClient(api_key="k", base_url="http://b/v1")
+        assert a.concurrency_limiter is b.concurrency_limiter
+        assert a.concurrency_limiter is not c.concurrency_limiter
+        assert a.concurrency_limiter.capacity == 6
+
+    def test_slot_released_on_keyboard_interrupt(self):
+        limiter = AIMDLimiter(initial_limit=1, max_limit=1)
+        client = OpenAICompatibleClient(api_key="k", base_url="http://a/v1", max_retries=0,
+                                        rate_limiter=None, circuit_breaker=None, concurrency_limiter=limiter)
+
+        def interrupt(**kwargs):
+            raise KeyboardInterrupt
+
+        client._get_client = lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=interrupt)))
+        with pytest.raises(KeyboardInterrupt):
+            client.chat([{"role": "user", "content": "你好"}])
+        with pytest.raises(KeyboardInterrupt):
+            list(client.stream_chat([{"role": "user", "content": "你好"}]))
+        assert limiter.stats()["in_flight"] == 0
+
+    @pytest.fixture
+    def fake_server(self, monkeypatch):
+        monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+        server = FakeLLMServer(config=FaultConfig(seed=5, latency=0.05, max_concurrent=3,
+                                                  retry_after=0.3)).start()
+        yield server
+        server.stop()
+        close_shared_clients()
+        reset_shared_circuit_breakers()
+
+    def test_converges_below_server_capacity(self, fake_server):
+        limiter = AIMDLimiter(initial_limit=12, name=fake_server.base_url)
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url=fake_server.base_url, max_retries=20,
+                                        rate_limiter=None, circuit_breaker=None, concurrency_limiter=limiter)
+        messages = [{"role": "user", "content": "你好"}]
+
+        async def run():
+            return await asyncio.gather(*(client.achat(messages) for _ in range(40)))
+
+        assert len(asyncio.run(run())) == 40
+        stats = limiter.stats()
+        assert stats["decreases"] >= 1
+        assert stats["min_seen"] <= 6
+        assert stats["in_flight"] == 0
+        assert fake_server.stats()["total"]["ok"] == 40
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""熔断器测试"""
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+import llm_client
+from circuit_breaker import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, get_shared_circuit_breaker,
+    reset_shared_circuit_breakers
+)
+from extractor import CharacterExtractor
+from fake_llm_server import FakeLLMServer, FaultConfig
+from llm_client import OpenAICompatibleClient, close_shared_clients
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def api_error(cls, status):
+    request = httpx.Request("POST", "http://test/v1/chat/completions")
+    return cls("error", response=httpx.Response(status, request=request), body=None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+    reset_shared_circuit_breakers()
+    yield
+    reset_shared_circuit_breakers()
+
+
+class TestStateMachine:
+    """测试状态切换"""
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=10, clock=FakeClock())
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.state == CLOSED
+
+        breaker.record_failure()
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpenError) as info:
+            breaker.allow()
+        assert info.value.retry_in == pytest.approx(10)
+        assert breaker.rejected == 1
+
+    def test_half_open_single_probe(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, clock=clock)
+        breaker.record_failure()
+
+        clock.now = 10
+        assert breaker.state == HALF_OPEN
+        breaker.allow()  # 探测请求
+        with pytest.raises(CircuitOpenError):
+            breaker.allow()
+
+        breaker.record_success()
+        assert breaker.state == CLOSED
+        breaker.allow()
+
+    def test_failed_probe_reopens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state == OPEN
+        assert breaker.times_opened == 2
+        clock.now = 15
+        with pytest.raises(CircuitOpenError):
+            breaker.allow()
+
+    def test_rate_limited_probe_closes(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        breaker.allow()
+        breaker.record(api_error(RateLimitError, 429))
+
+        # 429 说明服务端可达：探测结束，熔断器关闭，探测请求自己的重试也能放行
+        assert breaker.state == CLOSED
+        breaker.allow()
+
+    def test_local_error_releases_probe(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        breaker.allow()
+        breaker.record(TypeError("unexpected keyword argument"))
+        assert breaker.state == HALF_OPEN
+        breaker.allow()
+
+    def test_only_connection_errors_and_5xx_are_outages(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        for error in (TypeError("bad kwargs"), ValueError("bad url"), KeyError("choices"),
+                      api_error(RateLimitError, 429)):
+            breaker.record(error)
+        assert breaker.state == CLOSED
+
+        request = httpx.Request("POST", "http://test/v1/chat/completions")
+        for error in (APITimeoutError(request=request), APIConnectionError(request=request),
+                      api_error(InternalServerError, 503)):
+            breaker = CircuitBreaker(failure_threshold=1)
+            breaker.record(error)
+            assert breaker.state == OPEN
+
+    def test_shared_per_endpoint(self, monkeypatch):
+        monkeypatch.setenv("LLM_CIRCUIT_THRESHOLD", "2")
+        a = get_shared_circuit_breaker("http://a/v1", "k")
+        assert get_shared_circuit_breaker("http://a/v1", "k") is a
+        assert get_shared_circuit_breaker("http://b/v1", "k") is not a
+        assert a.failure_threshold == 2
+
+        monkeypatch.setenv("LLM_CIRCUIT_THRESHOLD", "0")
+        assert get_shared_circuit_breaker("http://c/v1", "k") is None
+
+
+class TestOutage:
+    """测试服务端故障期间的快速失败与恢复"""
+
+    def test_fail_fast_and_recover(self, monkeypatch):
+        monkeypatch.setenv("LLM_CIRCUIT_THRESHOLD", "3")
+        monkeypatch.setenv("LLM_CIRCUIT_COOLDOWN", "0.2")
+        with FakeLLMServer(config=FaultConfig(rate_5xx=1.0)) as server:
+            try:
+                client = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url,
+                                                max_retries=5, retry_delay=0.01)
+                extractor = CharacterExtractor(client)
+
+                # 第一次调用在第 3 次故障后停止重试，而不是走完 5 次重试
+                with pytest.raises(Exception):
+                    extractor.extract("文本")
+                assert server.stats()["total"]["requests"] == 3
+
+                # 熔断期间后续调用不访问网络，毫秒级失败
+                start = time.perf_counter()
+                for _ in range(20):
+                    with pytest.raises(CircuitOpenError):
+                        extractor.extract("文本")
+                assert time.perf_counter() - start < 0.1
+                assert server.stats()["total"]["requests"] == 3
+
+                # 服务恢复后，冷却结束的探测请求成功并关闭熔断器
+                server.config.rate_5xx = 0.0
+                time.sleep(0.25)
+                assert extractor.extract("文本")
+                assert client.circuit_breaker.state == CLOSED
+            finally:
+                close_shared_clients()
+
+    def test_connection_error_opens(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url="http://127.0.0.1:1/v1",
+                                        max_retries=0, circuit_breaker=breaker)
+        with pytest.raises(Exception):
+            client.chat([{"role": "user", "content": "hi"}])
+        assert breaker.state == OPEN
+        close_shared_clients()
+
+    def test_mid_stream_failure_counts(self):
+        def chunk(text):
+            return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=None)])
+
+        class DroppedStream:
+            def __iter__(self):
+                yield chunk("第一段")
+                raise APIConnectionError(request=httpx.Request("POST", "http://test/v1/chat/completions"))
+
+            def close(self):
+                pass
+
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url="http://test/v1",
+                                        max_retries=0, circuit_breaker=breaker)
+        client._get_client = lambda: SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: DroppedStream())))
+
+        # 流已建立、读取响应体时连接断开：计为故障而不是成功
+        with pytest.raises(APIConnectionError):
+            list(client.stream_chat([{"role": "user", "content": "hi"}]))
+        assert breaker.state == OPEN
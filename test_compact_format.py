@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""紧凑响应格式测试"""
+import json
+
+import pytest
+
+import llm_client
+from circuit_breaker import reset_shared_circuit_breakers
+from compact_format import (
+    COMPACT_MARKER, compact_prompt, compact_response, expand_response, is_compact_request
+)
+from extractor import CharacterExtractor, FusedExtractor, CHARACTER_EXTRACTION_SYSTEM_PROMPT
+from fake_llm_server import FakeLLMServer, FaultConfig
+from llm_client import MockLLMClient, OpenAICompatibleClient, close_shared_clients
+from llm_telemetry import get_telemetry, llm_stage, reset_telemetry
+from models import ScriptScene, TimelineEvent
+from response_schemas import response_schema
+from script_generator import ScriptGenerator
+from storyboard_generator import StoryboardGenerator
+
+
+SHOTS = {"shots": [
+    {"id": "scene_1_shot_1", "scene_id": "scene_1", "shot_number": 1, "shot_type": "全景",
+     "description": "山门全景", "camera_direction": "固定镜头", "duration_seconds": 4.0,
+     "audio_direction": "风声", "characters_in_shot": []},
+    {"id": "scene_1_shot_2", "scene_id": "scene_1", "shot_number": 2, "shot_type": "特写",
+     "description": "林舟握剑", "camera_direction": "推镜头", "duration_seconds": 2.5,
+     "audio_direction": None, "characters_in_shot": ["char_linzhou"]}
+]}
+
+SCENE = ScriptScene(id="scene_1", chapter=1, location="山门", time="夜", description="夜探山门",
+                    actions=["林舟拔剑"], dialogues=[{"character_id": "char_linzhou", "line": "谁？"}],
+                    character_ids=["char_linzhou"])
+
+
+@pytest.fixture(autouse=True)
+def fresh_telemetry():
+    reset_telemetry()
+    yield
+    reset_telemetry()
+
+
+class TestCodec:
+    """测试短键编码与还原"""
+
+    def test_shots_round_trip(self):
+        compact = compact_response(SHOTS)
+        assert compact["s"][0] == {"k": "W", "d": "山门全景", "m": "F", "t": 4.0, "au": "风声"}
+        assert compact["s"][1]["m"] == "I"
+
+        expanded = expand_response(compact)["shots"]
+        assert expanded[1] == {"shot_type": "特写", "description": "林舟握剑", "camera_direction": "推镜头",
+                               "duration_seconds": 2.5, "characters_in_shot": ["char_linzhou"]}
+
+    def test_dialogues_as_pairs(self):
+        data = {"scene": {"chapter": 1, "location": "山门", "dialogues": [{"character_id": "char_a", "line": "走"}]}}
+        compact = compact_response(data)
+        assert compact == {"sc": {"ch": 1, "l": "山门", "dl": [["char_a", "走"]]}}
+        assert expand_response(compact) == data
+
+    def test_unknown_code_kept_as_text(self):
+        expanded = expand_response({"s": [{"k": "中景", "m": "缓慢推进"}]})
+        assert expanded["shots"][0] == {"shot_type": "中景", "camera_direction": "缓慢推进"}
+
+    def test_standard_response_unchanged(self):
+        assert expand_response(SHOTS) == SHOTS
+        assert expand_response(None) is None
+
+    def test_compact_output_is_shorter(self):
+        standard = json.dumps(SHOTS, ensure_ascii=False)
+        compact = json.dumps(compact_response(SHOTS), ensure_ascii=False)
+        assert len(compact) < len(standard) * 0.6
+
+
+class TestPromptAndSchema:
+    """测试 prompt 对照表与紧凑 Schema"""
+
+    def test_prompt_keeps_original_schema(self):
+        prompt = compact_prompt(CHARACTER_EXTRACTION_SYSTEM_PROMPT, ("characters",))
+        assert prompt.startswith(CHARACTER_EXTRACTION_SYSTEM_PROMPT.rstrip("\n"))
+        assert COMPACT_MARKER in prompt and "characters→c" in prompt
+        assert is_compact_request(CharacterExtractor(compact=True).build_messages("正文"))
+        assert not is_compact_request(CharacterExtractor().build_messages("正文"))
+
+    def test_compact_schema(self):
+        schema = response_schema("storyboard", compact=True)["json_schema"]
+        shot = schema["schema"]["properties"]["s"]["items"]
+        assert schema["name"] == "storyboard_compact_response"
+        assert "shot_number" not in shot["properties"]
+        assert shot["properties"]["k"]["enum"] == ["W", "M", "C", "X", "XX"]
+        assert None in shot["properties"]["m"]["enum"]
+        assert shot["required"] == list(shot["properties"])
+
+        dialogues = response_schema("scene", compact=True)["json_schema"]["schema"]["properties"]["sc"]
+        assert dialogues["properties"]["dl"]["items"] == {"type": "array", "items": {"type": "string"}}
+
+    def test_client_sends_compact_schema(self):
+        client = OpenAICompatibleClient(api_key="sk-test", base_url="http://127.0.0.1:1/v1",
+                                        rate_limiter=None, circuit_breaker=None, structured_output=True)
+        messages = StoryboardGenerator(client, compact=True).build_messages(SCENE)
+        with llm_stage("storyboard"):
+            request = client.build_request(messages, 0.8, json_mode=False)
+        assert request["response_format"]["json_schema"]["name"] == "storyboard_compact_response"
+
+
+class TestPipeline:
+    """测试各模块解析紧凑响应"""
+
+    def test_storyboard_derives_numbering(self):
+        client = MockLLMClient(json.dumps(compact_response(SHOTS), ensure_ascii=False))
+        shots = StoryboardGenerator(client, compact=True).generate(SCENE)
+        assert [(s.id, s.shot_number, s.scene_id) for s in shots] == [
+            ("scene_1_shot_1", 1, "scene_1"), ("scene_1_shot_2", 2, "scene_1")
+        ]
+        assert shots[1].camera_direction == "推镜头"
+
+    def test_storyboard_stream(self):
+        client = MockLLMClient(json.dumps(compact_response(SHOTS), ensure_ascii=False))
+        shots = list(StoryboardGenerator(client, compact=True).generate_stream(SCENE))
+        assert [s.shot_type for s in shots] == ["全景", "特写"]
+        assert get_telemetry().parse_summary() == {}
+
+    @pytest.fixture
+    def fake_server(self, monkeypatch):
+        monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+        server = FakeLLMServer(config=FaultConfig(seed=3)).start()
+        yield server
+        server.stop()
+        close_shared_clients()
+        reset_shared_circuit_breakers()
+
+    def _run(self, server, compact):
+        reset_telemetry()
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=0)
+        text = "第1章 风起\n林舟推开客栈的门，沈念已在窗边等候多时。"
+        extracted = FusedExtractor(client, compact=compact).extract(text)
+        scenes = ScriptGenerator(client, compact=compact).generate(extracted["timeline_events"])
+        shots = [shot for scene in scenes for shot in StoryboardGenerator(client, compact=compact).generate(scene)]
+        return extracted, scenes, shots, get_telemetry().summary()
+
+    def test_same_result_fewer_output_tokens(self, fake_server):
+        standard = self._run(fake_server, compact=False)
+        compact = self._run(fake_server, compact=True)
+
+        # 空的可选字段在紧凑格式中省略，还原为 None
+        assert [(c.id, c.name, c.traits) for c in compact[0]["characters"]] == \
+            [(c.id, c.name, c.traits) for c in standard[0]["characters"]]
+        assert compact[0]["relationships"] == standard[0]["relationships"]
+        assert [(e.id, e.summary, e.character_ids) for e in compact[0]["timeline_events"]] == \
+            [(e.id, e.summary, e.character_ids) for e in standard[0]["timeline_events"]]
+        assert compact[1] == standard[1]
+        assert [(s.id, s.shot_type, s.camera_direction) for s in compact[2]] == \
+            [(s.id, s.shot_type, s.camera_direction) for s in standard[2]]
+        for stage in ("extraction", "scene", "storyboard"):
+            assert compact[3][stage]["completion_tokens"] < standard[3][stage]["completion_tokens"]
+        assert all(s["failed"] == 0 for s in get_telemetry().parse_summary().values())
+
+    def test_timeline_event_ids_survive(self):
+        event = TimelineEvent(id="event_ch1_1", chapter=1, summary="夜探山门")
+        client = MockLLMClient(json.dumps({"sc": {"ch": 1, "l": "山门", "tm": "夜", "a": ["推门"]}}))
+        scene = ScriptGenerator(client, compact=True).generate([event])[0]
+        assert (scene.id, scene.time, scene.actions) == ("scene_event_ch1_1", "夜", ["推门"])
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""本地替身服务器测试"""
+import asyncio
+import json
+import urllib.request
+
+import pytest
+
+import llm_client
+from circuit_breaker import reset_shared_circuit_breakers
+from extractor import CharacterExtractor, TimelineExtractor
+from fake_llm_server import FakeLLMServer, FaultConfig, canned_response, detect_prompt_type
+from llm_client import MockLLMClient, OpenAICompatibleClient, ResponseTruncatedError, close_shared_clients
+from llm_telemetry import get_telemetry, reset_telemetry
+from main import LongNovelProcessor
+from models import ScriptScene, TimelineEvent
+from script_generator import ScriptGenerator
+from storyboard_generator import StoryboardGenerator
+from test_phase5_pipeline import marked_novel_file  # noqa: F401
+
+
+@pytest.fixture
+def fake_server():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeLLMServer(config=FaultConfig(seed=7, **kwargs)).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+    close_shared_clients()
+    reset_shared_circuit_breakers()
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+
+
+def _client(server, **kwargs):
+    kwargs.setdefault("retry_delay", 0.0)
+    return OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, **kwargs)
+
+
+class TestCannedResponses:
+    """测试按 prompt 类型生成的固定响应"""
+
+    def test_scene_echoes_event(self):
+        event = TimelineEvent(id="event_ch3_1", chapter=3, summary="夜探山门", location="山门",
+                              character_ids=["char_林舟", "char_沈念"])
+        messages = ScriptGenerator().build_messages(event)
+        prompt = "\n".join(m["content"] for m in messages)
+        assert detect_prompt_type(prompt) == "scene"
+        _, text = canned_response(prompt)
+        scene = json.loads(text)["scene"]
+        assert scene["id"] == "scene_event_ch3_1"
+        assert scene["chapter"] == 3
+        assert scene["location"] == "山门"
+        assert scene["character_ids"] == ["char_林舟", "char_沈念"]
+
+    def test_deterministic(self):
+        prompt = "请阅读以下小说文本，提取其中出现的所有主要人物。\n小说文本：\n第1章 风起"
+        assert canned_response(prompt) == canned_response(prompt)
+
+
+class TestServer:
+    """测试通过 OpenAICompatibleClient 调用替身服务器"""
+
+    def test_extractors_parse_responses(self, fake_server):
+        client = _client(fake_server(), max_retries=0)
+        characters = CharacterExtractor(client).extract("第1章 风起\n林舟推开客栈的门。")
+        events = TimelineExtractor(client).extract("第1章 风起\n林舟推开客栈的门。")
+
+        assert len(characters) == 3
+        assert all(c.id.startswith("char_") for c in characters)
+        assert [e.chapter for e in events] == [1, 1]
+
+    def test_storyboard_stream(self, fake_server):
+        client = _client(fake_server(), max_retries=0)
+        scene = ScriptScene(id="scene_x", chapter=1, location="渡口", time="夜",
+                            description="离别", character_ids=["char_林舟"])
+        shots = list(StoryboardGenerator(client).generate_stream(scene))
+
+        assert 3 <= len(shots) <= 6
+        assert [s.shot_number for s in shots] == list(range(1, len(shots) + 1))
+        assert all(s.scene_id == "scene_x" for s in shots)
+
+    def test_injected_errors_are_retried(self, fake_server, monkeypatch):
+        # 故障率很高时连续失败会打开熔断器，这里只测试重试
+        monkeypatch.setenv("LLM_CIRCUIT_THRESHOLD", "0")
+        server = fake_server(rate_429=0.3, rate_5xx=0.3, retry_after=0.0)
+        client = _client(server, max_retries=10)
+
+        for i in range(10):
+            assert client.chat([{"role": "user", "content": f"请从以下文本中判断时间 {i}"}])
+
+        total = server.stats()["total"]
+        assert total["ok"] == 10
+        assert total["429"] + total["5xx"] > 0
+        assert total["requests"] == 10 + total["429"] + total["5xx"]
+
+    def test_truncation_raised_without_retry(self, fake_server):
+        server = fake_server(rate_truncate=1.0)
+        client = _client(server, max_retries=3)
+        messages = CharacterExtractor().build_messages("第1章 风起")
+        with pytest.raises(ResponseTruncatedError) as info:
+            client.chat(messages)
+
+        assert info.value.text.startswith('{"characters"')
+        assert server.stats()["total"]["requests"] == 1
+
+    def test_truncated_stream_raises(self, fake_server):
+        server = fake_server(rate_truncate=1.0)
+        client = _client(server, max_retries=3)
+        messages = CharacterExtractor().build_messages("第1章 风起")
+        received = []
+        with pytest.raises(ResponseTruncatedError) as info:
+            for chunk in client.stream_chat(messages):
+                received.append(chunk)
+        assert info.value.text == "".join(received)
+        assert server.stats()["total"]["requests"] == 1
+
+        async def consume():
+            return [chunk async for chunk in client.astream_chat(messages)]
+
+        with pytest.raises(ResponseTruncatedError):
+            asyncio.run(consume())
+
+    def test_truncated_response(self, fake_server):
+        full = CharacterExtractor(_client(fake_server(), max_retries=0)).extract("小说文本")
+        client = _client(fake_server(rate_truncate=1.0), max_retries=0)
+        characters = CharacterExtractor(client).extract("小说文本")
+        # 截断的 JSON 保留已完成的元素，丢弃未完成的部分
+        assert 0 < len(characters) < len(full)
+        assert characters == full[:len(characters)]
+
+    def test_stats_endpoint(self, fake_server):
+        server = fake_server()
+        _client(server, max_retries=0).chat([{"role": "user", "content": "你好"}])
+
+        with urllib.request.urlopen(server.base_url.replace("/v1", "/stats")) as response:
+            stats = json.loads(response.read())
+        assert stats["by_type"]["other"]["requests"] == 1
+
+
+class TestPromptCache:
+    """测试固定前缀的 prompt 布局与前缀缓存统计"""
+
+    def test_system_prefix_is_static(self):
+        class Capture(MockLLMClient):
+            def __init__(self):
+                super().__init__("{}")
+                self.messages = []
+
+            def chat(self, messages, temperature=0.7):
+                self.messages.append(messages)
+                return "{}"
+
+        client = Capture()
+        for text in ("第1章 风起\n林舟推开客栈的门。", "第2章 夜雨\n沈念撑伞走过长街。"):
+            CharacterExtractor(client).extract(text)
+            TimelineExtractor(client).extract(text)
+            event = TimelineEvent(id=f"event_{len(text)}", chapter=len(text), summary=text[-8:])
+            ScriptGenerator(client).generate([event], memory_context=text)
+            scene = ScriptScene(id=f"scene_{len(text)}", chapter=1, location="长街", time="夜", description=text)
+            StoryboardGenerator(client).generate(scene)
+
+        # 场景解析失败时的时间判断请求不属于五个 prompt 模板
+        calls = [m for m in client.messages if "判断时间" not in m[-1]["content"]]
+        assert len(calls) == 8
+        for a, b in zip(calls[:4], calls[4:]):
+            assert [m["role"] for m in a] == ["system", "user"]
+            # 系统消息逐字节相同，可变内容只出现在用户消息中
+            assert a[0]["content"] == b[0]["content"]
+            assert a[1]["content"] != b[1]["content"]
+            assert "风起" not in a[0]["content"] and "夜雨" not in b[0]["content"]
+
+    def test_pipeline_reports_cached_tokens(self, fake_server, marked_novel_file, monkeypatch):
+        monkeypatch.delenv("LOG_LLM_REQUESTS", raising=False)
+        reset_telemetry()
+        server = fake_server()
+        processor = LongNovelProcessor(_client(server, max_retries=0), enable_checkpoint=False)
+        processor.process_novel(marked_novel_file)
+
+        cache = server.stats()["prompt_cache"]
+        assert 0 < cache["cached_tokens"] < cache["prompt_tokens"]
+        summary = get_telemetry().summary()
+        assert sum(s["cached_tokens"] for s in summary.values()) == cache["cached_tokens"]
+        # 每个阶段除第一次调用外都命中系统消息前缀
+        assert all(s["cached_tokens"] > 0 for s in summary.values() if s["calls"] > 1)
+        reset_telemetry()
+
+
+class TestPipeline:
+    """测试完整流水线在替身服务器上运行"""
+
+    def test_async_pipeline_with_faults(self, fake_server, marked_novel_file):
+        server = fake_server(latency=0.01, latency_sigma=0.5, rate_5xx=0.1)
+        client = _client(server, max_retries=10)
+        processor = LongNovelProcessor(client, enable_checkpoint=False, max_concurrency=4)
+
+        async def run():
+            try:
+                return await processor.aprocess_novel(marked_novel_file)
+            finally:
+                await llm_client.aclose_shared_clients()
+
+        result = asyncio.run(run())
+        assert result["characters"]
+        assert result["script_scenes"]
+        assert result["storyboard_shots"]
+        assert server.stats()["by_type"]["storyboard"]["ok"] == len(result["script_scenes"])
+
+    def test_fused_extraction_one_call_per_chapter(self, fake_server, marked_novel_file):
+        separate = fake_server()
+        LongNovelProcessor(_client(separate, max_retries=0), enable_checkpoint=False).process_novel(marked_novel_file)
+
+        fused = fake_server()
+        processor = LongNovelProcessor(_client(fused, max_retries=0), enable_checkpoint=False,
+                                       fused_extraction=True)
+        result = processor.process_novel(marked_novel_file)
+
+        by_type = fused.stats()["by_type"]
+        chapters = separate.stats()["by_type"]["character"]["ok"]
+        assert by_type["extraction"]["ok"] == chapters
+        assert not {"character", "relationship", "timeline"} & set(by_type)
+        # 参考上下文只发送一次
+        assert fused.stats()["prompt_cache"]["prompt_tokens"] < separate.stats()["prompt_cache"]["prompt_tokens"]
+        assert result["characters"] and result["relationships"]
+        assert {e.chapter for e in processor.all_timeline_events} == set(range(1, chapters + 1))
+        assert result["script_scenes"]
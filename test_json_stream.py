@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""流式响应与增量 JSON 解析测试"""
+import asyncio
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from extractor import CharacterExtractor, TimelineExtractor
+from json_stream import IncrementalJSONParser, iter_json_items, parse_json, parse_json_response
+from llm_client import MockLLMClient, OpenAICompatibleClient, close_shared_clients, aclose_shared_clients
+from llm_cache import CachedLLMClient, LLMResponseCache
+from llm_telemetry import current_stage, llm_stage
+from models import ScriptScene, TimelineEvent
+from script_generator import ScriptGenerator
+from storyboard_generator import StoryboardGenerator
+
+
+CHARACTERS_RESPONSE = json.dumps({
+    "characters": [
+        {"id": "char_harry", "name": "哈利", "traits": ["勇敢"], "description": "说 \"{你好}\" 的男孩"},
+        {"id": "char_ron", "name": "罗恩", "traits": [], "description": "朋友"}
+    ]
+}, ensure_ascii=False)
+
+
+class ChunkedClient(MockLLMClient):
+    """按固定长度切片流式返回响应，并记录已产出的片段数"""
+
+    def __init__(self, response, size=3):
+        super().__init__(response)
+        self.size = size
+        self.sent = 0
+
+    def stream_chat(self, messages, temperature=0.7, **kwargs):
+        for i in range(0, len(self.mock_response), self.size):
+            self.sent += 1
+            yield self.mock_response[i:i + self.size]
+
+    async def astream_chat(self, messages, temperature=0.7, **kwargs):
+        for chunk in self.stream_chat(messages, temperature):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+class TestIncrementalJSONParser:
+    """测试增量解析器"""
+
+    def test_char_by_char_feed(self):
+        parser = IncrementalJSONParser(["characters"])
+        items = []
+        for ch in CHARACTERS_RESPONSE:
+            items.extend(parser.feed(ch))
+
+        assert [key for key, _ in items] == ["characters", "characters"]
+        assert items[0][1]["description"] == '说 "{你好}" 的男孩'
+        assert items[1][1]["name"] == "罗恩"
+
+    def test_element_emitted_before_response_ends(self):
+        parser = IncrementalJSONParser(["events"])
+        first = parser.feed('{"events": [{"id": "e1", "character_ids": ["a"]}, {"id": "e')
+        assert [item["id"] for _, item in first] == ["e1"]
+        rest = parser.feed('2"}]}')
+        assert [item["id"] for _, item in rest] == ["e2"]
+
+    def test_ignores_code_fence_and_other_keys(self):
+        text = '```json\n{"summary": {"x": 1}, "tags": [{"a": 1}], "shots": [{"shot_number": 1}]}\n```'
+        items = list(iter_json_items(text, ["shots"]))
+        assert items == [("shots", {"shot_number": 1})]
+
+    def test_nested_objects_inside_element(self):
+        text = '{"shots": [{"meta": {"k": [1, {"z": 2}]}, "id": "s1"}]}'
+        items = list(iter_json_items([text[:10], text[10:25], text[25:]], ["shots"]))
+        assert items == [("shots", {"meta": {"k": [1, {"z": 2}]}, "id": "s1"})]
+
+    def test_any_chunk_boundaries(self):
+        text = '```json\n{"meta": "x", "characters": ' + CHARACTERS_RESPONSE[len('{"characters": '):] + "\n```"
+        expected = list(iter_json_items([text], ["characters"]))
+        rng = random.Random(7)
+        for _ in range(50):
+            cuts = sorted(rng.sample(range(1, len(text)), 8))
+            chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+            parser = IncrementalJSONParser(["characters"])
+            assert list(iter_json_items(chunks, parser.keys, parser)) == expected
+            assert parser.text == text
+
+    def test_text_is_accumulated(self):
+        parser = IncrementalJSONParser(["shots"])
+        parser.feed("abc")
+        parser.feed("def")
+        assert parser.text == "abcdef"
+
+
+class TestParseJSONResponse:
+    """测试完整响应的容错解析"""
+
+    def test_plain_fenced_and_wrapped(self):
+        expected = json.loads(CHARACTERS_RESPONSE)
+        assert parse_json(CHARACTERS_RESPONSE).data == expected
+        assert parse_json("```json\n" + CHARACTERS_RESPONSE + "\n```").data == expected
+        # 对象之后的说明文字中也有花括号
+        result = parse_json("结果如下：" + CHARACTERS_RESPONSE + "\n注：{人物} 已去重")
+        assert result.data == expected
+        assert not result.truncated
+
+    def test_no_json(self):
+        assert parse_json_response("无法完成") is None
+        assert parse_json_response("[1, 2]") is None
+
+    def test_truncated_keeps_complete_elements(self):
+        # 在第二个元素内部任意位置截断，都只保留第一个元素
+        start = CHARACTERS_RESPONSE.index('{"id": "char_ron"')
+        for end in range(start + 1, len(CHARACTERS_RESPONSE) - 2):
+            result = parse_json(CHARACTERS_RESPONSE[:end])
+            assert result.truncated
+            assert [c["id"] for c in result.data["characters"]] == ["char_harry"]
+            assert result.recovered == 1
+
+    def test_truncated_nested_object(self):
+        text = '{"scene": {"id": "scene_1", "chapter": 3, "actions": ["推门", "拔剑'
+        result = parse_json(text)
+        assert result.data == {"scene": {"id": "scene_1", "chapter": 3, "actions": ["推门"]}}
+        assert result.recovered == 0
+
+    def test_truncated_scene_not_regenerated(self):
+        response = json.dumps({"scene": {"id": "scene_e1", "location": "城堡", "time": "夜",
+                                         "actions": ["巡逻", "交谈"]}}, ensure_ascii=False)
+        client = MockLLMClient(response[:response.index("交谈") + 1])
+        client.chat = MagicMock(wraps=client.chat)
+        event = TimelineEvent(id="e1", chapter=1, summary="夜巡")
+        [scene] = ScriptGenerator(client).generate([event])
+
+        # 截断修复后直接使用，不再调用 LLM 判断时间
+        assert client.chat.call_count == 1
+        assert (scene.location, scene.time, scene.actions) == ("城堡", "夜", ["巡逻"])
+
+
+class TestStreamingConsumers:
+    """测试提取器与分镜生成器的流式接口"""
+
+    def test_extractor_yields_before_stream_finishes(self):
+        client = ChunkedClient(CHARACTERS_RESPONSE)
+        stream = CharacterExtractor(client).extract_stream("text")
+
+        first = next(stream)
+        sent_at_first = client.sent
+        rest = list(stream)
+
+        assert first.name == "哈利"
+        assert [c.name for c in rest] == ["罗恩"]
+        assert sent_at_first < client.sent
+
+    def test_stream_matches_non_stream(self):
+        events = json.dumps({"events": [
+            {"id": "e1", "chapter": 1, "summary": "开端"},
+            {"id": "e2", "chapter": 1, "summary": "发展"}
+        ]}, ensure_ascii=False)
+        streamed = list(TimelineExtractor(ChunkedClient(events)).extract_stream("t"))
+        full = TimelineExtractor(MockLLMClient(events)).extract("t")
+        assert streamed == full
+
+    def test_async_stream(self):
+        extractor = CharacterExtractor(ChunkedClient(CHARACTERS_RESPONSE))
+
+        async def run():
+            return [c.id async for c in extractor.aextract_stream("text")]
+
+        assert asyncio.run(run()) == ["char_harry", "char_ron"]
+
+    def test_stream_sends_context_within_stage(self):
+        client = ChunkedClient(CHARACTERS_RESPONSE)
+        calls = []
+
+        def stream_chat(messages, temperature=0.7, **kwargs):
+            calls.append((messages, current_stage()))
+            return ChunkedClient.stream_chat(client, messages, temperature)
+
+        client.stream_chat = stream_chat
+        characters = list(CharacterExtractor(client).extract_stream("正文", context="前情提要"))
+        assert [c.id for c in characters] == ["char_harry", "char_ron"]
+        assert calls == [(CharacterExtractor().build_messages("正文", "前情提要"), "character")]
+
+    def test_stage_not_leaked_to_consumer(self):
+        client = ChunkedClient(CHARACTERS_RESPONSE)
+        pulled = []
+
+        def stream_chat(messages, temperature=0.7, **kwargs):
+            for chunk in ChunkedClient.stream_chat(client, messages, temperature):
+                pulled.append(current_stage())
+                yield chunk
+
+        client.stream_chat = stream_chat
+        with llm_stage("scene"):
+            stream = CharacterExtractor(client).extract_stream("text")
+            next(stream)
+            # 两次取值之间，调用方仍处于自己的阶段
+            assert current_stage() == "scene"
+            list(stream)
+            assert current_stage() == "scene"
+            abandoned = CharacterExtractor(ChunkedClient(CHARACTERS_RESPONSE)).extract_stream("text")
+            next(abandoned)
+            abandoned.close()
+            assert current_stage() == "scene"
+        assert set(pulled) == {"character"}
+
+    def test_async_stage_not_leaked_to_consumer(self):
+        extractor = CharacterExtractor(ChunkedClient(CHARACTERS_RESPONSE))
+
+        async def run():
+            stages = []
+            with llm_stage("scene"):
+                async for _ in extractor.aextract_stream("text"):
+                    stages.append(current_stage())
+            return stages
+
+        assert asyncio.run(run()) == ["scene", "scene"]
+
+    def test_storyboard_stream_falls_back_without_shots(self):
+        scene = ScriptScene(id="scene_1", chapter=1, location="礼堂", time="夜",
+                            description="分院仪式")
+        shots = list(StoryboardGenerator(ChunkedClient("not json")).generate_stream(scene))
+        assert shots == StoryboardGenerator(MockLLMClient("not json")).generate(scene)
+        assert shots[0].shot_type == "全景"
+
+    def test_cached_stream_stores_full_response(self, tmp_path):
+        cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"))
+        inner = ChunkedClient(CHARACTERS_RESPONSE)
+        client = CachedLLMClient(inner, cache=cache)
+        messages = [{"role": "user", "content": "x"}]
+
+        assert "".join(client.stream_chat(messages)) == CHARACTERS_RESPONSE
+        sent = inner.sent
+        assert list(client.stream_chat(messages)) == [CHARACTERS_RESPONSE]
+        assert inner.sent == sent
+        cache.close()
+
+
+class _SSEHandler(BaseHTTPRequestHandler):
+    """以 server-sent events 逐段返回的 /v1/chat/completions 替身"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        assert request["stream"] is True
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i in range(0, len(CHARACTERS_RESPONSE), 8):
+            event = {
+                "id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0,
+                "model": "test-model",
+                "choices": [{"index": 0, "delta": {"content": CHARACTERS_RESPONSE[i:i + 8]},
+                             "finish_reason": None}]
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sse_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SSEHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+    close_shared_clients()
+
+
+class TestOpenAIStreaming:
+    """测试 OpenAICompatibleClient 的流式调用"""
+
+    def test_stream_chat(self, sse_server):
+        client = OpenAICompatibleClient(api_key="sk-test", base_url=sse_server, max_retries=0)
+        chunks = list(client.stream_chat([{"role": "user", "content": "hi"}]))
+        assert len(chunks) > 1
+        assert "".join(chunks) == CHARACTERS_RESPONSE
+
+    def test_astream_chat_feeds_extractor(self, sse_server):
+        client = OpenAICompatibleClient(api_key="sk-test", base_url=sse_server, max_retries=0)
+        extractor = CharacterExtractor(client)
+
+        async def run():
+            try:
+                return [c.name async for c in extractor.aextract_stream("text")]
+            finally:
+                await aclose_shared_clients()
+
+        assert asyncio.run(run()) == ["哈利", "罗恩"]
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Batch API 离线提交测试"""
+import time
+
+import pytest
+
+import llm_client
+from circuit_breaker import reset_shared_circuit_breakers
+from extractor import CharacterExtractor, split_after_truncation as extractor_split
+from fake_llm_server import FakeLLMServer, FaultConfig
+from llm_batch import BatchRequest, BatchRunner
+from llm_cache import CachedLLMClient, LLMResponseCache
+from llm_client import OpenAICompatibleClient, client_fingerprint, close_shared_clients
+from main import LongNovelProcessor
+from test_phase5_pipeline import PromptAwareMockClient, marked_novel_file  # noqa: F401
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+    monkeypatch.setenv("LLM_CIRCUIT_THRESHOLD", "0")
+    yield
+    close_shared_clients()
+    reset_shared_circuit_breakers()
+
+
+@pytest.fixture
+def server():
+    with FakeLLMServer(config=FaultConfig(seed=3, batch_latency=0.05)) as server:
+        yield server
+
+
+def _client(server):
+    return OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=5, retry_delay=0.0)
+
+
+def _runner(client, tmp_path, **kwargs):
+    return BatchRunner(client, work_dir=str(tmp_path / "batches"), poll_interval=0.02, **kwargs)
+
+
+def _requests(count=6):
+    extractor = CharacterExtractor()
+    return [BatchRequest(f"r{i}", "character", extractor.build_messages(f"第{i}章 风起\n林舟推开门。"))
+            for i in range(count)]
+
+
+class TestBatchRunner:
+    """测试提交、轮询与取回"""
+
+    def test_round_trip(self, server, tmp_path):
+        client = _client(server)
+        runner = _runner(client, tmp_path)
+        results = runner.run(_requests(), "extraction")
+
+        assert set(results) == {f"r{i}" for i in range(6)}
+        # 与实时调用的响应一致
+        assert results["r2"] == client.chat(_requests()[2].messages)
+        assert runner.stats() == {"batches": 1, "submitted": 6, "cache_hits": 0, "live_calls": 0}
+        [batch] = server.batches.values()
+        assert batch["request_counts"]["completed"] == 6
+
+    def test_failed_requests_retried_live(self, server, tmp_path):
+        server.config.rate_5xx = 0.5
+        runner = _runner(_client(server), tmp_path)
+        results = runner.run(_requests(10), "extraction")
+
+        assert len(results) == 10
+        assert all(results.values())
+        stats = runner.stats()
+        assert stats["live_calls"] > 0
+        assert stats["submitted"] + stats["live_calls"] == 10
+
+    def test_truncated_items_not_cached(self, server, tmp_path):
+        server.config.rate_truncate = 1.0
+        cached = CachedLLMClient(_client(server), cache=LLMResponseCache(str(tmp_path / "cache.sqlite3")))
+        live = PromptAwareMockClient()
+        runner = _runner(cached, tmp_path)
+        # 批处理结果取回后再切换实时调用的客户端（截断比例为 1 时实时调用同样会被截断）
+        runner.sleep = lambda seconds: setattr(runner, "llm_client", live)
+        results = runner.run(_requests(3), "extraction")
+
+        assert all('"characters"' in text for text in results.values())
+        assert runner.stats()["submitted"] == 0 and runner.stats()["live_calls"] == 3
+        for request in _requests(3):
+            assert cached.cache.get(client_fingerprint(cached.client, request.messages, request.temperature)) is None
+        cached.cache.close()
+
+    def test_live_failure_isolated(self, tmp_path):
+        class FailingClient(PromptAwareMockClient):
+            def chat(self, messages, temperature=0.7):
+                if "第1章" in messages[-1]["content"]:
+                    raise RuntimeError("retries exhausted")
+                return super().chat(messages, temperature)
+
+        results = _runner(FailingClient(), tmp_path).run(_requests(3), "extraction")
+        assert isinstance(results["r1"], RuntimeError)
+        assert '"characters"' in results["r0"] and '"characters"' in results["r2"]
+
+    def test_rerun_reads_downloaded_results(self, server, tmp_path):
+        first = _runner(_client(server), tmp_path).run(_requests(), "extraction")
+        requests_before = server.stats()["total"]["requests"]
+
+        runner = _runner(_client(server), tmp_path)
+        assert runner.run(_requests(), "extraction") == first
+        assert runner.stats()["batches"] == 0
+        assert server.stats()["total"]["requests"] == requests_before
+
+    def test_resume_after_interruption(self, server, tmp_path):
+        server.config.batch_latency = 0.3
+
+        def interrupt(seconds):
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            _runner(_client(server), tmp_path, sleep=interrupt).run(_requests(), "extraction")
+
+        # 重新运行时继续等待原任务，不重复提交
+        runner = _runner(_client(server), tmp_path)
+        assert len(runner.run(_requests(), "extraction")) == 6
+        assert len(server.batches) == 1
+        assert runner.stats()["batches"] == 0
+
+    def test_cache_hits_not_submitted(self, server, tmp_path):
+        cached = CachedLLMClient(_client(server), cache=LLMResponseCache(str(tmp_path / "cache.sqlite3")))
+        first = _runner(cached, tmp_path / "a").run(_requests(), "extraction")
+
+        runner = _runner(cached, tmp_path / "b")
+        assert runner.run(_requests(), "extraction") == first
+        assert runner.stats()["cache_hits"] == 6
+        assert len(server.batches) == 1
+        cached.cache.close()
+
+    def test_unbatchable_client_runs_live(self, tmp_path):
+        runner = _runner(PromptAwareMockClient(), tmp_path)
+        results = runner.run(_requests(3), "extraction")
+
+        assert all('"characters"' in text for text in results.values())
+        assert runner.stats()["live_calls"] == 3
+        assert not (tmp_path / "batches").exists()
+
+
+class TestBatchPipeline:
+    """测试完整流水线的批处理模式"""
+
+    def test_matches_sync_pipeline(self, server, tmp_path, marked_novel_file):
+        sync = LongNovelProcessor(_client(server), enable_checkpoint=False).process_novel(marked_novel_file)
+
+        runner = _runner(_client(server), tmp_path)
+        processor = LongNovelProcessor(_client(server), enable_checkpoint=False)
+        start = time.perf_counter()
+        result = processor.process_novel_batch(marked_novel_file, batch_runner=runner)
+
+        assert time.perf_counter() - start < 10
+        for key in ("characters", "relationships", "timeline_events", "script_scenes", "storyboard_shots"):
+            assert result[key] == sync[key]
+        assert result["statistics"] == sync["statistics"]
+        # 提取、场景、分镜各一轮
+        assert runner.stats()["batches"] == 3
+        assert runner.stats()["live_calls"] == 0
+
+    def test_truncated_fallbacks_split_and_retry(self, server, tmp_path, marked_novel_file, monkeypatch):
+        server.config.rate_truncate = 1.0
+        split = []
+        monkeypatch.setattr("main.split_after_truncation",
+                            lambda *args: split.append(args[0]) or extractor_split(*args))
+        runner = _runner(_client(server), tmp_path)
+        processor = LongNovelProcessor(_client(server), enable_checkpoint=False)
+        result = processor.process_novel_batch(marked_novel_file, batch_runner=runner)
+
+        # 批处理与实时回退都被截断：拆分正文重试，整轮不中断
+        assert runner.stats()["submitted"] == 0
+        assert split and result["metadata"]["total_chapters"] == len(processor.chunking_pipeline.reader.chunks)
+
+    def test_fused_extraction(self, server, tmp_path, marked_novel_file):
+        runner = _runner(_client(server), tmp_path)
+        processor = LongNovelProcessor(_client(server), enable_checkpoint=False, fused_extraction=True)
+        result = processor.process_novel_batch(marked_novel_file, batch_runner=runner)
+
+        [extraction, *_] = server.batches.values()
+        assert extraction["request_counts"]["total"] == len(processor.chunking_pipeline.reader.chunks)
+        assert result["characters"] and result["timeline_events"]
+        assert runner.stats()["live_calls"] == 0
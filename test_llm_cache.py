@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""LLM 响应缓存测试"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_client import MockLLMClient, ResponseTruncatedError, request_fingerprint
+from llm_cache import CachedLLMClient, LLMResponseCache
+
+
+class CountingClient(MockLLMClient):
+    """记录调用次数的 Mock 客户端"""
+
+    def __init__(self, response: str = '{"characters": []}', model: str = "m-1"):
+        super().__init__(response)
+        self.model = model
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7, json_mode=False):
+        self.calls += 1
+        return self.mock_response
+
+
+class TruncatingStreamClient(CountingClient):
+    """流式响应在输出上限处被截断的 Mock 客户端"""
+
+    def stream_chat(self, messages, temperature=0.7, json_mode=False):
+        yield '{"characters": [{"id": "char_a"'
+        raise ResponseTruncatedError('{"characters": [{"id": "char_a"', self.model)
+
+    async def astream_chat(self, messages, temperature=0.7, json_mode=False):
+        yield '{"characters": [{"id": "char_a"'
+        raise ResponseTruncatedError('{"characters": [{"id": "char_a"', self.model)
+
+
+MESSAGES = [{"role": "user", "content": "提取人物"}]
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "cache.sqlite3")
+
+
+class TestRequestFingerprint:
+    """测试请求指纹"""
+
+    def test_same_request_same_key(self):
+        assert request_fingerprint("m", MESSAGES, 0.7) == request_fingerprint("m", list(MESSAGES), 0.7)
+
+    @pytest.mark.parametrize("other", [
+        ("m2", MESSAGES, 0.7, False),
+        ("m", [{"role": "user", "content": "其他"}], 0.7, False),
+        ("m", MESSAGES, 0.8, False),
+        ("m", MESSAGES, 0.7, True),
+    ])
+    def test_any_field_changes_key(self, other):
+        assert request_fingerprint("m", MESSAGES, 0.7, False) != request_fingerprint(*other)
+
+
+class TestCachedLLMClient:
+    """测试缓存客户端"""
+
+    def test_hit_after_miss(self, cache_path):
+        inner = CountingClient()
+        client = CachedLLMClient(inner, cache_path=cache_path)
+
+        assert client.chat(MESSAGES) == '{"characters": []}'
+        assert client.chat(MESSAGES) == '{"characters": []}'
+
+        assert inner.calls == 1
+        stats = client.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_rate"] == 0.5
+
+    def test_persists_across_runs(self, cache_path):
+        """重新运行时命中上一次写入的缓存"""
+        CachedLLMClient(CountingClient(), cache_path=cache_path).chat(MESSAGES)
+
+        inner = CountingClient()
+        client = CachedLLMClient(inner, cache_path=cache_path)
+        client.chat(MESSAGES)
+        assert inner.calls == 0
+
+    def test_model_and_json_mode_are_part_of_key(self, cache_path):
+        cache = LLMResponseCache(cache_path)
+        CachedLLMClient(CountingClient(model="m-1"), cache=cache).chat(MESSAGES)
+
+        other_model = CountingClient(model="m-2")
+        CachedLLMClient(other_model, cache=cache).chat(MESSAGES)
+        assert other_model.calls == 1
+
+        json_client = CountingClient(model="m-1")
+        CachedLLMClient(json_client, cache=cache).chat(MESSAGES, json_mode=True)
+        assert json_client.calls == 1
+
+    def test_ttl_expiry(self, cache_path):
+        inner = CountingClient()
+        client = CachedLLMClient(inner, cache_path=cache_path, ttl_seconds=0.05)
+        client.chat(MESSAGES)
+        time.sleep(0.1)
+        client.chat(MESSAGES)
+        assert inner.calls == 2
+
+    def test_lru_eviction_by_size(self, cache_path):
+        """超出容量时淘汰最久未访问的条目"""
+        cache = LLMResponseCache(cache_path, max_bytes=25)
+        cache.put("a", "x" * 10)
+        cache.put("b", "y" * 10)
+        time.sleep(0.01)
+        assert cache.get("a") is not None  # a 变为最近访问
+        time.sleep(0.01)
+        cache.put("c", "z" * 10)
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+        assert cache.total_bytes <= 25
+        assert cache.stats()["evictions"] == 1
+
+    def test_async_path_uses_cache(self, cache_path):
+        inner = CountingClient()
+        client = CachedLLMClient(inner, cache_path=cache_path)
+
+        async def run():
+            await client.achat(MESSAGES)
+            return await client.achat(MESSAGES)
+
+        assert asyncio.run(run()) == '{"characters": []}'
+        assert inner.calls == 1
+
+    def test_async_path_off_loop(self, cache_path, monkeypatch):
+        client = CachedLLMClient(CountingClient(), cache_path=cache_path)
+        threads = []
+        for name in ("get", "put"):
+            original = getattr(client.cache, name)
+            monkeypatch.setattr(client.cache, name,
+                                lambda *args, _f=original: threads.append(threading.get_ident()) or _f(*args))
+
+        async def run():
+            await client.achat(MESSAGES)
+            return [chunk async for chunk in client.astream_chat(MESSAGES)]
+
+        assert asyncio.run(run()) == ['{"characters": []}']
+        # SQLite 读写都在线程池中执行，不占用事件循环线程
+        assert len(threads) == 3 and threading.get_ident() not in threads
+
+    def test_truncated_stream_not_cached(self, cache_path):
+        inner = TruncatingStreamClient()
+        client = CachedLLMClient(inner, cache_path=cache_path)
+        with pytest.raises(ResponseTruncatedError):
+            list(client.stream_chat(MESSAGES))
+
+        async def consume():
+            return [chunk async for chunk in client.astream_chat(MESSAGES)]
+
+        with pytest.raises(ResponseTruncatedError):
+            asyncio.run(consume())
+
+        # 截断的文本没有写入缓存，chat 仍然请求内层客户端
+        assert client.chat(MESSAGES) == '{"characters": []}'
+        assert inner.calls == 1
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""模型级联测试"""
+import asyncio
+import json
+
+import pytest
+
+from circuit_breaker import CircuitOpenError
+from compact_format import compact_response
+from extractor import CharacterExtractor
+from llm_cascade import (
+    CascadeLLMClient, cascade_from_env, validate_characters, validate_extraction, validate_shots
+)
+from llm_client import MockLLMClient
+from llm_telemetry import llm_stage
+from models import ScriptScene
+from storyboard_generator import StoryboardGenerator
+
+
+CHARACTERS = json.dumps({"characters": [{"id": "char_linzhou", "name": "林舟"}]}, ensure_ascii=False)
+EMPTY = json.dumps({"characters": []})
+
+
+def shots(*numbers, characters=()):
+    return {"shots": [{"shot_number": n, "shot_type": "中景", "description": f"镜头{n}",
+                       "characters_in_shot": list(characters)} for n in numbers]}
+
+
+SCENE = ScriptScene(id="scene_1", chapter=1, location="山门", time="夜", description="夜探山门",
+                    character_ids=["char_linzhou"])
+
+
+class CountingClient(MockLLMClient):
+    """记录调用次数的固定响应客户端"""
+
+    def __init__(self, model, response):
+        super().__init__(response)
+        self.model = model
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7, **kwargs):
+        self.calls += 1
+        return self.mock_response
+
+    async def achat(self, messages, temperature=0.7, **kwargs):
+        return self.chat(messages, temperature)
+
+
+class FailingClient(CountingClient):
+    """每次调用都抛出指定异常的客户端"""
+
+    def __init__(self, model, error):
+        super().__init__(model, "")
+        self.error = error
+
+    def chat(self, messages, temperature=0.7, **kwargs):
+        self.calls += 1
+        raise self.error
+
+    def stream_chat(self, messages, temperature=0.7, **kwargs):
+        yield self.chat(messages, temperature)
+
+
+class TestValidators:
+    """测试各阶段的结果校验"""
+
+    def test_characters(self):
+        assert validate_characters([], CHARACTERS) is None
+        assert validate_characters([], EMPTY) == "没有提取到人物"
+        assert validate_characters([], '{"characters": [{"id": "char_a"}]}') == "人物缺少 id 或 name"
+        assert validate_characters([], "抱歉，我无法完成") == "响应不是合法的 JSON"
+
+    def test_extraction_relationships_reference_characters(self):
+        data = {"characters": [{"id": "char_a", "name": "甲"}, {"id": "char_b", "name": "乙"}],
+                "relationships": [{"character_id_1": "char_a", "character_id_2": "char_c"}],
+                "events": [{"summary": "相遇"}]}
+        assert validate_extraction([], json.dumps(data)) == "关系引用了未提取的人物"
+        data["relationships"][0]["character_id_2"] = "char_b"
+        assert validate_extraction([], json.dumps(data)) is None
+
+    def test_shots(self):
+        messages = StoryboardGenerator().build_messages(SCENE)
+        assert validate_shots(messages, json.dumps(shots(1, 2, characters=["char_linzhou"]))) is None
+        assert validate_shots(messages, json.dumps(shots(1, 3))) == "shot_number 不连续"
+        assert validate_shots(messages, json.dumps(shots(1, characters=["char_ghost"]))) == \
+            "镜头包含未知人物 char_ghost"
+        assert validate_shots(messages, json.dumps({"shots": []})) == "没有生成镜头"
+
+    def test_shots_match_whole_character_ids(self):
+        scene = ScriptScene(id="scene_1", chapter=1, location="山门", time="夜", description="夜探山门",
+                            character_ids=["c10"])
+        messages = StoryboardGenerator().build_messages(scene)
+        assert validate_shots(messages, json.dumps(shots(1, characters=["c10"]))) is None
+        assert validate_shots(messages, json.dumps(shots(1, characters=["c1"]))) == "镜头包含未知人物 c1"
+
+    def test_compact_response(self):
+        compact = json.dumps(compact_response(shots(1, 2, characters=["char_linzhou"])), ensure_ascii=False)
+        assert validate_shots(StoryboardGenerator().build_messages(SCENE), compact) is None
+
+
+class TestCascade:
+    """测试级联与升级"""
+
+    def test_cheap_result_accepted(self):
+        cheap, strong = CountingClient("mini", CHARACTERS), CountingClient("large", CHARACTERS)
+        characters = CharacterExtractor(CascadeLLMClient(cheap, strong)).extract("林舟推门而入。")
+        assert [c.name for c in characters] == ["林舟"]
+        assert (cheap.calls, strong.calls) == (1, 0)
+
+    def test_escalates_on_validation_failure(self):
+        cheap, strong = CountingClient("mini", EMPTY), CountingClient("large", CHARACTERS)
+        client = CascadeLLMClient(cheap, strong)
+        characters = CharacterExtractor(client).extract("林舟推门而入。")
+        assert [c.name for c in characters] == ["林舟"]
+        assert (cheap.calls, strong.calls) == (1, 1)
+        assert client.stats()["character"] == {"calls": 1, "escalated": 1, "escalation_rate": 1.0}
+
+    def test_storyboard_unknown_character_escalates(self):
+        cheap = CountingClient("mini", json.dumps(shots(1, characters=["char_ghost"])))
+        strong = CountingClient("large", json.dumps(shots(1, 2, characters=["char_linzhou"])))
+        result = asyncio.run(StoryboardGenerator(CascadeLLMClient(cheap, strong)).agenerate(SCENE))
+        assert [s.shot_number for s in result] == [1, 2]
+        assert (cheap.calls, strong.calls) == (1, 1)
+
+    def test_other_stages_use_strong_model(self):
+        cheap, strong = CountingClient("mini", "{}"), CountingClient("large", "{}")
+        client = CascadeLLMClient(cheap, strong)
+        with llm_stage("scene"):
+            client.chat([{"role": "user", "content": "hi"}])
+            assert client.model == "large"
+        with llm_stage("storyboard"):
+            assert client.model == "mini>large"
+        assert (cheap.calls, strong.calls) == (0, 1)
+
+    def test_stream_validates_whole_response(self):
+        cheap, strong = CountingClient("mini", EMPTY), CountingClient("large", CHARACTERS)
+        characters = list(CharacterExtractor(CascadeLLMClient(cheap, strong)).extract_stream("林舟推门而入。"))
+        assert [c.name for c in characters] == ["林舟"]
+
+    def test_escalates_on_cheap_model_error(self):
+        cheap, strong = FailingClient("mini", ValueError("bad gateway body")), CountingClient("large", CHARACTERS)
+        client = CascadeLLMClient(cheap, strong)
+        with llm_stage("character"):
+            assert client.chat([{"role": "user", "content": "hi"}]) == CHARACTERS
+            assert asyncio.run(client.achat([{"role": "user", "content": "hi"}])) == CHARACTERS
+            assert "".join(client.stream_chat([{"role": "user", "content": "hi"}])) == CHARACTERS
+        assert (cheap.calls, strong.calls) == (3, 3)
+        assert client.stats()["character"]["escalated"] == 3
+
+    def test_circuit_open_not_escalated(self):
+        cheap = FailingClient("mini", CircuitOpenError("http://mini/v1", 5.0))
+        strong = CountingClient("large", CHARACTERS)
+        with llm_stage("character"), pytest.raises(CircuitOpenError):
+            CascadeLLMClient(cheap, strong).chat([{"role": "user", "content": "hi"}])
+        assert strong.calls == 0
+
+    def test_stage_without_validator_rejected(self):
+        with pytest.raises(ValueError):
+            CascadeLLMClient(MockLLMClient(), MockLLMClient(), stages=("scene",))
+
+    def test_from_env(self, monkeypatch):
+        strong = CountingClient("large", "{}")
+        monkeypatch.delenv("LLM_CASCADE_MODEL", raising=False)
+        assert cascade_from_env(strong) is strong
+
+        monkeypatch.setenv("LLM_CASCADE_MODEL", "qwen-turbo")
+        monkeypatch.setenv("LLM_CASCADE_STAGES", "storyboard")
+        client = cascade_from_env(strong)
+        assert client.cheap.model == "qwen-turbo"
+        assert list(client.validators) == ["storyboard"]
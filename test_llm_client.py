@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""LLM 客户端层测试
+
+验证共享连接池：同一 (base_url, api_key) 复用同一个底层客户端与 TCP 连接，
+并且三个阶段模块导入的是同一套客户端定义；异步调用遵守并发上限。
+"""
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm_client
+from llm_client import (
+    OpenAICompatibleClient, MockLLMClient, AsyncLLMClient,
+    get_shared_openai_client, close_shared_clients, aclose_shared_clients
+)
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    """最小化的 /v1/chat/completions 替身，记录每个请求的来源端口"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.server.client_ports.add(self.client_address[1])
+        body = json.dumps({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "test-model",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": '{"characters": []}'},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+    """启动本地替身服务器"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatHandler)
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    close_shared_clients()
+
+
+class TestSharedClientPool:
+    """测试进程级共享连接池"""
+
+    def teardown_method(self):
+        close_shared_clients()
+
+    def test_same_endpoint_returns_same_client(self):
+        """相同 (base_url, api_key) 返回同一个客户端"""
+        a = get_shared_openai_client("sk-test", "http://127.0.0.1:1/v1")
+        b = get_shared_openai_client("sk-test", "http://127.0.0.1:1/v1")
+        assert a is b
+
+    def test_different_key_returns_different_client(self):
+        """不同 api_key 使用独立的连接池"""
+        a = get_shared_openai_client("sk-a", "http://127.0.0.1:1/v1")
+        b = get_shared_openai_client("sk-b", "http://127.0.0.1:1/v1")
+        assert a is not b
+
+    def test_pool_size_from_env(self, monkeypatch):
+        """连接池大小可由 LLM_POOL_SIZE 配置"""
+        monkeypatch.setenv("LLM_POOL_SIZE", "7")
+        assert llm_client._resolve_pool_size(None) == 7
+        assert llm_client._resolve_pool_size(3) == 3
+
+    def test_clients_share_connection(self, stand_in_server):
+        """多个客户端实例、多次调用复用同一个 keep-alive 连接"""
+        base_url = f"http://127.0.0.1:{stand_in_server.server_address[1]}/v1"
+        clients = [
+            OpenAICompatibleClient(api_key="sk-test", base_url=base_url, max_retries=0)
+            for _ in range(3)
+        ]
+        for client in clients:
+            for _ in range(3):
+                assert client.chat([{"role": "user", "content": "hi"}]) == '{"characters": []}'
+
+        assert len(stand_in_server.client_ports) == 1
+
+
+class TestSharedDefinitions:
+    """测试各阶段模块共用同一套客户端定义"""
+
+    def test_modules_share_client_classes(self):
+        import extractor
+        import script_generator
+        import storyboard_generator
+
+        for module in (extractor, script_generator, storyboard_generator):
+            assert module.OpenAICompatibleClient is OpenAICompatibleClient
+            assert module.MockLLMClient is MockLLMClient
+
+
+class TestAsyncClient:
+    """测试异步调用与并发限制"""
+
+    def test_default_achat_runs_sync_chat(self):
+        """只实现 chat 的客户端也能用 achat"""
+        client = MockLLMClient('{"ok": true}')
+        assert asyncio.run(client.achat([{"role": "user", "content": "hi"}])) == '{"ok": true}'
+
+    def test_async_client_bounds_concurrency(self):
+        """AsyncLLMClient 同时在途的请求数不超过 max_concurrency"""
+
+        class SlowClient(MockLLMClient):
+            def __init__(self):
+                super().__init__("{}")
+                self.in_flight = 0
+                self.peak = 0
+
+            async def achat(self, messages, temperature=0.7, **kwargs):
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+                await asyncio.sleep(0.01)
+                self.in_flight -= 1
+                return self.mock_response
+
+        inner = SlowClient()
+        client = AsyncLLMClient(inner, max_concurrency=3)
+
+        async def run():
+            await asyncio.gather(*[client.achat([]) for _ in range(12)])
+
+        asyncio.run(run())
+        assert inner.peak == 3
+
+    def test_wrapper_exposes_inner_attributes(self):
+        """包装客户端透传内部客户端的属性"""
+        inner = OpenAICompatibleClient(api_key="sk-test", model="m-1")
+        client = AsyncLLMClient(inner)
+        assert client.model == "m-1"
+        assert client.chat is not inner.chat
+
+    def test_native_achat_against_server(self, stand_in_server):
+        """OpenAICompatibleClient.achat 通过共享异步连接池调用"""
+        base_url = f"http://127.0.0.1:{stand_in_server.server_address[1]}/v1"
+        client = OpenAICompatibleClient(api_key="sk-test", base_url=base_url, max_retries=0)
+
+        async def run():
+            try:
+                return await asyncio.gather(*[
+                    client.achat([{"role": "user", "content": "hi"}]) for _ in range(4)
+                ])
+            finally:
+                await aclose_shared_clients()
+
+        assert asyncio.run(run()) == ['{"characters": []}'] * 4
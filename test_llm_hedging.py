@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""对冲请求测试"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_client import MockLLMClient
+from llm_hedging import HedgedLLMClient, StageLatencyTracker
+from llm_telemetry import current_stage, llm_stage
+
+
+class ScriptedClient(MockLLMClient):
+    """按调用顺序使用预设延迟；记录每次调用所在阶段与被取消的异步调用"""
+
+    def __init__(self, delays, default_delay=0.01):
+        super().__init__()
+        self.delays = list(delays)
+        self.default_delay = default_delay
+        self.calls = 0
+        self.stages = []
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            index = self.calls
+            self.calls += 1
+            self.stages.append(current_stage())
+        delay = self.delays[index] if index < len(self.delays) else self.default_delay
+        return index, delay
+
+    def chat(self, messages, temperature=0.7):
+        index, delay = self._next()
+        time.sleep(abs(delay))
+        if delay < 0:
+            raise RuntimeError("boom")
+        return f"call-{index}"
+
+    async def achat(self, messages, temperature=0.7, **kwargs):
+        index, delay = self._next()
+        try:
+            await asyncio.sleep(abs(delay))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"call-{index}"
+
+
+def _warm(client, stage, count):
+    with llm_stage(stage):
+        for _ in range(count):
+            client.chat([{"role": "user", "content": "warm"}])
+
+
+def _hedged(inner, **kwargs):
+    kwargs.setdefault("min_samples", 5)
+    kwargs.setdefault("max_extra_ratio", 0.5)
+    return HedgedLLMClient(inner, **kwargs)
+
+
+class TestTracker:
+    """测试延迟记录"""
+
+    def test_percentile_per_stage(self):
+        tracker = StageLatencyTracker(window=10)
+        for value in range(1, 21):
+            tracker.observe("scene", value / 10)
+        tracker.observe("storyboard", 5.0)
+
+        # 只保留最近 10 个样本
+        assert tracker.count("scene") == 10
+        assert tracker.percentile("scene", 0.0) == 1.1
+        assert tracker.percentile("storyboard", 0.95) == 5.0
+        assert tracker.percentile("character", 0.95) is None
+
+
+class TestSyncHedging:
+    """测试同步对冲"""
+
+    def test_slow_call_is_hedged(self):
+        inner = ScriptedClient([0.01] * 5 + [1.0])
+        client = _hedged(inner)
+        _warm(client, "timeline", 5)
+
+        start = time.perf_counter()
+        with llm_stage("timeline"):
+            assert client.chat([{"role": "user", "content": "x"}]) == "call-6"
+        assert time.perf_counter() - start < 0.5
+        assert client.stats()["hedged"] == 1
+        assert client.hedge_wins == 1
+        # 线程池中的调用保留了阶段标签
+        assert inner.stages[-1] == "timeline"
+
+    def test_no_hedge_before_min_samples(self):
+        inner = ScriptedClient([0.2])
+        client = _hedged(inner)
+        with llm_stage("timeline"):
+            client.chat([{"role": "user", "content": "x"}])
+        assert inner.calls == 1
+
+    def test_extra_cost_cap(self):
+        inner = ScriptedClient([0.01] * 5 + [0.1, 0.1])
+        client = _hedged(inner, max_extra_ratio=0.0)
+        _warm(client, "scene", 5)
+        with llm_stage("scene"):
+            client.chat([{"role": "user", "content": "x"}])
+        assert client.hedged == 0
+        assert inner.calls == 6
+
+    def test_stages_tracked_separately(self):
+        inner = ScriptedClient([0.01] * 5 + [0.1])
+        client = _hedged(inner)
+        _warm(client, "scene", 5)
+        # storyboard 阶段没有样本，不受 scene 阶段延迟影响
+        with llm_stage("storyboard"):
+            client.chat([{"role": "user", "content": "x"}])
+        assert client.hedged == 0
+
+    def test_failed_primary_uses_hedge(self):
+        inner = ScriptedClient([0.01] * 5 + [-0.1])
+        client = _hedged(inner)
+        _warm(client, "scene", 5)
+        with llm_stage("scene"):
+            assert client.chat([{"role": "user", "content": "x"}]) == "call-6"
+
+    def test_fast_failure_is_raised(self):
+        inner = ScriptedClient([0.05] * 5 + [-0.001])
+        client = _hedged(inner)
+        _warm(client, "scene", 5)
+        with llm_stage("scene"), pytest.raises(RuntimeError):
+            client.chat([{"role": "user", "content": "x"}])
+        assert client.hedged == 0
+
+
+class TestAsyncHedging:
+    """测试异步对冲"""
+
+    def test_loser_is_cancelled(self):
+        inner = ScriptedClient([0.01] * 5 + [1.0])
+        client = _hedged(inner)
+
+        async def run():
+            with llm_stage("storyboard"):
+                for _ in range(5):
+                    await client.achat([{"role": "user", "content": "warm"}])
+                start = time.perf_counter()
+                result = await client.achat([{"role": "user", "content": "x"}])
+                return result, time.perf_counter() - start
+
+        result, elapsed = asyncio.run(run())
+        assert result == "call-6"
+        assert elapsed < 0.5
+        assert inner.cancelled == 1
+        assert client.hedge_wins == 1
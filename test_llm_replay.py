@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""LLM 录制与回放测试"""
+import asyncio
+import json
+import time
+
+import pytest
+
+from llm_client import MockLLMClient
+from llm_replay import CassetteMissError, RecordingLLMClient, ReplayLLMClient, replay_key
+from llm_telemetry import llm_stage
+from main import LongNovelProcessor
+from test_phase5_pipeline import PromptAwareMockClient, marked_novel_file  # noqa: F401
+
+
+class EchoClient(MockLLMClient):
+    """返回 prompt 内容并模拟固定延迟"""
+
+    def __init__(self, delay=0.0, model="model-a"):
+        super().__init__()
+        self.delay = delay
+        self.model = model
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7):
+        self.calls += 1
+        time.sleep(self.delay)
+        return f"{self.model}:{messages[-1]['content']}"
+
+
+def _messages(text):
+    return [{"role": "user", "content": text}]
+
+
+class TestRecording:
+    """测试录制"""
+
+    def test_writes_cassette_lines(self, tmp_path):
+        path = tmp_path / "cassettes" / "run.jsonl"
+        client = RecordingLLMClient(EchoClient(delay=0.02), str(path))
+
+        with llm_stage("timeline"):
+            assert client.chat(_messages("甲"), temperature=0.3) == "model-a:甲"
+
+        [entry] = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+        assert entry["key"] == replay_key(_messages("甲"), 0.3)
+        assert entry["model"] == "model-a"
+        assert entry["stage"] == "timeline"
+        assert entry["response"] == "model-a:甲"
+        assert entry["latency"] >= 0.02
+        assert client.recorded == 1
+
+    def test_records_async_and_stream(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        client = RecordingLLMClient(EchoClient(), str(path))
+
+        asyncio.run(client.achat(_messages("乙")))
+        assert "".join(client.stream_chat(_messages("丙"))) == "model-a:丙"
+
+        responses = [json.loads(line)["response"] for line in path.read_text(encoding="utf-8").splitlines()]
+        assert responses == ["model-a:乙", "model-a:丙"]
+
+
+class TestReplay:
+    """测试回放"""
+
+    def _record(self, path, prompts, **kwargs):
+        client = RecordingLLMClient(EchoClient(**kwargs), str(path))
+        for prompt in prompts:
+            client.chat(_messages(prompt))
+
+    def test_replays_by_fingerprint(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲", "乙"])
+
+        replay = ReplayLLMClient(str(path))
+        assert replay.chat(_messages("乙")) == "model-a:乙"
+        assert asyncio.run(replay.achat(_messages("甲"))) == "model-a:甲"
+        assert replay.stats() == {"recorded": 2, "hits": 2, "misses": 0}
+
+    def test_temperature_is_part_of_key(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲"])
+
+        with pytest.raises(CassetteMissError):
+            ReplayLLMClient(str(path)).chat(_messages("甲"), temperature=0.1)
+
+    def test_miss_uses_fallback(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲"])
+
+        replay = ReplayLLMClient(str(path), fallback=MockLLMClient("{}"))
+        assert replay.chat(_messages("新 prompt")) == "{}"
+        assert replay.misses == 1
+
+    def test_recorded_latency(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲"], delay=0.05)
+
+        replay = ReplayLLMClient(str(path), latency_scale=1.0)
+        start = time.perf_counter()
+        replay.chat(_messages("甲"))
+        assert time.perf_counter() - start >= 0.05
+
+        instant = ReplayLLMClient(str(path))
+        start = time.perf_counter()
+        instant.chat(_messages("甲"))
+        assert time.perf_counter() - start < 0.05
+
+    def test_prefers_matching_model(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲"], model="model-a")
+        self._record(path, ["甲"], model="model-b")
+
+        assert ReplayLLMClient(str(path), model="model-b").chat(_messages("甲")) == "model-b:甲"
+        # 未指定模型时按录制顺序轮流返回
+        replay = ReplayLLMClient(str(path))
+        assert [replay.chat(_messages("甲")) for _ in range(3)] == ["model-a:甲", "model-b:甲", "model-a:甲"]
+
+    def test_skips_corrupt_lines(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        self._record(path, ["甲"])
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"key": "trunc')
+        assert len(ReplayLLMClient(str(path))) == 1
+
+
+class TestPipelineReplay:
+    """测试完整流水线的录制与离线回放"""
+
+    def test_replay_reproduces_recorded_run(self, tmp_path, marked_novel_file):
+        path = str(tmp_path / "novel.jsonl")
+
+        recorder = RecordingLLMClient(PromptAwareMockClient(), path)
+        recorded = LongNovelProcessor(recorder, enable_checkpoint=False).process_novel(marked_novel_file)
+
+        replay = ReplayLLMClient(path)
+        replayed = asyncio.run(
+            LongNovelProcessor(replay, enable_checkpoint=False, max_concurrency=4).aprocess_novel(marked_novel_file)
+        )
+
+        assert replay.misses == 0
+        for key in ("chapter_results", "characters", "script_scenes", "storyboard_shots"):
+            assert replayed[key] == recorded[key]
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""多端点路由测试"""
+import asyncio
+import json
+
+import httpx
+import pytest
+from openai import APIConnectionError, BadRequestError, InternalServerError
+
+from circuit_breaker import CircuitOpenError
+from llm_client import MockLLMClient
+from llm_router import RouterLLMClient, endpoints_from_env, is_failover_error
+
+
+_REQUEST = httpx.Request("POST", "http://test/v1/chat/completions")
+
+
+def server_error():
+    return InternalServerError("boom", response=httpx.Response(500, request=_REQUEST), body=None)
+
+
+def bad_request():
+    return BadRequestError("bad", response=httpx.Response(400, request=_REQUEST), body=None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ScriptedClient(MockLLMClient):
+    """按预设延迟返回或抛出预设异常的端点"""
+
+    def __init__(self, name, clock, latency=0.1, errors=None):
+        super().__init__(name)
+        self.model = name
+        self.clock = clock
+        self.latency = latency
+        self.errors = list(errors or [])
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7):
+        self.calls += 1
+        self.clock.now += self.latency
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.mock_response
+
+    async def achat(self, messages, temperature=0.7, **kwargs):
+        return self.chat(messages, temperature)
+
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class TestRouting:
+    """测试端点选择"""
+
+    def test_prefers_faster_endpoint(self):
+        clock = FakeClock()
+        slow = ScriptedClient("slow", clock, latency=2.0)
+        fast = ScriptedClient("fast", clock, latency=0.2)
+        router = RouterLLMClient([slow, fast], clock=clock)
+
+        # 两个端点先各被试探一次，之后持续使用较快的端点
+        results = [router.chat(MESSAGES) for _ in range(6)]
+
+        assert slow.calls == 1
+        assert results[-4:] == ["fast"] * 4
+
+    def test_fails_over_on_server_error(self):
+        clock = FakeClock()
+        broken = ScriptedClient("broken", clock, errors=[server_error()])
+        backup = ScriptedClient("backup", clock)
+        router = RouterLLMClient([broken, backup], clock=clock)
+
+        assert router.chat(MESSAGES) == "backup"
+        stats = {s["name"]: s for s in router.stats()}
+        assert stats["endpoint_0"]["failures"] == 1
+        assert stats["endpoint_0"]["cooldown_until"] > clock.now
+
+    def test_fails_over_on_connection_error(self):
+        clock = FakeClock()
+        broken = ScriptedClient("broken", clock, errors=[APIConnectionError(request=_REQUEST)])
+        backup = ScriptedClient("backup", clock)
+        router = RouterLLMClient([broken, backup], clock=clock)
+        assert router.chat(MESSAGES) == "backup"
+
+    def test_client_error_not_failed_over(self):
+        clock = FakeClock()
+        first = ScriptedClient("first", clock, errors=[bad_request()])
+        second = ScriptedClient("second", clock)
+        router = RouterLLMClient([first, second], clock=clock)
+
+        with pytest.raises(BadRequestError):
+            router.chat(MESSAGES)
+        assert second.calls == 0
+
+    def test_cooling_endpoint_skipped_then_recovers(self):
+        clock = FakeClock()
+        flaky = ScriptedClient("flaky", clock, latency=0.01, errors=[server_error()])
+        steady = ScriptedClient("steady", clock, latency=0.5)
+        router = RouterLLMClient([flaky, steady], cooldown=5.0, clock=clock)
+
+        router.chat(MESSAGES)
+        router.chat(MESSAGES)
+        assert flaky.calls == 1  # 冷却中，不再尝试
+
+        clock.now += 10.0
+        assert router.chat(MESSAGES) == "flaky"
+
+    def test_all_endpoints_fail_raises_last_error(self):
+        clock = FakeClock()
+        router = RouterLLMClient([
+            ScriptedClient("a", clock, errors=[server_error()]),
+            ScriptedClient("b", clock, errors=[APIConnectionError(request=_REQUEST)])
+        ], clock=clock)
+        with pytest.raises(APIConnectionError):
+            router.chat(MESSAGES)
+
+    def test_async_failover(self):
+        clock = FakeClock()
+        broken = ScriptedClient("broken", clock, errors=[server_error()])
+        backup = ScriptedClient("backup", clock)
+        router = RouterLLMClient([broken, backup], clock=clock)
+        assert asyncio.run(router.achat(MESSAGES)) == "backup"
+
+    def test_stream_failover_before_first_chunk(self):
+        clock = FakeClock()
+        broken = ScriptedClient("broken", clock, errors=[server_error()])
+        backup = ScriptedClient("backup", clock)
+        router = RouterLLMClient([broken, backup], clock=clock)
+        assert "".join(router.stream_chat(MESSAGES)) == "backup"
+
+    def test_failover_error_classification(self):
+        assert is_failover_error(server_error())
+        assert is_failover_error(APIConnectionError(request=_REQUEST))
+        assert not is_failover_error(bad_request())
+        assert not is_failover_error(ValueError("bad json"))
+        assert not is_failover_error(KeyError("choices"))
+        assert is_failover_error(CircuitOpenError("http://a/v1", 5.0))
+
+    def test_local_error_not_failed_over(self):
+        clock = FakeClock()
+        broken = ScriptedClient("broken", clock, errors=[ValueError("bad json")])
+        backup = ScriptedClient("backup", clock)
+        router = RouterLLMClient([broken, backup], clock=clock)
+        with pytest.raises(ValueError, match="bad json"):
+            router.chat(MESSAGES)
+        assert backup.calls == 0
+
+
+class TestEndpointsFromEnv:
+    """测试 LLM_ENDPOINTS 配置"""
+
+    def test_not_configured(self, monkeypatch):
+        monkeypatch.delenv("LLM_ENDPOINTS", raising=False)
+        assert endpoints_from_env() is None
+
+    def test_builds_router(self, monkeypatch):
+        monkeypatch.setenv("LLM_API_KEY", "sk-default")
+        monkeypatch.setenv("LLM_MODEL", "default-model")
+        monkeypatch.setenv("LLM_ENDPOINTS", json.dumps([
+            {"base_url": "http://a/v1", "model": "m-a", "name": "primary"},
+            {"base_url": "http://b/v1", "api_key": "none"}
+        ]))
+        router = endpoints_from_env()
+
+        assert [e.name for e in router.endpoints] == ["primary", "http://b/v1#default-model"]
+        assert router.endpoints[0].client.api_key == "sk-default"
+        assert router.endpoints[1].client.model == "default-model"
+        assert router.model == "default-model|m-a"
+
+    def test_invalid_json(self, monkeypatch):
+        monkeypatch.setenv("LLM_ENDPOINTS", "not json")
+        with pytest.raises(ValueError):
+            endpoints_from_env()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""分阶段模型路由测试"""
+import asyncio
+import json
+import threading
+
+import pytest
+
+from llm_client import MockLLMClient, OpenAICompatibleClient, client_fingerprint, close_shared_clients
+from llm_stages import (
+    StageConfig, StageLLMClient, format_stage_costs, model_prices_from_env, stage_configs_from_env,
+    summarize_stage_costs
+)
+from llm_telemetry import LLMCallRecord, get_telemetry, llm_stage, reset_telemetry
+from fake_llm_server import FakeLLMServer
+from main import LongNovelProcessor, create_stage_client
+from rate_limiter import CompositeRateLimiter, reset_shared_rate_limiters
+from test_phase5_pipeline import PromptAwareMockClient, marked_novel_file  # noqa: F401
+
+
+class NamedClient(MockLLMClient):
+    def __init__(self, model):
+        super().__init__(model)
+        self.model = model
+
+
+def _messages(text="hi"):
+    return [{"role": "user", "content": text}]
+
+
+class TestConfig:
+    """测试环境变量配置"""
+
+    def test_documented_model_variables(self, monkeypatch):
+        monkeypatch.setenv("EXTRACTOR_MODEL", "strong")
+        monkeypatch.setenv("STORYBOARD_GENERATOR_MODEL", "cheap")
+        monkeypatch.delenv("SCRIPT_GENERATOR_MODEL", raising=False)
+        monkeypatch.setenv("LLM_STAGES", json.dumps({
+            "timeline": {"model": "cheap"},
+            "storyboard": {"concurrency": 16, "rpm": 600}
+        }))
+
+        configs = stage_configs_from_env()
+        assert configs["character"].model == "strong"
+        assert configs["timeline"].model == "cheap"
+        assert configs["storyboard"] == StageConfig(model="cheap", max_concurrency=16, requests_per_minute=600)
+        assert "scene" not in configs
+
+    def test_unknown_stage(self, monkeypatch):
+        monkeypatch.setenv("LLM_STAGES", '{"dialogue": {"model": "x"}}')
+        with pytest.raises(ValueError):
+            stage_configs_from_env()
+
+
+class TestStageClient:
+    """测试按阶段分发"""
+
+    def test_dispatch_by_stage(self):
+        client = StageLLMClient(NamedClient("strong"), {"storyboard": NamedClient("cheap")})
+
+        assert client.chat(_messages()) == "strong"
+        with llm_stage("storyboard"):
+            assert client.chat(_messages()) == "cheap"
+            assert client.model == "cheap"
+            assert asyncio.run(client.achat(_messages())) == "cheap"
+        assert client.model == "strong"
+
+    def test_fingerprint_follows_stage_model(self):
+        client = StageLLMClient(NamedClient("strong"), {"storyboard": NamedClient("cheap")})
+        default_key = client_fingerprint(client, _messages(), 0.3)
+        with llm_stage("storyboard"):
+            assert client_fingerprint(client, _messages(), 0.3) != default_key
+
+    def test_create_stage_client_shares_clients(self):
+        default = OpenAICompatibleClient(api_key="sk-test", base_url="http://127.0.0.1:1/v1", model="strong")
+        client = create_stage_client(default, {
+            "character": StageConfig(model="strong"),
+            "timeline": StageConfig(model="cheap"),
+            "storyboard": StageConfig(model="cheap"),
+            "scene": StageConfig(model="cheap", requests_per_minute=60)
+        })
+
+        assert client.client_for("character") is default
+        assert client.client_for("timeline") is client.client_for("storyboard")
+        assert client.client_for("scene") is not client.client_for("timeline")
+        assert client.client_for("scene").rate_limiter.stats()["requests_per_minute"] == 60
+        assert len(client.distinct_clients()) == 3
+
+    def test_stage_budget_draws_from_account_budget(self, monkeypatch):
+        monkeypatch.setenv("LLM_RPM", "120")
+        monkeypatch.delenv("LLM_SHARED_LIMITS_PATH", raising=False)
+        reset_shared_rate_limiters()
+        try:
+            default = OpenAICompatibleClient(api_key="sk-test", base_url="http://127.0.0.1:1/v1", model="strong",
+                                             max_retries=7, retry_delay=0.1, pool_size=5)
+            client = create_stage_client(default, {"storyboard": StageConfig(model="cheap", requests_per_minute=600)})
+            storyboard = client.client_for("storyboard")
+            assert isinstance(storyboard.rate_limiter, CompositeRateLimiter)
+            assert default.rate_limiter in storyboard.rate_limiter.limiters
+            assert storyboard.rate_limiter.stats()["requests_per_minute"] == 120
+            assert (storyboard.max_retries, storyboard.retry_delay, storyboard.pool_size) == (7, 0.1, 5)
+        finally:
+            reset_shared_rate_limiters()
+
+    def test_no_overrides_returns_default(self):
+        default = NamedClient("strong")
+        assert create_stage_client(default, {"storyboard": StageConfig(max_concurrency=4)}) is default
+
+
+class TestStageConcurrency:
+    """测试阶段独立的并发上限"""
+
+    def test_storyboard_limit(self, marked_novel_file):
+        in_flight = {"storyboard": 0, "max_storyboard": 0}
+        lock = threading.Lock()
+
+        class TrackingClient(PromptAwareMockClient):
+            async def achat(self, messages, temperature=0.7, **kwargs):
+                storyboard = "分镜" in messages[0]["content"]
+                if storyboard:
+                    with lock:
+                        in_flight["storyboard"] += 1
+                        in_flight["max_storyboard"] = max(in_flight["max_storyboard"], in_flight["storyboard"])
+                await asyncio.sleep(0.01)
+                try:
+                    return self.chat(messages, temperature)
+                finally:
+                    if storyboard:
+                        with lock:
+                            in_flight["storyboard"] -= 1
+
+        processor = LongNovelProcessor(TrackingClient(), enable_checkpoint=False,
+                                       max_concurrency=8, stage_concurrency={"storyboard": 1})
+        assert processor.storyboard_generator.llm_client.max_concurrency == 1
+        assert processor.character_extractor.llm_client is processor.llm_client
+
+        asyncio.run(processor.aprocess_novel(marked_novel_file))
+        assert in_flight["max_storyboard"] == 1
+
+
+class TestCosts:
+    """测试按阶段的成本统计"""
+
+    def _records(self):
+        return [
+            LLMCallRecord(stage="character", model="strong", prompt_tokens=1000, completion_tokens=500),
+            LLMCallRecord(stage="storyboard", model="cheap", prompt_tokens=1000, completion_tokens=500),
+            LLMCallRecord(stage="storyboard", model="cheap", prompt_tokens=1000, completion_tokens=500),
+            LLMCallRecord(stage="scene", model="unknown", prompt_tokens=10, completion_tokens=10)
+        ]
+
+    def test_throughput_per_dollar(self):
+        prices = {"strong": (2.0, 8.0), "cheap": (0.2, 0.8)}
+        summary = summarize_stage_costs(self._records(), prices)
+
+        assert summary["character"]["cost"] == pytest.approx(0.006)
+        assert summary["storyboard"]["cost"] == pytest.approx(0.0012)
+        assert summary["storyboard"]["calls_per_dollar"] == pytest.approx(2 / 0.0012)
+        assert summary["scene"]["calls_per_dollar"] is None
+
+        lines = format_stage_costs(self._records(), prices)
+        assert lines[0].startswith("[COST] character（strong）")
+        assert "未配置价格" in lines[-1]
+
+    def test_cached_input_price(self, monkeypatch):
+        monkeypatch.setenv("LLM_PRICES", '{"strong": [2.0, 8.0, 0.5]}')
+        prices = model_prices_from_env()
+        record = LLMCallRecord(stage="character", model="strong", prompt_tokens=1000,
+                               completion_tokens=500, cached_tokens=800)
+        summary = summarize_stage_costs([record], prices)
+
+        # 200 个未命中 token 按输入价格，800 个命中 token 按缓存价格
+        assert summary["character"]["cost"] == pytest.approx((200 * 2.0 + 800 * 0.5 + 500 * 8.0) / 1e6)
+        assert "前缀缓存命中 80.0%" in format_stage_costs([record], prices)[0]
+
+
+class TestPipelineModels:
+    """测试完整流水线按阶段使用不同模型"""
+
+    def test_models_recorded_per_stage(self, marked_novel_file, monkeypatch):
+        monkeypatch.delenv("LOG_LLM_REQUESTS", raising=False)
+        reset_telemetry()
+        with FakeLLMServer() as server:
+            try:
+                default = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url,
+                                                 model="strong", max_retries=0)
+                client = create_stage_client(default, {
+                    "timeline": StageConfig(model="cheap"),
+                    "storyboard": StageConfig(model="cheap")
+                })
+                LongNovelProcessor(client, enable_checkpoint=False).process_novel(marked_novel_file)
+            finally:
+                close_shared_clients()
+
+        models = {}
+        for record in get_telemetry().records:
+            models.setdefault(record.stage, set()).add(record.model)
+        reset_telemetry()
+        assert models["character"] == {"strong"}
+        assert models["timeline"] == {"cheap"}
+        assert models["storyboard"] == {"cheap"}
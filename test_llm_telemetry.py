@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""LLM 调用遥测测试"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+import llm_client
+from extractor import CharacterExtractor
+from llm_client import OpenAICompatibleClient, MockLLMClient, close_shared_clients
+from llm_telemetry import (
+    LLMCallRecord, TelemetryCollector, begin_call, current_stage, end_call, get_telemetry,
+    llm_stage, reset_telemetry
+)
+
+
+class _SlowBodyHandler(BaseHTTPRequestHandler):
+    """先返回响应头、延迟后再写正文；可配置前 N 次请求返回 500"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+
+        if self.server.failures_left > 0:
+            self.server.failures_left -= 1
+            body = b'{"error": {"message": "boom"}}'
+            self.send_response(500)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        body = json.dumps({
+            "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "test-model",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": '{"characters": []}'},
+                         "finish_reason": self.server.finish_reason}],
+            "usage": {"prompt_tokens": 120, "completion_tokens": 30, "total_tokens": 150}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(0.1)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SlowBodyHandler)
+    server.failures_left = 0
+    server.finish_reason = "length"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    close_shared_clients()
+
+
+@pytest.fixture(autouse=True)
+def fresh_telemetry(monkeypatch):
+    monkeypatch.delenv("LOG_LLM_REQUESTS", raising=False)
+    reset_telemetry()
+    yield
+    reset_telemetry()
+
+
+def _client(server, **kwargs):
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return OpenAICompatibleClient(api_key="sk-test", base_url=base_url, **kwargs)
+
+
+class TestStage:
+    """测试阶段上下文"""
+
+    def test_default_and_nested(self):
+        assert current_stage() == "other"
+        with llm_stage("scene"):
+            with llm_stage("storyboard"):
+                assert current_stage() == "storyboard"
+            assert current_stage() == "scene"
+        assert current_stage() == "other"
+
+    def test_isolated_between_tasks(self):
+        async def tagged(name):
+            with llm_stage(name):
+                await asyncio.sleep(0.01)
+                return current_stage()
+
+        async def run():
+            return await asyncio.gather(tagged("character"), tagged("timeline"))
+
+        assert asyncio.run(run()) == ["character", "timeline"]
+
+    def test_inherited_by_to_thread(self):
+        async def run():
+            with llm_stage("relationship"):
+                return await asyncio.to_thread(current_stage)
+
+        assert asyncio.run(run()) == "relationship"
+
+
+class TestClientRecords:
+    """测试 OpenAICompatibleClient 生成的记录"""
+
+    def test_usage_finish_reason_and_ttfb(self, server):
+        extractor = CharacterExtractor(_client(server, max_retries=0))
+        extractor.extract("text")
+
+        [record] = get_telemetry().records
+        assert record.stage == "character"
+        assert record.model == "gpt-4o-mini"
+        assert (record.prompt_tokens, record.completion_tokens, record.total_tokens) == (120, 30, 150)
+        assert record.finish_reason == "length"
+        assert record.retries == 0
+        assert record.error is None
+        # 响应头先于正文到达
+        assert record.ttfb_seconds < record.wall_seconds - 0.05
+
+    def test_retries_counted(self, server, monkeypatch):
+        monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+        server.failures_left = 1
+        server.finish_reason = "stop"
+        client = _client(server, max_retries=2, retry_delay=0.0)
+
+        with llm_stage("scene"):
+            client.chat([{"role": "user", "content": "hi"}])
+
+        [record] = get_telemetry().records
+        assert record.stage == "scene"
+        assert record.retries == 1
+        assert record.error is None
+
+    def test_failed_call_recorded(self, server):
+        server.failures_left = 5
+        client = _client(server, max_retries=0)
+
+        with pytest.raises(Exception):
+            client.chat([{"role": "user", "content": "hi"}])
+
+        [record] = get_telemetry().records
+        assert record.error.startswith("InternalServerError")
+
+    def test_async_records_stage(self, server):
+        client = _client(server, max_retries=0)
+
+        async def run():
+            try:
+                await CharacterExtractor(client).aextract("text")
+            finally:
+                await llm_client.aclose_shared_clients()
+
+        asyncio.run(run())
+        [record] = get_telemetry().records
+        assert record.stage == "character"
+        assert record.total_tokens == 150
+
+    def test_mock_client_not_recorded(self):
+        CharacterExtractor(MockLLMClient("{}")).extract("text")
+        assert len(get_telemetry().records) == 0
+
+
+class TestAggregation:
+    """测试按阶段聚合"""
+
+    def _record(self, collector, stage, wall, prompt=10, completion=5, retries=0, finish="stop"):
+        record = LLMCallRecord(stage=stage, model="m", wall_seconds=wall, ttfb_seconds=wall / 2,
+                               prompt_tokens=prompt, completion_tokens=completion,
+                               retries=retries, finish_reason=finish)
+        collector.record(record)
+
+    def test_summary_by_stage(self):
+        collector = TelemetryCollector()
+        for wall in (0.2, 0.7, 3.0):
+            self._record(collector, "storyboard", wall)
+        self._record(collector, "character", 100.0, prompt=1000, retries=2, finish="length")
+
+        summary = collector.summary()
+        assert summary["storyboard"]["calls"] == 3
+        assert summary["storyboard"]["latency_p50"] == 0.7
+        assert summary["storyboard"]["latency_histogram"][:4] == [1, 1, 0, 1]
+        assert summary["character"]["latency_histogram"][-1] == 1
+        assert summary["character"]["retries"] == 2
+        assert summary["character"]["finish_reasons"] == {"length": 1}
+
+        lines = collector.format_summary()
+        # 按总耗时排序，耗时最多的阶段在前
+        assert lines[0].startswith("[STATS] character")
+
+    def test_cached_tokens(self):
+        openai_usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=10, total_tokens=1010,
+                                       prompt_tokens_details=SimpleNamespace(cached_tokens=768))
+        deepseek_usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=10, total_tokens=1010,
+                                         prompt_cache_hit_tokens=512)
+        with llm_stage("character"):
+            for usage in (openai_usage, deepseek_usage):
+                end_call(begin_call("m"), response=SimpleNamespace(usage=usage, choices=[]))
+
+        assert [r.cached_tokens for r in get_telemetry().records] == [768, 512]
+        assert get_telemetry().summary()["character"]["cached_tokens"] == 1280
+        assert any("前缀缓存命中 1280 token（prompt 的 64.0%）" in line
+                   for line in get_telemetry().format_summary())
+
+    def test_log_file(self, tmp_path, monkeypatch):
+        log_file = tmp_path / "logs" / "llm.log"
+        monkeypatch.setenv("LOG_LLM_REQUESTS", "true")
+        monkeypatch.setenv("LOG_FILE", str(log_file))
+        reset_telemetry()
+
+        with llm_stage("timeline"):
+            record = begin_call("m", "http://x")
+        end_call(record, messages=[{"role": "user", "content": "你好"}], text="{}")
+
+        entry = json.loads(log_file.read_text(encoding="utf-8").strip())
+        assert entry["stage"] == "timeline"
+        assert entry["request"][0]["content"] == "你好"
+        assert entry["response"] == "{}"
+        assert "_start" not in entry
@@ -3,9 +3,16 @@
 
 使用《哈利波特》片段测试提取器的泛化能力，通过 Mock LLM 返回值进行单元测试。
 """
+import asyncio
+import json
+import re
+
 import pytest
 from unittest.mock import MagicMock
-from extractor import CharacterExtractor, RelationshipExtractor, TimelineExtractor, MockLLMClient
+from extractor import (
+    CharacterExtractor, RelationshipExtractor, TimelineExtractor, FusedExtractor, MockLLMClient,
+    ResponseTruncatedError
+)
 
 
 class MockNovelText:
@@ -255,5 +262,98 @@ class TestTimelineExtractor:
         assert len(events_with_chars) > 0 or len(events) > 0
 
 
+class TestFusedExtractor:
+    """测试融合提取器"""
+
+    def _fused_response(self):
+        data = {}
+        for response in (get_character_mock_response(), get_relationship_mock_response(),
+                         get_timeline_mock_response()):
+            data.update(json.loads(response))
+        return json.dumps(data, ensure_ascii=False)
+
+    def test_extract_all_in_one_call(self):
+        """测试一次调用得到三类结果"""
+        mock_client = MockLLMClient(self._fused_response())
+        mock_client.chat = MagicMock(wraps=mock_client.chat)
+        extractor = FusedExtractor(mock_client)
+        result = extractor.extract(MockNovelText.get_harry_potter_sample())
+
+        assert mock_client.chat.call_count == 1
+        assert any("哈利" in c.name for c in result["characters"])
+        assert any(r.type == "朋友" for r in result["relationships"])
+        assert len(result["timeline_events"]) == 2
+
+    def test_context_sent_before_text(self):
+        """测试参考上下文只发送一次且位于正文之前"""
+        extractor = FusedExtractor()
+        messages = extractor.build_messages("本章正文", context="人物记忆")
+
+        assert len(messages) == 2
+        user = messages[1]["content"]
+        assert user.count("人物记忆") == 1
+        assert user.index("人物记忆") < user.index("本章正文")
+        # 系统消息不含可变内容
+        assert messages[0]["content"] == FusedExtractor().build_messages("其他正文")[0]["content"]
+
+    def test_missing_sections_empty(self):
+        """测试缺少的部分返回空列表"""
+        extractor = FusedExtractor(MockLLMClient(get_character_mock_response()))
+        result = extractor.extract("测试文本")
+
+        assert len(result["characters"]) == 2
+        assert result["relationships"] == []
+        assert result["timeline_events"] == []
+
+
+class OutputLimitedClient(MockLLMClient):
+    """正文中每个【事件N】生成一个事件，超过 max_events 个时按输出上限截断"""
+
+    def __init__(self, max_events):
+        super().__init__()
+        self.max_events = max_events
+        self.prompts = []
+
+    def chat(self, messages, temperature=0.7):
+        prompt = messages[-1]["content"]
+        self.prompts.append(prompt)
+        names = re.findall(r"【(事件\d+)】", prompt.split("正文：", 1)[-1])
+        response = json.dumps({"events": [
+            {"id": f"event_{name}", "chapter": 1, "summary": name} for name in names
+        ]}, ensure_ascii=False)
+        if len(names) > self.max_events:
+            raise ResponseTruncatedError(response[:len(response) // 2])
+        return response
+
+
+class TestTruncationSplit:
+    """测试响应被截断时拆分正文重新提取"""
+
+    def _text(self, count):
+        return "正文：" + "\n\n".join(f"【事件{i}】" + "剧情继续发展。" * 10 for i in range(count))
+
+    def test_split_recovers_all_events(self):
+        client = OutputLimitedClient(max_events=3)
+        events = TimelineExtractor(client).extract(self._text(8))
+
+        assert [e.summary for e in events] == [f"事件{i}" for i in range(8)]
+        # 8 -> 4 + 4 -> (2 + 2) + (2 + 2)
+        assert len(client.prompts) == 7
+
+    def test_context_kept_in_every_half(self):
+        client = OutputLimitedClient(max_events=3)
+        asyncio.run(TimelineExtractor(client).aextract(self._text(6), context="人物记忆"))
+
+        assert len(client.prompts) == 3
+        assert all(prompt.count("人物记忆") == 1 for prompt in client.prompts)
+
+    def test_short_text_parses_partial_response(self):
+        client = OutputLimitedClient(max_events=0)
+        events = TimelineExtractor(client).extract("正文：【事件0】【事件1】【事件2】")
+        # 无法再拆分：保留截断前已完成的元素
+        assert len(client.prompts) == 1
+        assert [e.summary for e in events] == ["事件0"]
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -3,8 +3,12 @@
 
 使用《哈利波特》片段测试分镜生成器的泛化能力。
 """
+import asyncio
+import json
+import re
+
 import pytest
-from storyboard_generator import StoryboardGenerator, MockLLMClient
+from storyboard_generator import StoryboardGenerator, MockLLMClient, ResponseTruncatedError
 from models import ScriptScene, StoryboardShot
 
 
@@ -248,5 +252,55 @@ class TestStoryboardGenerator:
         assert shots[0].shot_type == "全景"
 
 
+class OutputLimitedClient(MockLLMClient):
+    """每个动作生成一个镜头，超过 max_shots 个镜头时按输出上限截断"""
+
+    def __init__(self, max_shots):
+        super().__init__()
+        self.max_shots = max_shots
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7):
+        self.calls += 1
+        actions = re.search(r"动作列表：(.*)", messages[-1]["content"]).group(1).split(", ")
+        response = json.dumps({"shots": [
+            {"shot_number": n, "shot_type": "中景", "description": action}
+            for n, action in enumerate(actions, start=1)
+        ]}, ensure_ascii=False)
+        if len(actions) > self.max_shots:
+            raise ResponseTruncatedError(response[:len(response) // 2])
+        return response
+
+
+class TestTruncationSplit:
+    """测试分镜响应被截断时拆分场景重新生成"""
+
+    def _scene(self, count):
+        return ScriptScene(id="scene_long", chapter=1, location="长街", time="夜", description="追逐",
+                           actions=[f"动作{i}" for i in range(count)])
+
+    def test_split_recovers_all_shots(self):
+        client = OutputLimitedClient(max_shots=2)
+        shots = StoryboardGenerator(client).generate(self._scene(6))
+
+        assert [s.description for s in shots] == [f"动作{i}" for i in range(6)]
+        assert [s.shot_number for s in shots] == list(range(1, 7))
+        assert len({s.id for s in shots}) == 6
+        # 6 -> 3 + 3 -> (2 + 1) + (2 + 1)
+        assert client.calls == 7
+
+    def test_async_split(self):
+        client = OutputLimitedClient(max_shots=2)
+        shots = asyncio.run(StoryboardGenerator(client).agenerate(self._scene(5)))
+        assert [s.description for s in shots] == [f"动作{i}" for i in range(5)]
+
+    def test_unsplittable_scene_keeps_complete_shots(self):
+        client = OutputLimitedClient(max_shots=0)
+        shots = StoryboardGenerator(client).generate(self._scene(1))
+        # 截断前没有完整的镜头时才使用基础分镜
+        assert client.calls == 1
+        assert shots[0].shot_type == "全景"
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
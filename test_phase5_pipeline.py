@@ -3,8 +3,15 @@
 
 使用《哈利波特》片段测试完整的处理流水线。
 """
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
 import pytest
-from main import NovelProcessor
+from main import NovelProcessor, LongNovelProcessor
 from models import Character, Relationship, TimelineEvent, ScriptScene, StoryboardShot
 from extractor import MockLLMClient
 
@@ -232,5 +239,170 @@ class TestNovelProcessor:
         assert len(harry.traits) > 0 or len(harry.description) > 0
 
 
+# ==================== 异步流水线 ====================
+
+class PromptAwareMockClient(MockLLMClient):
+    """按 prompt 类型返回响应的 Mock 客户端
+
+    每章文本中带有【标记X】，响应内容由当前章节的标记决定；异步调用时
+    随机延迟，使请求完成顺序与发起顺序不同。
+    """
+
+    def chat(self, messages: list, temperature: float = 0.7) -> str:
+        prompt = "\n".join(m["content"] for m in messages)
+        markers = re.findall(r"【标记(\w+)】", prompt)
+        marker = markers[-1] if markers else "无"
+
+        characters = {"characters": [
+            {"id": f"char_{marker}", "name": f"人物{marker}", "description": f"来自{marker}",
+             "traits": [f"特质{marker}"], "goals": []}
+        ]}
+        relationships = {"relationships": [
+            {"id": f"rel_{marker}", "character_id_1": f"char_{marker}",
+             "character_id_2": "char_x", "type": "朋友", "description": ""}
+        ]}
+        events = {"events": [
+            {"id": f"event_{marker}_{i}", "chapter": 0, "summary": f"事件{marker}{i}",
+             "character_ids": [f"char_{marker}"]}
+            for i in range(2)
+        ]}
+        if "一次性完成三项分析" in prompt:
+            return json.dumps({**characters, **relationships, **events})
+        if "提取其中出现的所有主要人物" in prompt:
+            return json.dumps(characters)
+        if "提取其中人物之间的关系" in prompt:
+            return json.dumps(relationships)
+        if "提取其中的时间线事件" in prompt:
+            return json.dumps(events)
+        if "转化为规范的剧本场景" in prompt:
+            summary = re.search(r"摘要：(\S+)", prompt).group(1)
+            return json.dumps({"scene": {
+                "id": f"scene_{summary}", "location": "地点", "time": "日",
+                "description": summary, "actions": [summary], "dialogues": [],
+                # 记录生成时注入的记忆上下文，用于校验合并顺序的确定性
+                "character_ids": sorted(set(re.findall(r"char_\w+", prompt)))
+            }})
+        if "拆解为 3-6 个专业的分镜镜头" in prompt:
+            scene_id = re.search(r"场景 ID: (\S+)", prompt).group(1)
+            return json.dumps({"shots": [
+                {"shot_number": n, "shot_type": "中景", "description": f"{scene_id}-{n}"}
+                for n in (1, 2)
+            ]})
+        return "{}"
+
+    async def achat(self, messages: list, temperature: float = 0.7, **kwargs) -> str:
+        await asyncio.sleep(random.uniform(0, 0.01))
+        return self.chat(messages, temperature)
+
+
+@pytest.fixture
+def marked_novel_file(tmp_path):
+    """带章节标记的测试小说"""
+    chapters = []
+    for i, name in enumerate(["一", "二", "三", "四", "五"]):
+        chapters.append(f"第{name}章 标题{i}\n\n【标记{chr(65 + i)}】这一章讲述了新的故事。" + "故事继续发展。" * 10 + "\n")
+    path = tmp_path / "novel.txt"
+    path.write_text("\n".join(chapters), encoding="utf-8")
+    return str(path)
+
+
+class TestLongNovelProcessorAsync:
+    """测试异步长篇处理与同步版本结果一致"""
+
+    def _run_both(self, novel_file, use_vector_memory):
+        sync_processor = LongNovelProcessor(
+            PromptAwareMockClient(), enable_checkpoint=False,
+            use_vector_memory=use_vector_memory
+        )
+        async_processor = LongNovelProcessor(
+            PromptAwareMockClient(), enable_checkpoint=False,
+            use_vector_memory=use_vector_memory, max_concurrency=4
+        )
+        sync_result = sync_processor.process_novel(novel_file)
+        async_result = asyncio.run(async_processor.aprocess_novel(novel_file))
+        return sync_result, async_result
+
+    @pytest.mark.parametrize("use_vector_memory", [True, False])
+    def test_async_matches_sync(self, marked_novel_file, use_vector_memory):
+        """异步结果（含章节顺序与记忆上下文）与同步结果完全一致"""
+        sync_result, async_result = self._run_both(marked_novel_file, use_vector_memory)
+
+        for key in ("statistics", "chapter_results", "characters", "relationships",
+                    "timeline_events", "script_scenes", "storyboard_shots"):
+            assert async_result[key] == sync_result[key]
+
+    def test_async_keeps_chapter_order(self, marked_novel_file):
+        """异步结果按章节顺序排列"""
+        _, async_result = self._run_both(marked_novel_file, True)
+
+        chapters = [r["chapter"] for r in async_result["chapter_results"]]
+        assert chapters == sorted(chapters)
+        summaries = [e["summary"] for e in async_result["timeline_events"]]
+        assert summaries == [f"事件{chr(65 + i)}{j}" for i in range(5) for j in range(2)]
+
+
+class SlowMockClient(PromptAwareMockClient):
+    """每次调用固定延迟，失败阶段的提取请求抛出异常"""
+
+    def __init__(self, delay=0.0, failing=()):
+        super().__init__()
+        self.delay = delay
+        self.failing = failing
+
+    def chat(self, messages: list, temperature: float = 0.7) -> str:
+        prompt = "\n".join(m["content"] for m in messages)
+        time.sleep(self.delay)
+        if any(phrase in prompt for phrase in self.failing):
+            raise RuntimeError("injected failure")
+        return super().chat(messages, temperature)
+
+
+class TestConcurrentExtraction:
+    """测试同步模式下三个提取器并发执行"""
+
+    def test_latency_of_slowest_call(self, marked_novel_file):
+        processor = LongNovelProcessor(SlowMockClient(delay=0.2), enable_checkpoint=False)
+        chunk = processor.load_novel(marked_novel_file)[0]
+
+        start = time.perf_counter()
+        extracted = processor._extract_with_memory(chunk, "", "")
+        assert time.perf_counter() - start < 0.5
+        assert extracted["characters"] and extracted["relationships"] and extracted["timeline_events"]
+
+    def test_matches_serial(self, marked_novel_file):
+        serial = LongNovelProcessor(PromptAwareMockClient(), enable_checkpoint=False,
+                                    extraction_workers=1).process_novel(marked_novel_file)
+        concurrent = LongNovelProcessor(PromptAwareMockClient(), enable_checkpoint=False,
+                                        extraction_workers=3).process_novel(marked_novel_file)
+        for key in ("statistics", "characters", "relationships", "timeline_events", "script_scenes"):
+            assert concurrent[key] == serial[key]
+
+    def test_executor_shut_down_after_processing(self, marked_novel_file):
+        processor = LongNovelProcessor(PromptAwareMockClient(), enable_checkpoint=False, extraction_workers=3)
+        before = {t.name for t in threading.enumerate()}
+        processor.process_novel(marked_novel_file)
+        assert processor._extraction_executor is None
+        assert not any(t.name.startswith("extract") for t in threading.enumerate() if t.name not in before)
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_failed_extractor_isolated(self, marked_novel_file, use_async):
+        processor = LongNovelProcessor(SlowMockClient(failing=("提取其中人物之间的关系",)),
+                                       enable_checkpoint=False)
+        if use_async:
+            result = asyncio.run(processor.aprocess_novel(marked_novel_file))
+        else:
+            result = processor.process_novel(marked_novel_file)
+
+        assert result["relationships"] == []
+        assert len(result["characters"]) == 5
+        assert len(result["timeline_events"]) == 10
+
+    def test_all_failed_raises(self, marked_novel_file):
+        client = SlowMockClient(failing=("提取其中出现的所有主要人物", "提取其中人物之间的关系", "提取其中的时间线事件"))
+        processor = LongNovelProcessor(client, enable_checkpoint=False)
+        with pytest.raises(RuntimeError, match="injected failure"):
+            processor.process_novel(marked_novel_file)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""客户端限流器测试"""
+import httpx
+import pytest
+from openai import RateLimitError
+
+from llm_client import OpenAICompatibleClient, estimate_tokens, estimate_messages_tokens
+from rate_limiter import (
+    TokenBucket, RateLimiter, CompositeRateLimiter, parse_retry_after,
+    get_shared_rate_limiter, reset_shared_rate_limiters
+)
+
+
+class FakeClock:
+    """可手动推进的时钟"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_rate_limit_error(headers):
+    request = httpx.Request("POST", "http://test/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+class TestTokenEstimate:
+    """测试 token 估算"""
+
+    def test_cjk_counts_per_character(self):
+        assert estimate_tokens("哈利波特") == 4
+
+    def test_latin_counts_per_four_chars(self):
+        assert estimate_tokens("abcdefgh") == 2
+
+    def test_messages_include_overhead(self):
+        messages = [{"role": "user", "content": "哈利"}]
+        assert estimate_messages_tokens(messages) == 2 + 4
+
+
+class TestTokenBucket:
+    """测试令牌桶"""
+
+    def test_burst_then_wait(self):
+        clock = FakeClock()
+        bucket = TokenBucket(60, burst_seconds=2, clock=clock)  # 1 个/秒，容量 2
+        assert bucket.reserve(1) == 0
+        assert bucket.reserve(1) == 0
+        assert bucket.reserve(1) == pytest.approx(1.0)
+        # 透支后继续排队
+        assert bucket.reserve(1) == pytest.approx(2.0)
+
+    def test_refill_over_time(self):
+        clock = FakeClock()
+        bucket = TokenBucket(60, burst_seconds=1, clock=clock)
+        bucket.reserve(1)
+        clock.advance(1.0)
+        assert bucket.reserve(1) == 0
+
+
+class TestRateLimiter:
+    """测试 RPM/TPM 双桶限流"""
+
+    def test_tpm_limits_large_requests(self):
+        clock = FakeClock()
+        limiter = RateLimiter(tokens_per_minute=600, burst_seconds=10, clock=clock)  # 10 tok/s，容量 100
+        assert limiter.reserve(100) == 0
+        assert limiter.reserve(50) == pytest.approx(5.0)
+        assert limiter.throttled_requests == 1
+
+    def test_reconcile_refunds_overestimate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(tokens_per_minute=600, burst_seconds=10, clock=clock)
+        limiter.reserve(100)
+        limiter.reconcile(estimated_tokens=100, actual_tokens=40)
+        assert limiter.reserve(60) == 0
+
+    def test_reconcile_charges_underestimate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(tokens_per_minute=600, burst_seconds=10, clock=clock)
+        limiter.reserve(50)
+        limiter.reconcile(estimated_tokens=50, actual_tokens=100)
+        assert limiter.reserve(10) == pytest.approx(1.0)
+
+    def test_penalize_blocks_all_reservations(self):
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=6000, clock=clock)
+        limiter.penalize(3.0)
+        assert limiter.reserve(1) == pytest.approx(3.0)
+        clock.advance(3.0)
+        assert limiter.reserve(1) == 0
+
+    def test_composite_charges_every_budget(self):
+        clock = FakeClock()
+        account = RateLimiter(requests_per_minute=60, burst_seconds=2, clock=clock)  # 容量 2
+        storyboard = CompositeRateLimiter(RateLimiter(requests_per_minute=600, clock=clock), account)
+        scene = CompositeRateLimiter(RateLimiter(requests_per_minute=600, clock=clock), account)
+        assert storyboard.reserve(1) == 0
+        assert scene.reserve(1) == 0
+        # 阶段预算充足，但账号预算已用完
+        assert storyboard.reserve(1) == pytest.approx(1.0)
+        assert storyboard.stats()["throttled_requests"] == 1
+        storyboard.penalize(5.0)
+        assert scene.reserve(1) == pytest.approx(5.0)
+
+
+class TestRetryAfter:
+    """测试 Retry-After 解析与遵守"""
+
+    def test_parse_seconds(self):
+        assert parse_retry_after(make_rate_limit_error({"retry-after": "2"})) == 2.0
+
+    def test_parse_milliseconds(self):
+        assert parse_retry_after(make_rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+
+    def test_missing_header(self):
+        assert parse_retry_after(make_rate_limit_error({})) is None
+
+    def test_client_honours_retry_after(self):
+        limiter = RateLimiter(requests_per_minute=6000)
+        client = OpenAICompatibleClient(api_key="sk-test", retry_delay=100, rate_limiter=limiter)
+        delay = client._retry_delay(make_rate_limit_error({"retry-after": "0.5"}), attempt=0)
+        # 使用服务端给出的等待时间而不是指数退避
+        assert 0.5 <= delay < 0.7
+        assert limiter.reserve(1) > 0.3
+
+
+class TestSharedRateLimiter:
+    """测试进程级共享限流器"""
+
+    def teardown_method(self):
+        reset_shared_rate_limiters()
+
+    def test_disabled_without_budget(self, monkeypatch):
+        monkeypatch.delenv("LLM_RPM", raising=False)
+        monkeypatch.delenv("LLM_TPM", raising=False)
+        assert get_shared_rate_limiter("http://a", "k") is None
+
+    def test_clients_share_limiter(self, monkeypatch):
+        monkeypatch.setenv("LLM_RPM", "60")
+        monkeypatch.setenv("LLM_TPM", "100000")
+        a = OpenAICompatibleClient(api_key="k", base_url="http://a")
+        b = OpenAICompatibleClient(api_key="k", base_url="http://a", model="other")
+        assert a.rate_limiter is not None
+        assert a.rate_limiter is b.rate_limiter
+        assert a.rate_limiter.tokens_per_minute == 100000
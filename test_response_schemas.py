@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""结构化输出 Schema 测试"""
+import pytest
+
+import llm_client
+from circuit_breaker import reset_shared_circuit_breakers
+from fake_llm_server import FakeLLMServer, FaultConfig
+from llm_client import OpenAICompatibleClient, client_fingerprint, close_shared_clients
+from llm_telemetry import get_telemetry, llm_stage, reset_telemetry
+from models import ScriptScene, StoryboardShot, TimelineEvent
+from response_schemas import dataclass_schema, response_schema
+from script_generator import ScriptGenerator
+from storyboard_generator import StoryboardGenerator
+
+
+@pytest.fixture(autouse=True)
+def fresh_telemetry():
+    reset_telemetry()
+    yield
+    reset_telemetry()
+
+
+class TestSchemas:
+    """测试由数据类生成的 Schema"""
+
+    def test_strict_object(self):
+        schema = dataclass_schema(StoryboardShot)
+        assert schema["additionalProperties"] is False
+        assert schema["required"] == list(schema["properties"])
+        assert schema["properties"]["shot_number"] == {"type": "integer"}
+        assert schema["properties"]["duration_seconds"] == {"type": ["number", "null"]}
+        assert schema["properties"]["characters_in_shot"] == {"type": "array", "items": {"type": "string"}}
+
+    def test_dialogues_override(self):
+        dialogue = dataclass_schema(ScriptScene)["properties"]["dialogues"]["items"]
+        assert dialogue["required"] == ["character_id", "line"]
+        assert dialogue["additionalProperties"] is False
+
+    def test_stage_envelopes(self):
+        fused = response_schema("extraction")["json_schema"]
+        assert fused["strict"] is True
+        assert fused["schema"]["required"] == ["characters", "relationships", "events"]
+        assert response_schema("scene")["json_schema"]["schema"]["properties"]["scene"]["type"] == "object"
+        assert response_schema("scene_fallback") is None
+
+
+class TestClientRequest:
+    """测试按阶段选择 response_format"""
+
+    def _client(self, **kwargs):
+        return OpenAICompatibleClient(api_key="sk-test", base_url="http://127.0.0.1:1/v1",
+                                      rate_limiter=None, circuit_breaker=None, **kwargs)
+
+    def test_schema_follows_stage(self):
+        client = self._client(structured_output=True)
+        messages = [{"role": "user", "content": "hi"}]
+        with llm_stage("storyboard"):
+            request = client.build_request(messages, 0.8, json_mode=False)
+        assert request["response_format"]["type"] == "json_schema"
+        assert request["response_format"]["json_schema"]["name"] == "storyboard_response"
+
+        with llm_stage("scene_fallback"):
+            request = client.build_request(messages, 0.3, json_mode=False)
+        assert request["response_format"] == {"type": "json_object"}
+
+    def test_disabled_by_default(self, monkeypatch):
+        monkeypatch.delenv("LLM_STRUCTURED_OUTPUT", raising=False)
+        with llm_stage("storyboard"):
+            request = self._client().build_request([{"role": "user", "content": "hi"}], 0.8, json_mode=False)
+        assert request["response_format"] == {"type": "json_object"}
+
+    def test_enabled_from_env(self, monkeypatch):
+        monkeypatch.setenv("LLM_STRUCTURED_OUTPUT", "true")
+        assert self._client().structured_output is True
+
+    def test_fingerprint_includes_schema(self):
+        messages = [{"role": "user", "content": "hi"}]
+        with llm_stage("scene"):
+            plain = client_fingerprint(self._client(structured_output=False), messages, 0.8)
+            structured = client_fingerprint(self._client(structured_output=True), messages, 0.8)
+        assert plain != structured
+
+
+class TestParseOutcomes:
+    """测试解析失败率与回退率的统计"""
+
+    @pytest.fixture
+    def fake_server(self, monkeypatch):
+        monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: 0.0)
+        servers = []
+
+        def start(**kwargs):
+            server = FakeLLMServer(config=FaultConfig(seed=7, **kwargs)).start()
+            servers.append(server)
+            return server
+
+        yield start
+        for server in servers:
+            server.stop()
+        close_shared_clients()
+        reset_shared_circuit_breakers()
+
+    def _run(self, server, structured_output):
+        client = OpenAICompatibleClient(api_key="sk-fake", base_url=server.base_url, max_retries=0,
+                                        retry_delay=0.0, structured_output=structured_output)
+        events = [TimelineEvent(id=f"event_{i}", chapter=1, summary="夜探山门", location="山门") for i in range(4)]
+        scenes = ScriptGenerator(client).generate(events)
+        for scene in scenes:
+            StoryboardGenerator(client).generate(scene)
+        return get_telemetry().parse_summary()
+
+    def test_malformed_responses_fall_back(self, fake_server):
+        summary = self._run(fake_server(rate_malformed=1.0), structured_output=False)
+
+        assert summary["scene"]["failed"] == 4
+        assert summary["scene"]["fallback_rate"] == 1.0
+        assert summary["storyboard"]["fallback"] == 4
+        # 每个回退场景额外调用一次 LLM 判断时间
+        assert get_telemetry().summary()["scene_fallback"]["calls"] == 4
+
+    def test_structured_output_eliminates_fallbacks(self, fake_server):
+        summary = self._run(fake_server(rate_malformed=1.0), structured_output=True)
+
+        assert summary["scene"] == dict(summary["scene"], ok=4, failed=0, fallback=0)
+        assert summary["storyboard"]["fallback"] == 0
+        assert "scene_fallback" not in get_telemetry().summary()
+        assert any(line.startswith("[PARSE] scene") for line in get_telemetry().format_summary())
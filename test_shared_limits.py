@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""跨进程共享限流与并发测试"""
+import asyncio
+import multiprocessing
+import sqlite3
+import subprocess
+import sys
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+from adaptive_concurrency import get_shared_concurrency_limiter, reset_shared_concurrency_limiters
+from llm_telemetry import reset_telemetry
+from rate_limiter import get_shared_rate_limiter, get_stage_rate_limiter, reset_shared_rate_limiters
+from shared_limits import (
+    SharedConcurrencyLimiter, SharedLimitStore, SharedRateLimiter, close_limit_stores, limit_key
+)
+
+
+def make_rate_limit_error():
+    request = httpx.Request("POST", "http://test/v1/chat/completions")
+    return RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+
+
+def reserve_in_process(path, count):
+    """子进程：按共享预算预约 count 次，返回各次需要等待的秒数"""
+    limiter = SharedRateLimiter(SharedLimitStore(path), "http://fake/v1#k", requests_per_minute=6)
+    return [limiter.reserve(1) for _ in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    reset_telemetry()
+    yield
+    reset_shared_rate_limiters()
+    reset_shared_concurrency_limiters()
+    close_limit_stores()
+    reset_telemetry()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "limits.sqlite3")
+
+
+class TestSharedRateLimiter:
+    """测试共享令牌桶（每个 SharedLimitStore 模拟一个进程）"""
+
+    def test_budget_shared_between_stores(self, path):
+        a = SharedRateLimiter(SharedLimitStore(path), "k", requests_per_minute=60, burst_seconds=2)
+        b = SharedRateLimiter(SharedLimitStore(path), "k", requests_per_minute=60, burst_seconds=2)
+        assert a.reserve(1) == 0
+        assert b.reserve(1) == 0
+        assert a.reserve(1) == pytest.approx(1.0, abs=0.05)
+        assert b.reserve(1) == pytest.approx(2.0, abs=0.05)
+
+    def test_keys_are_independent(self, path):
+        store = SharedLimitStore(path)
+        a = SharedRateLimiter(store, "a", requests_per_minute=60, burst_seconds=1)
+        b = SharedRateLimiter(store, "b", requests_per_minute=60, burst_seconds=1)
+        assert a.reserve(1) == 0
+        assert b.reserve(1) == 0
+
+    def test_retry_after_pauses_every_process(self, path):
+        a = SharedRateLimiter(SharedLimitStore(path), "k", requests_per_minute=6000)
+        b = SharedRateLimiter(SharedLimitStore(path), "k", requests_per_minute=6000)
+        a.penalize(5.0)
+        assert b.reserve(1) == pytest.approx(5.0, abs=0.1)
+
+    def test_reconcile_refunds_shared_tokens(self, path):
+        a = SharedRateLimiter(SharedLimitStore(path), "k", tokens_per_minute=600, burst_seconds=10)
+        b = SharedRateLimiter(SharedLimitStore(path), "k", tokens_per_minute=600, burst_seconds=10)
+        assert a.reserve(100) == 0
+        a.reconcile(100, 10)
+        assert b.reserve(90) == 0
+
+    def test_real_processes_share_budget(self, path):
+        # 6 RPM、突发 10 秒：桶容量为 1，三个进程合计只有一次预约无需等待
+        SharedLimitStore(path)
+        with multiprocessing.get_context("spawn").Pool(3) as pool:
+            waits = [w for result in pool.starmap(reserve_in_process, [(path, 2)] * 3) for w in result]
+        assert len(waits) == 6
+        assert sum(1 for w in waits if w == 0) == 1
+
+
+class TestSharedConcurrencyLimiter:
+    """测试共享并发名额与 AIMD 上限"""
+
+    def test_slots_shared_between_stores(self, path):
+        a = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=2)
+        b = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=2)
+        slot = a.acquire()
+        b.acquire()
+        assert not a.try_acquire()
+        assert a.stats()["in_flight"] == 2
+        a.release(slot, latency=1.0)
+        assert b.try_acquire()
+
+    def test_429_lowers_limit_for_every_process(self, path):
+        a = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=8)
+        b = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=8)
+        a.release(a.acquire(), error=make_rate_limit_error())
+        assert b.stats()["limit"] == 4
+        # 同一轮内另一个进程的 429 不再重复下调
+        b.release(b.acquire(), error=make_rate_limit_error())
+        assert a.stats()["limit"] == 4 and a.stats()["decreases"] == 1
+
+    def test_reclaims_slots_of_exited_process(self, path):
+        limiter = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=1, max_limit=1)
+        dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                              capture_output=True, text=True, check=True)
+        with sqlite3.connect(path) as conn:
+            conn.execute("INSERT INTO holders (key, pid, in_flight) VALUES (?, ?, 1)", ("k", int(dead.stdout)))
+        assert limiter.try_acquire()
+
+
+class TestEventLoop:
+    """测试异步调用方不被 SQLite 写锁阻塞"""
+
+    @staticmethod
+    def _run_while_locked(path, make_call):
+        """另一个连接持有写锁 0.3 秒，期间统计事件循环的心跳次数"""
+
+        async def scenario():
+            blocker = sqlite3.connect(path, isolation_level=None)
+            blocker.execute("BEGIN IMMEDIATE")
+            ticks = 0
+
+            async def heartbeat():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            beat = asyncio.ensure_future(heartbeat())
+            call = asyncio.ensure_future(make_call())
+            await asyncio.sleep(0.3)
+            blocker.execute("COMMIT")
+            blocker.close()
+            result = await asyncio.wait_for(call, 5)
+            beat.cancel()
+            return ticks, result
+
+        return asyncio.run(scenario())
+
+    def test_aacquire_slot_off_loop(self, path):
+        limiter = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=2)
+        ticks, started = self._run_while_locked(path, limiter.aacquire)
+        assert ticks >= 10
+        limiter.release(started)
+        assert limiter.stats()["in_flight"] == 0
+
+    def test_rate_limiter_aacquire_off_loop(self, path):
+        limiter = SharedRateLimiter(SharedLimitStore(path), "k", requests_per_minute=600)
+        ticks, wait = self._run_while_locked(path, lambda: limiter.aacquire(1))
+        assert ticks >= 10 and wait == 0
+
+    def test_cancelled_waiter_returns_slot(self, path):
+        limiter = SharedConcurrencyLimiter(SharedLimitStore(path), "k", initial_limit=1, max_limit=1)
+
+        async def scenario():
+            waiter = asyncio.ensure_future(limiter.aacquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+
+        asyncio.run(scenario())
+        assert limiter.stats()["in_flight"] == 0
+
+
+class TestFactories:
+    """测试环境变量启用共享状态"""
+
+    def test_shared_limiters_from_env(self, path, monkeypatch):
+        monkeypatch.setenv("LLM_SHARED_LIMITS_PATH", path)
+        monkeypatch.setenv("LLM_RPM", "60")
+        monkeypatch.setenv("LLM_ADAPTIVE_CONCURRENCY", "true")
+        rate = get_shared_rate_limiter("http://a/v1", "sk-secret")
+        concurrency = get_shared_concurrency_limiter("http://a/v1", "sk-secret")
+        assert isinstance(rate, SharedRateLimiter)
+        assert isinstance(concurrency, SharedConcurrencyLimiter)
+        assert rate.key == concurrency.key == limit_key("http://a/v1", "sk-secret")
+
+        rate.reserve(1)
+        with open(path, "rb") as f:
+            assert b"sk-secret" not in f.read()
+
+    def test_stage_budget_shared_between_processes(self, path, monkeypatch):
+        monkeypatch.setenv("LLM_SHARED_LIMITS_PATH", path)
+        monkeypatch.delenv("LLM_RPM", raising=False)
+        monkeypatch.delenv("LLM_TPM", raising=False)
+        limiter = get_stage_rate_limiter("http://a/v1", "k", "storyboard", requests_per_minute=60)
+        assert isinstance(limiter, SharedRateLimiter)
+        assert limiter.key == limit_key("http://a/v1", "k") + "/storyboard"
+
+        # 另一个进程（独立连接）的同一阶段共用预算
+        other = SharedRateLimiter(SharedLimitStore(path), limiter.key, requests_per_minute=60)
+        assert [limiter.reserve(1) for _ in range(10)] == [0] * 10
+        assert other.reserve(1) == pytest.approx(1.0, abs=0.05)
+
+    def test_process_local_without_path(self, monkeypatch):
+        monkeypatch.delenv("LLM_SHARED_LIMITS_PATH", raising=False)
+        monkeypatch.setenv("LLM_RPM", "60")
+        assert not isinstance(get_shared_rate_limiter("http://a/v1", "k"), SharedRateLimiter)
+
+    def test_new_limiters_after_fork(self, path, monkeypatch):
+        monkeypatch.setenv("LLM_SHARED_LIMITS_PATH", path)
+        monkeypatch.setenv("LLM_RPM", "60")
+        monkeypatch.setenv("LLM_ADAPTIVE_CONCURRENCY", "true")
+        parent = (get_shared_rate_limiter("http://a/v1", "k"), get_shared_concurrency_limiter("http://a/v1", "k"))
+        # fork 出的子进程进程号不同，不沿用父进程的实例
+        monkeypatch.setattr("os.getpid", lambda: 999999)
+        child = (get_shared_rate_limiter("http://a/v1", "k"), get_shared_concurrency_limiter("http://a/v1", "k"))
+        assert child[0] is not parent[0] and child[1] is not parent[1]
+        assert child[1]._pid == 999999
+        assert child[0].store is not parent[0].store
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""单飞请求合并测试"""
+import asyncio
+import threading
+import time
+
+from llm_client import MockLLMClient
+from single_flight import (
+    SingleFlightGroup, SingleFlightLLMClient,
+    get_shared_single_flight_group, reset_shared_single_flight_group
+)
+
+
+class CountingClient(MockLLMClient):
+    """记录上游调用次数的慢速客户端"""
+
+    def __init__(self, delay=0.05, fail=False):
+        super().__init__('{"characters": []}')
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def chat(self, messages, temperature=0.7):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("upstream failed")
+        return self.mock_response + messages[0]["content"]
+
+    async def achat(self, messages, temperature=0.7, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("upstream failed")
+        return self.mock_response + messages[0]["content"]
+
+
+def _run_threads(target, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def worker(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+class TestSingleFlightSync:
+    """测试同步调用合并"""
+
+    def test_identical_concurrent_calls_coalesce(self):
+        inner = CountingClient()
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        results, errors = _run_threads(lambda: client.chat(messages), 8)
+
+        assert inner.calls == 1
+        assert errors == [None] * 8
+        assert set(results) == {'{"characters": []}A'}
+        assert client.stats()["calls"] == 1
+        assert client.stats()["coalesced"] == 7
+
+    def test_different_prompts_not_coalesced(self):
+        inner = CountingClient(delay=0.02)
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+
+        threads = [
+            threading.Thread(target=client.chat, args=([{"role": "user", "content": c}],))
+            for c in "ABC"
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert inner.calls == 3
+        assert client.stats()["coalesced"] == 0
+
+    def test_temperature_is_part_of_key(self):
+        inner = CountingClient(delay=0.02)
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        threads = [
+            threading.Thread(target=client.chat, args=(messages, t))
+            for t in (0.1, 0.9)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert inner.calls == 2
+
+    def test_error_shared_with_waiters(self):
+        inner = CountingClient(fail=True)
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        _, errors = _run_threads(lambda: client.chat(messages), 4)
+
+        assert inner.calls == 1
+        assert all(isinstance(e, RuntimeError) for e in errors)
+
+    def test_sequential_calls_not_cached(self):
+        """请求完成后不保留结果，下一次调用重新发出"""
+        inner = CountingClient(delay=0)
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        client.chat(messages)
+        client.chat(messages)
+
+        assert inner.calls == 2
+        assert client.group.in_flight() == 0
+
+
+class TestSingleFlightAsync:
+    """测试异步调用合并"""
+
+    def test_identical_concurrent_calls_coalesce(self):
+        inner = CountingClient()
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        async def run():
+            return await asyncio.gather(*[client.achat(messages) for _ in range(6)])
+
+        results = asyncio.run(run())
+        assert inner.calls == 1
+        assert results == ['{"characters": []}A'] * 6
+        assert client.stats()["coalesced"] == 5
+        assert client.group.in_flight() == 0
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        inner = CountingClient()
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        async def run():
+            first = asyncio.ensure_future(client.achat(messages))
+            second = asyncio.ensure_future(client.achat(messages))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(run()) == '{"characters": []}A'
+        assert inner.calls == 1
+
+    def test_error_shared_with_waiters(self):
+        inner = CountingClient(fail=True)
+        client = SingleFlightLLMClient(inner, group=SingleFlightGroup())
+        messages = [{"role": "user", "content": "A"}]
+
+        async def run():
+            return await asyncio.gather(*[client.achat(messages) for _ in range(3)],
+                                        return_exceptions=True)
+
+        results = asyncio.run(run())
+        assert inner.calls == 1
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+
+class TestSharedGroup:
+    """测试进程级共享合并组"""
+
+    def teardown_method(self):
+        reset_shared_single_flight_group()
+
+    def test_clients_share_default_group(self):
+        """不同任务各自创建的客户端默认共用一个合并组"""
+        a = SingleFlightLLMClient(CountingClient())
+        b = SingleFlightLLMClient(CountingClient())
+        assert a.group is b.group is get_shared_single_flight_group()
+
+    def test_coalesces_across_client_instances(self):
+        inner = CountingClient()
+        a = SingleFlightLLMClient(inner)
+        b = SingleFlightLLMClient(inner)
+        messages = [{"role": "user", "content": "A"}]
+
+        threads = [threading.Thread(target=c.chat, args=(messages,)) for c in (a, b)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert inner.calls == 1
+        assert get_shared_single_flight_group().stats()["coalesced"] == 1
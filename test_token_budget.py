@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Token 预算规划测试"""
+import pytest
+
+from llm_client import MockLLMClient, estimate_messages_tokens
+from main import LongNovelProcessor
+from models import ScriptScene
+from storyboard_generator import StoryboardGenerator
+from test_phase5_pipeline import PromptAwareMockClient
+from token_budget import (
+    TRIM_MARKER, ContextPart, PromptBudgetError, TokenBudgetPlanner, get_token_estimator,
+    set_token_estimator
+)
+
+
+class TestPlanner:
+    """测试按优先级裁剪"""
+
+    def _planner(self, max_tokens):
+        return TokenBudgetPlanner(max_tokens, estimator=len, overhead_tokens=0)
+
+    def _parts(self):
+        return [
+            ContextPart("previous", "前" * 50 + "后" * 50, keep="tail"),
+            ContextPart("memory", "记" * 50),
+            ContextPart("chunk", "正" * 100, required=True)
+        ]
+
+    def test_fits_without_trimming(self):
+        plan = self._planner(300).plan("模板" * 5, self._parts())
+        assert plan.trimmed == {}
+        assert plan.tokens == 260
+
+    def test_previous_trimmed_first(self):
+        plan = self._planner(240).plan("模板" * 5, self._parts())
+
+        assert plan.texts["memory"] == "记" * 50
+        assert plan.texts["chunk"] == "正" * 100
+        # 上一章保留靠近本章的结尾
+        assert plan.texts["previous"] == TRIM_MARKER + "前" * 28 + "后" * 50
+        assert plan.tokens <= 240
+
+    def test_memory_trimmed_after_previous(self):
+        plan = self._planner(140).plan("模板" * 5, self._parts())
+
+        assert plan.texts["previous"] == ""
+        assert plan.texts["memory"] == "记" * 28 + TRIM_MARKER
+        assert set(plan.trimmed) == {"previous", "memory"}
+
+    def test_required_over_budget_rejected(self):
+        planner = self._planner(100)
+        with pytest.raises(PromptBudgetError) as info:
+            planner.plan("模板" * 5, self._parts(), stage="character")
+        assert info.value.stage == "character"
+        assert info.value.required_tokens == 110
+        assert planner.stats()["rejected"] == 1
+
+    def test_pluggable_estimator(self):
+        assert get_token_estimator()("你好") == 2
+        set_token_estimator(lambda text: 10 * len(text))
+        try:
+            assert TokenBudgetPlanner(100).estimate("你好") == 20
+        finally:
+            set_token_estimator(None)
+
+
+class RecordingClient(PromptAwareMockClient):
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def chat(self, messages, temperature=0.7):
+        self.prompts.append(messages)
+        return super().chat(messages, temperature)
+
+
+class TestPipelineBudget:
+    """测试流水线中的预算检查"""
+
+    def _novel(self, tmp_path, chapter_chars):
+        chapters = [f"第{i}章 标题{i}\n" + "哈利和罗恩在对角巷购物。" * (chapter_chars // 12) for i in range(1, 4)]
+        path = tmp_path / "novel.txt"
+        path.write_text("\n\n".join(chapters), encoding="utf-8")
+        return str(path)
+
+    def test_prompts_fit_budget(self, tmp_path):
+        client = RecordingClient()
+        processor = LongNovelProcessor(client, enable_checkpoint=False, max_prompt_tokens=2000,
+                                       use_vector_memory=False)
+        processor.process_novel(self._novel(tmp_path, 1200))
+
+        assert client.prompts
+        # 加上 JSON 模式的系统消息后仍在预算内
+        assert max(estimate_messages_tokens(m) for m in client.prompts) <= 2000 - 24
+        assert processor.token_budgets["character"].stats()["trimmed_calls"] > 0
+
+    def test_oversized_chapter_not_sent(self, tmp_path):
+        client = RecordingClient()
+        processor = LongNovelProcessor(client, enable_checkpoint=False, max_prompt_tokens=500)
+
+        with pytest.raises(PromptBudgetError):
+            processor.process_novel(self._novel(tmp_path, 1200))
+        assert client.prompts == []
+
+    def test_storyboard_memory_trimmed(self):
+        client = RecordingClient()
+        planner = TokenBudgetPlanner(1500)
+        generator = StoryboardGenerator(client, token_budget=planner)
+        scene = ScriptScene(id="scene_1", chapter=1, location="城堡", time="夜", description="夜巡")
+
+        generator.generate(scene, memory_context="人物记忆。" * 1000)
+        assert estimate_messages_tokens(client.prompts[0]) <= 1500
+        assert planner.stats()["trimmed_calls"] == 1
+
+    def test_unbudgeted_processor_unchanged(self):
+        processor = LongNovelProcessor(MockLLMClient("{}"), enable_checkpoint=False)
+        assert processor.token_budgets == {}
+        assert processor.storyboard_generator.token_budget is None
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Token 预算规划 - 按优先级裁剪上下文，使 prompt 不超过模型窗口
+
+提取阶段的 prompt 由记忆上下文、上一章原文和当前章节正文拼接而成，
+场景和分镜阶段的 prompt 也会注入记忆上下文，过去没有任何长度检查：
+超长的 prompt 要么被服务端以 400 拒绝，要么被静默截断。
+
+TokenBudgetPlanner 在发送前估算各部分的 token 数：
+1. 系统指令（prompt 模板）和必需部分（当前章节正文）不裁剪
+2. 可选上下文按优先级依次裁剪：先裁上一章原文（保留靠近本章的结尾），
+   再裁记忆上下文（保留开头）
+3. 必需部分本身就超出预算时抛出 PromptBudgetError，注定失败的请求不会被发送
+
+token 估算器可替换：默认使用 llm_client.estimate_tokens 的中日韩感知启发式，
+安装了 tiktoken 时可以换成 tiktoken_estimator() 的精确计数。
+"""
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from llm_client import MESSAGE_TOKEN_OVERHEAD, estimate_tokens
+
+
+# token 估算器：文本 -> token 数
+TokenEstimator = Callable[[str], int]
+
+# JSON 模式附加的系统消息及消息格式开销的估计值
+DEFAULT_PROMPT_OVERHEAD = 2 * MESSAGE_TOKEN_OVERHEAD + 24
+
+# 裁剪后插入的省略标记
+TRIM_MARKER = "……"
+
+_estimator: TokenEstimator = estimate_tokens
+
+
+def set_token_estimator(estimator: Optional[TokenEstimator]) -> None:
+    """替换进程级默认的 token 估算器（传入 None 恢复启发式估算）"""
+    global _estimator
+    _estimator = estimator or estimate_tokens
+
+
+def get_token_estimator() -> TokenEstimator:
+    """返回当前默认的 token 估算器"""
+    return _estimator
+
+
+def tiktoken_estimator(encoding: str = "cl100k_base") -> TokenEstimator:
+    """
+    基于 tiktoken 的精确 token 计数（可选依赖）
+
+    Args:
+        encoding: tiktoken 编码名称
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError("请安装 tiktoken 包：pip install tiktoken")
+
+    enc = tiktoken.get_encoding(encoding)
+    return lambda text: len(enc.encode(text)) if text else 0
+
+
+class PromptBudgetError(ValueError):
+    """必需部分已超出 token 预算，请求注定失败，不予发送"""
+
+    def __init__(self, stage: str, required_tokens: int, max_tokens: int):
+        super().__init__(
+            f"{stage or 'LLM'} 阶段的 prompt 必需部分约 {required_tokens} token，"
+            f"超出预算 {max_tokens} token（可调小 --chunk-size 或调大 MAX_TOKENS_PER_CHUNK）"
+        )
+        self.stage = stage
+        self.required_tokens = required_tokens
+        self.max_tokens = max_tokens
+
+
+@dataclass
+class ContextPart:
+    """prompt 中的一段内容"""
+    name: str
+    text: str
+    keep: str = "head"  # 裁剪时保留开头（head）还是结尾（tail）
+    required: bool = False
+
+
+@dataclass
+class BudgetPlan:
+    """规划结果"""
+    texts: Dict[str, str]
+    tokens: int
+    trimmed: Dict[str, int] = field(default_factory=dict)  # 名称 -> 裁掉的 token 数
+
+
+class TokenBudgetPlanner:
+    """把 prompt 各部分装入 token 预算"""
+
+    def __init__(self, max_tokens: int, estimator: Optional[TokenEstimator] = None,
+                 overhead_tokens: int = DEFAULT_PROMPT_OVERHEAD):
+        """
+        初始化预算规划器
+
+        Args:
+            max_tokens: 单次请求的 prompt token 上限
+            estimator: token 估算器（默认使用进程级估算器）
+            overhead_tokens: 系统消息与消息格式的固定开销
+        """
+        self.max_tokens = max_tokens
+        self.estimator = estimator
+        self.overhead_tokens = overhead_tokens
+
+        self.planned = 0
+        self.trimmed_calls = 0
+        self.trimmed_tokens = 0
+        self.rejected = 0
+
+    def estimate(self, text: str) -> int:
+        return (self.estimator or get_token_estimator())(text)
+
+    def plan(self, template: str, parts: List[ContextPart], stage: str = "") -> BudgetPlan:
+        """
+        按优先级裁剪上下文
+
+        Args:
+            template: 不含可变部分的 prompt 模板（系统指令）
+            parts: prompt 的各部分，按裁剪优先级排列（排在前面的先被裁剪）
+            stage: 阶段名（用于错误信息）
+
+        Returns:
+            各部分裁剪后的文本
+
+        Raises:
+            PromptBudgetError: 模板和必需部分已超出预算
+        """
+        sizes = {part.name: self.estimate(part.text) for part in parts}
+        fixed = self.overhead_tokens + self.estimate(template) + \
+            sum(sizes[p.name] for p in parts if p.required)
+        self.planned += 1
+        if fixed > self.max_tokens:
+            self.rejected += 1
+            raise PromptBudgetError(stage, fixed, self.max_tokens)
+
+        # 优先级越低（越靠后）的部分越先分到剩余预算
+        remaining = self.max_tokens - fixed
+        texts: Dict[str, str] = {}
+        trimmed: Dict[str, int] = {}
+        for part in reversed(parts):
+            if part.required:
+                texts[part.name] = part.text
+                continue
+            allotted = min(sizes[part.name], remaining)
+            if allotted < sizes[part.name]:
+                texts[part.name] = self._truncate(part.text, allotted, part.keep)
+                trimmed[part.name] = sizes[part.name] - self.estimate(texts[part.name])
+            else:
+                texts[part.name] = part.text
+            remaining -= self.estimate(texts[part.name])
+
+        if trimmed:
+            self.trimmed_calls += 1
+            self.trimmed_tokens += sum(trimmed.values())
+        return BudgetPlan(texts=texts, tokens=self.max_tokens - remaining, trimmed=trimmed)
+
+    def _truncate(self, text: str, max_tokens: int, keep: str) -> str:
+        """保留开头或结尾，使文本（含省略标记）不超过 max_tokens"""
+        budget = max_tokens - self.estimate(TRIM_MARKER)
+        if budget <= 0:
+            return ""
+
+        # 二分查找可保留的最大字符数
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            piece = text[:mid] if keep == "head" else text[len(text) - mid:]
+            if self.estimate(piece) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        if low == 0:
+            return ""
+        return text[:low] + TRIM_MARKER if keep == "head" else TRIM_MARKER + text[len(text) - low:]
+
+    def stats(self) -> Dict[str, int]:
+        """返回规划统计"""
+        return {
+            "planned": self.planned,
+            "trimmed_calls": self.trimmed_calls,
+            "trimmed_tokens": self.trimmed_tokens,
+            "rejected": self.rejected
+        }